@@ -0,0 +1,4 @@
+-- チャットごとの Gemini 呼び出しの上限（NULL ならチャットサーバーの既定値 LLM_TENANT_*）
+ALTER TABLE chat_profiles ADD COLUMN llm_max_concurrency INTEGER;
+ALTER TABLE chat_profiles ADD COLUMN llm_rate_limit_per_min INTEGER;
+ALTER TABLE chat_profiles ADD COLUMN llm_burst INTEGER;
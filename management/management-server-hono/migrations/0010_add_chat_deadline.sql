@@ -0,0 +1,2 @@
+-- チャットごとの /api/chat の処理時間の上限（ミリ秒。NULL ならチャットサーバーの既定値 CHAT_DEADLINE_MS）
+ALTER TABLE chat_profiles ADD COLUMN deadline_ms INTEGER;
@@ -89,10 +89,17 @@ type ChatProfile = {
   target_type: string
   display_name: string
   system_prompt: string
+  llm_max_concurrency: number | null
+  llm_rate_limit_per_min: number | null
+  llm_burst: number | null
+  deadline_ms: number | null
   created_at: string
   updated_at: string
 }
 
+// 管理者だけが変更できるチャットごとの上限（チャットサーバーの DomainRegistry が読む）
+const CHAT_LIMIT_FIELDS = ['llm_max_concurrency', 'llm_rate_limit_per_min', 'llm_burst', 'deadline_ms'] as const
+
 type KnowledgeAsset = {
   id: string
   chat_id: string
@@ -161,6 +168,10 @@ type ChatProfileRow = {
   target_type: string
   display_name: string
   system_prompt: string
+  llm_max_concurrency: number | null
+  llm_rate_limit_per_min: number | null
+  llm_burst: number | null
+  deadline_ms: number | null
   created_at: string
   updated_at: string
   targets: string
@@ -372,6 +383,7 @@ app.post('/api/chats', async (c) => {
       )
     ]
     await c.env.DB.batch(statements)
+    await invalidateServerCache(c, id)
     const chat = await fetchChat(c, id)
     return c.json(chat, 201)
   } catch (err) {
@@ -474,6 +486,7 @@ app.put('/api/chats/:id', async (c) => {
     if (targetsProvided) {
       await replaceTargets(c, id, newTargets)
     }
+    await invalidateServerCache(c, id)
 
     const chat = await fetchChatIfOwned(c, id, user.uid)
     return c.json(chat)
@@ -498,6 +511,7 @@ app.delete('/api/chats/:id', async (c) => {
     if (!res.meta || res.meta.changes === 0) {
       return jsonError(c, 404, 'chat not found')
     }
+    await invalidateServerCache(c, id)
     return c.json({ deleted: true })
   } catch (err) {
     console.error(err)
@@ -768,6 +782,79 @@ app.put('/api/chats/:id/suggestions', async (c) => {
   }
 })
 
+// GET /api/chats/:id/knowledge/points - List the chat's points in Qdrant (cursor pagination)
+app.get('/api/chats/:id/knowledge/points', async (c) => {
+  const guard = await ensureAuthenticatedUser(c)
+  if (guard) return guard
+  const user = c.get('user') as FirebaseUser
+  const chatId = sanitizeAlias(c.req.param('id'))
+
+  try {
+    const chat = await fetchChatIfOwned(c, chatId, user.uid)
+    if (!chat) {
+      return jsonError(c, 404, 'chat not found')
+    }
+
+    const cfg = getConfig(c)
+    const params = new URLSearchParams({ chat_id: chatId })
+    for (const key of ['limit', 'cursor', 'fields', 'type']) {
+      const value = c.req.query(key)
+      if (value) params.set(key, value)
+    }
+    const res = await fetch(`${cfg.flaskBaseURL}/api/knowledge?${params.toString()}`, {
+      headers: cfg.adminAPIKey ? { 'X-Admin-API-Key': cfg.adminAPIKey } : {}
+    })
+    const body = await res.json().catch(() => ({}))
+    if (!res.ok) {
+      return jsonError(c, res.status, (body as any).error || 'Failed to list knowledge points')
+    }
+    return c.json(body)
+  } catch (err) {
+    console.error(err)
+    return serverError(c)
+  }
+})
+
+// GET /api/chats/:id/knowledge/export - Stream the chat's knowledge as NDJSON (?gzip=1)
+app.get('/api/chats/:id/knowledge/export', async (c) => {
+  const guard = await ensureAuthenticatedUser(c)
+  if (guard) return guard
+  const user = c.get('user') as FirebaseUser
+  const chatId = sanitizeAlias(c.req.param('id'))
+
+  try {
+    const chat = await fetchChatIfOwned(c, chatId, user.uid)
+    if (!chat) {
+      return jsonError(c, 404, 'chat not found')
+    }
+
+    const cfg = getConfig(c)
+    const params = new URLSearchParams({ chat_id: chatId })
+    for (const key of ['gzip', 'type']) {
+      const value = c.req.query(key)
+      if (value) params.set(key, value)
+    }
+    const res = await fetch(`${cfg.flaskBaseURL}/api/knowledge/export?${params.toString()}`, {
+      headers: cfg.adminAPIKey ? { 'X-Admin-API-Key': cfg.adminAPIKey } : {}
+    })
+    if (!res.ok || !res.body) {
+      const err = await res.json().catch(() => ({}))
+      return jsonError(c, res.ok ? 502 : res.status, (err as any).error || 'Failed to export knowledge')
+    }
+    // 本文はバッファせずにそのまま流す
+    return new Response(res.body, {
+      status: 200,
+      headers: {
+        'Content-Type': res.headers.get('Content-Type') || 'application/x-ndjson',
+        'Content-Disposition': res.headers.get('Content-Disposition') || `attachment; filename="${chatId}.ndjson"`,
+      },
+    })
+  } catch (err) {
+    console.error(err)
+    return serverError(c)
+  }
+})
+
 app.get('/api/knowledge', async (c) => {
   const guard = await ensureAuthenticatedUser(c)
   if (guard) return guard
@@ -1004,7 +1091,7 @@ app.get('/api/knowledge/:id', async (c) => {
     const cfg = getConfig(c)
     try {
       const res = await fetch(
-        `${cfg.flaskBaseURL}/api/knowledge/${row.qdrant_point_id}`,
+        `${cfg.flaskBaseURL}/api/knowledge/${row.qdrant_point_id}?chat_id=${encodeURIComponent(row.chat_id)}`,
         { headers: cfg.adminAPIKey ? { 'X-Admin-API-Key': cfg.adminAPIKey } : {} }
       )
 
@@ -1534,6 +1621,48 @@ app.get('/api/admin/chats', async (c) => {
   }
 })
 
+// PUT /api/admin/chats/:id/limits - Set per-chat limits used by the chat server (admin only)
+// 値は正の整数、null でチャットサーバーの既定値に戻す。チャットの所有者は自分の上限を変更できない
+app.put('/api/admin/chats/:id/limits', async (c) => {
+  const guard = await ensureAdminApiKey(c)
+  if (guard) return guard
+  const id = sanitizeAlias(c.req.param('id'))
+  const payload = await readJson<Record<string, unknown>>(c)
+  if (!payload || typeof payload !== 'object' || Array.isArray(payload)) {
+    return jsonError(c, 400, 'invalid json')
+  }
+
+  const sets: string[] = []
+  const params: any[] = []
+  for (const field of CHAT_LIMIT_FIELDS) {
+    if (payload[field] === undefined) continue
+    const value = payload[field]
+    if (value !== null && !(typeof value === 'number' && Number.isInteger(value) && value > 0)) {
+      return jsonError(c, 400, `${field} must be a positive integer or null`)
+    }
+    sets.push(`${field} = ?`)
+    params.push(value)
+  }
+  if (sets.length === 0) {
+    return jsonError(c, 400, `one of ${CHAT_LIMIT_FIELDS.join(', ')} is required`)
+  }
+
+  try {
+    sets.push("updated_at = datetime('now')")
+    const res = await c.env.DB.prepare(`UPDATE chat_profiles SET ${sets.join(', ')} WHERE id = ?`)
+      .bind(...params, id)
+      .run()
+    if (res.meta?.changes === 0) {
+      return jsonError(c, 404, 'chat not found')
+    }
+    await invalidateServerCache(c, id)
+    return c.json(await fetchChat(c, id))
+  } catch (err) {
+    console.error(err)
+    return serverError(c)
+  }
+})
+
 // GET /api/admin/knowledge - List all knowledge assets (admin only)
 app.get('/api/admin/knowledge', async (c) => {
   const guard = await ensureAdminApiKey(c)
@@ -1633,6 +1762,24 @@ export default Sentry.withSentry(
 
 // --- helpers ---
 
+// チャットの設定を変えたら Python サーバーの共有キャッシュ（レジストリ・回答）を全インスタンスで無効にする
+// （共有キャッシュを使っていない場合も受け付けたインスタンスは読み直す）。失敗しても TTL で反映されるため処理は続ける
+async function invalidateServerCache(c: any, chatId: string) {
+  const cfg = getConfig(c)
+  try {
+    await fetch(`${cfg.flaskBaseURL}/api/cache/invalidate`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        ...(cfg.adminAPIKey ? { 'X-Admin-API-Key': cfg.adminAPIKey } : {}),
+      },
+      body: JSON.stringify({ registry: true, chat_id: chatId }),
+    })
+  } catch (e) {
+    console.error('Failed to invalidate server cache:', e)
+  }
+}
+
 function getConfig(c: any): Config {
   const cached = typeof c.get === 'function' ? c.get('config') : undefined
   if (cached) return cached
@@ -1791,7 +1938,7 @@ function clearSessionCookie(c: any) {
 
 // userId を指定するとそのユーザーのチャットのみ、null なら全件（API Key用）
 async function fetchChats(c: any, userId: string | null): Promise<ChatProfile[]> {
-  const baseQuery = `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at,
+  const baseQuery = `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at,
             GROUP_CONCAT(DISTINCT ct.target) AS targets
      FROM chat_profiles cp
      LEFT JOIN chat_targets ct ON ct.chat_id = cp.id`
@@ -1801,13 +1948,13 @@ async function fetchChats(c: any, userId: string | null): Promise<ChatProfile[]>
     result = await c.env.DB.prepare(
       `${baseQuery}
        WHERE cp.owner_user_id = ?
-       GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at
+       GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at
        ORDER BY cp.created_at ASC`
     ).bind(userId).all<ChatProfileRow>()
   } else {
     result = await c.env.DB.prepare(
       `${baseQuery}
-       GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at
+       GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at
        ORDER BY cp.created_at ASC`
     ).all<ChatProfileRow>()
   }
@@ -1817,12 +1964,12 @@ async function fetchChats(c: any, userId: string | null): Promise<ChatProfile[]>
 
 async function fetchChat(c: any, id: string): Promise<ChatProfile | null> {
   const row = await c.env.DB.prepare(
-    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at,
+    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at,
             GROUP_CONCAT(DISTINCT ct.target) AS targets
      FROM chat_profiles cp
      LEFT JOIN chat_targets ct ON ct.chat_id = cp.id
      WHERE cp.id = ?
-     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at`
+     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at`
   )
     .bind(id)
     .first<ChatProfileRow>()
@@ -1833,12 +1980,12 @@ async function fetchChat(c: any, id: string): Promise<ChatProfile | null> {
 // 所有者チェック付きでチャットを取得
 async function fetchChatIfOwned(c: any, id: string, userId: string): Promise<ChatProfile | null> {
   const row = await c.env.DB.prepare(
-    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at,
+    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at,
             GROUP_CONCAT(DISTINCT ct.target) AS targets
      FROM chat_profiles cp
      LEFT JOIN chat_targets ct ON ct.chat_id = cp.id
      WHERE cp.id = ? AND cp.owner_user_id = ?
-     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at`
+     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at`
   )
     .bind(id, userId)
     .first<ChatProfileRow>()
@@ -1848,12 +1995,12 @@ async function fetchChatIfOwned(c: any, id: string, userId: string): Promise<Cha
 
 async function fetchChatByTarget(c: any, target: string): Promise<ChatProfile | null> {
   const row = await c.env.DB.prepare(
-    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at,
+    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at,
             GROUP_CONCAT(DISTINCT ct.target) AS targets
      FROM chat_targets ct
      JOIN chat_profiles cp ON cp.id = ct.chat_id
      WHERE ct.target = ?
-     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at`
+     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at`
   )
     .bind(target)
     .first<ChatProfileRow>()
@@ -1864,12 +2011,12 @@ async function fetchChatByTarget(c: any, target: string): Promise<ChatProfile |
 // 所有者チェック付きでターゲットからチャットを取得
 async function fetchChatByTargetIfOwned(c: any, target: string, userId: string): Promise<ChatProfile | null> {
   const row = await c.env.DB.prepare(
-    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at,
+    `SELECT cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at,
             GROUP_CONCAT(DISTINCT ct.target) AS targets
      FROM chat_targets ct
      JOIN chat_profiles cp ON cp.id = ct.chat_id
      WHERE ct.target = ? AND cp.owner_user_id = ?
-     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.created_at, cp.updated_at`
+     GROUP BY cp.id, cp.target, cp.target_type, cp.display_name, cp.system_prompt, cp.llm_max_concurrency, cp.llm_rate_limit_per_min, cp.llm_burst, cp.deadline_ms, cp.created_at, cp.updated_at`
   )
     .bind(target, userId)
     .first<ChatProfileRow>()
@@ -1918,6 +2065,10 @@ function mapChatRow(row: ChatProfileRow): ChatProfile {
     target_type: row.target_type as string,
     display_name: row.display_name as string,
     system_prompt: row.system_prompt as string,
+    llm_max_concurrency: row.llm_max_concurrency ?? null,
+    llm_rate_limit_per_min: row.llm_rate_limit_per_min ?? null,
+    llm_burst: row.llm_burst ?? null,
+    deadline_ms: row.deadline_ms ?? null,
     targets,
     created_at: row.created_at as string,
     updated_at: row.updated_at as string
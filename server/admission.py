@@ -0,0 +1,269 @@
+"""Admission control for Gemini calls.
+
+LLM 呼び出しの前に admit()（asyncio 版は admit_async()）を通し、次の制限をかける。
+- プロセス全体の同時実行数（LLM_MAX_CONCURRENCY）
+- チャットごとの同時実行数とトークンバケット（毎分のレートとバースト）
+
+チャットごとの値は DomainRegistry のエントリー（llm_max_concurrency / llm_rate_limit_per_min /
+llm_burst）で上書きでき、未設定なら settings の既定値を使う。
+上限はプロセスごとに数えるため、gunicorn で複数のワーカーを動かす場合は各値（インスタンス全体の上限）を
+ワーカー数（SERVER_WORKERS）で割って各ワーカーに割り当てる（同時実行数とバーストは切り上げ、最低 1）。
+空きがない場合は ADMISSION_MAX_WAIT_MS まで待ち、待ち行列（ADMISSION_MAX_QUEUE）が埋まっているか
+待ち時間内に空かなければ AdmissionRejected を送出する。拒否（またはキャンセル）されたリクエストが
+予約したトークンはバケットに戻し、テナントのレートの枠を消費させない。
+asyncio の待機は release() から（別スレッドからでも）起こされる asyncio.Event で待つ。
+"""
+
+import asyncio
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import settings
+from metrics import LLM_ADMISSION_QUEUED, LLM_ADMISSION_REJECTED, LLM_ADMISSION_WAIT, LLM_ADMISSION_WAITING, LLM_IN_FLIGHT
+
+
+class AdmissionRejected(Exception):
+    """LLM 呼び出しを受け付けられなかった（reason: rate_limited / concurrency / queue_full）。"""
+
+    def __init__(self, reason, retry_after=1.0):
+        super().__init__(f"LLM admission rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec, burst):
+        self.rate = rate_per_sec
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def configure(self, rate_per_sec, burst):
+        self.rate = rate_per_sec
+        self.capacity = burst
+
+    def reserve(self, now, max_wait):
+        """トークンを 1 つ予約し、使えるまでの待ち時間（秒）を返す。max_wait を超えるなら None。"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        wait = (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            return None
+        # 予約分を差し引いておき、待っている間に来た後続のリクエストより先に使う
+        self.tokens -= 1
+        return wait
+
+    def refund(self):
+        """reserve() で予約したトークンを戻す（使わずに終わったリクエスト）。"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def time_until_token(self):
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else 1.0
+
+
+def per_worker(limit):
+    """インスタンス全体の上限をワーカー 1 つ分に割る（切り上げ、最低 1）。"""
+    return max(1, math.ceil(limit / settings.SERVER_WORKERS))
+
+
+class _Limits:
+    __slots__ = ('rate_per_sec', 'burst', 'max_concurrency')
+
+    def __init__(self, chat):
+        chat = chat or {}
+        rate_per_min = chat.get('llm_rate_limit_per_min') or settings.LLM_TENANT_RATE_PER_MIN
+        self.rate_per_sec = rate_per_min / 60 / settings.SERVER_WORKERS
+        self.burst = per_worker(chat.get('llm_burst') or settings.LLM_TENANT_BURST)
+        self.max_concurrency = per_worker(chat.get('llm_max_concurrency') or settings.LLM_TENANT_MAX_CONCURRENCY)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency, max_queue, max_wait):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._in_flight_by_chat = {}
+        self._buckets = {}
+        self._waiting = 0
+        # release() で起こす asyncio の待機 (loop, asyncio.Event)
+        self._async_waiters = set()
+
+    # --- internal (呼び出し側で self._lock を保持する) ----------------------
+
+    def _bucket(self, chat_id, limits):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(limits.rate_per_sec, limits.burst)
+        else:
+            bucket.configure(limits.rate_per_sec, limits.burst)
+        return bucket
+
+    def _has_slot(self, chat_id, limits):
+        if self._in_flight >= self.max_concurrency:
+            return False
+        return self._in_flight_by_chat.get(chat_id, 0) < limits.max_concurrency
+
+    def _take_slot(self, chat_id):
+        self._in_flight += 1
+        self._in_flight_by_chat[chat_id] = self._in_flight_by_chat.get(chat_id, 0) + 1
+        LLM_IN_FLIGHT.set(self._in_flight)
+
+    def _enter_queue(self, chat_id):
+        if self._waiting >= self.max_queue:
+            self._refund(chat_id)
+            self._reject('queue_full')
+        self._waiting += 1
+        LLM_ADMISSION_QUEUED.inc()
+        LLM_ADMISSION_WAITING.set(self._waiting)
+
+    def _leave_queue(self):
+        self._waiting -= 1
+        LLM_ADMISSION_WAITING.set(self._waiting)
+
+    def _reject(self, reason, retry_after=1.0):
+        LLM_ADMISSION_REJECTED.inc(reason=reason)
+        raise AdmissionRejected(reason, retry_after)
+
+    def _reserve_token(self, chat_id, limits, max_wait):
+        """トークンを予約して待ち時間を返す（待てない場合は拒否）。"""
+        bucket = self._bucket(chat_id, limits)
+        wait = bucket.reserve(time.monotonic(), max_wait)
+        if wait is None:
+            self._reject('rate_limited', bucket.time_until_token())
+        return wait
+
+    def _refund(self, chat_id):
+        self._buckets[chat_id].refund()
+
+    def _finish_waiting(self, chat_id, admitted):
+        self._leave_queue()
+        if not admitted:
+            self._refund(chat_id)
+
+    def release(self, chat_id):
+        with self._lock:
+            self._in_flight -= 1
+            remaining = self._in_flight_by_chat.get(chat_id, 1) - 1
+            if remaining > 0:
+                self._in_flight_by_chat[chat_id] = remaining
+            else:
+                self._in_flight_by_chat.pop(chat_id, None)
+            LLM_IN_FLIGHT.set(self._in_flight)
+            self._released.notify_all()
+            waiters, self._async_waiters = self._async_waiters, set()
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 待っていたイベントループが既に閉じている
+                pass
+
+    # --- sync -------------------------------------------------------------
+
+    def _max_wait(self, max_wait):
+        """待てる時間（リクエストの残り時間が短ければそちらに合わせる）。"""
+        return self.max_wait if max_wait is None else max(0.0, min(self.max_wait, max_wait))
+
+    def acquire(self, chat, max_wait=None):
+        chat_id = (chat or {}).get('id') or 'unknown'
+        limits = _Limits(chat)
+        max_wait = self._max_wait(max_wait)
+        start = time.monotonic()
+        deadline = start + max_wait
+        with self._lock:
+            token_wait = self._reserve_token(chat_id, limits, max_wait)
+            if token_wait == 0 and self._has_slot(chat_id, limits):
+                self._take_slot(chat_id)
+                return chat_id
+            self._enter_queue(chat_id)
+        admitted = False
+        try:
+            if token_wait:
+                time.sleep(token_wait)
+            with self._lock:
+                while not self._has_slot(chat_id, limits):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject('concurrency')
+                    self._released.wait(remaining)
+                self._take_slot(chat_id)
+                admitted = True
+        finally:
+            with self._lock:
+                self._finish_waiting(chat_id, admitted)
+            LLM_ADMISSION_WAIT.observe(time.monotonic() - start)
+        return chat_id
+
+    @contextmanager
+    def admit(self, chat, max_wait=None):
+        chat_id = self.acquire(chat, max_wait)
+        try:
+            yield
+        finally:
+            self.release(chat_id)
+
+    # --- asyncio ----------------------------------------------------------
+
+    async def acquire_async(self, chat, max_wait=None):
+        chat_id = (chat or {}).get('id') or 'unknown'
+        limits = _Limits(chat)
+        max_wait = self._max_wait(max_wait)
+        start = time.monotonic()
+        deadline = start + max_wait
+        with self._lock:
+            token_wait = self._reserve_token(chat_id, limits, max_wait)
+            if token_wait == 0 and self._has_slot(chat_id, limits):
+                self._take_slot(chat_id)
+                return chat_id
+            self._enter_queue(chat_id)
+        loop = asyncio.get_running_loop()
+        admitted = False
+        try:
+            if token_wait:
+                await asyncio.sleep(token_wait)
+            while True:
+                with self._lock:
+                    if self._has_slot(chat_id, limits):
+                        self._take_slot(chat_id)
+                        admitted = True
+                        return chat_id
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject('concurrency')
+                    # イベントループをブロックしないよう threading.Condition ではなく Event で待つ
+                    waiter = (loop, asyncio.Event())
+                    self._async_waiters.add(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._lock:
+                        self._async_waiters.discard(waiter)
+        finally:
+            with self._lock:
+                self._finish_waiting(chat_id, admitted)
+            LLM_ADMISSION_WAIT.observe(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def admit_async(self, chat, max_wait=None):
+        chat_id = await self.acquire_async(chat, max_wait)
+        try:
+            yield
+        finally:
+            self.release(chat_id)
+
+
+controller = AdmissionController(
+    max_concurrency=per_worker(settings.LLM_MAX_CONCURRENCY),
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+    max_wait=settings.ADMISSION_MAX_WAIT_MS / 1000,
+)
@@ -1,15 +1,60 @@
-import traceback
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+import httpx
 from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
 from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError, ResourceExhausted
 
 import settings
+import structured_logging as slog
+from circuit_breaker import CircuitOpen
+from metrics import GEMINI_ERRORS, LLM_HEDGED
+from model_router import ModelRouter
+
+
+def classify_gemini_error(error):
+    """Gemini 呼び出しの例外をメトリクス用のエラー種別に分類する。"""
+    if isinstance(error, DeadlineExceeded):
+        return 'deadline_exceeded'
+    if isinstance(error, ResourceExhausted):
+        return 'resource_exhausted'
+    if isinstance(error, genai_errors.APIError):
+        if error.code == 429:
+            return 'resource_exhausted'
+        if error.code in (408, 504):
+            return 'deadline_exceeded'
+        return 'server_error' if isinstance(error, genai_errors.ServerError) else 'client_error'
+    if isinstance(error, GoogleAPICallError):
+        return 'api_error'
+    return 'unexpected'
+
+
+NO_CONTEXT_MESSAGE = "申し訳ありませんが、お尋ねの件について保存されている情報が見つかりませんでした。もう少し詳しく教えていただけますでしょうか？"
+
+# 応答を作った経路（BigQuery の answer_path）
+ANSWER_LLM = 'llm'
+ANSWER_NO_CONTEXT = 'no_context'
+ANSWER_FALLBACK_ERROR = 'fallback_error'
+ANSWER_FALLBACK_BUSY = 'fallback_busy'
+ANSWER_FALLBACK_DEADLINE = 'fallback_deadline'
+ANSWER_FALLBACK_UNAVAILABLE = 'fallback_unavailable'
+# 共有キャッシュ（shared_cache）の回答
+ANSWER_CACHED = 'cached'
 
 
 class AIAgent:
-    def __init__(self, model_name=None):
-        self.model_name = model_name or settings.GEMINI_MODEL_NAME
-        self.client = genai.Client(api_key=settings.GEMINI_API_KEY)
+    def __init__(self, model_name=None, models=None):
+        models = models or ([model_name] if model_name else settings.GEMINI_MODELS)
+        self.model_name = models[0]
+        self.router = ModelRouter(models)
+        self.client = self._create_client()
+        self._hedge_executor = None
+        self._hedge_slots = threading.BoundedSemaphore(settings.GEMINI_HEDGE_THREADS)
         self.system_prompt = (
             """
         あなたは親しみやすく知識豊富なAIチャットボットです。
@@ -33,6 +78,42 @@ class AIAgent:
         """
         )
 
+    def _create_client(self):
+        http_options = {
+            # aio クライアント（ASGI モード）で同時に保持できる接続数。httpx の既定は 100
+            'async_client_args': {
+                'limits': httpx.Limits(
+                    max_connections=settings.GEMINI_MAX_CONNECTIONS,
+                    max_keepalive_connections=min(settings.GEMINI_MAX_CONNECTIONS, 100),
+                ),
+            },
+        }
+        if settings.GEMINI_BASE_URL:
+            # 負荷試験などでローカルのスタンドインに向ける場合のみ使用する
+            http_options['base_url'] = settings.GEMINI_BASE_URL
+        return genai.Client(api_key=settings.GEMINI_API_KEY, http_options=types.HttpOptions(**http_options))
+
+    def reset_client(self):
+        """フォーク後のワーカーで HTTP 接続を共有しないようクライアントを作り直す。"""
+        self.client = self._create_client()
+        self._hedge_executor = None
+        self._hedge_slots = threading.BoundedSemaphore(settings.GEMINI_HEDGE_THREADS)
+
+    def busy_response(self, context):
+        """アドミッション制御で LLM を呼べなかった場合の応答（検索結果からの抜粋）。"""
+        message = "現在アクセスが集中しているため、ナレッジからの抜粋でお答えします。"
+        return (self._build_contextual_fallback(context, message), None, None, ANSWER_FALLBACK_BUSY, None)
+
+    def deadline_response(self, context):
+        """リクエストの期限までに Gemini の応答が得られなかった場合の応答（検索結果からの抜粋）。"""
+        message = "回答の生成に時間がかかっているため、ナレッジからの抜粋でお答えします。"
+        return (self._build_contextual_fallback(context, message), None, None, ANSWER_FALLBACK_DEADLINE, None)
+
+    def unavailable_response(self, context):
+        """サーキットブレーカーが open の間の応答（Gemini を呼ばずに検索結果からの抜粋を返す）。"""
+        message = "現在AIサービスに接続できないため、ナレッジからの抜粋でお答えします。"
+        return (self._build_contextual_fallback(context, message), None, None, ANSWER_FALLBACK_UNAVAILABLE, None)
+
     def _build_contextual_fallback(self, context, base_message):
         if not context or not context.strip():
             return base_message
@@ -47,17 +128,228 @@ class AIAgent:
 
         return f"{base_message}\n\n【参考情報（ナレッジからの抜粋）】\n{snippet}"
 
-    def think_and_respond(self, query, context="", system_prompt=None):
+    def think_and_respond(self, query, context="", system_prompt=None, timeout=None):
         """
-        Returns a tuple: (response_text, tokens_input, tokens_output)
-        If token info is unavailable, tokens will be None.
+        Returns a tuple: (response_text, tokens_input, tokens_output, answer_path, model)
+        If token info is unavailable, tokens will be None. model is the Gemini model
+        that produced the answer (None for fallback answers).
+        timeout (seconds) is the remaining request budget; when it runs out the
+        call is abandoned and an extractive answer is returned instead.
         """
         if not context.strip():
-            return ("申し訳ありませんが、お尋ねの件について保存されている情報が見つかりませんでした。もう少し詳しく教えていただけますでしょうか？", None, None)
+            return (NO_CONTEXT_MESSAGE, None, None, ANSWER_NO_CONTEXT, None)
+        if timeout is not None and timeout <= 0:
+            return self.deadline_response(context)
+
+        prompt = self._build_prompt(query, context, system_prompt)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            response, model = self._call_models(prompt, deadline)
+            return self._parse_response(response, model)
+        except (TimeoutError, httpx.TimeoutException):
+            return self.deadline_response(context)
+        except CircuitOpen:
+            return self.unavailable_response(context)
+        except Exception as e:
+            return self._handle_error(e, context)
+
+    async def think_and_respond_async(self, query, context="", system_prompt=None, timeout=None):
+        """think_and_respond の asyncio 版（ASGI の /api/chat から使う）。期限を過ぎると呼び出しをキャンセルする。"""
+        if not context.strip():
+            return (NO_CONTEXT_MESSAGE, None, None, ANSWER_NO_CONTEXT, None)
+        if timeout is not None and timeout <= 0:
+            return self.deadline_response(context)
+
+        prompt = self._build_prompt(query, context, system_prompt)
+        try:
+            response, model = await asyncio.wait_for(self._call_models_async(prompt), timeout)
+            return self._parse_response(response, model)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            return self.deadline_response(context)
+        except CircuitOpen:
+            return self.unavailable_response(context)
+        except Exception as e:
+            return self._handle_error(e, context)
+
+    def model_stats(self):
+        return self.router.stats()
+
+    # --- model routing (sync) ---------------------------------------------
+
+    def _call_models(self, prompt, deadline):
+        """速い順にモデルを試し、失敗したら次のモデルに切り替える。Returns (response, model)。"""
+        candidates = self.router.candidates()
+        error = None
+        while candidates:
+            model = candidates.pop(0)
+            try:
+                if self.router.hedge_after and candidates:
+                    return self._generate_hedged(model, candidates, prompt, deadline)
+                return self._generate(model, prompt, deadline), model
+            except CircuitOpen as e:
+                error = error or e
+            except Exception as e:
+                error = e
+                # 期限切れとリクエスト側の誤りは他のモデルでも結果が変わらない
+                if isinstance(e, (TimeoutError, httpx.TimeoutException)) or classify_gemini_error(e) == 'client_error':
+                    raise
+        raise error or CircuitOpen('gemini', 0)
+
+    def _generate(self, model, prompt, deadline):
+        model.breaker.check()
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise TimeoutError()
+        token = model.start()
+        try:
+            response = self.client.models.generate_content(
+                model=model.name,
+                contents=prompt,
+                config=self._request_config(timeout),
+            )
+        except httpx.TimeoutException:
+            # リクエストの期限による打ち切りは Gemini の障害としては数えない
+            model.finish(token, 'timeout')
+            raise
+        except Exception as e:
+            model.finish(token, 'error')
+            self._record_error(model, e)
+            raise
+        model.finish(token, 'success')
+        model.breaker.record_success()
+        return response
+
+    def _generate_hedged(self, primary, candidates, prompt, deadline):
+        """primary が hedge_after 以内に応答しなければ次に速いモデルにも送り、先に成功した方を使う。
+
+        呼び出しは GEMINI_HEDGE_THREADS 本のスレッドで行う。負けた呼び出しはキャンセルできないため
+        バックグラウンドで完了させて応答時間だけ記録し、その間スレッドを 1 本使う。空きスレッドがなければ
+        ヘッジせず、primary はリクエストのスレッドで呼ぶ（負荷が高いときにスレッドの空き待ちで遅れない）。
+        """
+        future = self._submit_hedge_call(primary, prompt, deadline)
+        if future is None:
+            return self._generate(primary, prompt, deadline), primary
+        futures = {future: primary}
+        done, _ = wait(futures, timeout=self.router.hedge_after)
+        if not done:
+            future = self._submit_hedge_call(candidates[0], prompt, deadline)
+            if future is not None:
+                futures[future] = candidates.pop(0)
+
+        pending = set(futures)
+        error = None
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError()
+            for future in done:
+                if future.exception() is None:
+                    model = futures[future]
+                    if len(futures) > 1:
+                        LLM_HEDGED.inc(winner='primary' if model is primary else 'secondary')
+                    return future.result(), model
+                if error is None or isinstance(error, CircuitOpen):
+                    error = future.exception()
+        raise error
+
+    def _submit_hedge_call(self, model, prompt, deadline):
+        """空きスレッドがあれば _generate をスレッドプールで実行する。Returns Future or None。"""
+        if not self._hedge_slots.acquire(blocking=False):
+            return None
+        slots = self._hedge_slots
+
+        def run():
+            try:
+                return self._generate(model, prompt, deadline)
+            finally:
+                slots.release()
 
+        return self._get_hedge_executor().submit(contextvars.copy_context().run, run)
+
+    def _get_hedge_executor(self):
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=settings.GEMINI_HEDGE_THREADS, thread_name_prefix='gemini-hedge'
+            )
+        return self._hedge_executor
+
+    # --- model routing (asyncio) ------------------------------------------
+
+    async def _call_models_async(self, prompt):
+        candidates = self.router.candidates()
+        error = None
+        while candidates:
+            model = candidates.pop(0)
+            try:
+                if self.router.hedge_after and candidates:
+                    return await self._generate_hedged_async(model, candidates, prompt)
+                return await self._generate_async(model, prompt), model
+            except CircuitOpen as e:
+                error = error or e
+            except Exception as e:
+                error = e
+                # 期限切れとリクエスト側の誤りは他のモデルでも結果が変わらない
+                if isinstance(e, (TimeoutError, httpx.TimeoutException)) or classify_gemini_error(e) == 'client_error':
+                    raise
+        raise error or CircuitOpen('gemini', 0)
+
+    async def _generate_async(self, model, prompt):
+        model.breaker.check()
+        token = model.start()
+        try:
+            response = await self.client.aio.models.generate_content(model=model.name, contents=prompt)
+        except asyncio.CancelledError:
+            # 期限切れ・ヘッジで負けてキャンセルされた呼び出し
+            model.finish(token, 'cancelled')
+            raise
+        except httpx.TimeoutException:
+            model.finish(token, 'timeout')
+            raise
+        except Exception as e:
+            model.finish(token, 'error')
+            self._record_error(model, e)
+            raise
+        model.finish(token, 'success')
+        model.breaker.record_success()
+        return response
+
+    async def _generate_hedged_async(self, primary, candidates, prompt):
+        tasks = {asyncio.ensure_future(self._generate_async(primary, prompt)): primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.router.hedge_after)
+            if not done:
+                secondary = candidates.pop(0)
+                tasks[asyncio.ensure_future(self._generate_async(secondary, prompt))] = secondary
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        model = tasks[task]
+                        if len(tasks) > 1:
+                            LLM_HEDGED.inc(winner='primary' if model is primary else 'secondary')
+                        return task.result(), model
+                    if error is None or isinstance(error, CircuitOpen):
+                        error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _request_config(timeout):
+        """残り時間を HTTP のタイムアウト（ミリ秒）として渡す設定。"""
+        if timeout is None:
+            return None
+        return types.GenerateContentConfig(http_options=types.HttpOptions(timeout=max(1, int(timeout * 1000))))
+
+    def _build_prompt(self, query, context, system_prompt):
         prompt_header = system_prompt if system_prompt else self.system_prompt
 
-        prompt = f"""
+        return f"""
         {prompt_header}
 
         【利用可能な情報】
@@ -77,32 +369,32 @@ class AIAgent:
         情報が複数ある場合は、質問の意図に最も合うものを中心に、整理された形で回答してください。
         """
 
-        try:
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt
-            )
-            tokens_input = None
-            tokens_output = None
-            if hasattr(response, 'usage_metadata') and response.usage_metadata:
-                tokens_input = getattr(response.usage_metadata, 'prompt_token_count', None)
-                tokens_output = getattr(response.usage_metadata, 'candidates_token_count', None)
-            return (response.text, tokens_input, tokens_output)
-        except DeadlineExceeded as e:
-            print("Gemini DeadlineExceeded:", e)
-            traceback.print_exc()
-            return ("現在AIの応答生成に時間がかかっています。少し待ってからもう一度お試しください。", None, None)
-        except ResourceExhausted as e:
-            print("Gemini quota exhausted:", e)
-            traceback.print_exc()
+    def _parse_response(self, response, model):
+        tokens_input = None
+        tokens_output = None
+        if hasattr(response, 'usage_metadata') and response.usage_metadata:
+            tokens_input = getattr(response.usage_metadata, 'prompt_token_count', None)
+            tokens_output = getattr(response.usage_metadata, 'candidates_token_count', None)
+        return (response.text, tokens_input, tokens_output, ANSWER_LLM, model.name)
+
+    def _record_error(self, model, e):
+        error_type = classify_gemini_error(e)
+        GEMINI_ERRORS.inc(type=error_type)
+        # リクエスト側の誤り（4xx）はモデルの障害として数えない
+        if error_type == 'client_error':
+            model.breaker.record_success()
+        else:
+            model.breaker.record_failure()
+        slog.exception("gemini_error", model=model.name, error_type=error_type, error=str(e))
+
+    def _handle_error(self, e, context):
+        """Gemini 呼び出しの例外をユーザー向けの応答に変換する。"""
+        if isinstance(e, DeadlineExceeded):
+            return ("現在AIの応答生成に時間がかかっています。少し待ってからもう一度お試しください。", None, None, ANSWER_FALLBACK_ERROR, None)
+        if isinstance(e, ResourceExhausted):
             message = "Gemini APIの利用上限に達しました"
-            return (self._build_contextual_fallback(context, message), None, None)
-        except GoogleAPICallError as e:
-            print("Gemini API error:", e)
-            traceback.print_exc()
+            return (self._build_contextual_fallback(context, message), None, None, ANSWER_FALLBACK_ERROR, None)
+        if isinstance(e, GoogleAPICallError):
             message = "AIサービスの呼び出しに失敗しました。時間をおいて再度お試しください。"
-            return (self._build_contextual_fallback(context, message), None, None)
-        except Exception as e:
-            print("Unexpected Gemini error:", e)
-            traceback.print_exc()
-            return ("回答の生成中にエラーが発生しました。別の質問でお試しいただけますか？", None, None)
+            return (self._build_contextual_fallback(context, message), None, None, ANSWER_FALLBACK_ERROR, None)
+        return ("回答の生成中にエラーが発生しました。別の質問でお試しいただけますか？", None, None, ANSWER_FALLBACK_ERROR, None)
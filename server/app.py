@@ -1,22 +1,41 @@
-import json
 import os
+import re
+import threading
 import time
 import uuid
 
+import grpc
 import sentry_sdk
-from flask import Flask, jsonify, g, request
+from flask import Flask, Response, g, jsonify, request, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_cors import CORS
 from sentry_sdk.integrations.flask import FlaskIntegration
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, FieldCondition, Filter, MatchValue, PayloadSchemaType, PointIdsList, PointStruct, VectorParams
-from sentence_transformers import SentenceTransformer
-
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import PointStruct
+
+import chat_pipeline
+import embedding_cache
+import knowledge_bulk
+import knowledge_listing
+import metrics
+import profiling
 import settings
-from ai_agent import AIAgent
-from auth import require_admin_auth, require_domain_session
-from bq_logger import log_chat_request
+import shared_cache
+import startup
+import structured_logging as slog
+import tenancy
+import tracing
+from admission import AdmissionRejected
+from ai_agent import ANSWER_CACHED, ANSWER_FALLBACK_DEADLINE, AIAgent
+from auth import require_admin_auth, require_admin_key, require_domain_session
+from bq_logger import BQ_ENABLED, get_logger as get_bq_logger, shutdown_logger as shutdown_bq_logger
+from circuit_breaker import CircuitBreaker, GuardedClient
+from collection_config import knowledge_collections
 from domain_registry import DomainRegistry
-from file_utils import add_manual_knowledge, handle_file_upload, handle_url_fetch
+from file_utils import UploadRequest, add_manual_knowledge, format_size, handle_file_upload, handle_url_fetch
+from timing import get_stage_timings, server_timing_header, stage
+from write_buffer import WriteBuffer, ack_mode
 
 
 # Initialize Sentry error tracking
@@ -31,126 +50,282 @@ if settings.SENTRY_DSN:
     )
 
 app = Flask(__name__)
-CORS(app)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = settings.MAX_REQUEST_SIZE
+# asgi.py の /api/chat も同じ設定で CORS ヘッダーを付ける
+CORS_OPTIONS = {}
+CORS(app, **CORS_OPTIONS)
 
 
-@app.before_request
-def sentry_set_context():
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    return jsonify({'error': f'リクエストサイズが上限（{format_size(settings.MAX_FILE_SIZE)}）を超えています'}), 413
+
+
+def set_sentry_request_context(url, method, origin):
     """Attach request context to Sentry for better error debugging."""
     if settings.SENTRY_DSN:
         sentry_sdk.set_context("request", {
-            "url": request.url,
-            "method": request.method,
-            "origin": request.headers.get('Origin', ''),
+            "url": url,
+            "method": method,
+            "origin": origin,
         })
 
 
+@app.before_request
+def sentry_set_context():
+    set_sentry_request_context(request.url, request.method, request.headers.get('Origin', ''))
+
+
 qdrant_client = None
 embedding_model = None
+qdrant_breaker = CircuitBreaker('qdrant')
+# gRPC 接続でリクエスト側の誤り（HTTP の 4xx に相当）として扱うステータス
+_GRPC_CLIENT_ERRORS = {
+    grpc.StatusCode.INVALID_ARGUMENT,
+    grpc.StatusCode.NOT_FOUND,
+    grpc.StatusCode.ALREADY_EXISTS,
+    grpc.StatusCode.FAILED_PRECONDITION,
+    grpc.StatusCode.PERMISSION_DENIED,
+    grpc.StatusCode.UNAUTHENTICATED,
+}
+_qdrant_reconnect_thread = None
+# 接続時に読み取ったコレクションの次元数（埋め込みモデルのロード後に _check_vector_size で照合する）
+_collection_vector_size = None
+_vector_size_lock = threading.Lock()
+_vector_size_checked = False
 if not settings.MGMT_API_BASE_URL:
     raise ValueError("MGMT_API_BASE_URL must be set to use the management API registry")
+# インスタンス間で共有するキャッシュ（SHARED_CACHE_URL 未設定なら何も保持しない）
+shared_tier = shared_cache.from_settings()
 domain_registry = DomainRegistry(
     settings.MGMT_API_BASE_URL,
     settings.MGMT_ADMIN_API_KEY,
     cache_ttl=settings.MGMT_API_CACHE_TTL,
     timeout=settings.MGMT_API_TIMEOUT_SEC,
+    shared_cache=shared_tier,
+    preload=False,
 )
 ai_agent = AIAgent()
+# テナントごとのナレッジの置き場所（共有コレクション / シャードキー / 専用コレクション）
+# 取り込みの点は write_buffer でまとめて書き込む（QDRANT_WRITE_BUFFER）
+# ナレッジを変更したチャットの共有キャッシュの回答は全インスタンスで無効にする
+write_buffer = WriteBuffer(lambda: qdrant_client) if settings.QDRANT_WRITE_BUFFER else None
+if settings.QDRANT_WRITE_ACK == 'buffered' and ack_mode() != 'buffered':
+    print(f"[WARN] QDRANT_WRITE_ACK=buffered requires a single worker; using flushed ({settings.SERVER_WORKERS} workers)")
+tenant_directory = tenancy.TenantDirectory(
+    lambda: qdrant_client, write_buffer=write_buffer, on_change=shared_tier.invalidate_chat
+)
 
 
-def _ensure_payload_indexes(client):
+def _ensure_payload_indexes(client, collection):
     """Ensure required payload indexes exist on the collection."""
-    required_indexes = ["chat_id", "type"]
     try:
-        info = client.get_collection(settings.QDRANT_COLLECTION_NAME)
-        existing_indexes = set(info.payload_schema.keys()) if info.payload_schema else set()
-        for field in required_indexes:
-            if field not in existing_indexes:
-                client.create_payload_index(
-                    collection_name=settings.QDRANT_COLLECTION_NAME,
-                    field_name=field,
-                    field_schema=PayloadSchemaType.KEYWORD,
-                )
-                print(f"Created missing index for '{field}' field")
+        tenancy.ensure_payload_indexes(client, collection)
     except Exception as e:
         print(f"Warning: Failed to ensure payload indexes: {e}")
 
 
-def init_qdrant():
-    """Qdrantクライアントと埋め込みモデルの初期化を行う。"""
-    global qdrant_client, embedding_model
-    max_retries = 5
-    retry_delay = 2
-
-    for attempt in range(max_retries):
-        try:
-            print(f"Attempting to connect to Qdrant (attempt {attempt + 1}/{max_retries})")
-            qdrant_kwargs = {}
-            if settings.QDRANT_URL:
-                qdrant_kwargs["url"] = settings.QDRANT_URL
-                if settings.QDRANT_API_KEY:
-                    qdrant_kwargs["api_key"] = settings.QDRANT_API_KEY
-                print(f"Connecting to Qdrant via URL endpoint: {settings.QDRANT_URL}")
-            else:
-                qdrant_kwargs["host"] = settings.QDRANT_HOST
-                qdrant_kwargs["port"] = settings.QDRANT_PORT
-                print(f"Connecting to Qdrant via host/port: {settings.QDRANT_HOST}:{settings.QDRANT_PORT}")
-            qdrant_client = QdrantClient(**qdrant_kwargs)
-
-            # 接続テスト
-            qdrant_client.get_collections()
-
-            # 埋め込みモデルの初期化
-            embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-
-            # コレクションの確認/作成
-            collections = qdrant_client.get_collections()
-            collection_exists = any(
-                col.name == settings.QDRANT_COLLECTION_NAME for col in collections.collections
-            )
-
-            if not collection_exists:
-                qdrant_client.create_collection(
-                    collection_name=settings.QDRANT_COLLECTION_NAME,
-                    vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-                )
-                print(f"Created collection '{settings.QDRANT_COLLECTION_NAME}'")
+def _check_vector_size():
+    """コレクションの次元数が埋め込みモデルと合わなければ知らせる（モデルを変えて reindex.py を実行していない）。
+
+    埋め込みモデルと Qdrant の準備は並行に行うため、両方が揃った時点で 1 回だけ確認する。
+    """
+    global _vector_size_checked
+    with _vector_size_lock:
+        size = _collection_vector_size
+        if _vector_size_checked or size is None or embedding_model is None:
+            return
+        _vector_size_checked = True
+    expected = embedding_model.get_sentence_embedding_dimension()
+    if size != expected:
+        print(
+            f"[ERROR] '{settings.QDRANT_COLLECTION_NAME}' stores {size}-dim vectors but {settings.EMBEDDING_MODEL} "
+            f"produces {expected}-dim ones; run `python reindex.py build` and `switch` to re-embed the knowledge"
+        )
 
-                # Create payload indexes for filtering
-                qdrant_client.create_payload_index(
-                    collection_name=settings.QDRANT_COLLECTION_NAME,
-                    field_name="chat_id",
-                    field_schema=PayloadSchemaType.KEYWORD,
-                )
-                print("Created index for 'chat_id' field")
 
-                qdrant_client.create_payload_index(
-                    collection_name=settings.QDRANT_COLLECTION_NAME,
-                    field_name="type",
-                    field_schema=PayloadSchemaType.KEYWORD,
-                )
-                print("Created index for 'type' field")
-            else:
-                print(f"Collection '{settings.QDRANT_COLLECTION_NAME}' already exists")
-                # Ensure payload indexes exist for existing collection
-                _ensure_payload_indexes(qdrant_client)
-            print("Qdrant connected successfully")
-            return True
+def qdrant_client_kwargs():
+    qdrant_kwargs = {}
+    if settings.QDRANT_URL == ':memory:':
+        qdrant_kwargs["location"] = ':memory:'
+        return qdrant_kwargs
+    if settings.QDRANT_URL:
+        qdrant_kwargs["url"] = settings.QDRANT_URL
+        if settings.QDRANT_API_KEY:
+            qdrant_kwargs["api_key"] = settings.QDRANT_API_KEY
+    else:
+        qdrant_kwargs["host"] = settings.QDRANT_HOST
+        qdrant_kwargs["port"] = settings.QDRANT_PORT
+    if settings.QDRANT_PREFER_GRPC:
+        qdrant_kwargs["prefer_grpc"] = True
+        qdrant_kwargs["grpc_port"] = settings.QDRANT_GRPC_PORT
+        if settings.QDRANT_GRPC_KEEPALIVE_MS > 0:
+            qdrant_kwargs["grpc_options"] = {
+                "grpc.keepalive_time_ms": settings.QDRANT_GRPC_KEEPALIVE_MS,
+                "grpc.keepalive_permit_without_calls": 1,
+            }
+    return qdrant_kwargs
+
+
+def _is_qdrant_failure(error):
+    """Qdrant の障害として数える例外か（リクエスト側の誤りによる 4xx は除く）。"""
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code is None or error.status_code >= 500
+    if isinstance(error, grpc.RpcError) and hasattr(error, 'code'):
+        return error.code() not in _GRPC_CLIENT_ERRORS
+    return True
+
+
+def guard_qdrant(client):
+    """Qdrant クライアントの呼び出しをサーキットブレーカーで保護する（AsyncQdrantClient も可）。"""
+    return GuardedClient(client, qdrant_breaker, is_failure=_is_qdrant_failure)
+
+
+def _connect_qdrant():
+    """Qdrant に接続し、コレクションとペイロードインデックスを確認/作成する。"""
+    global _collection_vector_size
+    qdrant_kwargs = qdrant_client_kwargs()
+    if "location" in qdrant_kwargs:
+        print("Using in-memory Qdrant (local mode)")
+    elif "url" in qdrant_kwargs:
+        print(f"Connecting to Qdrant via URL endpoint: {settings.QDRANT_URL}")
+    else:
+        print(f"Connecting to Qdrant via host/port: {settings.QDRANT_HOST}:{settings.QDRANT_PORT}")
+    # コレクションの確認/作成は REST で行う。gRPC のチャネルは最初の呼び出しで作られるため、
+    # preload したマスターではチャネルを持たずにフォークできる
+    rest_kwargs = {k: v for k, v in qdrant_kwargs.items() if k not in ("prefer_grpc", "grpc_port", "grpc_options")}
+    client = QdrantClient(**rest_kwargs)
+
+    # 接続テストを兼ねてコレクションとエイリアスの確認/作成（読み書きはエイリアスで行い、reindex.py が付け替える）
+    collection, created = tenancy.ensure_serving_alias(
+        client, settings.QDRANT_COLLECTION_NAME, custom_sharding=settings.QDRANT_SHARDING == 'custom'
+    )
 
+    if created:
+        print(f"Created collection '{collection}' with indexes for 'chat_id' and 'type'")
+    else:
+        print(f"Collection '{collection}' already exists")
+        # Ensure payload indexes exist for existing collection
+        _ensure_payload_indexes(client, collection)
+        _collection_vector_size = getattr(client.get_collection(collection).config.params.vectors, 'size', None)
+    print(f"Serving '{settings.QDRANT_COLLECTION_NAME}' through alias "
+          f"'{tenancy.serving_alias(settings.QDRANT_COLLECTION_NAME)}' -> '{collection}'")
+    tenancy.ensure_placements_collection(client)
+    # エイリアスを使う前に作ったテナント専用コレクションにもエイリアスを向ける
+    for name in knowledge_collections(client)[1:]:
+        tenancy.ensure_serving_alias(client, name)
+
+    if qdrant_kwargs.get("prefer_grpc"):
+        print(f"Using gRPC transport for Qdrant (port {settings.QDRANT_GRPC_PORT})")
+        client.close()
+        client = QdrantClient(**qdrant_kwargs)
+    return client
+
+
+def _load_embedding_model():
+    global embedding_model
+    # torch / sentence-transformers の import だけで数秒かかるため、準備のスレッドで import する
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(settings.EMBEDDING_MODEL)
+    # 最初のリクエストが初回推論の遅さを負わないよう、キャッシュを通さずに一度推論しておく
+    model.encode(['warmup'])
+    embedding_model = embedding_cache.cached(model, shared=shared_tier)
+    _check_vector_size()
+
+
+def _init_qdrant():
+    """Qdrant に接続する。接続できない場合もバックグラウンドで再接続を続ける
+    （接続できるまで検索なしで応答し、知識の追加などはエラーを返す）。
+    """
+    global qdrant_client
+    try:
+        client = _connect_qdrant()
+    except Exception:
+        start_qdrant_reconnect()
+        raise
+    qdrant_client = guard_qdrant(client)
+    _check_vector_size()
+
+
+def _load_domain_registry():
+    domain_registry.ensure_loaded()
+    if not domain_registry.loaded:
+        raise RuntimeError(domain_registry.last_error or 'management API unavailable')
+
+
+def start_qdrant_reconnect():
+    """Qdrant に接続できるまでバックグラウンドで再試行する（間隔は失敗ごとに倍にする）。"""
+    global _qdrant_reconnect_thread
+    if _qdrant_reconnect_thread is not None and _qdrant_reconnect_thread.is_alive():
+        return
+    _qdrant_reconnect_thread = threading.Thread(target=_reconnect_qdrant, name='qdrant-reconnect', daemon=True)
+    _qdrant_reconnect_thread.start()
+
+
+def _reconnect_qdrant():
+    global qdrant_client
+    delay = settings.QDRANT_RECONNECT_INTERVAL_SEC
+    while qdrant_client is None:
+        time.sleep(delay)
+        try:
+            client = _connect_qdrant()
         except Exception as e:
-            print(f"Qdrant connection attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                print("All Qdrant connection attempts failed")
-                qdrant_client = None
-                embedding_model = None
-                return False
-
-
-# 初期化実行
-init_qdrant()
+            delay = min(delay * 2, settings.QDRANT_RECONNECT_MAX_INTERVAL_SEC)
+            print(f"Qdrant reconnect failed (next attempt in {delay:.0f}s): {e}")
+            continue
+        qdrant_client = guard_qdrant(client)
+        print("Qdrant reconnected")
+        _check_vector_size()
+
+
+# 起動時の準備（STARTUP_WARMUP_BACKGROUND なら import を待たせずに並行して行い、GET /ready で完了を返す）
+SEARCH_COMPONENTS = ('embedding_model', 'qdrant')
+warmup = startup.Warmup()
+warmup.add('embedding_model', _load_embedding_model, check=lambda: embedding_model is not None)
+warmup.add('qdrant', _init_qdrant, check=lambda: qdrant_client is not None)
+warmup.add('domain_registry', _load_domain_registry, check=lambda: domain_registry.loaded)
+if BQ_ENABLED:
+    # google-cloud-bigquery の import とクライアントの作成を最初のチャットの前に済ませておく
+    warmup.add('bigquery', get_bq_logger, required=False)
+warmup.start(block=not settings.STARTUP_WARMUP_BACKGROUND)
+
+
+def init_worker():
+    """pre-fork サーバー（gunicorn.conf.py の post_fork）からワーカーごとに呼ぶ。
+
+    埋め込みモデルとドメインレジストリはマスターでロード済みのものを copy-on-write で共有し、
+    ソケットを持つクライアントとバックグラウンドスレッドだけをワーカーで作り直す
+    （フォーク前に終わらなかった準備はワーカーでやり直す）。
+    """
+    global qdrant_client
+    if settings.TORCH_NUM_THREADS:
+        try:
+            import torch
+            torch.set_num_threads(settings.TORCH_NUM_THREADS)
+        except ImportError:
+            pass
+    warmup.restart_after_fork()
+    if qdrant_client is None:
+        if warmup.finished(['qdrant']):
+            start_qdrant_reconnect()
+    elif settings.QDRANT_URL != ':memory:':
+        qdrant_client = guard_qdrant(QdrantClient(**qdrant_client_kwargs()))
+    ai_agent.reset_client()
+    slog.restart_after_fork()
+    tracing.restart_after_fork()
+    if settings.MULTIPROC_DIR:
+        metrics.start_multiprocess(settings.MULTIPROC_DIR, settings.METRICS_MULTIPROC_INTERVAL_SEC)
+
+
+def shutdown_worker():
+    """ワーカー終了時にキューに残った BigQuery イベント・ログ・Qdrant への書き込みとメトリクスを書き出す。"""
+    if write_buffer is not None:
+        write_buffer.close()
+    shutdown_bq_logger()
+    metrics.stop_multiprocess()
+    slog.shutdown()
 
 
 @app.before_request
@@ -158,187 +333,152 @@ def before_request():
     """Set up request context for logging."""
     g.request_id = str(uuid.uuid4())
     g.start_time = time.time()
+    g.metrics_endpoint = request.endpoint or 'unknown'
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+    tracing.start_request_trace(g.request_id, g.metrics_endpoint, request.headers.get('traceparent'))
+
+
+@app.after_request
+def record_request_metrics(response):
+    g.response_status = response.status_code
+    if hasattr(g, 'start_time') and hasattr(g, 'metrics_endpoint'):
+        duration = time.time() - g.start_time
+        metrics.HTTP_REQUEST_DURATION.observe(
+            duration,
+            endpoint=g.metrics_endpoint,
+            status=f"{response.status_code // 100}xx",
+        )
+        if g.metrics_endpoint == 'chat':
+            chat_id = getattr(g, 'chat', {}).get('id')
+            metrics.CHAT_REQUEST_DURATION.observe(duration, **metrics.chat_duration_labels(chat_id))
+    return response
+
+
+@app.teardown_request
+def release_in_flight(exc):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+    tracing.finish_request_trace(g.pop('response_status', None), exc)
+
+
+@app.after_request
+def add_server_timing(response):
+    if settings.SERVER_TIMING_ENABLED:
+        timings = get_stage_timings()
+        if hasattr(g, 'start_time'):
+            timings['total'] = (time.time() - g.start_time) * 1000
+        if timings:
+            response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
+
+@app.after_request
+def add_profile_header(response):
+    artifacts = g.pop('profile_artifacts', None)
+    if artifacts:
+        response.headers['X-Profile-Artifacts'] = profiling.artifacts_header(artifacts)
+    return response
+
+
+def _run_chat_pipeline(query, chat_entry, system_prompt, deadline):
+    """埋め込み・ベクター検索・Gemini 呼び出し（同時に届いた同一の質問の間で共有される）。
+
+    deadline（time.time() 基準）を Qdrant のタイムアウト・アドミッションの待ち時間・Gemini の
+    タイムアウトに渡し、期限を過ぎたら Gemini の応答を待たずに検索結果からの抜粋で応答する。
+    """
+    chat_id = chat_entry.get('id')
+    result = chat_pipeline.cached_answer(shared_tier, chat_id, system_prompt, query)
+    if result.answer_path == ANSWER_CACHED:
+        return result
+
+    if not (qdrant_client and embedding_model) and not warmup.finished(SEARCH_COMPONENTS):
+        # 起動直後は埋め込みモデルと Qdrant の準備を（期限の半分まで）待ってから検索する
+        warmup.wait(SEARCH_COMPONENTS, timeout=chat_pipeline.remaining(deadline) / 2)
+
+    # ベクター検索を実行
+    if qdrant_client and embedding_model:
+        try:
+            vector_search_start = time.time()
+            with stage('embed'):
+                query_vectors = embedding_model.encode(chat_pipeline.query_variants(query)).tolist()
+
+            with stage('search'):
+                target = tenant_directory.read_target(chat_id)
+                search_result = chat_pipeline.merge_search_results(qdrant_client.search_batch(
+                    collection_name=target.serving_name,
+                    requests=chat_pipeline.search_requests(query_vectors, chat_id, shard_key=target.shard_key),
+                    timeout=chat_pipeline.search_timeout(deadline),
+                ))
+            result.vector_search_duration_ms = int((time.time() - vector_search_start) * 1000)
+
+            with stage('context'):
+                result.context = chat_pipeline.build_context(search_result, chat_id)
+
+        except Exception as e:
+            slog.error("vector_search_failed", chat_id=chat_id, error=str(e))
+            if chat_pipeline.remaining(deadline) <= 0:
+                chat_pipeline.record_deadline_exceeded('search')
+
+    context = result.context.context
+    chat_pipeline.log_llm_input(query, system_prompt, context, result.context.context_found)
+
+    llm_start = time.time()
+    with stage('llm'):
+        try:
+            with chat_pipeline.admission(chat_entry, context, deadline):
+                result.response, result.tokens_input, result.tokens_output, result.answer_path, result.llm_model = (
+                    ai_agent.think_and_respond(
+                        query, context, system_prompt=system_prompt, timeout=chat_pipeline.remaining(deadline)
+                    )
+                )
+        except AdmissionRejected as e:
+            result.admission_error = e
+            result.response, result.tokens_input, result.tokens_output, result.answer_path, result.llm_model = (
+                ai_agent.busy_response(context)
+            )
+    result.llm_request_duration_ms = int((time.time() - llm_start) * 1000)
+    if result.answer_path == ANSWER_FALLBACK_DEADLINE:
+        chat_pipeline.record_deadline_exceeded('llm')
+    chat_pipeline.store_answer(shared_tier, chat_id, system_prompt, query, result)
+    return result
 
 
 @app.route('/api/chat', methods=['POST'])
+@profiling.profiled()
 @require_domain_session(domain_registry)
 def chat():
-    error_code = None
-    error_message = None
-    response = None
-    context_found = False
-    context_sources_count = 0
-    vector_search_duration_ms = None
-    top_similarity_score = None
-    llm_request_duration_ms = None
-    tokens_input = None
-    tokens_output = None
-    
     # Parse request data once to be used in both success and error paths
-    data = request.get_json() or {}
-    query = data.get('message', '')
-    parent_origin = data.get('parent_origin')
+    data = chat_pipeline.request_body(request.get_json(silent=True))
+    chat_request = chat_pipeline.chat_request(data, request.headers, request.remote_addr)
+    query = chat_request.query
     chat_entry = getattr(g, 'chat', {})
     chat_id = chat_entry.get('id')
-    client_ip = request.headers.get('X-Forwarded-For', '').split(',')[0].strip() or request.remote_addr
+    trace = tracing.current_trace()
+    if trace:
+        trace.root.set_attribute('chat_id', chat_id)
 
+    result = None
+    coalesced = False
     try:
         if not chat_id:
             return jsonify({'error': 'Chat configuration is invalid'}), 500
         system_prompt = chat_entry.get('system_prompt')
 
         # === デバッグログ: クライアントからのリクエスト ===
-        request_log = {
-            "severity": "INFO",
-            "log_type": "chat_request",
-            "message": query,
-            "chat_id": chat_id,
-        }
-        print(json.dumps(request_log, ensure_ascii=False), flush=True)
-
-        context = ""
-
-        # ベクター検索を実行
-        if qdrant_client and embedding_model:
-            try:
-                vector_search_start = time.time()
-                query_vector = embedding_model.encode(query).tolist()
-
-                search_filter = Filter(
-                    must=[
-                        FieldCondition(
-                            key="chat_id",
-                            match=MatchValue(value=chat_id),
-                        )
-                    ],
-                    must_not=[
-                        FieldCondition(
-                            key="type",
-                            match=MatchValue(value="chat"),
-                        )
-                    ],
-                )
-
-                search_result = qdrant_client.search(
-                    collection_name=settings.QDRANT_COLLECTION_NAME,
-                    query_vector=query_vector,
-                    limit=10,
-                    query_filter=search_filter,
-                )
-                vector_search_duration_ms = int((time.time() - vector_search_start) * 1000)
-
-                print(f"Vector search results: {len(search_result)} candidates found")
-                if search_result:
-                    top_similarity_score = search_result[0].score if search_result else None
-                    context_items = []
-                    for i, point in enumerate(search_result):
-                        print(
-                            f"  Candidate {i+1}: score={point.score:.3f}, title='{point.payload.get('title', 'No title')}'"
-                        )
-                        if point.score > 0.05:
-                            context_items.append(point.payload.get('text', ''))
-                            print(
-                                f"    -> Added to context (text length: {len(point.payload.get('text', ''))})"
-                            )
-
-                    if context_items:
-                        context = "\n---\n".join(context_items)
-                        context_found = True
-                        context_sources_count = len(context_items)
-                        print(
-                            f"Final context items: {len(context_items)}, total context length: {len(context)}"
-                        )
-                    else:
-                        print("No items passed the score threshold")
-
-            except Exception as e:
-                print(f"Vector search failed: {e}")
-
-        # === デバッグログ: LLMに渡す値 ===
-        llm_input_log = {
-            "severity": "INFO",
-            "log_type": "llm_input",
-            "query": query,
-            "system_prompt_preview": system_prompt[:300] if system_prompt else None,
-            "system_prompt_length": len(system_prompt) if system_prompt else 0,
-            "context_found": context_found,
-            "context_length": len(context),
-            "context_preview": context[:500] if context else None
-        }
-        print(json.dumps(llm_input_log, ensure_ascii=False), flush=True)
+        slog.info("chat_request", message=query, chat_id=chat_id)
 
-        llm_start = time.time()
-        response, tokens_input, tokens_output = ai_agent.think_and_respond(query, context, system_prompt=system_prompt)
-        llm_request_duration_ms = int((time.time() - llm_start) * 1000)
-
-        response_data = {
-            'response': response,
-            'context_found': context_found,
-            'sources_used': context_sources_count,
-        }
-        if os.getenv('FLASK_ENV') == 'development':
-            response_data['chat_id'] = chat_id
-
-        # BigQuery logging
-        total_duration_ms = int((time.time() - g.start_time) * 1000) if hasattr(g, 'start_time') else None
-        log_chat_request(
-            chat_id=chat_id,
-            query=query,
-            response=response,
-            request_id=getattr(g, 'request_id', None),
-            user_agent=request.headers.get('User-Agent'),
-            origin_domain=parent_origin or request.headers.get('X-Original-Origin') or request.headers.get('Origin'),
-            context_found=context_found,
-            context_sources_count=context_sources_count,
-            vector_search_duration_ms=vector_search_duration_ms,
-            top_similarity_score=top_similarity_score,
-            llm_model=settings.GEMINI_MODEL_NAME,
-            llm_request_duration_ms=llm_request_duration_ms,
-            total_duration_ms=total_duration_ms,
-            client_ip=client_ip,
-            tokens_input=tokens_input,
-            tokens_output=tokens_output,
+        deadline = chat_pipeline.request_deadline(chat_entry, getattr(g, 'start_time', time.time()))
+        result, coalesced = chat_pipeline.coalesce(
+            chat_id, query, lambda: _run_chat_pipeline(query, chat_entry, system_prompt, deadline)
         )
-
-        return jsonify(response_data)
+        payload, status, headers = chat_pipeline.finish_chat(chat_request, chat_id, result, coalesced)
+        return jsonify(payload), status, headers
 
     except Exception as e:
-        error_code = 'INTERNAL_ERROR'
-        error_message = str(e)
-
-        # Log error to BigQuery
-        total_duration_ms = int((time.time() - g.start_time) * 1000) if hasattr(g, 'start_time') else None
-        log_chat_request(
-            chat_id=chat_id if chat_id else 'unknown',
-            query=query,
-            response='',
-            request_id=getattr(g, 'request_id', None),
-            user_agent=request.headers.get('User-Agent'),
-            origin_domain=parent_origin or request.headers.get('X-Original-Origin') or request.headers.get('Origin'),
-            context_found=context_found,
-            context_sources_count=context_sources_count,
-            vector_search_duration_ms=vector_search_duration_ms,
-            top_similarity_score=top_similarity_score,
-            llm_model=settings.GEMINI_MODEL_NAME,
-            llm_request_duration_ms=llm_request_duration_ms,
-            total_duration_ms=total_duration_ms,
-            error_code=error_code,
-            error_message=error_message,
-            client_ip=client_ip,
-            tokens_input=tokens_input,
-            tokens_output=tokens_output,
-        )
-
-        # Report to Sentry
-        if settings.SENTRY_DSN:
-            sentry_sdk.set_context("chat", {
-                "chat_id": chat_id,
-                "query": query,
-                "context_found": context_found,
-            })
-            sentry_sdk.capture_exception(e)
-
-        return jsonify({'error': str(e)}), 500
+        # Log error to BigQuery and report to Sentry
+        payload, status, headers = chat_pipeline.fail_chat(chat_request, chat_id, e, result, coalesced)
+        return jsonify(payload), status, headers
 
 
 @app.route('/public/init', methods=['POST'])
@@ -378,6 +518,7 @@ def public_init():
 
 @app.route('/api/add_knowledge', methods=['POST'])
 @require_admin_auth
+@profiling.profiled(memory=True)
 def add_knowledge():
     try:
         data = request.get_json() or {}
@@ -399,7 +540,7 @@ def add_knowledge():
                     chat_id,
                     category,
                     tags,
-                    qdrant_client,
+                    tenant_directory,
                     embedding_model,
                 )
                 return jsonify(result), status
@@ -414,6 +555,7 @@ def add_knowledge():
 
 @app.route('/api/upload_file', methods=['POST'])
 @require_admin_auth
+@profiling.profiled(memory=True)
 def upload_file():
     try:
         chat_id = request.form.get('chat_id') or request.form.get('tenant_id') or request.form.get('tenantId')
@@ -425,14 +567,18 @@ def upload_file():
             return jsonify({'error': 'ファイルが選択されていません'}), 400
 
         file = request.files['file']
-        result, status = handle_file_upload(file, chat_id, qdrant_client, embedding_model)
+        result, status = handle_file_upload(file, chat_id, tenant_directory, embedding_model)
         return jsonify(result), status
+    except RequestEntityTooLarge:
+        # 本文を読み切る前の 413 は handle_request_too_large に任せる
+        raise
     except Exception as e:
         return jsonify({'error': f'アップロードエラー: {str(e)}'}), 500
 
 
 @app.route('/api/fetch_url', methods=['POST'])
 @require_admin_auth
+@profiling.profiled(memory=True)
 def fetch_url():
     try:
         data = request.get_json() or {}
@@ -452,7 +598,7 @@ def fetch_url():
                 url,
                 custom_title,
                 chat_id,
-                qdrant_client,
+                tenant_directory,
                 embedding_model,
             )
             return jsonify(result), status
@@ -462,24 +608,109 @@ def fetch_url():
         return jsonify({'error': f'URL取得エラー: {str(e)}'}), 500
 
 
+@app.route('/api/knowledge', methods=['GET'])
+@require_admin_auth
+def list_knowledge():
+    """List a chat's knowledge points page by page (cursor pagination, no vectors).
+
+    Query: chat_id（必須）, limit, cursor（前のページの next_cursor）, fields（カンマ区切り）, type
+    """
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({'error': 'chat_id is required'}), 400
+    if not domain_registry.resolve(chat_id):
+        return jsonify({'error': 'Unknown chat_id'}), 404
+    if not qdrant_client:
+        return jsonify({'error': 'Qdrant not available'}), 500
+
+    try:
+        limit = int(request.args.get('limit', settings.KNOWLEDGE_LIST_DEFAULT_LIMIT))
+        if not 1 <= limit <= settings.KNOWLEDGE_LIST_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {settings.KNOWLEDGE_LIST_MAX_LIMIT}")
+        cursor = knowledge_listing.decode_cursor(request.args.get('cursor'))
+        fields = knowledge_listing.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        page = knowledge_listing.list_page(
+            tenant_directory, chat_id, limit, cursor, fields, knowledge_listing.parse_types(request.args.getlist('type'))
+        )
+        return jsonify(page)
+    except Exception as e:
+        print(f"Failed to list knowledge: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/knowledge/export', methods=['GET'])
+@require_admin_auth
+def export_knowledge():
+    """Stream a chat's whole knowledge corpus as NDJSON (gzip=1 で gzip 圧縮)."""
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({'error': 'chat_id is required'}), 400
+    if not domain_registry.resolve(chat_id):
+        return jsonify({'error': 'Unknown chat_id'}), 404
+    if not qdrant_client:
+        return jsonify({'error': 'Qdrant not available'}), 500
+
+    chunks = knowledge_listing.iter_export(
+        tenant_directory, chat_id, knowledge_listing.parse_types(request.args.getlist('type'))
+    )
+    try:
+        # 最初のページはレスポンスを返す前に読み込み、Qdrant のエラーを 500 として返す
+        first = next(chunks, b'')
+    except Exception as e:
+        print(f"Failed to export knowledge: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    def body():
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            # ヘッダー送信後のため途中で打ち切る（最終行が欠けたエクスポートになる）
+            print(f"[ERROR] Knowledge export for {chat_id} aborted: {e}")
+
+    filename = f"{re.sub(r'[^0-9A-Za-z_-]', '_', chat_id)}.ndjson"
+    stream = body()
+    if request.args.get('gzip', '').lower() in ('1', 'true'):
+        stream = knowledge_listing.gzip_stream(stream)
+        filename += '.gz'
+    return Response(
+        stream,
+        mimetype='application/gzip' if filename.endswith('.gz') else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'},
+    )
+
+
 @app.route('/api/knowledge/<point_id>', methods=['GET'])
 @require_admin_auth
 def get_knowledge(point_id):
-    """Retrieve a single knowledge point from Qdrant by ID."""
+    """Retrieve a single knowledge point from Qdrant by ID.
+
+    chat_id を指定するとテナントの置き場所（tenancy）から取得する。未指定の場合は共有コレクションのみ。
+    """
+    chat_id = request.args.get('chat_id')
     if not qdrant_client:
         return jsonify({'error': 'Qdrant not available'}), 500
 
     try:
-        points = qdrant_client.retrieve(
-            collection_name=settings.QDRANT_COLLECTION_NAME,
-            ids=[point_id],
-            with_payload=True,
-            with_vectors=False
-        )
+        if chat_id:
+            points = tenant_directory.retrieve(chat_id, [point_id], with_payload=True, with_vectors=False)
+        else:
+            points = qdrant_client.retrieve(
+                collection_name=tenancy.serving_alias(settings.QDRANT_COLLECTION_NAME),
+                ids=[point_id],
+                with_payload=True,
+                with_vectors=False
+            )
         if not points:
             return jsonify({'error': 'Knowledge not found'}), 404
 
         point = points[0]
+        if chat_id and point.payload.get('chat_id') != chat_id:
+            return jsonify({'error': 'Knowledge not found'}), 404
         return jsonify({
             'id': point_id,
             'title': point.payload.get('title', ''),
@@ -514,48 +745,32 @@ def update_knowledge(point_id):
         return jsonify({'error': 'Qdrant not available'}), 500
 
     try:
-        # Retrieve existing point
-        points = qdrant_client.retrieve(
-            collection_name=settings.QDRANT_COLLECTION_NAME,
-            ids=[point_id],
-            with_payload=True,
-            with_vectors=True
-        )
+        # Retrieve existing point (ベクトルは読み込まない)
+        points = tenant_directory.retrieve(chat_id, [point_id], with_payload=True, with_vectors=False)
         if not points:
             return jsonify({'error': 'Knowledge not found'}), 404
 
-        point = points[0]
-        current_payload = point.payload
+        current_payload = points[0].payload
 
         # Verify ownership
         if current_payload.get('chat_id') != chat_id:
             return jsonify({'error': 'Unauthorized'}), 403
 
-        # Update payload
-        updated_payload = {**current_payload}
+        changes = {'timestamp': time.time()}
         if new_title is not None:
-            updated_payload['title'] = new_title
-
-        # If text changed, re-compute vector
-        current_text = current_payload.get('text', '')
-        if new_text is not None and new_text != current_text:
-            updated_payload['text'] = new_text
-            new_vector = embedding_model.encode(new_text).tolist()
+            changes['title'] = new_title
+
+        if new_text is not None and new_text != current_payload.get('text', ''):
+            # 本文が変わった場合のみ埋め込み直して点ごと書き込む
+            updated_point = PointStruct(
+                id=point_id,
+                vector=embedding_model.encode(new_text).tolist(),
+                payload={**current_payload, **changes, 'text': new_text},
+            )
+            tenant_directory.upsert(chat_id, [updated_point])
         else:
-            new_vector = point.vector
-
-        updated_payload['timestamp'] = time.time()
-
-        # Upsert with same ID
-        updated_point = PointStruct(
-            id=point_id,
-            vector=new_vector,
-            payload=updated_payload,
-        )
-        qdrant_client.upsert(
-            collection_name=settings.QDRANT_COLLECTION_NAME,
-            points=[updated_point],
-        )
+            # タイトルだけの変更はペイロードの部分更新（ベクトルを転送しない）
+            tenant_directory.set_payload(chat_id, changes, [point_id])
 
         return jsonify({
             'success': True,
@@ -583,32 +798,158 @@ def delete_knowledge(point_id):
 
     try:
         # Verify ownership first
-        points = qdrant_client.retrieve(
-            collection_name=settings.QDRANT_COLLECTION_NAME,
-            ids=[point_id],
-            with_payload=True,
-            with_vectors=False
-        )
+        points = tenant_directory.retrieve(chat_id, [point_id], with_payload=['chat_id'], with_vectors=False)
         if not points:
             return jsonify({'error': 'Knowledge not found'}), 404
 
         if points[0].payload.get('chat_id') != chat_id:
             return jsonify({'error': 'Unauthorized'}), 403
 
-        qdrant_client.delete(
-            collection_name=settings.QDRANT_COLLECTION_NAME,
-            points_selector=PointIdsList(points=[point_id])
-        )
+        tenant_directory.delete(chat_id, [point_id])
         return jsonify({'success': True, 'deleted': True})
     except Exception as e:
         print(f"Failed to delete knowledge: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+def _bulk_request():
+    """bulk_delete / bulk_update の共通の検証。Returns (data, chat_id, Filter, error_response)."""
+    data = request.get_json(silent=True) or {}
+    chat_id = data.get('chat_id')
+    if not chat_id:
+        return data, None, None, (jsonify({'error': 'chat_id is required'}), 400)
+    if not domain_registry.resolve(chat_id):
+        return data, None, None, (jsonify({'error': 'Unknown chat_id'}), 404)
+    if not qdrant_client:
+        return data, None, None, (jsonify({'error': 'Qdrant not available'}), 500)
+    try:
+        points_filter = knowledge_bulk.selection_filter(chat_id, data.get('filter'))
+    except ValueError as e:
+        return data, None, None, (jsonify({'error': str(e)}), 400)
+    return data, chat_id, points_filter, None
+
+
+@app.route('/api/knowledge/bulk_delete', methods=['POST'])
+@require_admin_key
+def bulk_delete_knowledge():
+    """Delete every knowledge point of a chat that matches the filter in one server-side operation.
+
+    Body: {"chat_id": ..., "filter": {...}, "dry_run": false}（filter の条件は knowledge_bulk を参照。ADMIN_API_KEY 必須）
+    Qdrant は削除件数を返さないため、件数は削除の直前に数えた見込み（estimated_deleted）として返す。
+    """
+    data, chat_id, points_filter, error = _bulk_request()
+    if error:
+        return error
+    try:
+        matched = tenant_directory.count(chat_id, points_filter)
+        if data.get('dry_run'):
+            return jsonify({'success': True, 'dry_run': True, 'matched': matched})
+        result = tenant_directory.delete_matching(chat_id, points_filter)
+        return jsonify({'success': True, 'estimated_deleted': matched, 'status': result.status.value})
+    except Exception as e:
+        print(f"Failed to bulk delete knowledge: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/knowledge/bulk_update', methods=['POST'])
+@require_admin_key
+def bulk_update_knowledge():
+    """Patch title / category / tags of every knowledge point of a chat that matches the filter.
+
+    Body: {"chat_id": ..., "filter": {...}, "set": {"title": ..., "category": ..., "tags": [...]}, "dry_run": false}
+    ペイロードの部分更新のみでベクトルは転送しない（ADMIN_API_KEY 必須。件数は bulk_delete と同じく見込み）。
+    """
+    data, chat_id, points_filter, error = _bulk_request()
+    if error:
+        return error
+    try:
+        changes = knowledge_bulk.parse_patch(data.get('set'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        matched = tenant_directory.count(chat_id, points_filter)
+        if data.get('dry_run'):
+            return jsonify({'success': True, 'dry_run': True, 'matched': matched})
+        result = tenant_directory.set_payload(chat_id, {**changes, 'timestamp': time.time()}, points_filter)
+        return jsonify({'success': True, 'estimated_updated': matched, 'status': result.status.value})
+    except Exception as e:
+        print(f"Failed to bulk update knowledge: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+@require_admin_key
+def invalidate_cache():
+    """Invalidate shared caches on every instance (e.g. after a chat's settings change in the management API).
+
+    Body: {"registry": true} でレジストリを読み直させ、{"chat_id": ...} でそのチャットの回答のキャッシュを無効にする。
+    ADMIN_API_KEY 必須（管理サーバーは MGMT_ADMIN_API_KEY を X-Admin-API-Key として送る）。
+    """
+    data = request.get_json(silent=True) or {}
+    chat_id = data.get('chat_id')
+    if not data.get('registry') and not chat_id:
+        return jsonify({'error': 'registry or chat_id is required'}), 400
+    if data.get('registry'):
+        shared_tier.invalidate_registry()
+    if chat_id:
+        shared_tier.invalidate_chat(chat_id)
+    return jsonify({'success': True, 'shared': shared_tier.enabled})
+
+
 @app.route('/health')
 def health():
     return jsonify({'status': 'healthy'})
 
 
+@app.route('/ready')
+def ready():
+    """起動時の準備が終わり、検索を含めて応答できるか（Cloud Run の startup probe 用）。"""
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/metrics', endpoint='metrics')
+def export_metrics():
+    if settings.METRICS_AUTH_TOKEN:
+        if request.headers.get('Authorization', '') != f"Bearer {settings.METRICS_AUTH_TOKEN}":
+            return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render_all(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+@require_admin_key
+def profiling_settings():
+    """プロファイリングのサンプリング率を参照・変更する（ADMIN_API_KEY 必須）。"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            profiling.set_sample_rate(data.get('sample_rate', 0))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'sample_rate must be a number between 0 and 1'}), 400
+    return jsonify({
+        'sample_rate': profiling.get_sample_rate(),
+        'format': settings.PROFILE_FORMAT,
+        'output_dir': settings.PROFILE_OUTPUT_DIR,
+    })
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@require_admin_key
+def list_profiles():
+    """このインスタンスに保存されたプロファイルの一覧（ADMIN_API_KEY 必須）。"""
+    return jsonify({'profiles': profiling.list_artifacts()})
+
+
+@app.route('/api/admin/profiles/<name>', methods=['GET'])
+@require_admin_key
+def download_profile(name):
+    """X-Profile-Artifacts で返したファイルをダウンロードする（ADMIN_API_KEY 必須）。"""
+    path = profiling.artifact_path(name)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, as_attachment=True, download_name=name)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    # 開発用サーバー（本番は gunicorn -c gunicorn.conf.py app:app）
+    app.run(host='0.0.0.0', port=8000, debug=os.getenv('FLASK_ENV') == 'development')
@@ -0,0 +1,351 @@
+"""ASGI entry point with an asyncio-native /api/chat.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8000
+
+POST /api/chat をイベントループ上で処理する。
+- テナント解決と埋め込み計算（スレッドプール）を並行に実行する
+- Qdrant 検索は AsyncQdrantClient、Gemini 呼び出しは client.aio を使う
+- 応答待ちの間はスレッドを占有しないため、遅い Gemini 呼び出しを多数同時に保持できる
+
+それ以外のルートは a2wsgi 経由で Flask アプリ（app.py）にそのまま渡す。
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import sentry_sdk
+from a2wsgi import WSGIMiddleware
+from flask_cors.core import get_cors_headers, get_cors_options
+from qdrant_client import AsyncQdrantClient
+from werkzeug.datastructures import Headers
+
+import app as wsgi
+import chat_pipeline
+import metrics
+import profiling
+import request_state
+import settings
+import structured_logging as slog
+import tracing
+from admission import AdmissionRejected
+from ai_agent import ANSWER_CACHED, ANSWER_FALLBACK_DEADLINE
+from auth import extract_chat_id, extract_request_host, report_unknown_chat, resolve_chat
+from file_utils import format_size
+from timing import get_stage_timings, server_timing_header, stage
+
+_cors_options = get_cors_options(wsgi.app, wsgi.CORS_OPTIONS)
+_embed_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_EMBED_WORKERS, thread_name_prefix='embed')
+_async_qdrant = None
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class _Request:
+    """ASGI の scope と本文から /api/chat に必要な値だけを取り出したもの。"""
+
+    def __init__(self, scope, body):
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.body = body
+        client = scope.get('client')
+        self.remote_addr = client[0] if client else None
+        self.host = self.headers.get('host', '')
+
+    def get_json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+
+async def _read_body(receive, limit):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise RequestTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _cors_headers(request):
+    """Flask 側（CORS(app, **CORS_OPTIONS)）と同じ設定で flask-cors に CORS ヘッダーを計算させる。"""
+    return get_cors_headers(_cors_options, Headers(request.headers), 'POST')
+
+
+async def _send_json(send, status, payload, request=None, extra_headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('latin-1')),
+    ]
+    if request:
+        headers.extend(
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in _cors_headers(request).items(multi=True)
+        )
+    headers.extend((name.encode('latin-1'), value.encode('latin-1')) for name, value in extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _get_async_qdrant():
+    """ワーカーのイベントループで使う AsyncQdrantClient（インメモリモードでは None）。"""
+    global _async_qdrant
+    if _async_qdrant is None and settings.QDRANT_URL != ':memory:':
+        _async_qdrant = wsgi.guard_qdrant(AsyncQdrantClient(**wsgi.qdrant_client_kwargs()))
+    return _async_qdrant
+
+
+async def _resolve_chat(chat_id, request):
+    registry = wsgi.domain_registry
+
+    def host_fn():
+        return extract_request_host(request.headers.get('origin', ''), request.host)
+
+    with stage('registry'):
+        if registry.needs_reload():
+            # 管理API への再読み込みはブロッキング I/O なのでスレッドで行う
+            return await asyncio.to_thread(resolve_chat, registry, chat_id, host_fn)
+        return resolve_chat(registry, chat_id, host_fn)
+
+
+async def _embed(query):
+    embedding_model = wsgi.embedding_model
+    loop = asyncio.get_running_loop()
+    with stage('embed'):
+        vectors = await loop.run_in_executor(
+            _embed_executor, embedding_model.encode, chat_pipeline.query_variants(query)
+        )
+    return vectors.tolist()
+
+
+async def _read_target(chat_id):
+    directory = wsgi.tenant_directory
+    if directory.needs_reload():
+        # 配置の再読み込みはブロッキング I/O なのでスレッドで行う
+        return await asyncio.to_thread(directory.read_target, chat_id)
+    return directory.read_target(chat_id)
+
+
+async def _search(query_vectors, chat_id, deadline):
+    client = _get_async_qdrant()
+    target = await _read_target(chat_id)
+    kwargs = dict(
+        collection_name=target.serving_name,
+        requests=chat_pipeline.search_requests(query_vectors, chat_id, shard_key=target.shard_key),
+        timeout=chat_pipeline.search_timeout(deadline),
+    )
+    with stage('search'):
+        if client is None:
+            search = asyncio.to_thread(wsgi.qdrant_client.search_batch, **kwargs)
+        else:
+            search = client.search_batch(**kwargs)
+        return chat_pipeline.merge_search_results(
+            await asyncio.wait_for(search, max(0, chat_pipeline.remaining(deadline)))
+        )
+
+
+async def _run_chat_pipeline(embed_task, vector_search_start, query, chat_entry, system_prompt, deadline):
+    """app._run_chat_pipeline() の asyncio 版（埋め込みは _chat() で開始済み）。
+
+    期限を過ぎた検索・Gemini 呼び出しはキャンセルする。
+    """
+    chat_id = chat_entry.get('id')
+    result = chat_pipeline.PipelineResult()
+    if wsgi.shared_tier.enabled:
+        # 共有キャッシュはブロッキング I/O なのでスレッドで読む
+        result = await asyncio.to_thread(
+            chat_pipeline.cached_answer, wsgi.shared_tier, chat_id, system_prompt, query
+        )
+        if result.answer_path == ANSWER_CACHED:
+            if embed_task:
+                embed_task.cancel()
+            return result
+    if embed_task:
+        try:
+            query_vectors = await embed_task
+            search_result = await _search(query_vectors, chat_id, deadline)
+            result.vector_search_duration_ms = int((time.time() - vector_search_start) * 1000)
+
+            with stage('context'):
+                result.context = chat_pipeline.build_context(search_result, chat_id)
+
+        except asyncio.TimeoutError:
+            chat_pipeline.record_deadline_exceeded('search')
+        except Exception as e:
+            slog.error("vector_search_failed", chat_id=chat_id, error=str(e))
+
+    context = result.context.context
+    chat_pipeline.log_llm_input(query, system_prompt, context, result.context.context_found)
+
+    llm_start = time.time()
+    with stage('llm'):
+        try:
+            async with chat_pipeline.admission_async(chat_entry, context, deadline):
+                result.response, result.tokens_input, result.tokens_output, result.answer_path, result.llm_model = (
+                    await wsgi.ai_agent.think_and_respond_async(
+                        query, context, system_prompt=system_prompt, timeout=chat_pipeline.remaining(deadline)
+                    )
+                )
+        except AdmissionRejected as e:
+            result.admission_error = e
+            result.response, result.tokens_input, result.tokens_output, result.answer_path, result.llm_model = (
+                wsgi.ai_agent.busy_response(context)
+            )
+    result.llm_request_duration_ms = int((time.time() - llm_start) * 1000)
+    if result.answer_path == ANSWER_FALLBACK_DEADLINE:
+        chat_pipeline.record_deadline_exceeded('llm')
+    if wsgi.shared_tier.enabled:
+        await asyncio.to_thread(chat_pipeline.store_answer, wsgi.shared_tier, chat_id, system_prompt, query, result)
+    return result
+
+
+async def _chat(request):
+    """app.chat() と同じ処理を asyncio で行う。Returns (status, payload, headers)。"""
+    data = chat_pipeline.request_body(request.get_json())
+    chat_request = chat_pipeline.chat_request(data, request.headers, request.remote_addr)
+    query = chat_request.query
+    requested_chat_id = extract_chat_id(data, request.args)
+
+    # テナント解決と埋め込み計算は互いに独立なので並行に実行する
+    can_search = wsgi.qdrant_client is not None and wsgi.embedding_model is not None
+    vector_search_start = time.time()
+    embed_task = asyncio.ensure_future(_embed(query)) if can_search else None
+    chat_entry, request_host = await _resolve_chat(requested_chat_id, request)
+    if not chat_entry:
+        if embed_task:
+            embed_task.cancel()
+        report_unknown_chat(wsgi.domain_registry, requested_chat_id, request_host, request.headers.get('origin'))
+        return 404, {'error': 'Unknown chat'}, {}
+
+    request_state.current().chat = chat_entry
+    chat_id = chat_entry.get('id')
+    trace = tracing.current_trace()
+    if trace:
+        trace.root.set_attribute('chat_id', chat_id)
+    deadline = chat_pipeline.request_deadline(chat_entry, request_state.current().start_time)
+
+    if not can_search and not wsgi.warmup.finished(wsgi.SEARCH_COMPONENTS):
+        # 起動直後は埋め込みモデルと Qdrant の準備を（テナントの期限の半分まで）待ってから検索する
+        await asyncio.to_thread(wsgi.warmup.wait, wsgi.SEARCH_COMPONENTS, chat_pipeline.remaining(deadline) / 2)
+        if wsgi.qdrant_client is not None and wsgi.embedding_model is not None:
+            vector_search_start = time.time()
+            embed_task = asyncio.ensure_future(_embed(query))
+
+    result = None
+    coalesced = False
+    try:
+        if not chat_id:
+            return 500, {'error': 'Chat configuration is invalid'}, {}
+        system_prompt = chat_entry.get('system_prompt')
+
+        slog.info("chat_request", message=query, chat_id=chat_id)
+
+        result, coalesced = await chat_pipeline.coalesce_async(
+            chat_id,
+            query,
+            lambda: _run_chat_pipeline(embed_task, vector_search_start, query, chat_entry, system_prompt, deadline),
+        )
+        if coalesced and embed_task:
+            embed_task.cancel()
+        payload, status, headers = chat_pipeline.finish_chat(chat_request, chat_id, result, coalesced)
+        return status, payload, headers
+
+    except Exception as e:
+        payload, status, headers = chat_pipeline.fail_chat(chat_request, chat_id, e, result, coalesced)
+        return status, payload, headers
+
+
+def _request_url(scope, request):
+    return f"{scope.get('scheme', 'http')}://{request.host}{scope.get('root_path', '')}{scope['path']}"
+
+
+async def handle_chat(scope, receive, send):
+    with sentry_sdk.isolation_scope():
+        # Sentry のコンテキストを並行して処理している他のリクエストと混ぜない
+        await _handle_chat(scope, receive, send)
+
+
+async def _handle_chat(scope, receive, send):
+    state = request_state.begin(request_id=str(uuid.uuid4()), start_time=time.time(), metrics_endpoint='chat')
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc(endpoint='chat')
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+    tracing.start_request_trace(state.request_id, 'chat', headers.get('traceparent'))
+
+    request = None
+    status = 500
+    error = None
+    try:
+        try:
+            body = await _read_body(receive, settings.MAX_REQUEST_SIZE)
+        except RequestTooLarge:
+            status = 413
+            await _send_json(send, status, {'error': f'リクエストサイズが上限（{format_size(settings.MAX_FILE_SIZE)}）を超えています'})
+            return
+
+        request = _Request(scope, body)
+        wsgi.set_sentry_request_context(_request_url(scope, request), 'POST', request.headers.get('origin', ''))
+        try:
+            status, payload, headers = await profiling.profile_async(request.headers, 'POST /api/chat', _chat, request)
+        except Exception as e:
+            error = e
+            status, payload, headers = 500, {'error': str(e)}, {}
+
+        extra_headers = list(headers.items())
+        artifacts = state.pop('profile_artifacts', None)
+        if artifacts:
+            extra_headers.append(('x-profile-artifacts', profiling.artifacts_header(artifacts)))
+        if settings.SERVER_TIMING_ENABLED:
+            timings = get_stage_timings()
+            timings['total'] = (time.time() - state.start_time) * 1000
+            extra_headers.append(('server-timing', server_timing_header(timings)))
+        await _send_json(send, status, payload, request, extra_headers)
+    finally:
+        duration = time.time() - state.start_time
+        metrics.HTTP_REQUEST_DURATION.observe(duration, endpoint='chat', status=f"{status // 100}xx")
+        chat_id = state.get('chat', {}).get('id')
+        metrics.CHAT_REQUEST_DURATION.observe(duration, **metrics.chat_duration_labels(chat_id))
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec(endpoint='chat')
+        tracing.finish_request_trace(status, error)
+
+
+async def _lifespan(receive, send):
+    global _async_qdrant
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _async_qdrant is not None:
+                await _async_qdrant.close()
+                _async_qdrant = None
+            _embed_executor.shutdown(wait=False)
+            wsgi.shutdown_worker()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+_flask_app = WSGIMiddleware(wsgi.app, workers=settings.ASGI_WSGI_THREADS)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/api/chat' and scope['method'] == 'POST':
+        await handle_chat(scope, receive, send)
+    else:
+        await _flask_app(scope, receive, send)
@@ -1,3 +1,4 @@
+import hmac
 import json
 from functools import wraps
 from urllib.parse import urlparse
@@ -5,22 +6,29 @@ from urllib.parse import urlparse
 from flask import jsonify, g, request
 import sentry_sdk
 
+import settings
 from domain_registry import DomainRegistry
+from timing import stage
 
 
 def _extract_chat_id():
-    data = request.get_json(silent=True) or {}
+    data = request.get_json(silent=True)
+    return extract_chat_id(data if isinstance(data, dict) else {}, request.args)
+
+
+def extract_chat_id(data, args):
+    """リクエストボディ（dict）とクエリパラメーターから chat_id を取り出す。"""
     candidates = (
         data.get('chat_id'),
         data.get('chatId'),
         data.get('tenant_id'),
         data.get('tenantId'),
         data.get('domain'),
-        request.args.get('chat_id'),
-        request.args.get('chatId'),
-        request.args.get('tenant_id'),
-        request.args.get('tenantId'),
-        request.args.get('domain'),
+        args.get('chat_id'),
+        args.get('chatId'),
+        args.get('tenant_id'),
+        args.get('tenantId'),
+        args.get('domain'),
     )
     for value in candidates:
         if value:
@@ -29,7 +37,12 @@ def _extract_chat_id():
 
 
 def _extract_request_host():
-    origin = request.headers.get('Origin', '').strip()
+    return extract_request_host(request.headers.get('Origin', ''), request.host)
+
+
+def extract_request_host(origin, fallback_host):
+    """Origin ヘッダー（なければ Host）からテナント解決に使うホスト名を取り出す。"""
+    origin = (origin or '').strip()
     host = origin
     if origin:
         try:
@@ -38,10 +51,44 @@ def _extract_request_host():
         except Exception:
             host = origin
     if not host:
-        host = request.host
+        host = fallback_host
     return host
 
 
+def resolve_chat(registry: DomainRegistry, chat_id, host_fn):
+    """chat_id、なければリクエストのホスト名からチャットを解決する。
+
+    Returns (chat, request_host)。host_fn は chat_id で解決できなかった場合のみ呼ぶ。
+    """
+    chat = registry.resolve(chat_id) if chat_id else None
+    request_host = None
+    if not chat:
+        request_host = host_fn()
+        if request_host:
+            chat = registry.find_by_host(request_host)
+    return chat, request_host
+
+
+def report_unknown_chat(registry: DomainRegistry, chat_id, request_host, origin_header):
+    """解決できなかったチャットの詳細をサーバーログと Sentry に出力する。"""
+    registry_stats = registry.get_stats()
+    debug_info = {
+        'provided_chat_id': chat_id,
+        'request_host': request_host,
+        'origin_header': origin_header,
+        'registry_loaded': registry_stats['loaded'],
+        'registry_chat_count': registry_stats['chat_count'],
+        'registry_last_error': registry_stats['last_error'],
+        'available_chat_ids': registry_stats['available_ids'][:10],
+    }
+    print(f"[ERROR] Unknown chat - {json.dumps(debug_info, ensure_ascii=False)}")
+    sentry_sdk.capture_message(
+        'Unknown chat error',
+        level='error',
+        extras=debug_info
+    )
+
+
 def require_admin_auth(fn):
     """認証は一時的に無効化（常に通過）。"""
 
@@ -52,39 +99,45 @@ def require_admin_auth(fn):
     return wrapper
 
 
+def is_admin_request(headers=None):
+    """X-Admin-API-Key が ADMIN_API_KEY と一致するか（未設定なら常に False）。
+
+    headers を省略した場合は Flask のリクエストのヘッダーを見る（ASGI では小文字のキーの dict を渡す）。
+    """
+    if not settings.ADMIN_API_KEY:
+        return False
+    if headers is None:
+        provided = request.headers.get('X-Admin-API-Key')
+    else:
+        provided = headers.get('x-admin-api-key')
+    return hmac.compare_digest((provided or '').encode('utf-8'), settings.ADMIN_API_KEY.encode('utf-8'))
+
+
+def require_admin_key(fn):
+    """ADMIN_API_KEY を X-Admin-API-Key で送ったリクエストだけを通す（データをまとめて変更する・内部を見せる API 用）。"""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
 def require_domain_session(registry: DomainRegistry):
     """認証は無効化し、chat_id かホスト名からテナントを解決する。"""
 
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            chat_id = _extract_chat_id()
-            chat = registry.resolve(chat_id) if chat_id else None
-
-            request_host = None
-            if not chat:
-                request_host = _extract_request_host()
-                if request_host:
-                    chat = registry.find_by_host(request_host)
+            with stage('registry'):
+                chat_id = _extract_chat_id()
+                chat, request_host = resolve_chat(registry, chat_id, _extract_request_host)
 
             if not chat:
                 # サーバーログとSentryに詳細を出力
-                registry_stats = registry.get_stats()
-                debug_info = {
-                    'provided_chat_id': chat_id,
-                    'request_host': request_host,
-                    'origin_header': request.headers.get('Origin'),
-                    'registry_loaded': registry_stats['loaded'],
-                    'registry_chat_count': registry_stats['chat_count'],
-                    'registry_last_error': registry_stats['last_error'],
-                    'available_chat_ids': registry_stats['available_ids'][:10],
-                }
-                print(f"[ERROR] Unknown chat - {json.dumps(debug_info, ensure_ascii=False)}")
-                sentry_sdk.capture_message(
-                    'Unknown chat error',
-                    level='error',
-                    extras=debug_info
-                )
+                report_unknown_chat(registry, chat_id, request_host, request.headers.get('Origin'))
                 return jsonify({'error': 'Unknown chat'}), 404
 
             g.chat = chat
@@ -0,0 +1,269 @@
+"""/api/chat パイプラインのベンチマーク。
+
+Flask のテストクライアントで chat() を呼び出し、Server-Timing ヘッダーから
+ステージ別（embed / search / context / llm / logging / total）の所要時間を集計する。
+外部依存はローカルのスタンドインに置き換える。
+
+- Qdrant: インメモリモード（QDRANT_URL=":memory:"）。ローカルモードの検索は
+  全件走査になるため、10万件規模は --qdrant-url で実サーバーを指定して計測する
+  （その場合は bench_chat_context コレクションを作り直して使う）
+- Gemini: FakeGenaiClient（--llm-latency-ms で応答遅延を指定）
+- 管理API: serve_management_stub で起動するスタブ
+
+    cd server
+    python -m bench.bench_chat --corpus-sizes 1000 --queries 200 --llm-latency-ms 300
+    python -m bench.bench_chat --corpus-sizes 100000 --qdrant-url http://localhost:6333
+    python -m bench.bench_chat --compare bench/results/chat-<sha>.json
+
+結果は bench/results/chat-<git sha>-<timestamp>.json に保存され、--compare で
+以前の結果とのステージ別 p50/p95 の差分を表示できる。
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bench.standins import FakeEmbedder, FakeGenaiClient, make_chats, random_unit_vectors, serve_management_stub
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+TENANT_COUNT = 10
+SAMPLE_QUERIES = [
+    "営業時間を教えてください",
+    "料金プランの違いは何ですか？",
+    "返品の手続き方法を知りたいです",
+    "アカウントのパスワードを変更するには？",
+    "サポートへの問い合わせ先はどこですか",
+    "無料トライアルはありますか",
+    "請求書の発行方法を教えて",
+    "対応している支払い方法は？",
+]
+
+
+def _git_sha():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def _parse_server_timing(header):
+    timings = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name or not params.startswith('dur='):
+            continue
+        timings[name] = float(params[4:])
+    return timings
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return round(ordered[index], 3)
+
+
+def _summarize(values):
+    return {
+        'count': len(values),
+        'mean': round(statistics.mean(values), 3) if values else None,
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'p99': _percentile(values, 99),
+    }
+
+
+def _import_app(base_url, qdrant_url):
+    os.environ['MGMT_API_BASE_URL'] = base_url
+    os.environ['QDRANT_URL'] = qdrant_url or ':memory:'
+    if qdrant_url:
+        os.environ['QDRANT_COLLECTION_NAME'] = 'bench_chat_context'
+    os.environ['SERVER_TIMING_ENABLED'] = 'true'
+    os.environ.setdefault('GEMINI_API_KEY', 'bench-fake-key')
+    os.environ['BQ_ENABLED'] = 'false'
+    import app as app_module
+    app_module.warmup.wait()
+    return app_module
+
+
+def _seed_corpus(app_module, corpus_size, batch_size=1000):
+    from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+    import settings
+    import tenancy
+
+    client = app_module.qdrant_client
+    # アプリはエイリアス経由で読むので、エイリアスが指す実体を作り直してエイリアスを戻す
+    collection = tenancy.resolve_collection(client, settings.QDRANT_COLLECTION_NAME)
+    client.delete_collection(collection)
+    client.create_collection(
+        collection_name=collection,
+        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
+    )
+    tenancy.ensure_serving_alias(client, settings.QDRANT_COLLECTION_NAME)
+    vectors = random_unit_vectors(corpus_size, seed=corpus_size)
+    for offset in range(0, corpus_size, batch_size):
+        points = [
+            PointStruct(
+                id=i,
+                vector=vectors[i].tolist(),
+                payload={
+                    'text': f"ベンチマーク用ドキュメント {i}。" + "サンプル本文。" * 40,
+                    'title': f"doc-{i}",
+                    'chat_id': f"bench-chat-{i % TENANT_COUNT}",
+                    'type': 'knowledge',
+                    'source': 'bench',
+                },
+            )
+            for i in range(offset, min(offset + batch_size, corpus_size))
+        ]
+        client.upsert(collection_name=tenancy.serving_alias(settings.QDRANT_COLLECTION_NAME), points=points)
+
+
+def _run_queries(app_module, query_count, concurrency):
+    def send(i):
+        client = app_module.app.test_client()
+        res = client.post('/api/chat', json={
+            'message': SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)],
+            'chat_id': f"bench-chat-{i % TENANT_COUNT}",
+        })
+        return res.status_code, _parse_server_timing(res.headers.get('Server-Timing'))
+
+    if concurrency <= 1:
+        return [send(i) for i in range(query_count)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, range(query_count)))
+
+
+def run_benchmark(args):
+    server, base_url = serve_management_stub(make_chats(TENANT_COUNT))
+    sink = open(os.devnull, 'w') if not args.show_logs else sys.stdout
+    try:
+        with contextlib.redirect_stdout(sink):
+            app_module = _import_app(base_url, args.qdrant_url)
+        if app_module.qdrant_client is None:
+            sys.exit("Qdrant could not be initialized")
+        app_module.ai_agent.client = FakeGenaiClient(args.llm_latency_ms, args.llm_jitter_ms)
+        if args.fake_embedder or app_module.embedding_model is None:
+            app_module.embedding_model = FakeEmbedder()
+
+        runs = []
+        for corpus_size in args.corpus_sizes:
+            print(f"Seeding {corpus_size} points...", file=sys.stderr)
+            with contextlib.redirect_stdout(sink):
+                _seed_corpus(app_module, corpus_size)
+                _run_queries(app_module, args.warmup, 1)
+
+                tracemalloc.start()
+                started = time.perf_counter()
+                results = _run_queries(app_module, args.queries, args.concurrency)
+                elapsed = time.perf_counter() - started
+                _, traced_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            stages = {}
+            for _status, timings in results:
+                for name, duration_ms in timings.items():
+                    stages.setdefault(name, []).append(duration_ms)
+            runs.append({
+                'corpus_size': corpus_size,
+                'queries': args.queries,
+                'concurrency': args.concurrency,
+                'errors': sum(1 for status, _ in results if status >= 400),
+                'throughput_rps': round(len(results) / elapsed, 2) if elapsed else None,
+                'stages_ms': {name: _summarize(values) for name, values in stages.items()},
+                'tracemalloc_peak_kb': traced_peak // 1024,
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            })
+    finally:
+        server.shutdown()
+        if sink is not sys.stdout:
+            sink.close()
+
+    return {
+        'benchmark': 'chat_pipeline',
+        'git_sha': _git_sha(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'params': {
+            'llm_latency_ms': args.llm_latency_ms,
+            'llm_jitter_ms': args.llm_jitter_ms,
+            'fake_embedder': args.fake_embedder,
+            'qdrant': 'server' if args.qdrant_url else 'memory',
+            'warmup': args.warmup,
+        },
+        'runs': runs,
+    }
+
+
+def print_report(result, baseline=None):
+    baseline_runs = {r['corpus_size']: r for r in (baseline or {}).get('runs', [])}
+    for run in result['runs']:
+        print(
+            f"\ncorpus={run['corpus_size']} queries={run['queries']} concurrency={run['concurrency']} "
+            f"throughput={run['throughput_rps']} rps errors={run['errors']} "
+            f"py_peak={run['tracemalloc_peak_kb']}KB rss={run['max_rss_kb']}KB"
+        )
+        base = baseline_runs.get(run['corpus_size'], {}).get('stages_ms', {})
+        print(f"  {'stage':<10} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'Δp50':>9} {'Δp95':>9}")
+        for name, summary in run['stages_ms'].items():
+            delta_p50 = delta_p95 = ''
+            if name in base and base[name]['p50'] is not None:
+                delta_p50 = f"{summary['p50'] - base[name]['p50']:+.2f}"
+                delta_p95 = f"{summary['p95'] - base[name]['p95']:+.2f}"
+            print(
+                f"  {name:<10} {summary['mean']:>9} {summary['p50']:>9} {summary['p95']:>9} "
+                f"{summary['p99']:>9} {delta_p50:>9} {delta_p95:>9}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus-sizes', default='1000',
+                        type=lambda v: [int(x) for x in v.split(',') if x])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--llm-latency-ms', type=float, default=0)
+    parser.add_argument('--llm-jitter-ms', type=float, default=0)
+    parser.add_argument('--fake-embedder', action='store_true',
+                        help='SentenceTransformer の代わりにハッシュベースの埋め込みを使う')
+    parser.add_argument('--qdrant-url', help='インメモリの代わりに使う Qdrant サーバーの URL')
+    parser.add_argument('--show-logs', action='store_true', help='サーバーのログ出力を抑制しない')
+    parser.add_argument('--output', help='結果 JSON の保存先（省略時は bench/results/ 配下）')
+    parser.add_argument('--compare', help='比較対象の結果 JSON')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    output = Path(args.output) if args.output else (
+        RESULTS_DIR / f"chat-{result['git_sha']}-{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nSaved results to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""HTML 抽出処理のベンチマーク。
+
+保存済みページ（*.html）のディレクトリを対象に、従来の BeautifulSoup
+(html.parser) 実装と lxml 実装の抽出時間とピークメモリを比較する。
+
+    cd server
+    python -m bench.bench_html_extract path/to/saved_pages --repeat 5
+
+ピークメモリは実装ごとに別プロセスで計測する（lxml の C 側の確保は
+tracemalloc に現れないため、ru_maxrss の増分も合わせて出力する）。
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+IMPLEMENTATIONS = ('bs4', 'lxml')
+
+
+def _load_corpus(corpus_dir):
+    pages = []
+    for path in sorted(Path(corpus_dir).glob('**/*.htm*')):
+        pages.append((path.name, path.read_bytes()))
+    return pages
+
+
+def _maxrss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_worker(impl, corpus_dir, repeat):
+    import file_utils
+
+    extract = file_utils._extract_html_bs4 if impl == 'bs4' else file_utils._extract_html_lxml
+    pages = _load_corpus(corpus_dir)
+    baseline_rss = _maxrss_kb()
+
+    durations_ms = []
+    extracted_chars = 0
+    tracemalloc.start()
+    for _ in range(repeat):
+        for _name, raw in pages:
+            start = time.perf_counter()
+            _title, text = extract(raw)
+            durations_ms.append((time.perf_counter() - start) * 1000)
+            extracted_chars += len(text)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'impl': impl,
+        'pages': len(pages),
+        'repeat': repeat,
+        'total_ms': round(sum(durations_ms), 2),
+        'mean_ms': round(statistics.mean(durations_ms), 3) if durations_ms else None,
+        'p95_ms': round(sorted(durations_ms)[int(len(durations_ms) * 0.95) - 1], 3) if durations_ms else None,
+        'tracemalloc_peak_kb': traced_peak // 1024,
+        'rss_growth_kb': _maxrss_kb() - baseline_rss,
+        'extracted_chars': extracted_chars // max(repeat, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus_dir', help='保存済み HTML ページのディレクトリ')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    parser.add_argument('--worker', choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(_run_worker(args.worker, args.corpus_dir, args.repeat)))
+        return
+
+    if not _load_corpus(args.corpus_dir):
+        sys.exit(f"No HTML files found under {args.corpus_dir}")
+
+    server_dir = Path(__file__).resolve().parent.parent
+    results = []
+    for impl in IMPLEMENTATIONS:
+        completed = subprocess.run(
+            [sys.executable, '-m', 'bench.bench_html_extract', args.corpus_dir,
+             '--repeat', str(args.repeat), '--worker', impl],
+            cwd=server_dir,
+            env={**os.environ, 'PYTHONPATH': str(server_dir)},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print(f"{'impl':<6} {'pages':>6} {'mean_ms':>9} {'p95_ms':>9} {'py_peak_kb':>11} {'rss_kb':>9} {'chars':>9}")
+    for r in results:
+        print(
+            f"{r['impl']:<6} {r['pages']:>6} {r['mean_ms']:>9} {r['p95_ms']:>9} "
+            f"{r['tracemalloc_peak_kb']:>11} {r['rss_growth_kb']:>9} {r['extracted_chars']:>9}"
+        )
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
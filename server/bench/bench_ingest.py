@@ -0,0 +1,140 @@
+"""Qdrant への取り込みの書き込み方式のベンチマーク。
+
+同時に --concurrency 本の取り込み（1 ドキュメント = 1 点）を行い、1 件ずつ upsert する場合と
+write_buffer でまとめて書き込む場合の、1 件あたりの応答時間・スループット・upsert の回数を比較する。
+取り込み側は書き込み完了を待つ（QDRANT_WRITE_ACK=flushed と同じ）。
+
+    cd server
+    python -m bench.bench_ingest --qdrant-url http://localhost:6333 --concurrency 1,8,32 --docs 2000
+    python -m bench.bench_ingest --qdrant-url :memory: --concurrency 8    # 動作確認用
+"""
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+from bench.standins import VECTOR_SIZE, random_unit_vectors
+from tenancy import Target
+from write_buffer import WriteBuffer
+
+COLLECTION = 'bench_ingest_context'
+TARGETS = [Target(COLLECTION)]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class _CountingClient:
+    def __init__(self, client):
+        self._client = client
+        self.upserts = 0
+
+    def upsert(self, **kwargs):
+        self.upserts += 1
+        return self._client.upsert(**kwargs)
+
+
+def _reset(client):
+    if client.collection_exists(COLLECTION):
+        client.delete_collection(COLLECTION)
+    client.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+    )
+
+
+def run(name, client, concurrency, args):
+    _reset(client)
+    counting = _CountingClient(client)
+    buffer = None
+    if name == 'buffered':
+        buffer = WriteBuffer(
+            lambda: counting, batch_size=args.batch_size, max_delay_ms=args.max_delay_ms, wait=True
+        )
+    vectors = random_unit_vectors(args.docs, seed=concurrency)
+    latencies = []
+    lock = threading.Lock()
+    next_doc = iter(range(args.docs))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(next_doc, None)
+            if i is None:
+                return
+            point = PointStruct(
+                id=str(uuid.uuid4()),
+                vector=vectors[i].tolist(),
+                payload={'text': f"doc {i}", 'chat_id': f"bench-chat-{i % 10}", 'type': 'knowledge'},
+            )
+            start = time.perf_counter()
+            if buffer is not None:
+                buffer.submit(TARGETS, [point]).wait()
+            else:
+                counting.upsert(collection_name=COLLECTION, points=[point], wait=True)
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if buffer is not None:
+        buffer.close()
+    return {
+        'config': name,
+        'concurrency': concurrency,
+        'docs_per_sec': round(args.docs / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(_percentile(latencies, 0.95), 2),
+        'p99_ms': round(_percentile(latencies, 0.99), 2),
+        'upserts': counting.upserts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--qdrant-url', default='http://localhost:6333')
+    parser.add_argument('--docs', type=int, default=2000, help='構成ごとに取り込むドキュメント数')
+    parser.add_argument('--concurrency', default='1,8,32', help='同時に取り込むスレッド数（カンマ区切り）')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--max-delay-ms', type=int, default=20)
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    args = parser.parse_args()
+
+    if args.qdrant_url == ':memory:':
+        client = QdrantClient(location=':memory:')
+    else:
+        client = QdrantClient(url=args.qdrant_url, api_key=os.getenv('QDRANT_API_KEY'))
+
+    results = []
+    print(f"{'config':<9} {'conc':>5} {'docs/s':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'upserts':>8}")
+    for concurrency in [int(v) for v in args.concurrency.split(',') if v.strip()]:
+        for name in ('direct', 'buffered'):
+            row = run(name, client, concurrency, args)
+            results.append(row)
+            print(
+                f"{row['config']:<9} {row['concurrency']:>5} {row['docs_per_sec']:>9} {row['p50_ms']:>8} "
+                f"{row['p95_ms']:>8} {row['p99_ms']:>8} {row['upserts']:>8}"
+            )
+
+    client.delete_collection(COLLECTION)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
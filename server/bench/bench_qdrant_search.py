@@ -0,0 +1,174 @@
+"""/api/chat のベクター検索の転送方式のベンチマーク。
+
+実 Qdrant に bench_search_context コレクションを作り、1 リクエスト分の検索
+（質問のバリエーション数 = --variants）にかかる時間と受け取るペイロードの量を比較する。
+
+- rest-full:     REST、質問ごとに search を 1 回ずつ、ペイロード全体（従来の動作）
+- rest-batch:    REST、search_batch で 1 往復、ペイロードは text / title のみ
+- grpc-batch:    gRPC（チャネルを使い回す）、search_batch で 1 往復、text / title のみ
+
+    cd server
+    python -m bench.bench_qdrant_search --qdrant-url http://localhost:6333 --variants 1,3
+    # Qdrant Cloud など（API キーが必要な場合）
+    QDRANT_API_KEY=... python -m bench.bench_qdrant_search --qdrant-url https://xxx.cloud.qdrant.io:6333
+
+--qdrant-url :memory: ではローカルモードで rest-* のみ実行する（スクリプトの動作確認用。
+ネットワークを通らないため転送時間の比較にはならない）。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+import chat_pipeline
+from bench.standins import VECTOR_SIZE, random_unit_vectors
+
+COLLECTION = 'bench_search_context'
+TENANT_COUNT = 10
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _client(args, prefer_grpc):
+    if args.qdrant_url == ':memory:':
+        return QdrantClient(location=':memory:')
+    return QdrantClient(
+        url=args.qdrant_url,
+        api_key=os.getenv('QDRANT_API_KEY'),
+        prefer_grpc=prefer_grpc,
+        grpc_port=args.grpc_port,
+    )
+
+
+def _seed(client, corpus_size, text_chars, batch_size=500):
+    if client.collection_exists(COLLECTION):
+        client.delete_collection(COLLECTION)
+    client.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+    )
+    vectors = random_unit_vectors(corpus_size, seed=corpus_size)
+    body = "サンプル本文。" * (text_chars // 7)
+    for offset in range(0, corpus_size, batch_size):
+        points = [
+            PointStruct(
+                id=i,
+                vector=vectors[i].tolist(),
+                # add_knowledge / URL 取得で保存されるものと同じ構成のペイロード
+                payload={
+                    'text': f"ベンチマーク用ドキュメント {i}。{body}",
+                    'title': f"doc-{i}",
+                    'chat_id': f"bench-chat-{i % TENANT_COUNT}",
+                    'type': 'knowledge',
+                    'source': 'url_fetch',
+                    'url': f"https://example.com/docs/{i}",
+                    'category': 'general',
+                    'tags': ['bench', f"tag-{i % 7}"],
+                    'timestamp': time.time(),
+                },
+            )
+            for i in range(offset, min(offset + batch_size, corpus_size))
+        ]
+        client.upsert(collection_name=COLLECTION, points=points)
+
+
+def _search_full(client, query_vectors, chat_id):
+    return [
+        client.search(
+            collection_name=COLLECTION,
+            query_vector=vector,
+            limit=chat_pipeline.SEARCH_LIMIT,
+            query_filter=chat_pipeline.search_filter(chat_id),
+        )
+        for vector in query_vectors
+    ]
+
+
+def _search_batch(client, query_vectors, chat_id):
+    return client.search_batch(
+        collection_name=COLLECTION,
+        requests=chat_pipeline.search_requests(query_vectors, chat_id),
+    )
+
+
+def _payload_bytes(batches):
+    """受け取ったペイロードの量（JSON 換算。まとめる前の全候補）。"""
+    return sum(
+        len(json.dumps(point.payload, ensure_ascii=False).encode('utf-8')) for hits in batches for point in hits
+    )
+
+
+def run(name, client, search, variants, args):
+    queries = random_unit_vectors(args.queries * variants, seed=variants + 1)
+    for i in range(min(args.warmup, args.queries)):
+        search(client, [queries[i].tolist()], f"bench-chat-{i % TENANT_COUNT}")
+
+    latencies = []
+    payload_bytes = []
+    for i in range(args.queries):
+        query_vectors = [queries[i * variants + j].tolist() for j in range(variants)]
+        start = time.perf_counter()
+        batches = search(client, query_vectors, f"bench-chat-{i % TENANT_COUNT}")
+        chat_pipeline.merge_search_results(batches)
+        latencies.append((time.perf_counter() - start) * 1000)
+        payload_bytes.append(_payload_bytes(batches))
+    return {
+        'config': name,
+        'variants': variants,
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(_percentile(latencies, 0.95), 2),
+        'p99_ms': round(_percentile(latencies, 0.99), 2),
+        'payload_kb': round(statistics.mean(payload_bytes) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--qdrant-url', default='http://localhost:6333')
+    parser.add_argument('--grpc-port', type=int, default=6334)
+    parser.add_argument('--corpus-size', type=int, default=10000)
+    parser.add_argument('--text-chars', type=int, default=1500, help='ドキュメント本文の長さ（文字数）')
+    parser.add_argument('--queries', type=int, default=300, help='構成ごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--variants', default='1,3', help='1 リクエストあたりの質問ベクトル数（カンマ区切り）')
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    args = parser.parse_args()
+
+    rest = _client(args, prefer_grpc=False)
+    print(f"seeding {args.corpus_size} points into {COLLECTION} ...")
+    _seed(rest, args.corpus_size, args.text_chars)
+
+    configs = [('rest-full', rest, _search_full), ('rest-batch', rest, _search_batch)]
+    if args.qdrant_url != ':memory:':
+        configs.append(('grpc-batch', _client(args, prefer_grpc=True), _search_batch))
+
+    results = []
+    print(f"{'config':<11} {'variants':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'payload':>10}")
+    for variants in [int(v) for v in args.variants.split(',') if v.strip()]:
+        baseline = None
+        for name, client, search in configs:
+            row = run(name, client, search, variants, args)
+            baseline = baseline or row
+            row['saved_p50_ms'] = round(baseline['p50_ms'] - row['p50_ms'], 2)
+            results.append(row)
+            print(
+                f"{row['config']:<11} {row['variants']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+                f"{row['p99_ms']:>8} {row['payload_kb']:>8}KB  (p50 {row['saved_p50_ms']:+.2f}ms saved)"
+            )
+
+    rest.delete_collection(COLLECTION)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""ナレッジのコレクションの保存形式（量子化・オンディスク・HNSW）ごとの再現率・応答時間・メモリの比較。
+
+実 Qdrant のナレッジ（--source-collection、既定 QDRANT_COLLECTION_NAME）から最大 --sample 点を
+ベクトルごとコピーし、設定ごとに bench_quant_<name> コレクションを作って同じ質問を chat_id で
+絞り込んで検索する。正解は float32 の全件走査（exact）の上位 10 件。
+
+質問: --events（BigQuery の chatbot_events の書き出し）があれば実際の質問を埋め込んで使い、
+無ければナレッジのベクトルに雑音を加えたものを使う。
+
+    cd server
+    python -m bench.bench_quantization --qdrant-url http://localhost:6333 --sample 20000 --queries 300
+    python -m bench.bench_quantization --qdrant-url http://localhost:6333 --events events.ndjson \\
+        --configs float32,scalar,scalar-ondisk,binary-ondisk --search-ef 128
+
+--qdrant-url :memory: ではランダムなベクトルで動作確認だけを行う（ローカルモードは量子化・HNSW を使わない）。
+"""
+
+import argparse
+import json
+import statistics
+import time
+from dataclasses import asdict, replace
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import (
+    CollectionStatus,
+    KeywordIndexParams,
+    KeywordIndexType,
+    OptimizersConfigDiff,
+    PointStruct,
+    QuantizationSearchParams,
+    SearchParams,
+)
+
+import settings
+import tenancy
+from bench.standins import random_unit_vectors
+from collection_config import CollectionConfig
+
+TOP_K = 10
+VARIANTS = {
+    'float32': CollectionConfig(),
+    'float32-ondisk': CollectionConfig(vectors_on_disk=True),
+    'scalar': CollectionConfig(quantization='scalar'),
+    'scalar-ondisk': CollectionConfig(quantization='scalar', vectors_on_disk=True),
+    'scalar-norescore': CollectionConfig(quantization='scalar', vectors_on_disk=True, rescore=False),
+    'binary-ondisk': CollectionConfig(quantization='binary', vectors_on_disk=True, oversampling=3.0),
+}
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def load_sample(client, collection, sample, batch_size=512):
+    """ナレッジの点（ベクトルと chat_id）を最大 sample 件読み込む。"""
+    points = []
+    offset = None
+    while len(points) < sample:
+        records, offset = client.scroll(
+            collection_name=collection,
+            limit=min(batch_size, sample - len(points)),
+            offset=offset,
+            with_payload=['chat_id'],
+            with_vectors=True,
+        )
+        points.extend(
+            (record.id, record.vector, record.payload.get('chat_id'))
+            for record in records
+            if record.payload.get('chat_id') and record.vector
+        )
+        if offset is None:
+            break
+    return points
+
+
+def synthetic_sample(sample, tenants=10):
+    vectors = random_unit_vectors(sample, seed=sample)
+    return [(i, vectors[i].tolist(), f"bench-chat-{i % tenants}") for i in range(sample)]
+
+
+def make_queries(points, args):
+    """Returns [(vector, chat_id)]."""
+    rng = np.random.default_rng(0)
+    if args.events:
+        from sentence_transformers import SentenceTransformer
+
+        from bench.loadgen import load_events
+
+        tenants = {chat_id for _, _, chat_id in points}
+        events = [e for e in load_events(args.events) if e['chat_id'] in tenants]
+        events = [events[i] for i in rng.permutation(len(events))[:args.queries]]
+        model = SentenceTransformer('all-MiniLM-L6-v2')
+        vectors = model.encode([e['message'] for e in events])
+        return [(vector.tolist(), e['chat_id']) for vector, e in zip(vectors, events)]
+
+    queries = []
+    for i in rng.choice(len(points), size=min(args.queries, len(points)), replace=False):
+        _, vector, chat_id = points[i]
+        noisy = np.asarray(vector) + rng.standard_normal(len(vector)) * args.noise / np.sqrt(len(vector))
+        queries.append(((noisy / np.linalg.norm(noisy)).tolist(), chat_id))
+    return queries
+
+
+def build_collection(client, name, config, points, per_tenant, timeout_sec, batch_size=256):
+    if client.collection_exists(name):
+        client.delete_collection(name)
+    client.create_collection(
+        collection_name=name,
+        # 少ない点数でも HNSW・量子化を作らせる
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=1),
+        **config.create_kwargs(per_tenant=per_tenant),
+    )
+    client.create_payload_index(
+        collection_name=name,
+        field_name='chat_id',
+        field_schema=KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),
+    )
+    start = time.perf_counter()
+    for offset in range(0, len(points), batch_size):
+        client.upsert(
+            collection_name=name,
+            points=[
+                PointStruct(id=point_id, vector=vector, payload={'chat_id': chat_id})
+                for point_id, vector, chat_id in points[offset:offset + batch_size]
+            ],
+            wait=False,
+        )
+    while time.perf_counter() - start < timeout_sec:
+        if client.get_collection(name).status == CollectionStatus.GREEN:
+            break
+        time.sleep(1)
+    return time.perf_counter() - start
+
+
+def search(client, name, queries, params):
+    results = []
+    latencies = []
+    for vector, chat_id in queries:
+        start = time.perf_counter()
+        hits = client.query_points(
+            collection_name=name,
+            query=vector,
+            query_filter=tenancy.tenant_filter(chat_id),
+            limit=TOP_K,
+            search_params=params,
+            with_payload=False,
+        ).points
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([hit.id for hit in hits])
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--qdrant-url', default='http://localhost:6333')
+    parser.add_argument('--source-collection', default=settings.QDRANT_COLLECTION_NAME)
+    parser.add_argument('--sample', type=int, default=20000, help='コピーするナレッジの点数の上限')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--events', help='実際の質問を使う場合の chatbot_events の書き出し（NDJSON/CSV）')
+    parser.add_argument('--noise', type=float, default=0.5, help='--events が無い場合に質問ベクトルに加える雑音')
+    parser.add_argument('--configs', default=','.join(VARIANTS), help=f"比較する設定（{', '.join(VARIANTS)}）")
+    parser.add_argument('--hnsw-m', type=int, default=settings.QDRANT_HNSW_M)
+    parser.add_argument('--ef-construct', type=int, default=settings.QDRANT_HNSW_EF_CONSTRUCT)
+    parser.add_argument('--search-ef', type=int, default=settings.QDRANT_SEARCH_HNSW_EF)
+    parser.add_argument('--global-graph', action='store_true', help='テナントごとではなく全体の HNSW グラフで作る')
+    parser.add_argument('--index-timeout', type=float, default=600, help='インデックス作成を待つ上限（秒）')
+    parser.add_argument('--keep', action='store_true', help='ベンチマーク用のコレクションを残す')
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    args = parser.parse_args()
+
+    if args.qdrant_url == ':memory:':
+        client = QdrantClient(location=':memory:')
+        points = synthetic_sample(min(args.sample, 2000))
+    else:
+        client = QdrantClient(url=args.qdrant_url, api_key=settings.QDRANT_API_KEY)
+        points = load_sample(client, tenancy.resolve_collection(client, args.source_collection), args.sample)
+    if not points:
+        raise SystemExit(f"no points with vectors in {args.source_collection}")
+    queries = make_queries(points, args)
+    print(f"{len(points)} points, {len(queries)} queries, {len({c for _, _, c in points})} tenants")
+
+    names = [name.strip() for name in args.configs.split(',') if name.strip()]
+    configs = {
+        name: replace(
+            VARIANTS[name],
+            vector_size=len(points[0][1]),
+            hnsw_m=args.hnsw_m,
+            hnsw_ef_construct=args.ef_construct,
+            search_ef=args.search_ef,
+        )
+        for name in names
+    }
+
+    rows = []
+    truth = None
+    print(f"{'config':<18} {'recall@10':>9} {'p50':>7} {'p95':>7} {'ram_mb':>8} {'build_s':>8}")
+    for name, config in configs.items():
+        collection = f"bench_quant_{name.replace('-', '_')}"
+        build_sec = build_collection(client, collection, config, points, not args.global_graph, args.index_timeout)
+        if truth is None:
+            exact = SearchParams(exact=True, quantization=QuantizationSearchParams(ignore=True))
+            truth, _ = search(client, collection, queries, exact)
+        results, latencies = search(client, collection, queries, config.search_params())
+        recall = statistics.mean(
+            len(set(found) & set(expected)) / len(expected) if expected else 1.0
+            for found, expected in zip(results, truth)
+        )
+        row = {
+            'config': name,
+            'recall_at_10': round(recall, 4),
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(_percentile(latencies, 0.95), 2),
+            'ram_mb': round(config.estimated_ram_bytes(len(points)) / 1024 / 1024, 1),
+            'build_sec': round(build_sec, 1),
+            'settings': asdict(config),
+        }
+        rows.append(row)
+        print(
+            f"{name:<18} {row['recall_at_10']:>9} {row['p50_ms']:>7} {row['p95_ms']:>7} "
+            f"{row['ram_mb']:>8} {row['build_sec']:>8}"
+        )
+        if not args.keep:
+            client.delete_collection(collection)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'points': len(points), 'results': rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Gemini のモデル振り分け（ModelRouter）とヘッジのベンチマーク。
+
+FakeGenaiClient でモデルごとの応答時間・エラー率を段階的に変え、AIAgent.think_and_respond の
+応答時間（p50/p95/p99）と各モデルへの呼び出し数をフェーズごとに比較する。
+
+- single: 先頭のモデルのみ（従来の動作）
+- routed: 速いモデルへの振り分けとエラー時の切り替え
+- hedged: routed に加え、--hedge-after-ms 応答がなければ次のモデルにも送る
+
+フェーズ: healthy（通常）→ degraded（先頭のモデルが遅延）→ quota（先頭のモデルがエラー）→ recovered
+
+    cd server
+    python -m bench.bench_router --latency-ms 300 --degraded-latency-ms 3000 --hedge-after-ms 600
+"""
+
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('GEMINI_API_KEY', 'bench')
+
+from ai_agent import AIAgent  # noqa: E402
+from bench.standins import FakeGenaiClient  # noqa: E402
+from model_router import ModelRouter  # noqa: E402
+
+CONTEXT = "営業時間は平日9時から17時です。\n---\n土日祝日は休業です。"
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _phases(args, primary):
+    return [
+        ('healthy', {}, {}),
+        ('degraded', {primary: args.degraded_latency_ms}, {}),
+        ('quota', {}, {primary: 1.0}),
+        ('recovered', {}, {}),
+    ]
+
+
+def run_config(name, models, args, hedge_after):
+    fake = FakeGenaiClient(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    # 2番目以降のモデルは少し遅い（通常時は先頭のモデルが選ばれる）
+    for i, model in enumerate(models[1:], start=1):
+        fake.models.model_latency_ms[model] = args.latency_ms * (1 + 0.5 * i)
+    agent = AIAgent(models=models)
+    agent.client = fake
+    agent.router = ModelRouter(models, window_sec=args.window_sec, hedge_after=hedge_after)
+    base_latency = dict(fake.models.model_latency_ms)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for phase, latency_override, error_override in _phases(args, models[0]):
+            fake.models.model_latency_ms = {**base_latency, **latency_override}
+            fake.models.model_error_rate = dict(error_override)
+            calls_before = dict(fake.models.calls_by_model)
+
+            def one(_):
+                start = time.perf_counter()
+                _, _, _, answer_path, model = agent.think_and_respond(
+                    "営業時間は？", CONTEXT, timeout=args.timeout_ms / 1000
+                )
+                return (time.perf_counter() - start) * 1000, answer_path, model
+
+            samples = list(pool.map(one, range(args.requests)))
+            latencies = [ms for ms, _, _ in samples]
+            calls = {
+                model: fake.models.calls_by_model.get(model, 0) - calls_before.get(model, 0)
+                for model in fake.models.calls_by_model
+            }
+            results.append({
+                'config': name,
+                'phase': phase,
+                'p50_ms': round(statistics.median(latencies)),
+                'p95_ms': round(_percentile(latencies, 0.95)),
+                'p99_ms': round(_percentile(latencies, 0.99)),
+                'llm_answers': sum(1 for _, path, _ in samples if path == 'llm'),
+                'calls': calls,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', default='model-a,model-b', help='comma separated, in priority order')
+    parser.add_argument('--requests', type=int, default=200, help='requests per phase')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--degraded-latency-ms', type=float, default=3000)
+    parser.add_argument('--hedge-after-ms', type=float, default=600)
+    parser.add_argument('--timeout-ms', type=float, default=10000, help='per-request deadline')
+    parser.add_argument('--window-sec', type=float, default=10)
+    args = parser.parse_args()
+
+    models = [m.strip() for m in args.models.split(',') if m.strip()]
+    configs = [
+        ('single', models[:1], 0),
+        ('routed', models, 0),
+        ('hedged', models, args.hedge_after_ms / 1000),
+    ]
+    print(f"{'config':<8} {'phase':<10} {'p50':>6} {'p95':>6} {'p99':>6} {'llm':>5}  calls")
+    for name, config_models, hedge_after in configs:
+        for row in run_config(name, config_models, args, hedge_after):
+            print(
+                f"{row['config']:<8} {row['phase']:<10} {row['p50_ms']:>6} {row['p95_ms']:>6} "
+                f"{row['p99_ms']:>6} {row['llm_answers']:>5}  {row['calls']}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""起動時間のベンチマーク（Cloud Run のゼロからのスケールアウトを想定）。
+
+サーバーをサブプロセスで起動し、起動からの経過時間を計測する。
+
+- import: 別プロセスで `import app` にかかる時間
+- health: GET /health が初めて 200 を返すまで（待ち受けの開始）
+- ready: GET /ready が初めて 200 を返すまで（埋め込みモデル・Qdrant・ドメイン情報の準備の完了）
+- first_chat: 起動と同時に送り始めた POST /api/chat が初めて応答を返すまで
+
+STARTUP_WARMUP_BACKGROUND=false（import 中に準備を終える）と true（バックグラウンドで並行に準備する）を比較する。
+管理API と Gemini はスタンドインを使う。
+
+    cd server
+    python -m bench.bench_startup --server gunicorn --runs 3
+    python -m bench.bench_startup --server uvicorn --qdrant-url http://localhost:6333
+    python -m bench.bench_startup --importtime 20     # import に時間のかかるモジュールの上位 20 件
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench.standins import make_chats, serve_gemini_stub, serve_management_stub
+
+MODES = {'blocking': 'false', 'background': 'true'}
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _server_command(server, port):
+    if server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port)]
+    return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{port}", 'app:app']
+
+
+def measure_import(env):
+    # 準備のスレッドも stdout に出力するため、計測値は stderr に書く
+    code = "import sys, time; t = time.perf_counter(); import app; sys.stderr.write(f'\\nimport_s={time.perf_counter() - t}\\n')"
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=SERVER_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    return next(float(line[len('import_s='):]) for line in out.stderr.splitlines() if line.startswith('import_s='))
+
+
+def import_profile(env, top):
+    """python -X importtime の結果を、トップレベルのパッケージごとの import 時間（self の合計）の順に返す。"""
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app; app.warmup.wait()'],
+        cwd=SERVER_DIR, env={**env, 'STARTUP_WARMUP_BACKGROUND': 'true'}, capture_output=True, text=True,
+    )
+    packages = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        package = name.strip().split('.')[0]
+        if package == 'app':
+            # app 自体の self には準備のスレッドの import も含まれてしまうため除く
+            continue
+        packages[package] = packages.get(package, 0) + int(self_us) / 1e6
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def run_once(args, env, port):
+    """サーバーを起動し、各時点までの経過時間（秒）を返す。"""
+    base = f"http://127.0.0.1:{port}"
+    result = {'health_s': None, 'ready_s': None, 'first_chat_s': None, 'first_chat_status': None}
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        _server_command(args.server, port), cwd=SERVER_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=None if args.show_logs else subprocess.DEVNULL,
+    )
+
+    def first_chat():
+        while time.perf_counter() - start < args.timeout:
+            try:
+                res = requests.post(
+                    f"{base}/api/chat", json={'message': '営業時間を教えてください', 'chat_id': 'bench-chat-0'},
+                    timeout=args.timeout,
+                )
+            except requests.ConnectionError:
+                time.sleep(args.poll_ms / 1000)
+                continue
+            result['first_chat_s'] = time.perf_counter() - start
+            result['first_chat_status'] = res.status_code
+            return
+
+    chat_thread = threading.Thread(target=first_chat, daemon=True)
+    chat_thread.start()
+    try:
+        while time.perf_counter() - start < args.timeout and result['ready_s'] is None:
+            for path, key in (('/health', 'health_s'), ('/ready', 'ready_s')):
+                if result[key] is not None:
+                    continue
+                try:
+                    if requests.get(base + path, timeout=1).status_code == 200:
+                        result[key] = time.perf_counter() - start
+                except requests.RequestException:
+                    break
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode} (rerun with --show-logs)")
+            time.sleep(args.poll_ms / 1000)
+        chat_thread.join(max(0.0, args.timeout - (time.perf_counter() - start)))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return result
+
+
+def _fmt(value):
+    return '-' if value is None else f"{value:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn のワーカー数（WEB_CONCURRENCY）')
+    parser.add_argument('--qdrant-url', default=':memory:')
+    parser.add_argument('--runs', type=int, default=3, help='起動方式ごとの試行回数')
+    parser.add_argument('--timeout', type=float, default=300.0, help='1 回の起動を待つ上限（秒）')
+    parser.add_argument('--poll-ms', type=float, default=20.0)
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='import に時間のかかるパッケージの上位 N 件を表示する')
+    parser.add_argument('--show-logs', action='store_true', help='サーバーのログ（stderr）を表示する')
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    args = parser.parse_args()
+
+    mgmt_server, mgmt_url = serve_management_stub(make_chats(10))
+    gemini_server, gemini_url = serve_gemini_stub(latency_ms=0)
+    cache_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    base_env = {
+        **os.environ,
+        'MGMT_API_BASE_URL': mgmt_url,
+        'GEMINI_BASE_URL': gemini_url,
+        'GEMINI_API_KEY': 'stub',
+        'QDRANT_URL': args.qdrant_url,
+        'WEB_CONCURRENCY': str(args.workers),
+        'EMBEDDING_CACHE_PATH': os.path.join(cache_dir, 'embedding_cache.sqlite3'),
+        'PYTHONUNBUFFERED': '1',
+    }
+    if args.qdrant_url != ':memory:':
+        base_env['QDRANT_COLLECTION_NAME'] = 'bench_startup_context'
+
+    results = []
+    try:
+        if args.importtime:
+            print(f"{'package':<28} {'import s':>12}")
+            for package, seconds in import_profile(base_env, args.importtime):
+                print(f"{package:<28} {seconds:>12.3f}")
+            print()
+
+        print(f"{'mode':<11} {'run':>3} {'import':>8} {'health':>8} {'ready':>8} {'1st chat':>9} {'status':>7}")
+        for mode, background in MODES.items():
+            env = {**base_env, 'STARTUP_WARMUP_BACKGROUND': background}
+            for run in range(args.runs):
+                row = {'mode': mode, 'run': run, 'import_s': measure_import(env)}
+                row.update(run_once(args, env, _free_port()))
+                results.append(row)
+                print(
+                    f"{mode:<11} {run:>3} {_fmt(row['import_s']):>8} {_fmt(row['health_s']):>8} "
+                    f"{_fmt(row['ready_s']):>8} {_fmt(row['first_chat_s']):>9} {row['first_chat_status'] or '-':>7}"
+                )
+
+        print()
+        for mode in MODES:
+            rows = [r for r in results if r['mode'] == mode]
+            medians = {
+                key: statistics.median(values) if values else None
+                for key in ('import_s', 'health_s', 'ready_s', 'first_chat_s')
+                for values in [[r[key] for r in rows if r[key] is not None]]
+            }
+            print(f"{mode:<11} median " + ' '.join(f"{key}={_fmt(value)}" for key, value in medians.items()))
+    finally:
+        mgmt_server.shutdown()
+        gemini_server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
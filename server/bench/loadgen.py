@@ -0,0 +1,379 @@
+"""ChatbotEvent のエクスポートを使った負荷試験・トラフィック再生ツール。
+
+BigQuery の chatbot_events から書き出した行（message_content / chat_id /
+event_timestamp）を使い、実際のクエリ構成で起動中のサーバーに負荷をかける。
+
+    # エクスポート例
+    bq extract --destination_format NEWLINE_DELIMITED_JSON \\
+        'PROJECT:ai_chat_logs.chatbot_events' gs://BUCKET/events.ndjson
+
+    cd server
+    # 1. スタンドイン（Gemini / 管理API）を起動し、表示された環境変数でサーバーを起動
+    python -m bench.standins --events events.ndjson --llm-latency-ms 800 --llm-jitter-ms 400
+    # 2. 過去の応答文をナレッジとして投入（インメモリQdrantでも検索が走るようにする）
+    python -m bench.loadgen seed --events events.ndjson --target http://localhost:8000
+    # 3. 負荷をかける
+    python -m bench.loadgen run --events events.ndjson --target http://localhost:8000 \\
+        --mode closed --concurrency 1,2,4,8,16,32 --duration 30
+    python -m bench.loadgen run --events events.ndjson --target http://localhost:8000 \\
+        --mode open --rates 2,5,10,20 --duration 30
+    python -m bench.loadgen run --events events.ndjson --target http://localhost:8000 \\
+        --mode replay --speedup 20
+
+モード:
+- closed: 同時接続数ごとに、各ワーカーが応答を待ってから次を送る
+- open:   指定レート（req/s）のポアソン到着で送信する。レイテンシは予定送信時刻から
+          計測するため、サーバーが詰まった場合の待ち時間も含まれる
+- replay: event_timestamp の到着間隔を --speedup 倍に縮めて再生する
+
+レベルごとのレイテンシパーセンタイル・エラー率・スループットと、p99 が SLO を
+超える／エラー率が閾値を超える／スループットが伸びなくなる最初のレベル
+（飽和点）を出力する。
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(' UTC', '+00:00').replace('Z', '+00:00')
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def load_events(path):
+    """NDJSON もしくは CSV の ChatbotEvent エクスポートを読み込む。
+
+    chat_request のうち message_content と chat_id を持つ行のみを返し、
+    event_timestamp の昇順に並べる。
+    """
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    events = []
+    for row in rows:
+        if row.get('event_type', 'chat_request') != 'chat_request':
+            continue
+        if not row.get('message_content') or not row.get('chat_id'):
+            continue
+        events.append({
+            'chat_id': row['chat_id'],
+            'message': row['message_content'],
+            'response': row.get('response_content') or '',
+            'ts': _parse_timestamp(row.get('event_timestamp')),
+        })
+    events.sort(key=lambda e: e['ts'] if e['ts'] is not None else 0)
+    return events
+
+
+class _Sender:
+    """スレッドごとに requests.Session を持つ送信器。"""
+
+    def __init__(self, target, timeout, chat_id_override=None):
+        self.url = target.rstrip('/') + '/api/chat'
+        self.timeout = timeout
+        self.chat_id_override = chat_id_override
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def send(self, event, scheduled_at=None):
+        """リクエストを送信し (latency_ms, outcome) を返す。outcome は 'ok' かエラー種別。"""
+        started = scheduled_at if scheduled_at is not None else time.perf_counter()
+        payload = {
+            'message': event['message'],
+            'chat_id': self.chat_id_override or event['chat_id'],
+        }
+        try:
+            res = self._session().post(self.url, json=payload, timeout=self.timeout)
+            outcome = 'ok' if res.status_code < 400 else f"http_{res.status_code}"
+        except requests.Timeout:
+            outcome = 'timeout'
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+        return (time.perf_counter() - started) * 1000, outcome
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return round(ordered[index], 1)
+
+
+def _summarize_level(label, offered, results, elapsed):
+    latencies = [latency for latency, _ in results]
+    ok_latencies = [latency for latency, outcome in results if outcome == 'ok']
+    outcomes = Counter(outcome for _, outcome in results)
+    errors = len(results) - outcomes.get('ok', 0)
+    return {
+        'level': label,
+        'offered': offered,
+        'sent': len(results),
+        'ok': outcomes.get('ok', 0),
+        'errors': dict((k, v) for k, v in outcomes.items() if k != 'ok'),
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'throughput_rps': round(outcomes.get('ok', 0) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(statistics.mean(latencies), 1) if latencies else None,
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': round(max(latencies), 1) if latencies else None,
+        },
+        'ok_latency_p99_ms': _percentile(ok_latencies, 99),
+    }
+
+
+def run_closed(sender, events, concurrency, duration):
+    """同時接続数 concurrency のクローズドループで duration 秒間送信する。"""
+    source = itertools.cycle(events)
+    lock = threading.Lock()
+    results = []
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        local_results = []
+        while time.perf_counter() < deadline:
+            with lock:
+                event = next(source)
+            local_results.append(sender.send(event))
+        with lock:
+            results.extend(local_results)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def _run_schedule(sender, schedule, max_inflight):
+    """(offset_sec, event) の予定に従ってオープンループで送信する。"""
+    results = []
+    lock = threading.Lock()
+
+    def fire(event, scheduled_at):
+        outcome = sender.send(event, scheduled_at=scheduled_at)
+        with lock:
+            results.append(outcome)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        for offset, event in schedule:
+            scheduled_at = started + offset
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(fire, event, scheduled_at)
+    return results, time.perf_counter() - started
+
+
+def run_open(sender, events, rate, duration, max_inflight, seed=0):
+    """平均 rate req/s のポアソン到着で duration 秒間送信する。"""
+    rng = random.Random(seed)
+    schedule = []
+    offset = 0.0
+    source = itertools.cycle(events)
+    while True:
+        offset += rng.expovariate(rate)
+        if offset >= duration:
+            break
+        schedule.append((offset, next(source)))
+    return _run_schedule(sender, schedule, max_inflight)
+
+
+def run_replay(sender, events, speedup, max_inflight, limit=None):
+    """event_timestamp の到着間隔を speedup 倍速で再生する。"""
+    timed = [e for e in events if e['ts'] is not None]
+    if limit:
+        timed = timed[:limit]
+    if not timed:
+        return [], 0.0
+    origin = timed[0]['ts']
+    schedule = [((e['ts'] - origin) / speedup, e) for e in timed]
+    return _run_schedule(sender, schedule, max_inflight)
+
+
+def find_saturation(levels, slo_p99_ms, max_error_rate, min_gain=0.05):
+    """飽和点（最初に SLO・エラー率・スループットの伸びの条件を満たさなくなったレベル）を返す。"""
+    previous = None
+    for level in levels:
+        p99 = level['latency_ms']['p99']
+        if slo_p99_ms and p99 is not None and p99 > slo_p99_ms:
+            return {'level': level['level'], 'reason': f"p99 {p99}ms > SLO {slo_p99_ms}ms"}
+        if level['error_rate'] > max_error_rate:
+            return {'level': level['level'], 'reason': f"error rate {level['error_rate']:.2%} > {max_error_rate:.2%}"}
+        if previous and previous['throughput_rps'] > 0:
+            gain = (level['throughput_rps'] - previous['throughput_rps']) / previous['throughput_rps']
+            if gain < min_gain:
+                return {
+                    'level': level['level'],
+                    'reason': f"throughput gain {gain:+.1%} vs {previous['level']}",
+                }
+        previous = level
+    return None
+
+
+def _print_levels(levels, saturation):
+    print(f"{'level':<18} {'sent':>6} {'ok':>6} {'err%':>7} {'rps':>8} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for level in levels:
+        lat = level['latency_ms']
+        print(
+            f"{level['level']:<18} {level['sent']:>6} {level['ok']:>6} {level['error_rate'] * 100:>6.2f}% "
+            f"{level['throughput_rps']:>8} {lat['p50']!s:>8} {lat['p90']!s:>8} {lat['p95']!s:>8} "
+            f"{lat['p99']!s:>8} {lat['max']!s:>8}"
+        )
+        if level['errors']:
+            print(f"{'':<18} errors: {level['errors']}")
+    if saturation:
+        print(f"\nSaturation: {saturation['level']} ({saturation['reason']})")
+    else:
+        print("\nSaturation: not reached")
+
+
+def command_run(args):
+    events = load_events(args.events)
+    if not events:
+        raise SystemExit(f"No usable chat_request rows in {args.events}")
+    sender = _Sender(args.target, args.timeout, args.chat_id)
+
+    levels = []
+    if args.mode == 'closed':
+        for concurrency in args.concurrency:
+            results, elapsed = run_closed(sender, events, concurrency, args.duration)
+            levels.append(_summarize_level(f"concurrency={concurrency}", concurrency, results, elapsed))
+            _cooldown(args.cooldown)
+    elif args.mode == 'open':
+        for rate in args.rates:
+            results, elapsed = run_open(sender, events, rate, args.duration, args.max_inflight, seed=args.seed)
+            levels.append(_summarize_level(f"rate={rate}/s", rate, results, elapsed))
+            _cooldown(args.cooldown)
+    else:
+        results, elapsed = run_replay(sender, events, args.speedup, args.max_inflight, args.limit)
+        levels.append(_summarize_level(f"replay x{args.speedup}", args.speedup, results, elapsed))
+
+    saturation = find_saturation(levels, args.slo_p99_ms, args.max_error_rate)
+    _print_levels(levels, saturation)
+
+    if args.output:
+        report = {
+            'target': args.target,
+            'mode': args.mode,
+            'events_file': args.events,
+            'event_count': len(events),
+            'duration_sec': args.duration,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'levels': levels,
+            'saturation': saturation,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Saved report to {args.output}")
+
+
+def _cooldown(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def command_seed(args):
+    """過去の応答文を /api/add_knowledge でチャットごとに投入する。"""
+    events = load_events(args.events)
+    per_chat = Counter()
+    url = args.target.rstrip('/') + '/api/add_knowledge'
+    session = requests.Session()
+    added = 0
+    for event in events:
+        if not event['response'] or per_chat[event['chat_id']] >= args.docs_per_chat:
+            continue
+        res = session.post(url, json={
+            'chat_id': event['chat_id'],
+            'title': event['message'][:80],
+            'content': event['response'],
+        }, timeout=args.timeout)
+        if res.ok:
+            per_chat[event['chat_id']] += 1
+            added += 1
+        else:
+            print(f"seed failed for {event['chat_id']}: {res.status_code} {res.text[:200]}")
+    print(f"Seeded {added} documents across {len(per_chat)} chats")
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def _float_list(value):
+    return [float(x) for x in value.split(',') if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='負荷をかけて結果を集計する')
+    run.add_argument('--events', required=True)
+    run.add_argument('--target', default='http://localhost:8000')
+    run.add_argument('--mode', choices=('closed', 'open', 'replay'), default='closed')
+    run.add_argument('--concurrency', type=_int_list, default=[1, 2, 4, 8, 16, 32])
+    run.add_argument('--rates', type=_float_list, default=[1, 2, 5, 10, 20])
+    run.add_argument('--speedup', type=float, default=1.0)
+    run.add_argument('--limit', type=int, help='replay で再生する最大イベント数')
+    run.add_argument('--duration', type=float, default=30, help='各レベルの計測秒数')
+    run.add_argument('--cooldown', type=float, default=2, help='レベル間の待ち時間（秒）')
+    run.add_argument('--max-inflight', type=int, default=512, help='open/replay で同時に保持する最大リクエスト数')
+    run.add_argument('--timeout', type=float, default=60)
+    run.add_argument('--chat-id', help='全リクエストをこの chat_id に送る')
+    run.add_argument('--slo-p99-ms', type=float, default=5000)
+    run.add_argument('--max-error-rate', type=float, default=0.01)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='レポート JSON の保存先')
+    run.set_defaults(func=command_run)
+
+    seed = subparsers.add_parser('seed', help='過去の応答文をナレッジとして投入する')
+    seed.add_argument('--events', required=True)
+    seed.add_argument('--target', default='http://localhost:8000')
+    seed.add_argument('--docs-per-chat', type=int, default=50)
+    seed.add_argument('--timeout', type=float, default=60)
+    seed.set_defaults(func=command_seed)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
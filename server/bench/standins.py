@@ -0,0 +1,432 @@
+"""ベンチマーク・負荷試験用のローカルスタンドイン。
+
+外部サービス（Gemini / 管理API / 共有キャッシュの Redis）を使わずにチャットパイプラインを動かすための
+フェイク実装をまとめる。Qdrant はインメモリモード（QDRANT_URL=":memory:"）を使う。
+
+負荷試験では HTTP のスタンドインを起動し、表示される環境変数でサーバーを起動する。
+
+    cd server
+    python -m bench.standins --events events.ndjson --llm-latency-ms 800 --llm-jitter-ms 400
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+
+VECTOR_SIZE = 384
+
+
+class _FakeModels:
+    def __init__(self, latency_ms, jitter_ms, error_rate):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # モデルごとの上書き（ベンチマーク中に書き換えて劣化を再現する）
+        self.model_latency_ms = {}
+        self.model_error_rate = {}
+        self.calls = 0
+        self.calls_by_model = {}
+        self._lock = threading.Lock()
+
+    def _next_delay(self, model=None):
+        with self._lock:
+            self.calls += 1
+            self.calls_by_model[model] = self.calls_by_model.get(model, 0) + 1
+        latency_ms = self.model_latency_ms.get(model, self.latency_ms)
+        return (latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+    def _respond(self, model, contents):
+        error_rate = self.model_error_rate.get(model, self.error_rate)
+        if error_rate and random.random() < error_rate:
+            from google.api_core.exceptions import ResourceExhausted
+            raise ResourceExhausted("fake quota exhausted")
+        prompt = contents if isinstance(contents, str) else str(contents)
+        text = f"[{model}] fake answer ({len(prompt)} chars of prompt)"
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=len(prompt) // 4,
+                candidates_token_count=len(text) // 4,
+            ),
+        )
+
+    def generate_content(self, model, contents, config=None):
+        delay = self._next_delay(model)
+        if delay > 0:
+            time.sleep(delay)
+        return self._respond(model, contents)
+
+
+class _FakeAsyncModels:
+    def __init__(self, models):
+        self._models = models
+
+    async def generate_content(self, model, contents, config=None):
+        delay = self._models._next_delay(model)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self._models._respond(model, contents)
+
+
+class FakeGenaiClient:
+    """genai.Client の代わりに使うフェイク。models.generate_content（と aio 版）のみ実装する。"""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0):
+        self.models = _FakeModels(latency_ms, jitter_ms, error_rate)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(self.models))
+
+
+class FakeEmbedder:
+    """テキストのハッシュから決定的なベクトルを返す SentenceTransformer の代替。"""
+
+    def __init__(self, vector_size=VECTOR_SIZE):
+        self.vector_size = vector_size
+
+    def _encode_one(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.vector_size).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get_sentence_embedding_dimension(self):
+        return self.vector_size
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str):
+            return self._encode_one(sentences)
+        return np.stack([self._encode_one(s) for s in sentences])
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 負荷試験で多数の接続が同時に来ても取りこぼさないよう listen backlog を広げる
+    request_queue_size = 1024
+
+
+def make_chats(count):
+    """管理API の /api/chats が返す形式のチャット一覧を生成する。"""
+    return [
+        {
+            "id": f"bench-chat-{i}",
+            "target": f"bench{i}.example.com",
+            "targets": [f"bench{i}.example.com"],
+            "target_type": "web",
+            "display_name": f"Bench chat {i}",
+            "system_prompt": "",
+        }
+        for i in range(count)
+    ]
+
+
+def serve_management_stub(chats, host='127.0.0.1', port=0, latency_ms=0):
+    """DomainRegistry が参照する管理API のスタブを別スレッドで起動する。
+
+    Returns (server, base_url)。終了時は server.shutdown() を呼ぶ。
+    """
+    body = json.dumps({"chats": chats}).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/api/chats':
+                self.send_error(404)
+                return
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _StubServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def serve_gemini_stub(host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, error_rate=0.0):
+    """Gemini API（generateContent）のスタブを別スレッドで起動する。
+
+    GEMINI_BASE_URL に返り値の base_url を設定すると AIAgent がこのスタブを呼ぶ。
+    error_rate の割合で 429 RESOURCE_EXHAUSTED を返す。
+    Returns (server, base_url)。
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            prompt_length = len(self.rfile.read(length))
+            if ':generateContent' not in self.path:
+                self.send_error(404)
+                return
+
+            delay_ms = latency_ms + random.uniform(0, jitter_ms)
+            if delay_ms > 0:
+                time.sleep(delay_ms / 1000)
+
+            if error_rate and random.random() < error_rate:
+                status = 429
+                payload = {"error": {"code": 429, "message": "stub quota exhausted", "status": "RESOURCE_EXHAUSTED"}}
+            else:
+                status = 200
+                text = f"スタブ応答です（プロンプト {prompt_length} バイト）。"
+                payload = {
+                    "candidates": [{
+                        "content": {"parts": [{"text": text}], "role": "model"},
+                        "finishReason": "STOP",
+                        "index": 0,
+                    }],
+                    "usageMetadata": {
+                        "promptTokenCount": prompt_length // 4,
+                        "candidatesTokenCount": len(text),
+                        "totalTokenCount": prompt_length // 4 + len(text),
+                    },
+                }
+
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _StubServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def _resp(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, Exception):
+        return b'-ERR %s\r\n' % str(value).encode('utf-8')
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode('utf-8')
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(_resp(v) for v in value)
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _read_command(reader):
+    """クライアントのコマンド（バルク文字列の配列）を 1 つ読む。Returns [bytes] or None（切断）。"""
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        raise ValueError('protocol error')
+    args = []
+    for _ in range(int(line[1:])):
+        header = reader.readline()
+        if not header.startswith(b'$'):
+            raise ValueError('protocol error')
+        size = int(header[1:])
+        data = reader.read(size + 2)
+        if len(data) != size + 2:
+            return None
+        args.append(data[:-2])
+    return args
+
+
+class _RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_resp_stub(host='127.0.0.1', port=0, latency_ms=0):
+    """共有キャッシュ（SHARED_CACHE_URL）の Redis 互換スタブを別スレッドで起動する。
+
+    shared_cache（redis-py）が使うコマンド（GET / MGET / SET EX NX / DEL / INCR(BY) / PUBLISH / SUBSCRIBE など）を
+    メモリ上で実装する。latency_ms はコマンドごとの遅延。
+    Returns (server, url)。server.store で保存されている値、server.subscribers で購読中のチャンネルを参照できる。
+    """
+    store = {}  # key -> (value, expires_at)
+    subscribers = {}  # channel -> {handler}
+    lock = threading.Lock()
+
+    def live(key, now):
+        item = store.get(key)
+        if item and item[1] is not None and item[1] <= now:
+            del store[key]
+            return None
+        return item
+
+    def execute(handler, name, args):
+        now = time.monotonic()
+        with lock:
+            if name in ('AUTH', 'SELECT', 'CLIENT'):
+                return 'OK'
+            if name == 'PING':
+                return [b'pong', b''] if handler.channels else 'PONG'
+            if name == 'GET':
+                item = live(args[0], now)
+                return item[0] if item else None
+            if name == 'MGET':
+                return [(live(k, now) or (None,))[0] for k in args]
+            if name == 'SET':
+                options = [a.upper() for a in args[2:]]
+                ttl = int(options[options.index(b'EX') + 1]) if b'EX' in options else None
+                if b'NX' in options and live(args[0], now):
+                    return None
+                store[args[0]] = (args[1], now + ttl if ttl else None)
+                return 'OK'
+            if name == 'DEL':
+                return sum(1 for k in args if live(k, now) and store.pop(k))
+            if name in ('INCR', 'INCRBY'):
+                item = live(args[0], now)
+                value = int(item[0] if item else 0) + (int(args[1]) if name == 'INCRBY' else 1)
+                store[args[0]] = (str(value).encode(), item[1] if item else None)
+                return value
+            if name == 'EXPIRE':
+                item = live(args[0], now)
+                if item:
+                    store[args[0]] = (item[0], now + int(args[1]))
+                return 1 if item else 0
+            if name == 'FLUSHALL':
+                store.clear()
+                return 'OK'
+            if name == 'DBSIZE':
+                return sum(1 for k in list(store) if live(k, now))
+            if name == 'PUBLISH':
+                receivers = list(subscribers.get(args[0], ()))
+            elif name == 'SUBSCRIBE':
+                for channel in args:
+                    subscribers.setdefault(channel, set()).add(handler)
+                    handler.channels.add(channel)
+                return [[b'subscribe', channel, len(handler.channels)] for channel in args]
+            else:
+                return ValueError(f"unknown command '{name}'")
+        for receiver in receivers:
+            receiver.send([b'message', args[0], args[1]])
+        return len(receivers)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def setup(self):
+            super().setup()
+            self.channels = set()
+            self.write_lock = threading.Lock()
+
+        def send(self, value):
+            try:
+                with self.write_lock:
+                    self.wfile.write(_resp(value))
+            except OSError:
+                pass
+
+        def handle(self):
+            try:
+                while True:
+                    command = _read_command(self.rfile)
+                    if command is None:
+                        return
+                    if not command:
+                        self.send(ValueError('protocol error'))
+                        return
+                    if latency_ms:
+                        time.sleep(latency_ms / 1000)
+                    name = command[0].decode().upper()
+                    result = execute(self, name, command[1:])
+                    # SUBSCRIBE はチャンネルごとに応答する
+                    for reply in (result if name == 'SUBSCRIBE' else [result]):
+                        self.send(reply)
+            except (ConnectionError, OSError, ValueError):
+                pass
+            finally:
+                with lock:
+                    for channel in self.channels:
+                        subscribers.get(channel, set()).discard(self)
+
+    server = _RespServer((host, port), Handler)
+    server.store = store
+    server.subscribers = subscribers
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"redis://{host}:{server.server_address[1]}/0"
+
+
+def chats_from_events(events):
+    """ChatbotEvent の chat_id から管理API スタブ用のチャット一覧を作る。"""
+    chat_ids = sorted({e['chat_id'] for e in events if e.get('chat_id')})
+    return [
+        {
+            "id": chat_id,
+            "target": f"{chat_id}.example.com",
+            "targets": [f"{chat_id}.example.com"],
+            "target_type": "web",
+            "display_name": chat_id,
+            "system_prompt": "",
+        }
+        for chat_id in chat_ids
+    ]
+
+
+def random_unit_vectors(count, vector_size=VECTOR_SIZE, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, vector_size)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--mgmt-port', type=int, default=8787)
+    parser.add_argument('--gemini-port', type=int, default=8788)
+    parser.add_argument('--events', help='chat_id を取り出す ChatbotEvent のエクスポート（NDJSON/CSV）')
+    parser.add_argument('--chats', type=int, default=10, help='--events 未指定時に生成するチャット数')
+    parser.add_argument('--llm-latency-ms', type=float, default=500)
+    parser.add_argument('--llm-jitter-ms', type=float, default=0)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--resp-port', type=int, default=0, help='共有キャッシュの Redis 互換スタブのポート（0 なら起動しない）')
+    args = parser.parse_args()
+
+    if args.events:
+        from bench.loadgen import load_events
+        chats = chats_from_events(load_events(args.events))
+    else:
+        chats = make_chats(args.chats)
+
+    mgmt_server, mgmt_url = serve_management_stub(chats, host=args.host, port=args.mgmt_port)
+    gemini_server, gemini_url = serve_gemini_stub(
+        host=args.host,
+        port=args.gemini_port,
+        latency_ms=args.llm_latency_ms,
+        jitter_ms=args.llm_jitter_ms,
+        error_rate=args.llm_error_rate,
+    )
+    resp_server, resp_url = serve_resp_stub(host=args.host, port=args.resp_port) if args.resp_port else (None, None)
+    print(f"Management API stub: {mgmt_url} ({len(chats)} chats)")
+    print(f"Gemini stub:         {gemini_url}")
+    if resp_server:
+        print(f"Shared cache stub:   {resp_url}")
+    print("\nStart the server against the stand-ins with:")
+    shared_env = f" SHARED_CACHE_URL={resp_url}" if resp_server else ""
+    print(
+        f"  MGMT_API_BASE_URL={mgmt_url} GEMINI_BASE_URL={gemini_url} GEMINI_API_KEY=stub QDRANT_URL=:memory:"
+        f"{shared_env} python app.py"
+    )
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mgmt_server.shutdown()
+        gemini_server.shutdown()
+        if resp_server:
+            resp_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,25 @@
 """BigQuery logging module for chat events."""
 
+import atexit
 import os
 import threading
 import uuid
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
-from queue import Empty, Queue
+from queue import Empty, Full, Queue
 from typing import Optional
 
 import sentry_sdk
 
+from metrics import BQ_EVENTS_DROPPED
+
 # Environment variables
 BQ_ENABLED = os.getenv('BQ_ENABLED', 'false').lower() == 'true'
 GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID', '')
 BQ_DATASET_ID = os.getenv('BQ_DATASET_ID', 'ai_chat_logs')
 BQ_BATCH_SIZE = int(os.getenv('BQ_BATCH_SIZE', '100'))
 BQ_FLUSH_INTERVAL_SEC = int(os.getenv('BQ_FLUSH_INTERVAL_SEC', '10'))
+BQ_MAX_QUEUE_SIZE = int(os.getenv('BQ_MAX_QUEUE_SIZE', '10000'))
 
 
 @dataclass
@@ -44,6 +48,9 @@ class ChatbotEvent:
     error_message: Optional[str] = None
     total_duration_ms: Optional[int] = None
     client_ip: Optional[str] = None
+    slowest_stage: Optional[str] = None
+    coalesced: Optional[bool] = None
+    answer_path: Optional[str] = None
 
     def to_dict(self) -> dict:
         """Convert to dictionary, filtering out None values for optional fields."""
@@ -63,12 +70,13 @@ class BigQueryLogger:
         dataset_id: str,
         batch_size: int = 100,
         flush_interval: int = 10,
+        max_queue_size: int = 10000,
     ):
         self.project_id = project_id
         self.dataset_id = dataset_id
         self.batch_size = batch_size
         self.flush_interval = flush_interval
-        self._queue: Queue = Queue()
+        self._queue: Queue = Queue(maxsize=max_queue_size)
         self._client = None
         self._enabled = False
         self._shutdown = False
@@ -102,7 +110,10 @@ class BigQueryLogger:
         """Background loop to flush events periodically."""
         while not self._shutdown:
             try:
-                self._flush_batch()
+                # Keep draining while full batches are available so the queue
+                # does not fall behind (and start dropping) under load.
+                while self._flush_batch() >= self.batch_size and not self._shutdown:
+                    pass
             except Exception as e:
                 print(f"BigQuery flush error: {e}")
                 sentry_sdk.capture_exception(e)
@@ -113,8 +124,8 @@ class BigQueryLogger:
                     break
                 threading.Event().wait(0.1)
 
-    def _flush_batch(self):
-        """Flush accumulated events to BigQuery."""
+    def _flush_batch(self) -> int:
+        """Flush accumulated events to BigQuery. Returns the number of events taken."""
         if not self._enabled or not self._client:
             # Drain queue if disabled
             while not self._queue.empty():
@@ -122,7 +133,7 @@ class BigQueryLogger:
                     self._queue.get_nowait()
                 except Empty:
                     break
-            return
+            return 0
 
         events = []
         while len(events) < self.batch_size:
@@ -133,7 +144,7 @@ class BigQueryLogger:
                 break
 
         if not events:
-            return
+            return 0
 
         # Group events by table
         by_table: dict = {}
@@ -148,6 +159,7 @@ class BigQueryLogger:
                 table_ref = f"{self.project_id}.{self.dataset_id}.{table_id}"
                 errors = self._client.insert_rows_json(table_ref, rows)
                 if errors:
+                    BQ_EVENTS_DROPPED.inc(len(errors), reason='insert_error')
                     print(f"BigQuery insert errors for {table_id}: {errors[:3]}")
                     sentry_sdk.capture_message(
                         f"BigQuery insert errors for {table_id}",
@@ -161,14 +173,20 @@ class BigQueryLogger:
                 else:
                     print(f"BigQuery: inserted {len(rows)} rows into {table_id}")
             except Exception as e:
+                BQ_EVENTS_DROPPED.inc(len(rows), reason='insert_failed')
                 print(f"BigQuery insert failed for {table_id}: {e}")
                 sentry_sdk.capture_exception(e)
 
+        return len(events)
+
     def log_chat_event(self, event: ChatbotEvent):
         """Queue a chatbot event for logging."""
         if not self._enabled:
             return
-        self._queue.put(('chatbot_events', event.to_dict()))
+        try:
+            self._queue.put_nowait(('chatbot_events', event.to_dict()))
+        except Full:
+            BQ_EVENTS_DROPPED.inc(reason='queue_full')
 
     def shutdown(self):
         """Gracefully shutdown the logger, flushing remaining events."""
@@ -192,10 +210,22 @@ def get_logger() -> Optional[BigQueryLogger]:
             dataset_id=BQ_DATASET_ID,
             batch_size=BQ_BATCH_SIZE,
             flush_interval=BQ_FLUSH_INTERVAL_SEC,
+            max_queue_size=BQ_MAX_QUEUE_SIZE,
         )
     return _logger
 
 
+def shutdown_logger():
+    """Flush and stop the global logger (called on worker exit)."""
+    global _logger
+    if _logger is not None:
+        _logger.shutdown()
+        _logger = None
+
+
+atexit.register(shutdown_logger)
+
+
 def create_chat_event(
     chat_id: str,
     event_type: str = 'chat_request',
@@ -232,6 +262,9 @@ def log_chat_request(
     client_ip: Optional[str] = None,
     tokens_input: Optional[int] = None,
     tokens_output: Optional[int] = None,
+    slowest_stage: Optional[str] = None,
+    coalesced: bool = False,
+    answer_path: Optional[str] = None,
 ):
     """Convenience function to log a chat request event."""
     logger = get_logger()
@@ -260,5 +293,8 @@ def log_chat_request(
         client_ip=client_ip,
         tokens_input=tokens_input,
         tokens_output=tokens_output,
+        slowest_stage=slowest_stage,
+        coalesced=coalesced,
+        answer_path=answer_path,
     )
     logger.log_chat_event(event)
@@ -0,0 +1,399 @@
+"""Chat pipeline steps shared by the Flask and ASGI /api/chat handlers.
+
+app.chat()（WSGI）と asgi.py（asyncio）で共通の処理（リクエストから取り出す値、検索フィルター、
+コンテキストの組み立て、ログ出力、レスポンスの形、BigQuery と Sentry への記録）をまとめる。
+I/O の呼び出し方だけが各ハンドラーで異なる。
+"""
+
+import logging
+import math
+import os
+import time
+import unicodedata
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Optional
+
+import sentry_sdk
+from qdrant_client.http.models import FieldCondition, Filter, MatchValue, PayloadSelectorInclude, SearchRequest
+
+import request_state
+import settings
+import structured_logging as slog
+import tracing
+from admission import AdmissionRejected, controller as admission_controller
+from ai_agent import ANSWER_CACHED, ANSWER_LLM
+from bq_logger import log_chat_request
+from collection_config import CONFIG as COLLECTION_CONFIG
+from metrics import CHAT_COALESCED, CHAT_DEADLINE_EXCEEDED
+from singleflight import SingleFlight
+from timing import get_stage_timings, stage
+
+SEARCH_LIMIT = 10
+CONTEXT_SCORE_THRESHOLD = 0.05
+# 検索結果から使うペイロードのフィールド（build_context が参照するもののみ転送させる）
+SEARCH_PAYLOAD_FIELDS = ['text', 'title']
+# 質問のバリエーションとして末尾から取り除く言い回し（長いものから順に試す）
+_QUESTION_SUFFIXES = sorted(
+    ['について教えてください', 'を教えてください', 'を教えて', 'を知りたいです', 'はありますか', 'ですか', 'でしょうか', 'とは'],
+    key=len,
+    reverse=True,
+)
+
+
+@dataclass
+class ChatRequest:
+    """/api/chat のリクエストのうち、パイプラインと BigQuery のログに使う値。"""
+    query: str = ""
+    origin_domain: Optional[str] = None
+    user_agent: Optional[str] = None
+    client_ip: Optional[str] = None
+
+
+@dataclass
+class ContextResult:
+    context: str = ""
+    context_found: bool = False
+    sources_count: int = 0
+    top_score: Optional[float] = None
+
+
+@dataclass
+class PipelineResult:
+    """検索から LLM 応答までの結果。同時に届いた同一の質問の間で共有される。"""
+    response: str = ""
+    context: ContextResult = field(default_factory=ContextResult)
+    vector_search_duration_ms: Optional[int] = None
+    llm_request_duration_ms: Optional[int] = None
+    tokens_input: Optional[int] = None
+    tokens_output: Optional[int] = None
+    admission_error: Optional[AdmissionRejected] = None
+    answer_path: Optional[str] = None
+    llm_model: Optional[str] = None
+    # 共有キャッシュを引いた時点のナレッジの世代（回答はこの世代で保存する）
+    cache_generation: Optional[int] = None
+
+
+_flights = SingleFlight()
+
+
+def request_body(data):
+    """読み込んだ JSON の本文。オブジェクトでない（読めない）本文は空の本文として扱う。"""
+    return data if isinstance(data, dict) else {}
+
+
+def chat_request(data, headers, remote_addr):
+    """リクエスト本文（dict）とヘッダーから ChatRequest を作る。
+
+    headers は小文字の名前で引ける mapping（Flask の request.headers か ASGI のヘッダーの dict）。
+    """
+    return ChatRequest(
+        query=data.get('message', ''),
+        origin_domain=data.get('parent_origin') or headers.get('x-original-origin') or headers.get('origin'),
+        user_agent=headers.get('user-agent'),
+        client_ip=client_ip(headers.get('x-forwarded-for'), remote_addr),
+    )
+
+
+def search_filter(chat_id):
+    """チャットのナレッジ（会話ログ以外）に絞り込むフィルター。"""
+    return Filter(
+        must=[
+            FieldCondition(
+                key="chat_id",
+                match=MatchValue(value=chat_id),
+            )
+        ],
+        must_not=[
+            FieldCondition(
+                key="type",
+                match=MatchValue(value="chat"),
+            )
+        ],
+    )
+
+
+def query_variants(query, limit=None):
+    """検索に使う質問のバリエーション（先頭は元の質問）。最大 limit（既定 CHAT_QUERY_VARIANTS）件。
+
+    表記ゆれ（全角/半角）と文末の疑問の言い回しを除いたものを加える。
+    """
+    limit = settings.CHAT_QUERY_VARIANTS if limit is None else limit
+    variants = [query]
+    normalized = unicodedata.normalize('NFKC', query).strip().rstrip('?？。.!！ ')
+    stripped = normalized
+    for suffix in _QUESTION_SUFFIXES:
+        if stripped.endswith(suffix) and len(stripped) > len(suffix):
+            stripped = stripped[:-len(suffix)]
+            break
+    for variant in (normalized, stripped):
+        if variant and variant not in variants:
+            variants.append(variant)
+    return variants[:max(1, limit)]
+
+
+def search_requests(query_vectors, chat_id, shard_key=None):
+    """質問ベクトルごとの検索リクエスト（search_batch で 1 往復にまとめて送る）。
+
+    shard_key はテナントの配置（tenancy.Target）のシャードキー。
+    """
+    query_filter = search_filter(chat_id)
+    with_payload = PayloadSelectorInclude(include=SEARCH_PAYLOAD_FIELDS)
+    params = COLLECTION_CONFIG.search_params()
+    return [
+        SearchRequest(
+            vector=vector,
+            filter=query_filter,
+            limit=SEARCH_LIMIT,
+            with_payload=with_payload,
+            shard_key=shard_key,
+            params=params,
+        )
+        for vector in query_vectors
+    ]
+
+
+def merge_search_results(batches):
+    """search_batch の結果を 1 つにまとめる（同じ点は最も高いスコアを採用し、スコア順に SEARCH_LIMIT 件）。"""
+    if len(batches) == 1:
+        return batches[0]
+    best = {}
+    for hits in batches:
+        for point in hits:
+            current = best.get(point.id)
+            if current is None or point.score > current.score:
+                best[point.id] = point
+    return sorted(best.values(), key=lambda point: point.score, reverse=True)[:SEARCH_LIMIT]
+
+
+def build_context(search_result, chat_id):
+    """検索結果からしきい値を超えた候補を連結して LLM に渡すコンテキストを作る。"""
+    result = ContextResult()
+    if search_result:
+        result.top_score = search_result[0].score
+        context_items = [
+            point.payload.get('text', '') for point in search_result if point.score > CONTEXT_SCORE_THRESHOLD
+        ]
+        if context_items:
+            result.context = "\n---\n".join(context_items)
+            result.context_found = True
+            result.sources_count = len(context_items)
+
+    # 候補ごとの詳細は DEBUG のときだけ組み立てる
+    if slog.is_enabled_for(logging.DEBUG):
+        slog.debug(
+            "vector_candidates",
+            chat_id=chat_id,
+            candidates=[
+                {
+                    "score": round(point.score, 3),
+                    "title": point.payload.get('title', 'No title'),
+                    "text_length": len(point.payload.get('text', '')),
+                    "added": point.score > CONTEXT_SCORE_THRESHOLD,
+                }
+                for point in search_result
+            ],
+        )
+    slog.info(
+        "vector_search",
+        chat_id=chat_id,
+        candidates=len(search_result),
+        context_items=result.sources_count,
+        context_length=len(result.context),
+        top_score=result.top_score,
+    )
+    return result
+
+
+def log_llm_input(query, system_prompt, context, context_found):
+    # === デバッグログ: LLMに渡す値（プレビューを含むためサンプリング） ===
+    slog.info(
+        "llm_input",
+        sampled=True,
+        query=query,
+        system_prompt_preview=system_prompt[:300] if system_prompt else None,
+        system_prompt_length=len(system_prompt) if system_prompt else 0,
+        context_found=context_found,
+        context_length=len(context),
+        context_preview=context[:500] if context else None,
+    )
+
+
+def response_payload(response, context_found, sources_count, chat_id):
+    response_data = {
+        'response': response,
+        'context_found': context_found,
+        'sources_used': sources_count,
+    }
+    if os.getenv('FLASK_ENV') == 'development':
+        response_data['chat_id'] = chat_id
+    return response_data
+
+
+def request_deadline(chat_entry, start_time):
+    """リクエストの期限（time.time() 基準）。チャットの deadline_ms、未設定なら CHAT_DEADLINE_MS。"""
+    budget_ms = chat_entry.get('deadline_ms') or settings.CHAT_DEADLINE_MS
+    return start_time + budget_ms / 1000
+
+
+def remaining(deadline):
+    """期限までの残り時間（秒）。"""
+    return deadline - time.time()
+
+
+def search_timeout(deadline):
+    """Qdrant に渡すサーバー側のタイムアウト（整数秒、最低 1 秒）。"""
+    return max(1, math.ceil(remaining(deadline)))
+
+
+def record_deadline_exceeded(stage):
+    CHAT_DEADLINE_EXCEEDED.inc(stage=stage)
+    slog.warning("deadline_exceeded", stage=stage)
+
+
+def admission(chat_entry, context, deadline):
+    """Gemini を呼ぶ場合（コンテキストがある場合）のみアドミッション制御を通す（待つのは期限まで）。"""
+    if not context.strip():
+        return nullcontext()
+    return admission_controller.admit(chat_entry, max_wait=remaining(deadline))
+
+
+def admission_async(chat_entry, context, deadline):
+    if not context.strip():
+        return nullcontext()
+    return admission_controller.admit_async(chat_entry, max_wait=remaining(deadline))
+
+
+def should_reject(admission_error):
+    """アドミッションで拒否された場合に 429 を返すか（false なら抜粋で応答する）。"""
+    return admission_error is not None and not settings.ADMISSION_FALLBACK
+
+
+def rejection_response(admission_error):
+    """Returns (payload, status, headers) for a request rejected by admission control."""
+    retry_after = max(1, math.ceil(admission_error.retry_after))
+    payload = {'error': '現在アクセスが集中しています。しばらくしてから再度お試しください。'}
+    return payload, 429, {'Retry-After': str(retry_after)}
+
+
+def cached_answer(shared_cache, chat_id, system_prompt, query):
+    """共有キャッシュを引く。
+
+    Returns PipelineResult（キャッシュにあれば answer_path が ANSWER_CACHED。なければ空の結果に
+    引いた時点の世代を入れて返し、store_answer() はその世代で保存する）。
+    """
+    generation = shared_cache.answer_generation(chat_id)
+    answer = shared_cache.get_answer(chat_id, generation, system_prompt, query)
+    if not answer or not isinstance(answer.get('response'), str):
+        return PipelineResult(cache_generation=generation)
+    return PipelineResult(
+        response=answer['response'],
+        context=ContextResult(
+            context_found=bool(answer.get('context_found')),
+            sources_count=answer.get('sources_count') or 0,
+            top_score=answer.get('top_score'),
+        ),
+        answer_path=ANSWER_CACHED,
+        llm_model=answer.get('llm_model'),
+        cache_generation=generation,
+    )
+
+
+def store_answer(shared_cache, chat_id, system_prompt, query, result):
+    """検索できた上で Gemini が回答した結果だけを共有キャッシュに入れる（縮退した応答は入れない）。"""
+    if result.answer_path != ANSWER_LLM or result.vector_search_duration_ms is None or result.admission_error:
+        return
+    shared_cache.store_answer(chat_id, result.cache_generation, system_prompt, query, {
+        'response': result.response,
+        'context_found': result.context.context_found,
+        'sources_count': result.context.sources_count,
+        'top_score': result.context.top_score,
+        'llm_model': result.llm_model,
+    })
+
+
+def coalesce(chat_id, query, fn):
+    """同一の (chat_id, query) が処理中ならその結果を共有する。Returns (PipelineResult, coalesced)。"""
+    if not settings.CHAT_COALESCE_ENABLED:
+        return fn(), False
+    result, coalesced = _flights.do((chat_id, query), fn)
+    if coalesced:
+        CHAT_COALESCED.inc()
+    return result, coalesced
+
+
+async def coalesce_async(chat_id, query, fn):
+    if not settings.CHAT_COALESCE_ENABLED:
+        return await fn(), False
+    result, coalesced = await _flights.do_async((chat_id, query), fn)
+    if coalesced:
+        CHAT_COALESCED.inc()
+    return result, coalesced
+
+
+def finish_chat(chat, chat_id, result, coalesced):
+    """パイプラインの結果を BigQuery に記録し、レスポンスを組み立てる。Returns (payload, status, headers)。"""
+    admission_error = result.admission_error
+    rejected = should_reject(admission_error)
+    error_code = None
+    error_message = None
+    if admission_error:
+        error_code = f"ADMISSION_{admission_error.reason.upper()}"
+        error_message = str(admission_error)
+
+    # BigQuery logging（キューに積むだけなのでイベントループをブロックしない）
+    with stage('logging'):
+        _log_chat(chat, chat_id, result, coalesced, '' if rejected else result.response, error_code, error_message)
+
+    if rejected:
+        return rejection_response(admission_error)
+    return response_payload(result.response, result.context.context_found, result.context.sources_count, chat_id), 200, {}
+
+
+def fail_chat(chat, chat_id, error, result=None, coalesced=False):
+    """処理中の例外を BigQuery と Sentry に記録する。Returns (payload, status, headers)。"""
+    result = result or PipelineResult()
+    _log_chat(chat, chat_id, result, coalesced, '', 'INTERNAL_ERROR', str(error))
+
+    if settings.SENTRY_DSN:
+        sentry_sdk.set_context("chat", {
+            "chat_id": chat_id,
+            "query": chat.query,
+            "context_found": result.context.context_found,
+        })
+        sentry_sdk.capture_exception(error)
+
+    return {'error': str(error)}, 500, {}
+
+
+def _log_chat(chat, chat_id, result, coalesced, response, error_code, error_message):
+    state = request_state.current()
+    start_time = getattr(state, 'start_time', None)
+    # 共有した結果の検索・LLM の所要時間とトークン数は実行したリクエスト側にだけ記録する
+    log_chat_request(
+        chat_id=chat_id if chat_id else 'unknown',
+        query=chat.query,
+        response=response,
+        request_id=getattr(state, 'request_id', None),
+        user_agent=chat.user_agent,
+        origin_domain=chat.origin_domain,
+        context_found=result.context.context_found,
+        context_sources_count=result.context.sources_count,
+        vector_search_duration_ms=None if coalesced else result.vector_search_duration_ms,
+        top_similarity_score=result.context.top_score,
+        llm_model=result.llm_model,
+        llm_request_duration_ms=None if coalesced else result.llm_request_duration_ms,
+        total_duration_ms=int((time.time() - start_time) * 1000) if start_time else None,
+        error_code=error_code,
+        error_message=error_message,
+        client_ip=chat.client_ip,
+        tokens_input=None if coalesced else result.tokens_input,
+        tokens_output=None if coalesced else result.tokens_output,
+        slowest_stage=tracing.slowest_stage(get_stage_timings()),
+        coalesced=coalesced,
+        answer_path=result.answer_path,
+    )
+
+
+def client_ip(forwarded_for, remote_addr):
+    return (forwarded_for or '').split(',')[0].strip() or remote_addr
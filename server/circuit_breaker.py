@@ -0,0 +1,202 @@
+"""Circuit breakers for external dependencies (Qdrant, Gemini, management API).
+
+直近 CIRCUIT_WINDOW_SEC の呼び出しのうち失敗の割合が CIRCUIT_FAILURE_RATE 以上
+（かつ CIRCUIT_MIN_CALLS 件以上）になると open になり、CIRCUIT_OPEN_SEC の間は
+呼び出さずに即座に失敗（または縮退）させる。その後 half-open で CIRCUIT_HALF_OPEN_PROBES 件だけ
+試し、成功すれば closed に戻り、失敗すれば再び open になる。
+
+    breaker = CircuitBreaker('gemini')
+    if not breaker.allow():
+        ...  # 縮退した応答を返す
+    try:
+        call()
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+
+任意のクライアントをまとめて保護する場合は GuardedClient で包む。
+"""
+
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+
+import settings
+import structured_logging as slog
+from metrics import CIRCUIT_REJECTED, CIRCUIT_STATE
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """ブレーカーが open のため呼び出さなかった。"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        failure_rate=None,
+        min_calls=None,
+        window_sec=None,
+        open_sec=None,
+        half_open_probes=None,
+    ):
+        self.name = name
+        self.failure_rate = settings.CIRCUIT_FAILURE_RATE if failure_rate is None else failure_rate
+        self.min_calls = settings.CIRCUIT_MIN_CALLS if min_calls is None else min_calls
+        self.window_sec = settings.CIRCUIT_WINDOW_SEC if window_sec is None else window_sec
+        self.open_sec = settings.CIRCUIT_OPEN_SEC if open_sec is None else open_sec
+        self.half_open_probes = settings.CIRCUIT_HALF_OPEN_PROBES if half_open_probes is None else half_open_probes
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._outcomes = deque()  # (timestamp, ok)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_started_at = 0.0
+        CIRCUIT_STATE.set(_STATE_VALUES[CLOSED], dependency=name)
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def retry_after(self):
+        """open の場合、half-open になるまでの秒数。"""
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_sec - time.monotonic())
+
+    def allow(self):
+        """呼び出してよいか。open 中（または half-open の試行枠が埋まっている）なら False。"""
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN:
+                # 結果が記録されないまま終わった試行（キャンセルなど）で枠が埋まり続けないようにする
+                if self._probes >= self.half_open_probes and now - self._probe_started_at >= self.open_sec:
+                    self._probes = 0
+                if self._probes < self.half_open_probes:
+                    self._probes += 1
+                    self._probe_started_at = now
+                    return True
+        CIRCUIT_REJECTED.inc(dependency=self.name)
+        return False
+
+    def check(self):
+        """allow() の例外版。"""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+
+    def record_success(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._transition(CLOSED)
+                return
+            self._record(time.monotonic(), True)
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                self._open(now)
+                return
+            if self._state == OPEN:
+                return
+            self._record(now, False)
+            calls = len(self._outcomes)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if calls >= self.min_calls and failures / calls >= self.failure_rate:
+                self._open(now)
+
+    # --- internal (self._lock を保持して呼ぶ) -----------------------------
+
+    def _record(self, now, ok):
+        self._outcomes.append((now, ok))
+        horizon = now - self.window_sec
+        while self._outcomes and self._outcomes[0][0] < horizon:
+            self._outcomes.popleft()
+
+    def _maybe_half_open(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_sec:
+            self._transition(HALF_OPEN)
+
+    def _open(self, now):
+        self._opened_at = now
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        previous, self._state = self._state, state
+        self._outcomes.clear()
+        self._probes = 0
+        CIRCUIT_STATE.set(_STATE_VALUES[state], dependency=self.name)
+        slog.warning("circuit_state_changed", dependency=self.name, previous=previous, state=state)
+
+
+class GuardedClient:
+    """クライアントのメソッド呼び出しを CircuitBreaker で保護するプロキシ。
+
+    is_failure(exc) が False を返す例外（リクエスト側の誤りなど）は失敗として数えない。
+    コルーチン関数（AsyncQdrantClient など）にも対応する。
+    """
+
+    def __init__(self, client, breaker, is_failure=None):
+        self._client = client
+        self._breaker = breaker
+        self._is_failure = is_failure or (lambda exc: True)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        breaker = self._breaker
+        is_failure = self._is_failure
+
+        if inspect.iscoroutinefunction(attr):
+            @functools.wraps(attr)
+            async def guarded_async(*args, **kwargs):
+                breaker.check()
+                try:
+                    result = await attr(*args, **kwargs)
+                except Exception as e:
+                    if is_failure(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    raise
+                breaker.record_success()
+                return result
+
+            return guarded_async
+
+        @functools.wraps(attr)
+        def guarded(*args, **kwargs):
+            breaker.check()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                if is_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+            breaker.record_success()
+            return result
+
+        return guarded
@@ -0,0 +1,207 @@
+"""Vector storage, quantization and HNSW configuration of the knowledge collections.
+
+ナレッジのコレクション（共有コレクションとテナント専用コレクション）を作成するときの設定と、
+検索時のパラメーターを settings から組み立てる。
+
+- QDRANT_QUANTIZATION: none / scalar（int8、メモリ 1/4）/ binary（1/32。384 次元では再スコアリング前提）
+- QDRANT_VECTORS_ON_DISK: 元の float32 ベクトルをディスクに置き、メモリには量子化したものだけを持つ
+- QDRANT_PAYLOAD_ON_DISK: ペイロード（本文）をディスクに置く
+- QDRANT_HNSW_M / QDRANT_HNSW_EF_CONSTRUCT / QDRANT_SEARCH_HNSW_EF: HNSW のグラフと検索の精度
+
+既存のコレクションへの反映:
+
+    cd server
+    python collection_config.py show
+    python collection_config.py apply                  # 共有コレクションと全テナント専用コレクション
+    python collection_config.py apply --collection chat_context
+
+設定ごとの再現率・応答時間の比較は bench/bench_quantization.py を使う。
+"""
+
+import argparse
+from dataclasses import dataclass
+
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CollectionParamsDiff,
+    Disabled,
+    Distance,
+    HnswConfigDiff,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+    VectorParamsDiff,
+)
+
+import settings
+
+VECTOR_SIZE = settings.EMBEDDING_VECTOR_SIZE
+QUANTIZATIONS = ('none', 'scalar', 'binary')
+# 1 次元あたりのメモリ上のバイト数（HNSW のリンクを除く）
+_BYTES_PER_DIMENSION = {'none': 4, 'scalar': 1, 'binary': 1 / 8}
+
+
+@dataclass(frozen=True)
+class CollectionConfig:
+    vector_size: int = VECTOR_SIZE
+    quantization: str = 'none'
+    always_ram: bool = True
+    rescore: bool = True
+    oversampling: float = 2.0
+    vectors_on_disk: bool = False
+    payload_on_disk: bool = False
+    hnsw_m: int = 16
+    hnsw_ef_construct: int = 100
+    search_ef: int = 0
+
+    @classmethod
+    def from_settings(cls):
+        quantization = settings.QDRANT_QUANTIZATION
+        if quantization not in QUANTIZATIONS:
+            print(f"[WARN] Unknown QDRANT_QUANTIZATION={quantization!r}; using 'none'")
+            quantization = 'none'
+        return cls(
+            vector_size=settings.EMBEDDING_VECTOR_SIZE,
+            quantization=quantization,
+            always_ram=settings.QDRANT_QUANTIZATION_ALWAYS_RAM,
+            rescore=settings.QDRANT_QUANTIZATION_RESCORE,
+            oversampling=settings.QDRANT_QUANTIZATION_OVERSAMPLING,
+            vectors_on_disk=settings.QDRANT_VECTORS_ON_DISK,
+            payload_on_disk=settings.QDRANT_PAYLOAD_ON_DISK,
+            hnsw_m=settings.QDRANT_HNSW_M,
+            hnsw_ef_construct=settings.QDRANT_HNSW_EF_CONSTRUCT,
+            search_ef=settings.QDRANT_SEARCH_HNSW_EF,
+        )
+
+    def vectors_config(self):
+        return VectorParams(size=self.vector_size, distance=Distance.COSINE, on_disk=self.vectors_on_disk)
+
+    def hnsw_config(self, per_tenant=False):
+        """per_tenant: 全体のグラフを作らず、テナント（chat_id）ごとのグラフだけを作る（共有コレクション）。"""
+        if per_tenant:
+            return HnswConfigDiff(
+                m=0, payload_m=settings.QDRANT_TENANT_PAYLOAD_M, ef_construct=self.hnsw_ef_construct
+            )
+        return HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+
+    def quantization_config(self):
+        if self.quantization == 'scalar':
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=self.always_ram)
+            )
+        if self.quantization == 'binary':
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=self.always_ram))
+        return None
+
+    def search_params(self):
+        """検索リクエストに付けるパラメーター（既定のままなら None）。"""
+        quantization = None
+        if self.quantization != 'none':
+            quantization = QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+        if quantization is None and not self.search_ef:
+            return None
+        return SearchParams(hnsw_ef=self.search_ef or None, quantization=quantization)
+
+    def create_kwargs(self, per_tenant=False):
+        """create_collection() に渡す引数。"""
+        return dict(
+            vectors_config=self.vectors_config(),
+            hnsw_config=self.hnsw_config(per_tenant),
+            quantization_config=self.quantization_config(),
+            on_disk_payload=self.payload_on_disk,
+        )
+
+    def update_kwargs(self, per_tenant=False):
+        """update_collection() に渡す引数（既存のコレクションをこの設定に揃える）。"""
+        return dict(
+            vectors_config={'': VectorParamsDiff(on_disk=self.vectors_on_disk)},
+            hnsw_config=self.hnsw_config(per_tenant),
+            quantization_config=self.quantization_config() or Disabled.DISABLED,
+            collection_params=CollectionParamsDiff(on_disk_payload=self.payload_on_disk),
+        )
+
+    def estimated_ram_bytes(self, points):
+        """ベクトルがメモリに占めるおおよそのバイト数（HNSW のリンクとペイロードを除く）。"""
+        per_dimension = 0 if self.vectors_on_disk else _BYTES_PER_DIMENSION['none']
+        if self.quantization != 'none' and self.always_ram:
+            per_dimension += _BYTES_PER_DIMENSION[self.quantization]
+        return int(points * self.vector_size * per_dimension)
+
+
+CONFIG = CollectionConfig.from_settings()
+
+
+def describe(info):
+    """get_collection() の結果から比較用の設定を取り出す。"""
+    params = info.config.params
+    vectors = params.vectors
+    quantization = info.config.quantization_config or getattr(vectors, 'quantization_config', None)
+    if isinstance(quantization, ScalarQuantization):
+        kind = 'scalar'
+    elif isinstance(quantization, BinaryQuantization):
+        kind = 'binary'
+    else:
+        kind = 'none'
+    hnsw = info.config.hnsw_config
+    return {
+        'points': info.points_count,
+        'vector_size': getattr(vectors, 'size', None),
+        'quantization': kind,
+        'vectors_on_disk': bool(getattr(vectors, 'on_disk', False)),
+        'payload_on_disk': bool(params.on_disk_payload),
+        'hnsw_m': hnsw.m,
+        'payload_m': hnsw.payload_m,
+        'ef_construct': hnsw.ef_construct,
+    }
+
+
+def knowledge_collections(client):
+    """共有コレクションと、配置が記録されているテナント専用コレクションの論理名。"""
+    import tenancy
+
+    names = [settings.QDRANT_COLLECTION_NAME]
+    existing = {collection.name for collection in client.get_collections().collections}
+    directory = tenancy.TenantDirectory(lambda: client, cache_ttl=0)
+    for placement in directory.placements().values():
+        for target in (placement.target, placement.source):
+            if target and target.collection not in names and tenancy.resolve_collection(client, target.collection) in existing:
+                names.append(target.collection)
+    return names
+
+
+def per_tenant(name):
+    """テナントごとの HNSW グラフで作るコレクションか（QDRANT_TENANT_INDEX の共有コレクション）。"""
+    return settings.QDRANT_TENANT_INDEX and name == settings.QDRANT_COLLECTION_NAME
+
+
+def main():
+    import tenancy
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('show')
+    apply = sub.add_parser('apply')
+    apply.add_argument('--collection', help='対象のコレクション（既定: 共有コレクションと全テナント専用コレクション）')
+    args = parser.parse_args()
+
+    client = tenancy.admin_client()
+    names = [args.collection] if getattr(args, 'collection', None) else knowledge_collections(client)
+    print(f"desired: {CONFIG}")
+    for name in names:
+        current = describe(client.get_collection(tenancy.resolve_collection(client, name)))
+        ram_mb = CONFIG.estimated_ram_bytes(current['points'] or 0) / 1024 / 1024
+        print(f"{name}: {current} (vectors in RAM with desired config: ~{ram_mb:.1f} MB)")
+        if args.command == 'apply':
+            client.update_collection(
+                collection_name=tenancy.resolve_collection(client, name),
+                **CONFIG.update_kwargs(per_tenant=per_tenant(name)),
+            )
+            print("  applied; Qdrant re-optimizes segments in the background")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,28 @@
+import threading
 import time
 from urllib.parse import urlparse
 
 import requests
 
+import settings
+from circuit_breaker import CircuitBreaker
+from metrics import CACHE_REQUESTS, REGISTRY_RELOADS
+
 
 class DomainRegistry:
     """
     management-server-hono の API から chat_profiles を取得する。
     """
 
-    def __init__(self, base_url: str, admin_api_key: str = "", cache_ttl: int = 30, timeout: int = 5):
+    def __init__(
+        self,
+        base_url: str,
+        admin_api_key: str = "",
+        cache_ttl: int = 30,
+        timeout: int = 5,
+        shared_cache=None,
+        preload: bool = True,
+    ):
         self.base_url = base_url.rstrip("/")
         self.admin_api_key = admin_api_key or ""
         self.cache_ttl = cache_ttl
@@ -20,11 +33,75 @@ class DomainRegistry:
         self._expires_at = 0.0
         self._last_error = None
         self._loaded_successfully = False
-        self.reload()
+        # 同時に期限切れを見たリクエスト（と起動時の準備）のうち 1 つだけが読み込む
+        self._reload_lock = threading.Lock()
+        # 再読み込みは TTL ごとにしか発生しないため、少ない失敗回数・長めの窓で判定する
+        self.breaker = CircuitBreaker(
+            'management_api',
+            min_calls=2,
+            window_sec=max(settings.CIRCUIT_WINDOW_SEC, cache_ttl * 4),
+        )
+        # インスタンス間で共有するスナップショット（shared_cache.SharedCache）
+        self.shared_cache = shared_cache
+        if shared_cache is not None:
+            shared_cache.on_registry_invalidated(self.invalidate)
+        # preload=False の場合は最初の resolve()（または起動時の準備の ensure_loaded()）で読み込む
+        if preload:
+            self.reload()
+
+    @property
+    def loaded(self):
+        return self._loaded_successfully
+
+    @property
+    def last_error(self):
+        return self._last_error
 
     def reload(self):
+        """共有キャッシュに新しいスナップショットがあればそれを使い、無ければ管理API から取得する。
+
+        スナップショットを取り直すのは排他を取った 1 インスタンスだけで、他のインスタンスは読み込み済みの
+        エントリー（無ければ古いスナップショット）で応答し、少し後に共有キャッシュを読み直す
+        （どちらも無い起動直後のインスタンスは自分で取得する）。
+        """
+        snapshot = self.shared_cache.registry_snapshot() if self.shared_cache is not None else None
+        if snapshot and time.time() < snapshot[1] + self.cache_ttl:
+            REGISTRY_RELOADS.inc(result='shared')
+            self._apply(*snapshot)
+            return
+        can_serve = self._loaded_successfully or snapshot is not None
+        if can_serve and self.shared_cache is not None and not self.shared_cache.try_lock('registry', self.timeout + 1):
+            if not self._loaded_successfully:
+                self._apply(*snapshot)
+            self._expires_at = time.time() + 1.0
+            return
+
+        fetched_at = time.time()
+        rows = self._fetch()
+        if rows is None:
+            if snapshot and not self._loaded_successfully:
+                # 管理API が落ちている間に起動したインスタンスは古いスナップショットで応答する
+                expires_at = self._expires_at
+                self._apply(*snapshot)
+                self._expires_at = expires_at
+            return
+        if self.shared_cache is not None:
+            self.shared_cache.store_registry_snapshot(rows, fetched_at)
+        self._apply(rows, fetched_at)
+
+    def invalidate(self):
+        """次の resolve() で読み直す（共有キャッシュからの無効化の通知など）。"""
+        self._expires_at = 0.0
+
+    def _fetch(self):
+        """管理API の /api/chats を取得する。Returns the chat rows or None on failure."""
         api_url = f"{self.base_url}/api/chats"
         has_api_key = bool(self.admin_api_key)
+        if not self.breaker.allow():
+            # 管理API が落ちている間はタイムアウトを待たず、読み込み済みのエントリーで応答し続ける
+            REGISTRY_RELOADS.inc(result='circuit_open')
+            self._expires_at = time.time() + max(1.0, self.breaker.retry_after())
+            return None
         try:
             headers = {}
             if self.admin_api_key:
@@ -35,22 +112,32 @@ class DomainRegistry:
                 error_body = res.text[:500]
                 error_msg = f"API returned {res.status_code}: {error_body}"
                 print(f"[ERROR] DomainRegistry reload failed - url={api_url}, has_api_key={has_api_key}, status={res.status_code}, body={error_body}")
+                REGISTRY_RELOADS.inc(result='http_error')
+                if res.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
                 self._last_error = error_msg
                 self._expires_at = time.time() + self.cache_ttl / 2
-                return
+                return None
 
             payload = res.json()
             rows = payload.get("chats", [])
             print(f"[INFO] DomainRegistry reload success - loaded {len(rows)} chats from {api_url}")
+            REGISTRY_RELOADS.inc(result='success')
+            self.breaker.record_success()
             self._last_error = None
-            self._loaded_successfully = True
         except Exception as e:
             error_msg = f"{type(e).__name__}: {e}"
             print(f"[ERROR] DomainRegistry reload exception - url={api_url}, has_api_key={has_api_key}, error={error_msg}")
+            REGISTRY_RELOADS.inc(result='exception')
+            self.breaker.record_failure()
             self._last_error = error_msg
             self._expires_at = time.time() + self.cache_ttl / 2
-            return
+            return None
+        return rows
 
+    def _apply(self, rows, fetched_at):
         chats = {}
         host_map = {}
         id_map = {}
@@ -77,6 +164,12 @@ class DomainRegistry:
                 "target_type": target_type,
                 "display_name": display_name,
                 "system_prompt": system_prompt,
+                # LLM 呼び出しのアドミッション制御（未設定なら settings の既定値）
+                "llm_max_concurrency": self._positive_int(row.get("llm_max_concurrency")),
+                "llm_rate_limit_per_min": self._positive_int(row.get("llm_rate_limit_per_min")),
+                "llm_burst": self._positive_int(row.get("llm_burst")),
+                # /api/chat の処理時間の上限（未設定なら CHAT_DEADLINE_MS）
+                "deadline_ms": self._positive_int(row.get("deadline_ms")),
             }
             chats[chat_id] = entry
             id_map[chat_id] = entry
@@ -95,7 +188,9 @@ class DomainRegistry:
         self.chats = chats
         self.host_map = host_map
         self.id_map = id_map
-        self._expires_at = time.time() + self.cache_ttl
+        self._loaded_successfully = True
+        # 共有キャッシュのスナップショットは取得した時刻から数える
+        self._expires_at = max(time.time() + 1.0, fetched_at + self.cache_ttl)
 
     def resolve(self, key: str):
         """chat_id もしくは target(web) から解決"""
@@ -116,9 +211,22 @@ class DomainRegistry:
             return None
         return self.host_map.get(normalized)
 
+    def needs_reload(self):
+        """次の resolve() で管理API への再読み込み（ブロッキング I/O）が発生するか。"""
+        return time.time() >= self._expires_at
+
     def _ensure_latest(self):
         if time.time() >= self._expires_at:
-            self.reload()
+            CACHE_REQUESTS.inc(cache='domain_registry', result='miss')
+            self.ensure_loaded()
+        else:
+            CACHE_REQUESTS.inc(cache='domain_registry', result='hit')
+
+    def ensure_loaded(self):
+        """期限切れなら読み直す。同時に呼ばれた場合は 1 つだけが読み込み、他はその結果を待つ。"""
+        with self._reload_lock:
+            if time.time() >= self._expires_at:
+                self.reload()
 
     def get_stats(self):
         """デバッグ用の統計情報を返す"""
@@ -131,8 +239,17 @@ class DomainRegistry:
             'available_hosts': list(self.host_map.keys()),
             'api_url': self.base_url,
             'has_api_key': bool(self.admin_api_key),
+            'circuit': self.breaker.state,
         }
 
+    @staticmethod
+    def _positive_int(value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+
     def _normalize_domain(self, value: str):
         if not value:
             return None
@@ -0,0 +1,233 @@
+"""Persistent, content-addressed cache of embeddings.
+
+同じテキストを埋め込み直す処理（再取り込み・reindex.py・よくある質問）でモデルの推論を省くため、
+埋め込みを (モデル名, 正規化したテキストの SHA-256) をキーにローカルディスクの SQLite に保存する。
+ベクトルは EMBEDDING_CACHE_DTYPE（既定 float16）のバイト列で保存し、使用量が EMBEDDING_CACHE_MAX_MB を
+超えたら最後に使われた時刻の古いものから消す。gunicorn の各ワーカー・reindex.py から同じファイルを共有できる
+（WAL モード）。
+
+CachedEmbedder は SentenceTransformer と同じ encode() を持つため、埋め込みモデルを使う箇所
+（app.py・asgi.py・file_utils.py・reindex.py）はそのまま使える。ローカルのキャッシュに無いものは
+インスタンス間の共有キャッシュ（shared_cache、SHARED_CACHE_URL 設定時）を参照してからモデルで計算する。
+キャッシュに当たったかどうかで結果が変わらないよう、モデルで計算したベクトルも保存する精度に丸めて返す。
+キャッシュの読み書きに失敗しても埋め込みは止めない（モデルで計算する）。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+import settings
+from metrics import CACHE_REQUESTS, EMBEDDING_CACHE_EVICTIONS
+
+_DTYPES = {'float16': np.float16, 'float32': np.float32}
+# 最後に使われた時刻はこれより古い場合だけ更新する（読み込みのたびに書き込まない）
+_TOUCH_INTERVAL_SEC = 3600
+# この件数を書き込むごとに使用量を確認する
+_EVICT_CHECK_EVERY = 256
+# 上限を超えたらこの割合まで減らす
+_EVICT_TARGET = 0.9
+# SQLite の 1 文の変数の上限（999）より少なく
+_LOOKUP_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key BLOB PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    last_used INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+"""
+
+
+def normalize_text(text):
+    """キャッシュのキーと埋め込みに使うテキスト（Unicode NFC、前後の空白を除く）。"""
+    return unicodedata.normalize('NFC', text).strip()
+
+
+def cache_key(model_id, text):
+    return hashlib.sha256(f"{model_id}\0{text}".encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=None, max_mb=None, dtype=None):
+        self.path = path or settings.EMBEDDING_CACHE_PATH
+        self.max_bytes = (settings.EMBEDDING_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+        self.dtype = _DTYPES.get(dtype or settings.EMBEDDING_CACHE_DTYPE, np.float16)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self):
+        # 接続はスレッドごと（fork 後のワーカーでは作り直す）
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _failed(self, action, error):
+        print(f"[WARN] Embedding cache {action} failed ({self.path}): {error}")
+
+    def get_many(self, keys):
+        """Returns {key: np.ndarray(float32)} for the keys found in the cache."""
+        if not keys:
+            return {}
+        found = {}
+        now = int(time.time())
+        try:
+            conn = self._connect()
+            for offset in range(0, len(keys), _LOOKUP_CHUNK):
+                chunk = keys[offset:offset + _LOOKUP_CHUNK]
+                rows = conn.execute(
+                    f"SELECT key, dim, vector, last_used FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                stale = []
+                for key, dim, blob, last_used in rows:
+                    vector = np.frombuffer(blob, dtype=self.dtype)
+                    if vector.shape[0] != dim:
+                        # EMBEDDING_CACHE_DTYPE を変えた場合など。計算し直して上書きする
+                        continue
+                    found[bytes(key)] = vector.astype(np.float32)
+                    if now - last_used > _TOUCH_INTERVAL_SEC:
+                        stale.append(key)
+                if stale:
+                    conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(stale))})",
+                        [now, *stale],
+                    )
+        except sqlite3.Error as e:
+            self._failed('read', e)
+        return found
+
+    def put_many(self, items):
+        """items: [(key, vector)]。"""
+        if not items:
+            return
+        now = int(time.time())
+        rows = [(key, len(vector), np.asarray(vector, dtype=self.dtype).tobytes(), now) for key, vector in items]
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            self._failed('write', e)
+            return
+        with self._lock:
+            self._writes += len(rows)
+            check = self._writes >= _EVICT_CHECK_EVERY
+            if check:
+                self._writes = 0
+        if check:
+            self.evict()
+
+    def used_bytes(self, conn=None):
+        conn = conn or self._connect()
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return (pages - free) * page_size
+
+    def evict(self):
+        """使用量が上限を超えていれば、最後に使われた時刻の古いものから消す。Returns removed count."""
+        try:
+            conn = self._connect()
+            used = self.used_bytes(conn)
+            if used <= self.max_bytes:
+                return 0
+            count = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            remove = max(1, int(count * (1 - self.max_bytes * _EVICT_TARGET / used)))
+            conn.execute(
+                'DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                (remove,),
+            )
+        except sqlite3.Error as e:
+            self._failed('eviction', e)
+            return 0
+        EMBEDDING_CACHE_EVICTIONS.inc(remove)
+        print(f"[INFO] Embedding cache over {self.max_bytes // (1024 * 1024)} MB, evicted {remove} of {count} entries")
+        return remove
+
+
+class CachedEmbedder:
+    """model（SentenceTransformer）の encode() の結果を cache（ローカル）と shared（インスタンス間で共有、
+    shared_cache.SharedCache）に保存する。どちらかは None でもよい。その他の属性は model のもの。
+    """
+
+    def __init__(self, model, cache, model_id, shared=None):
+        self.model = model
+        self.cache = cache
+        self.model_id = model_id
+        self.shared = shared
+        # 共有キャッシュは float16 で保存するため、計算したベクトルも合わせる
+        self.dtype = np.float16 if shared is not None or cache is None else cache.dtype
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if kwargs:
+            # 出力が変わるオプション（normalize_embeddings など）はキャッシュしない
+            return self.model.encode(sentences, batch_size=batch_size, **kwargs)
+        single = isinstance(sentences, str)
+        texts = [normalize_text(t) for t in ([sentences] if single else sentences)]
+        if not texts:
+            return self.model.encode(texts, batch_size=batch_size)
+        keys = [cache_key(self.model_id, t) for t in texts]
+        unique = dict(zip(keys, texts))
+
+        vectors = self.cache.get_many(list(unique)) if self.cache is not None else {}
+        hits = sum(1 for key in keys if key in vectors)
+        if hits:
+            CACHE_REQUESTS.inc(hits, cache='embedding', result='hit')
+        if hits < len(keys):
+            CACHE_REQUESTS.inc(len(keys) - hits, cache='embedding', result='miss')
+
+        missing = [key for key in unique if key not in vectors]
+        if missing and self.shared is not None:
+            found = self.shared.get_vectors(self.model_id, missing)
+            if found:
+                vectors.update(found)
+                if self.cache is not None:
+                    self.cache.put_many(list(found.items()))
+                missing = [key for key in missing if key not in found]
+        if missing:
+            computed = self.model.encode([unique[key] for key in missing], batch_size=batch_size)
+            new = list(zip(missing, np.asarray(computed, dtype=self.dtype).astype(np.float32)))
+            vectors.update(new)
+            if self.cache is not None:
+                self.cache.put_many(new)
+            if self.shared is not None:
+                self.shared.put_vectors(self.model_id, new)
+
+        result = np.stack([vectors[key] for key in keys])
+        return result[0] if single else result
+
+
+def cached(model, model_id=None, shared=None):
+    """EMBEDDING_CACHE_ENABLED または共有キャッシュ（shared）があれば model を CachedEmbedder で包む。"""
+    shared = shared if shared is not None and shared.enabled else None
+    if model is None or not (settings.EMBEDDING_CACHE_ENABLED or shared):
+        return model
+    cache = EmbeddingCache() if settings.EMBEDDING_CACHE_ENABLED else None
+    return CachedEmbedder(model, cache, model_id or settings.EMBEDDING_MODEL, shared)
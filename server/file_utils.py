@@ -1,13 +1,14 @@
+import codecs
+import io
 import json
+import mmap
 import os
 import tempfile
 import time
 import uuid
+from contextlib import contextmanager
 
-import PyPDF2
-import pdfplumber
-from bs4 import BeautifulSoup
-from docx import Document
+from flask import Request
 from qdrant_client.http.models import PointStruct
 import requests
 from werkzeug.utils import secure_filename
@@ -58,71 +59,254 @@ def normalize_pdf_text(raw_text: str) -> str:
     return "\n".join(cleaned).strip()
 
 
-def extract_text_from_file(file_path, file_extension):
+class _MappedReader(io.RawIOBase):
+    """mmap をシーク可能なファイルライクオブジェクトとして扱うためのラッパー。"""
+
+    def __init__(self, mapped):
+        super().__init__()
+        self.mapped = mapped
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.mapped.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        return self.mapped.read(size if size is not None and size >= 0 else None)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.mapped.seek(offset, whence)
+        return self.mapped.tell()
+
+    def tell(self):
+        return self.mapped.tell()
+
+
+def _read_text(source):
+    """アップロード本文を UTF-8 として読み込む（バッファはコピーせずにデコードする）。"""
+    if isinstance(source, io.BytesIO):
+        with source.getbuffer() as view:
+            return str(view, 'utf-8')
+    if isinstance(source, _MappedReader):
+        with memoryview(source.mapped) as view:
+            return str(view, 'utf-8')
+    return source.read().decode('utf-8')
+
+
+def extract_text_from_file(source, file_extension):
+    """バイナリのファイルライクオブジェクトからテキストを抽出する。"""
     try:
+        source.seek(0)
         if file_extension == 'txt' or file_extension == 'md':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+            return _read_text(source)
 
         if file_extension == 'json':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return json.dumps(data, ensure_ascii=False, indent=2)
+            data = json.loads(_read_text(source))
+            return json.dumps(data, ensure_ascii=False, indent=2)
 
+        # PDF・Word のライブラリは起動を遅くしないよう、使う時に import する
         if file_extension == 'pdf':
+            import pdfplumber
+
             text_parts = []
             try:
-                with pdfplumber.open(file_path) as pdf:
+                with pdfplumber.open(source) as pdf:
                     for page in pdf.pages:
                         page_text = page.extract_text(x_tolerance=1, y_tolerance=1)
                         if page_text:
                             text_parts.append(page_text)
             except Exception as e:
                 print(f"pdfplumber failed ({e}), falling back to PyPDF2")
-                with open(file_path, 'rb') as f:
-                    pdf_reader = PyPDF2.PdfReader(f)
-                    for page in pdf_reader.pages:
-                        extracted = page.extract_text()
-                        if extracted:
-                            text_parts.append(extracted)
+                text_parts = []
+                source.seek(0)
+                import PyPDF2
+
+                pdf_reader = PyPDF2.PdfReader(source)
+                for page in pdf_reader.pages:
+                    extracted = page.extract_text()
+                    if extracted:
+                        text_parts.append(extracted)
 
             text = "\n\n".join(text_parts).strip()
             return normalize_pdf_text(text) if text else text
 
         if file_extension == 'docx':
-            doc = Document(file_path)
+            from docx import Document
+
+            doc = Document(source)
             text = "".join(paragraph.text + "\n" for paragraph in doc.paragraphs)
             return text
 
         return None
 
     except Exception as e:
-        print(f"Error extracting text from {file_path}: {e}")
+        print(f"Error extracting text from .{file_extension} upload: {e}")
         return None
 
 
-def fetch_url_content(url):
-    try:
-        response = requests.get(url, timeout=10)
+class ContentTooLargeError(Exception):
+    """Raised when a download or upload exceeds its configured byte cap."""
+
+    def __init__(self, limit):
+        super().__init__(f"content exceeds {limit} bytes")
+        self.limit = limit
+
+
+def format_size(num_bytes):
+    if num_bytes >= 1024 * 1024:
+        return f"{num_bytes / (1024 * 1024):.0f}MB"
+    return f"{num_bytes / 1024:.0f}KB"
+
+
+_BOILERPLATE_TAGS = (
+    'script', 'style', 'noscript', 'template', 'nav', 'header', 'footer', 'aside', 'form', 'iframe', 'svg',
+)
+_BOILERPLATE_ROLES = ('navigation', 'banner', 'contentinfo', 'complementary', 'search')
+_CONTENT_XPATHS = (
+    '//main',
+    '//article',
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' content ')]",
+    "//*[@id='content']",
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' post ')]",
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' article ')]",
+)
+_LINK_DENSE_TAGS = ('ul', 'ol', 'div', 'section', 'table')
+
+
+def _charset_from_headers(headers):
+    """Content-Type ヘッダーの charset を返す（未指定・不正な場合は None）。"""
+    content_type = headers.get('Content-Type', '')
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() != 'charset':
+            continue
+        charset = value.strip().strip('"\'').lower()
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            return None
+        return charset
+    return None
+
+
+def _download_capped(url, max_bytes, timeout):
+    """レスポンスをストリーミングで読み込み、max_bytes を超えた時点で打ち切る。"""
+    with requests.get(url, timeout=timeout, stream=True) as response:
         response.raise_for_status()
 
-        soup = BeautifulSoup(response.content, 'html.parser')
-        for element in soup(['script', 'style', 'nav', 'header', 'footer']):
-            element.decompose()
+        declared_length = response.headers.get('Content-Length', '')
+        if declared_length.isdigit() and int(declared_length) > max_bytes:
+            raise ContentTooLargeError(max_bytes)
+
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            body += chunk
+            if len(body) > max_bytes:
+                raise ContentTooLargeError(max_bytes)
+
+        return bytes(body), _charset_from_headers(response.headers)
+
+
+def _text_lines(element):
+    """BeautifulSoup の get_text(separator='\\n', strip=True) と同等のテキストを返す。"""
+    return '\n'.join(part.strip() for part in element.itertext() if part.strip())
 
-        title = soup.find('title')
-        title_text = title.get_text().strip() if title else ""
 
-        content_selectors = ['main', 'article', '.content', '#content', '.post', '.article']
-        content = None
-        for selector in content_selectors:
-            content = soup.select_one(selector)
-            if content:
-                break
-        if not content:
-            content = soup.find('body')
+def _is_link_dense(element):
+    links = element.findall('.//a')
+    if len(links) < 3:
+        return False
+    text_length = len(''.join(element.itertext()).strip())
+    if not text_length:
+        return True
+    link_length = sum(len(''.join(link.itertext()).strip()) for link in links)
+    return link_length / text_length > 0.8
 
-        text = content.get_text(separator='\n', strip=True) if content else ""
+
+def _extract_html_lxml(raw_html, charset=None):
+    # PDF・Word のライブラリと同じく、起動を遅くしないよう使う時に import する
+    import lxml.html
+
+    parser = lxml.html.HTMLParser(encoding=charset, remove_comments=True, remove_pis=True)
+    root = lxml.html.document_fromstring(raw_html, parser=parser)
+
+    title = root.find('.//title')
+    title_text = (title.text_content() or '').strip() if title is not None else ""
+
+    for element in list(root.iter(*_BOILERPLATE_TAGS)):
+        element.drop_tree()
+    for element in root.xpath('//*[@hidden or @aria-hidden="true" or @role]'):
+        hidden = element.get('hidden') is not None or element.get('aria-hidden') == 'true'
+        if hidden or element.get('role') in _BOILERPLATE_ROLES:
+            element.drop_tree()
+
+    content = None
+    for xpath in _CONTENT_XPATHS:
+        matches = root.xpath(xpath)
+        if matches:
+            content = matches[0]
+            break
+    if content is None:
+        content = root.find('body')
+    if content is None:
+        return title_text, ""
+
+    for element in list(content.iter(*_LINK_DENSE_TAGS)):
+        if element is not content and element.getparent() is not None and _is_link_dense(element):
+            element.drop_tree()
+
+    return title_text, _text_lines(content)
+
+
+def _extract_html_bs4(raw_html, charset=None):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(raw_html, 'html.parser', from_encoding=charset)
+    for element in soup(['script', 'style', 'nav', 'header', 'footer']):
+        element.decompose()
+
+    title = soup.find('title')
+    title_text = title.get_text().strip() if title else ""
+
+    content_selectors = ['main', 'article', '.content', '#content', '.post', '.article']
+    content = None
+    for selector in content_selectors:
+        content = soup.select_one(selector)
+        if content:
+            break
+    if not content:
+        content = soup.find('body')
+
+    text = content.get_text(separator='\n', strip=True) if content else ""
+    return title_text, text
+
+
+def extract_html_content(raw_html, charset=None):
+    """HTML バイト列からタイトルと本文テキストを抽出する。
+
+    lxml が利用可能な場合は C 実装のパーサーで定型部分（ナビゲーション、
+    フッター、リンク集など）を除去し、利用できない場合は BeautifulSoup で処理する。
+    """
+    try:
+        return _extract_html_lxml(raw_html, charset)
+    except ImportError:
+        return _extract_html_bs4(raw_html, charset)
+
+
+def fetch_url_content(url):
+    try:
+        raw_html, charset = _download_capped(
+            url,
+            settings.URL_FETCH_MAX_BYTES,
+            settings.URL_FETCH_TIMEOUT_SEC,
+        )
+        title_text, text = extract_html_content(raw_html, charset)
 
         return {
             'title': title_text,
@@ -130,12 +314,79 @@ def fetch_url_content(url):
             'url': url
         }
 
+    except ContentTooLargeError:
+        print(f"URL content too large: {url} (limit={settings.URL_FETCH_MAX_BYTES} bytes)")
+        raise
     except Exception as e:
         print(f"Error fetching URL {url}: {e}")
         return None
 
 
-def save_knowledge_to_qdrant(qdrant_client, vector, payload):
+class UploadRequest(Request):
+    """アップロードを一時ファイルに書き出さずに保持するリクエストクラス。
+
+    UPLOAD_SPOOL_MAX_BYTES 以下のリクエストはメモリ上の BytesIO に、それを超える
+    ものは匿名の一時ファイルに直接ストリーミングされ、抽出時に mmap される。
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= settings.UPLOAD_SPOOL_MAX_BYTES:
+            return io.BytesIO()
+        if total_content_length is None:
+            return tempfile.SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_MAX_BYTES, mode='rb+')
+        return tempfile.TemporaryFile('rb+', dir=settings.UPLOAD_FOLDER)
+
+
+def _spool_upload(file_storage, max_bytes):
+    """アップロードを読み取り可能なストリームとして返す。(stream, size)
+
+    UploadRequest が用意したストリームはそのまま再利用し、シークできない
+    ストリームのみ上限を確認しながら SpooledTemporaryFile にコピーする。
+    """
+    stream = file_storage.stream
+    if stream.seekable():
+        size = stream.seek(0, io.SEEK_END)
+        if size > max_bytes:
+            raise ContentTooLargeError(max_bytes)
+        stream.seek(0)
+        return stream, size
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_MAX_BYTES, mode='rb+')
+    size = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            spooled.close()
+            raise ContentTooLargeError(max_bytes)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, size
+
+
+@contextmanager
+def _open_upload_source(stream):
+    """ディスク上にあるアップロードは mmap し、メモリ上のものはそのまま渡す。"""
+    if isinstance(stream, (io.BytesIO, tempfile.SpooledTemporaryFile)):
+        stream.seek(0)
+        yield stream
+        return
+
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        stream.seek(0)
+        yield stream
+        return
+
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+        yield _MappedReader(mapped)
+
+
+def save_knowledge_to_qdrant(tenants, vector, payload):
+    """tenants（tenancy.TenantDirectory）が示すテナントの置き場所に保存する。"""
     point_id = str(uuid.uuid4())
     point = PointStruct(
         id=point_id,
@@ -143,14 +394,11 @@ def save_knowledge_to_qdrant(qdrant_client, vector, payload):
         payload=payload,
     )
 
-    qdrant_client.upsert(
-        collection_name=settings.QDRANT_COLLECTION_NAME,
-        points=[point],
-    )
+    tenants.upsert(payload['chat_id'], [point])
     return point_id
 
 
-def handle_file_upload(file_storage, chat_id, qdrant_client, embedding_model):
+def handle_file_upload(file_storage, chat_id, tenants, embedding_model):
     original_filename = file_storage.filename
     if original_filename == '':
         return {'error': 'ファイル名が空です'}, 400
@@ -165,12 +413,16 @@ def handle_file_upload(file_storage, chat_id, qdrant_client, embedding_model):
     if not file_extension:
         return {'error': 'ファイル拡張子を判別できませんでした'}, 400
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_extension}') as temp_file:
-        file_storage.save(temp_file.name)
-        temp_path = temp_file.name
+    try:
+        stream, size = _spool_upload(file_storage, settings.MAX_FILE_SIZE)
+    except ContentTooLargeError as e:
+        return {'error': f'ファイルサイズが上限（{format_size(e.limit)}）を超えています'}, 413
+    if size == 0:
+        return {'error': 'ファイルが空です'}, 400
 
     try:
-        extracted_text = extract_text_from_file(temp_path, file_extension)
+        with _open_upload_source(stream) as source:
+            extracted_text = extract_text_from_file(source, file_extension)
         if not extracted_text:
             return {'error': 'ファイルからテキストを抽出できませんでした'}, 400
         if not extracted_text.strip():
@@ -180,6 +432,7 @@ def handle_file_upload(file_storage, chat_id, qdrant_client, embedding_model):
         payload = {
             "text": extracted_text,
             "title": filename,
+            "file_name": filename,
             "source": "file_upload",
             "file_type": file_extension,
             "chat_id": chat_id,
@@ -187,7 +440,7 @@ def handle_file_upload(file_storage, chat_id, qdrant_client, embedding_model):
             "timestamp": time.time(),
         }
 
-        point_id = save_knowledge_to_qdrant(qdrant_client, vector, payload)
+        point_id = save_knowledge_to_qdrant(tenants, vector, payload)
 
         preview = extracted_text[:500] + ('...' if len(extracted_text) > 500 else '')
         return {
@@ -198,14 +451,14 @@ def handle_file_upload(file_storage, chat_id, qdrant_client, embedding_model):
             'qdrant_point_id': point_id,
         }, 200
     finally:
-        try:
-            os.unlink(temp_path)
-        except Exception:
-            pass
+        stream.close()
 
 
-def handle_url_fetch(url, title, chat_id, qdrant_client, embedding_model):
-    content_data = fetch_url_content(url)
+def handle_url_fetch(url, title, chat_id, tenants, embedding_model):
+    try:
+        content_data = fetch_url_content(url)
+    except ContentTooLargeError as e:
+        return {'error': f'コンテンツのサイズが上限（{format_size(e.limit)}）を超えています'}, 413
     if not content_data:
         return {'error': 'URLからコンテンツを取得できませんでした'}, 400
 
@@ -226,7 +479,7 @@ def handle_url_fetch(url, title, chat_id, qdrant_client, embedding_model):
         "timestamp": time.time(),
     }
 
-    point_id = save_knowledge_to_qdrant(qdrant_client, vector, payload)
+    point_id = save_knowledge_to_qdrant(tenants, vector, payload)
 
     return {
         'success': True,
@@ -236,7 +489,7 @@ def handle_url_fetch(url, title, chat_id, qdrant_client, embedding_model):
     }, 200
 
 
-def add_manual_knowledge(content, title, chat_id, category, tags, qdrant_client, embedding_model):
+def add_manual_knowledge(content, title, chat_id, category, tags, tenants, embedding_model):
     knowledge_vector = embedding_model.encode(content).tolist()
     payload = {
         "text": content,
@@ -249,5 +502,5 @@ def add_manual_knowledge(content, title, chat_id, category, tags, qdrant_client,
         "source": "manual",
     }
 
-    point_id = save_knowledge_to_qdrant(qdrant_client, knowledge_vector, payload)
+    point_id = save_knowledge_to_qdrant(tenants, knowledge_vector, payload)
     return {'success': True, 'message': '知識が追加されました', 'qdrant_point_id': point_id}, 200
@@ -0,0 +1,85 @@
+"""Production server configuration.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+preload_app で app.py をマスターで一度だけ読み込み、ワーカーはフォークしてメモリを copy-on-write で共有する。
+起動時の準備（埋め込みモデル・ドメインレジストリ・Qdrant コレクションの確認）は app.py の import 後も
+バックグラウンドで並行に進むため、マスターは待ち受けを始めてから、フォークの直前（pre_fork）で完了を待つ。
+フォーク後にソケットを持つクライアントとバックグラウンドスレッドだけを app.init_worker() で作り直す。
+
+ワーカーが 2 つ以上の場合、プロセスごとに持つ状態は次のように扱う。
+- /metrics: 各ワーカーが MULTIPROC_DIR に値を書き出し、応答したワーカーが合算する
+- プロファイリングのサンプリング率（/api/admin/profiling）: MULTIPROC_DIR のファイルで全ワーカーに反映する
+- Gemini のアドミッション制御: LLM_* の上限をワーカー数（SERVER_WORKERS）で割って各ワーカーに割り当てる
+- 同一の質問の single-flight: ワーカー内だけでまとめる（ワーカーをまたぐ重複は SHARED_CACHE_URL の回答キャッシュで減らす）
+"""
+
+import gc
+import glob
+import multiprocessing
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count())
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+# ワーカーが 1 つならメモリを共有する相手がいないため preload せず、マスターはすぐに待ち受けを始める
+# （ワーカーが app.py を import し、準備の間も /health・/ready に応答する）
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true' if workers > 1 else 'false').lower() == 'true'
+# app の import より前に設定する（settings は import 時に環境変数を読む）
+os.environ['SERVER_WORKERS'] = str(workers)
+if workers > 1:
+    os.environ.setdefault('MULTIPROC_DIR', tempfile.mkdtemp(prefix='iflame-multiproc-'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '20'))
+keepalive = 5
+accesslog = None
+errorlog = '-'
+
+# 全ワーカーが CPU 数ぶんの演算スレッドを持つと過剰になるため、既定では CPU をワーカーで分け合う。
+# torch の import（preload）より前に設定する必要がある。
+_default_threads = str(max(1, multiprocessing.cpu_count() // workers))
+os.environ.setdefault('TORCH_NUM_THREADS', _default_threads)
+os.environ.setdefault('OMP_NUM_THREADS', os.environ['TORCH_NUM_THREADS'])
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+# マスターでロードしたオブジェクトを GC が触らないようにし、copy-on-write のページ複製を抑える
+gc.disable()
+
+
+def on_starting(server):
+    # MULTIPROC_DIR を指定して再起動した場合に、前回のワーカーの値を合算しないよう消しておく
+    directory = os.getenv('MULTIPROC_DIR')
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+
+def when_ready(server):
+    gc.freeze()
+    gc.enable()
+    server.log.info("Preloaded app; starting %s workers x %s threads", workers, threads)
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        import app
+        import settings
+        # 埋め込みモデルをロードし終えてからフォークし、全ワーカーで共有する
+        if not app.warmup.wait(timeout=settings.STARTUP_WARMUP_TIMEOUT_SEC):
+            server.log.warning(
+                "Startup warmup still running after %ss; forking anyway", settings.STARTUP_WARMUP_TIMEOUT_SEC
+            )
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    import app
+    app.init_worker()
+
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_worker()
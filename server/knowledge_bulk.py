@@ -0,0 +1,92 @@
+"""Filter-based bulk delete / patch of a chat's knowledge.
+
+一括操作（POST /api/knowledge/bulk_delete, /api/knowledge/bulk_update）の対象は
+chat_id と filter の条件で選び、Qdrant 側で FilterSelector による削除・set_payload を行う。
+点を 1 件ずつ読み込んだりベクトルを転送したりしない。
+
+filter の条件（すべて AND。文字列の条件はリストにすると「いずれか」）:
+
+    url / file_name / category / source / type   一致
+    tags                                         いずれかのタグを含む
+    timestamp                                    {"gte": ..., "lt": ...}（UNIX 秒）
+
+type を指定しない場合、会話ログ（type=chat）は対象にしない。
+"""
+
+from qdrant_client.http.models import FieldCondition, Filter, MatchAny, MatchValue, Range
+
+_MATCH_FIELDS = ('url', 'category', 'source', 'type')
+SELECTOR_KEYS = _MATCH_FIELDS + ('file_name', 'tags', 'timestamp')
+_RANGE_KEYS = ('gt', 'gte', 'lt', 'lte')
+# bulk_update で書き換えられるペイロード（text の変更は埋め込み直しが必要なため 1 件ずつの PUT で行う）
+PATCHABLE_FIELDS = ('title', 'category', 'tags')
+
+
+def _strings(key, value):
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(v, str) and v for v in values):
+        raise ValueError(f"filter.{key} must be a non-empty string or a list of strings")
+    return values
+
+
+def _match(key, value):
+    values = _strings(key, value)
+    if len(values) == 1:
+        return FieldCondition(key=key, match=MatchValue(value=values[0]))
+    return FieldCondition(key=key, match=MatchAny(any=values))
+
+
+def _timestamp_range(value):
+    if not isinstance(value, dict) or not value or set(value) - set(_RANGE_KEYS):
+        raise ValueError(f"filter.timestamp must be an object with {', '.join(_RANGE_KEYS)}")
+    for bound in value.values():
+        if isinstance(bound, bool) or not isinstance(bound, (int, float)):
+            raise ValueError("filter.timestamp bounds must be UNIX timestamps (seconds)")
+    return FieldCondition(key='timestamp', range=Range(**value))
+
+
+def selection_filter(chat_id, criteria):
+    """chat_id と filter の条件から Qdrant の Filter を作る。Raises ValueError for invalid criteria."""
+    if not isinstance(criteria, dict) or not criteria:
+        raise ValueError('filter is required (e.g. {"url": "https://..."})')
+    unknown = sorted(set(criteria) - set(SELECTOR_KEYS))
+    if unknown:
+        raise ValueError(f"unknown filter keys: {', '.join(unknown)} (allowed: {', '.join(SELECTOR_KEYS)})")
+
+    must = [FieldCondition(key='chat_id', match=MatchValue(value=chat_id))]
+    for key in _MATCH_FIELDS:
+        if key in criteria:
+            must.append(_match(key, criteria[key]))
+    if 'tags' in criteria:
+        must.append(FieldCondition(key='tags', match=MatchAny(any=_strings('tags', criteria['tags']))))
+    if 'file_name' in criteria:
+        names = _strings('file_name', criteria['file_name'])
+        # file_name を保存する前にアップロードされた点はファイル名が title に入っている
+        must.append(Filter(should=[
+            FieldCondition(key='file_name', match=MatchAny(any=names)),
+            Filter(must=[
+                FieldCondition(key='source', match=MatchValue(value='file_upload')),
+                FieldCondition(key='title', match=MatchAny(any=names)),
+            ]),
+        ]))
+    if 'timestamp' in criteria:
+        must.append(_timestamp_range(criteria['timestamp']))
+
+    must_not = [] if 'type' in criteria else [FieldCondition(key='type', match=MatchValue(value='chat'))]
+    return Filter(must=must, must_not=must_not or None)
+
+
+def parse_patch(value):
+    """bulk_update の set。Raises ValueError unless it only contains PATCHABLE_FIELDS."""
+    if not isinstance(value, dict) or not value:
+        raise ValueError(f"set is required (any of {', '.join(PATCHABLE_FIELDS)})")
+    unknown = sorted(set(value) - set(PATCHABLE_FIELDS))
+    if unknown:
+        raise ValueError(f"fields cannot be bulk updated: {', '.join(unknown)}")
+    if 'title' in value and not isinstance(value['title'], str):
+        raise ValueError('set.title must be a string')
+    if 'category' in value and value['category'] is not None and not isinstance(value['category'], str):
+        raise ValueError('set.category must be a string or null')
+    if 'tags' in value and not (isinstance(value['tags'], list) and all(isinstance(t, str) for t in value['tags'])):
+        raise ValueError('set.tags must be a list of strings')
+    return dict(value)
@@ -0,0 +1,116 @@
+"""Cursor-paginated listing and streaming export of a chat's knowledge.
+
+一覧（GET /api/knowledge）は Qdrant の scroll を点 ID のカーソル（offset）で進めるため、
+どのページも先頭から数え直さずに取得でき、ページあたりの時間はテナントの大きさによらない。
+エクスポート（GET /api/knowledge/export）はページごとに読み込んで NDJSON（任意で gzip）として
+逐次書き出すため、テナント全体をメモリに載せない。どちらもベクトルは読み込まない。
+"""
+
+import base64
+import binascii
+import json
+import re
+import zlib
+
+from qdrant_client.http.models import FieldCondition, Filter, MatchAny, MatchValue
+
+import settings
+from chat_pipeline import search_filter
+
+# fields 未指定時に一覧で返すペイロード（本文 text は含めない）
+DEFAULT_FIELDS = ('title', 'type', 'source', 'timestamp', 'category', 'tags')
+_FIELD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def encode_cursor(offset):
+    """scroll の next_page_offset（点 ID）を URL に載せられる文字列にする。最後のページなら None。"""
+    if offset is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(offset).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Raises ValueError if the cursor was not produced by encode_cursor()."""
+    if not cursor:
+        return None
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise ValueError('invalid cursor')
+    if isinstance(offset, bool) or not isinstance(offset, (int, str)):
+        raise ValueError('invalid cursor')
+    return offset
+
+
+def parse_fields(value):
+    """fields=title,text のようなカンマ区切りの指定。Raises ValueError for invalid field names."""
+    if not value:
+        return list(DEFAULT_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    invalid = [field for field in fields if not _FIELD_RE.fullmatch(field)]
+    if invalid:
+        raise ValueError(f"invalid fields: {', '.join(invalid)}")
+    return fields
+
+
+def parse_types(values):
+    """type=knowledge,url_fetch（複数指定可）。未指定なら None（会話ログ以外のすべて）。"""
+    types = [t.strip() for value in values for t in value.split(',') if t.strip()]
+    return types or None
+
+
+def knowledge_filter(chat_id, types=None):
+    if not types:
+        return search_filter(chat_id)
+    return Filter(must=[
+        FieldCondition(key="chat_id", match=MatchValue(value=chat_id)),
+        FieldCondition(key="type", match=MatchAny(any=types)),
+    ])
+
+
+def list_page(tenants, chat_id, limit, cursor=None, fields=None, types=None):
+    """1 ページ分の一覧。Returns {'items': [...], 'next_cursor': str | None}."""
+    records, next_offset = tenants.scroll(
+        chat_id,
+        scroll_filter=knowledge_filter(chat_id, types),
+        limit=limit,
+        offset=cursor,
+        with_payload=list(fields or DEFAULT_FIELDS),
+        with_vectors=False,
+    )
+    return {
+        'items': [{'id': record.id, **(record.payload or {})} for record in records],
+        'next_cursor': encode_cursor(next_offset),
+    }
+
+
+def iter_export(tenants, chat_id, types=None, page_size=None):
+    """テナントのナレッジを 1 行 1 件の NDJSON として、ページごとの bytes で返す。"""
+    page_size = page_size or settings.KNOWLEDGE_EXPORT_PAGE_SIZE
+    offset = None
+    while True:
+        records, offset = tenants.scroll(
+            chat_id,
+            scroll_filter=knowledge_filter(chat_id, types),
+            limit=page_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False,
+        )
+        if records:
+            yield b''.join(
+                json.dumps({'id': record.id, **(record.payload or {})}, ensure_ascii=False).encode('utf-8') + b'\n'
+                for record in records
+            )
+        if offset is None:
+            return
+
+
+def gzip_stream(chunks, level=6):
+    """bytes のイテレーターを gzip 形式で逐次圧縮する。"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,445 @@
+"""In-process metrics registry exported in the Prometheus text format.
+
+カウンター・ゲージ・ヒストグラムをプロセス内に保持し、/metrics で公開する。
+ラベルは低カーディナリティのもの（stage, endpoint, type など）に限定し、
+chat_id ラベルは METRICS_CHAT_ID_LABEL を有効にした場合のみ付与する。
+
+gunicorn で複数のワーカーを動かす場合（MULTIPROC_DIR が設定されている場合）は、各ワーカーが
+METRICS_MULTIPROC_INTERVAL_SEC ごとに自分の値を MULTIPROC_DIR/<pid>.json に書き出し、/metrics を
+処理したワーカーが全ワーカーの値を合算して返す（他のワーカーの値は最大でその間隔だけ古い）。
+カウンターとヒストグラムは合計、ゲージは生きているワーカーの値の合計（multiprocess_mode='max' なら最大）。
+"""
+
+import bisect
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import settings
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+    # 終了したワーカーの値も合算に含めるか（カウンター・ヒストグラム）
+    cumulative = True
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, others=()):
+        """others は他のワーカーのスナップショット（snapshot() の値）と、そのワーカーが生きているかの組。"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            values = {key: self._copy(value) for key, value in self._values.items()}
+        for samples, live in others:
+            if not live and not self.cumulative:
+                continue
+            for key, value in samples:
+                key = tuple(key)
+                values[key] = self._merge(values[key], value) if key in values else value
+        lines.extend(self._render_samples(sorted(values.items())))
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def _merge(self, a, b):
+        return a + b
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+    cumulative = False
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='sum'):
+        super().__init__(name, documentation, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+
+    def _merge(self, a, b):
+        return max(a, b) if self.multiprocess_mode == 'max' else a + b
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _merge(self, a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self, others=()):
+        """others は他のワーカーの (snapshot(), live) の組（render_all() が読み込む）。"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render([(snapshot.get(metric.name, ()), live) for snapshot, live in others]))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), multiprocess_mode='sum'):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, multiprocess_mode))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# --- Metric definitions -----------------------------------------------------
+
+HTTP_REQUEST_DURATION = histogram(
+    'http_request_duration_seconds',
+    'Total request handling time by endpoint and status class.',
+    ['endpoint', 'status'],
+)
+HTTP_REQUESTS_IN_FLIGHT = gauge(
+    'http_requests_in_flight',
+    'Requests currently being handled.',
+    ['endpoint'],
+)
+STAGE_DURATION = histogram(
+    'request_stage_duration_seconds',
+    'Duration of request pipeline stages recorded via timing.stage().',
+    ['stage'],
+)
+CHAT_REQUEST_DURATION = histogram(
+    'chat_request_duration_seconds',
+    'End-to-end /api/chat duration.',
+    ['chat_id'] if settings.METRICS_CHAT_ID_LABEL else [],
+)
+CACHE_REQUESTS = counter(
+    'cache_requests_total',
+    'Cache lookups by cache name and result (hit/miss).',
+    ['cache', 'result'],
+)
+GEMINI_ERRORS = counter(
+    'gemini_errors_total',
+    'Gemini API errors by type.',
+    ['type'],
+)
+REGISTRY_RELOADS = counter(
+    'registry_reloads_total',
+    'DomainRegistry reloads from the management API by result.',
+    ['result'],
+)
+BQ_EVENTS_DROPPED = counter(
+    'bq_events_dropped_total',
+    'BigQuery events dropped before insertion by reason.',
+    ['reason'],
+)
+
+LLM_IN_FLIGHT = gauge(
+    'llm_in_flight',
+    'Gemini calls currently admitted.',
+)
+LLM_ADMISSION_WAITING = gauge(
+    'llm_admission_waiting',
+    'Requests currently waiting for LLM admission.',
+)
+LLM_ADMISSION_QUEUED = counter(
+    'llm_admission_queued_total',
+    'Requests that had to wait for LLM admission.',
+)
+LLM_ADMISSION_REJECTED = counter(
+    'llm_admission_rejected_total',
+    'Requests rejected by LLM admission control by reason.',
+    ['reason'],
+)
+LLM_ADMISSION_WAIT = histogram(
+    'llm_admission_wait_seconds',
+    'Time spent waiting for LLM admission (queued requests only).',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+CHAT_COALESCED = counter(
+    'chat_requests_coalesced_total',
+    'Chat requests answered by sharing an identical in-flight request.',
+)
+CHAT_DEADLINE_EXCEEDED = counter(
+    'chat_deadline_exceeded_total',
+    'Chat requests that ran out of their deadline, by the stage that was cut short.',
+    ['stage'],
+)
+CIRCUIT_STATE = gauge(
+    'circuit_breaker_state',
+    'Circuit breaker state per dependency (0=closed, 1=half-open, 2=open).',
+    ['dependency'],
+    multiprocess_mode='max',
+)
+CIRCUIT_REJECTED = counter(
+    'circuit_breaker_rejected_total',
+    'Calls short-circuited because the dependency breaker was open.',
+    ['dependency'],
+)
+LLM_MODEL_REQUESTS = counter(
+    'llm_model_requests_total',
+    'Gemini calls per model by result (success/error/timeout/cancelled).',
+    ['model', 'result'],
+)
+LLM_MODEL_LATENCY = histogram(
+    'llm_model_latency_seconds',
+    'Latency of successful Gemini calls per model.',
+    ['model'],
+)
+LLM_HEDGED = counter(
+    'llm_hedged_requests_total',
+    'Hedged Gemini requests by which call answered first (primary/secondary).',
+    ['winner'],
+)
+
+QDRANT_WRITE_BATCH_POINTS = histogram(
+    'qdrant_write_batch_points',
+    'Points per batched Qdrant upsert from the write buffer.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+QDRANT_WRITE_LATENCY = histogram(
+    'qdrant_write_latency_seconds',
+    'Latency of batched Qdrant upserts from the write buffer.',
+)
+QDRANT_WRITE_PENDING = gauge(
+    'qdrant_write_pending_points',
+    'Points waiting in the write buffer.',
+)
+QDRANT_WRITE_ERRORS = counter(
+    'qdrant_write_errors_total',
+    'Batched Qdrant upserts from the write buffer that failed.',
+)
+EMBEDDING_CACHE_EVICTIONS = counter(
+    'embedding_cache_evictions_total',
+    'Embeddings removed from the persistent embedding cache to stay under its size limit.',
+)
+SHARED_CACHE_ERRORS = counter(
+    'shared_cache_errors_total',
+    'Failed shared cache (Redis protocol) operations by operation.',
+    ['op'],
+)
+SHARED_CACHE_INVALIDATIONS = counter(
+    'shared_cache_invalidations_total',
+    'Invalidation messages received from the shared cache by type (registry/knowledge).',
+    ['type'],
+)
+STARTUP_COMPONENT_SECONDS = gauge(
+    'startup_component_seconds',
+    'Time the startup warmup took to make each component ready.',
+    ['component'],
+    multiprocess_mode='max',
+)
+
+
+# --- Multi-process (gunicorn workers) --------------------------------------
+
+_multiproc_dir = None
+_multiproc_stop = threading.Event()
+_multiproc_thread = None
+
+
+def _snapshot_path(directory, pid):
+    return os.path.join(directory, f"{pid}.json")
+
+
+def write_snapshot():
+    """このワーカーの値を MULTIPROC_DIR に書き出す（読み手が途中の内容を読まないよう置き換える）。"""
+    if _multiproc_dir is None:
+        return
+    path = _snapshot_path(_multiproc_dir, os.getpid())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(REGISTRY.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _write_periodically(interval):
+    while not _multiproc_stop.wait(interval):
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"Failed to write metrics snapshot: {e}")
+
+
+def start_multiprocess(directory, interval):
+    """ワーカー（フォーク後）で呼び、値を interval 秒ごとに directory に書き出すスレッドを開始する。"""
+    global _multiproc_dir, _multiproc_thread
+    os.makedirs(directory, exist_ok=True)
+    _multiproc_dir = directory
+    _multiproc_stop.clear()
+    _multiproc_thread = threading.Thread(
+        target=_write_periodically, args=(interval,), name='metrics-snapshot', daemon=True
+    )
+    _multiproc_thread.start()
+
+
+def stop_multiprocess():
+    """ワーカーの終了時に呼び、最後の値を書き出す（カウンターは終了後も合算に残る）。"""
+    global _multiproc_thread
+    if _multiproc_thread is None:
+        return
+    _multiproc_stop.set()
+    _multiproc_thread.join(timeout=5)
+    _multiproc_thread = None
+    write_snapshot()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render_all():
+    """/metrics の本文。複数ワーカーの場合は他のワーカーが書き出した値も合算する。"""
+    if _multiproc_dir is None:
+        return REGISTRY.render()
+    others = []
+    own = f"{os.getpid()}.json"
+    for name in os.listdir(_multiproc_dir):
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            pid = int(name[:-len('.json')])
+            with open(os.path.join(_multiproc_dir, name), encoding='utf-8') as f:
+                others.append((json.load(f), _pid_alive(pid)))
+        except (ValueError, OSError):
+            continue
+    return REGISTRY.render(others)
+
+
+def chat_duration_labels(chat_id):
+    """CHAT_REQUEST_DURATION 用のラベル（chat_id ラベルは設定で有効な場合のみ）。"""
+    return {'chat_id': chat_id or 'unknown'} if settings.METRICS_CHAT_ID_LABEL else {}
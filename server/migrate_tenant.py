@@ -0,0 +1,262 @@
+"""Move tenants between Qdrant layouts (shared / shard / dedicated) without downtime.
+
+    cd server
+    python migrate_tenant.py status
+    python migrate_tenant.py prepare                      # 共有コレクションを is_tenant インデックス・テナントごとの HNSW に
+    python migrate_tenant.py plan                         # QDRANT_TENANT_DEDICATED_THRESHOLD 以上のテナントを表示
+    python migrate_tenant.py plan --apply                 # それらを専用コレクションへ移行
+    python migrate_tenant.py move <chat_id> --to dedicated
+    python migrate_tenant.py move <chat_id> --to shared
+
+移行の手順（tenancy.py の state）:
+
+1. migrating に切り替え、全ワーカーが配置を読み直すまで待つ（以降の書き込みは移行元・移行先の両方）
+2. 既存の点を移行先にコピーし（移行先の方が新しい点は上書きしない）、移行元に無い点を移行先から消す
+3. cutover に切り替えて待つ（読み込みが移行先に移る。書き込みは引き続き両方）
+4. active に切り替えて待ち、移行元からテナントの点（専用コレクションならコレクションごと）を削除する
+
+途中で中断した場合は同じコマンドを再実行すると続きから再開する。
+"""
+
+import argparse
+import sys
+import time
+
+from qdrant_client.http.models import FilterSelector, PointIdsList, PointStruct, ShardingMethod
+
+import settings
+import tenancy
+from collection_config import CONFIG
+from tenancy import ACTIVE, CUTOVER, DEDICATED, MIGRATING, SHARD, SHARED, Placement, TenantDirectory
+
+
+def _wait_for_workers(wait_sec, log):
+    if wait_sec > 0:
+        log(f"  waiting {wait_sec:.0f}s for workers to reload tenant placements ...")
+        time.sleep(wait_sec)
+
+
+def _prepare_target(client, chat_id, target, layout):
+    if layout == DEDICATED:
+        tenancy.ensure_serving_alias(client, target.collection)
+    elif layout == SHARD:
+        collection = tenancy.resolve_collection(client, settings.QDRANT_COLLECTION_NAME)
+        info = client.get_collection(collection)
+        if info.config.params.sharding_method != ShardingMethod.CUSTOM:
+            sys.exit(
+                f"'{settings.QDRANT_COLLECTION_NAME}' was not created with custom sharding "
+                "(QDRANT_SHARDING=custom); use --to dedicated instead"
+            )
+        try:
+            client.create_shard_key(collection, target.shard_key)
+        except Exception as e:
+            if 'already exists' not in str(e):
+                raise
+
+
+def copy_points(client, chat_id, source, target, batch_size):
+    """移行元のテナントの点を移行先にコピーする。移行先に同じか新しい版（timestamp）があれば残す。"""
+    copied = skipped = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=source.serving_name,
+            scroll_filter=tenancy.tenant_filter(chat_id),
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+            shard_key_selector=source.shard_key,
+        )
+        if records:
+            existing = {
+                record.id: (record.payload or {}).get('timestamp', 0)
+                for record in client.retrieve(
+                    collection_name=target.serving_name,
+                    ids=[record.id for record in records],
+                    with_payload=['timestamp'],
+                    shard_key_selector=target.shard_key,
+                )
+            }
+            points = [
+                PointStruct(id=record.id, vector=record.vector, payload=record.payload)
+                for record in records
+                if record.id not in existing or existing[record.id] < record.payload.get('timestamp', 0)
+            ]
+            if points:
+                client.upsert(collection_name=target.serving_name, points=points, shard_key_selector=target.shard_key)
+            copied += len(points)
+            skipped += len(records) - len(points)
+        if offset is None:
+            return copied, skipped
+
+
+def remove_stale_points(client, chat_id, source, target, batch_size):
+    """コピー中に移行元から削除された点を移行先からも削除する。"""
+    removed = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=target.serving_name,
+            scroll_filter=tenancy.tenant_filter(chat_id),
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            shard_key_selector=target.shard_key,
+        )
+        if records:
+            present = {
+                record.id
+                for record in client.retrieve(
+                    collection_name=source.serving_name,
+                    ids=[record.id for record in records],
+                    with_payload=False,
+                    shard_key_selector=source.shard_key,
+                )
+            }
+            stale = [record.id for record in records if record.id not in present]
+            if stale:
+                client.delete(
+                    collection_name=target.serving_name,
+                    points_selector=PointIdsList(points=stale),
+                    shard_key_selector=target.shard_key,
+                )
+            removed += len(stale)
+        if offset is None:
+            return removed
+
+
+def drop_source(client, chat_id, source):
+    if source.collection != settings.QDRANT_COLLECTION_NAME:
+        # 専用コレクションはエイリアスで読み書きしているので、実体と古い版を削除する（エイリアスも消える）
+        names = {collection.name for collection in client.get_collections().collections}
+        versions = [version for _, version in tenancy.collection_versions(client, source.collection)]
+        for name in [source.collection, *versions]:
+            if name in names:
+                client.delete_collection(name)
+        return
+    client.delete(
+        collection_name=source.serving_name,
+        points_selector=FilterSelector(filter=tenancy.tenant_filter(chat_id)),
+        shard_key_selector=source.shard_key,
+    )
+    if source.shard_key and source.shard_key != tenancy.DEFAULT_SHARD_KEY:
+        client.delete_shard_key(tenancy.resolve_collection(client, source.collection), source.shard_key)
+
+
+def move_tenant(client, chat_id, layout, wait_sec, batch_size=256, log=print):
+    directory = TenantDirectory(lambda: client, cache_ttl=0)
+    current = directory.placement(chat_id)
+    target = tenancy.target_for(chat_id, layout)
+    if current.state == ACTIVE:
+        # 記録済みの配置はコレクション名の付け方が変わる前のものでもそのまま使う
+        if current.layout == layout:
+            log(f"{chat_id}: already {layout}")
+            return
+        source = current.target
+    elif current.layout == layout:
+        target = current.target
+        source = current.source
+        log(f"{chat_id}: resuming migration to {layout} (state={current.state})")
+    else:
+        sys.exit(f"{chat_id} is being migrated to {current.layout}; finish that migration first")
+
+    log(f"{chat_id}: {source.collection} -> {layout} ({target.collection})")
+    _prepare_target(client, chat_id, target, layout)
+
+    if current.state != CUTOVER:
+        directory.save(Placement(chat_id, layout, target, MIGRATING, source))
+        log("  state=migrating (dual writes)")
+        _wait_for_workers(wait_sec, log)
+        copied, skipped = copy_points(client, chat_id, source, target, batch_size)
+        removed = remove_stale_points(client, chat_id, source, target, batch_size)
+        log(f"  copied {copied} points ({skipped} already up to date, {removed} stale removed)")
+
+    directory.save(Placement(chat_id, layout, target, CUTOVER, source))
+    log("  state=cutover (reads from the new layout)")
+    _wait_for_workers(wait_sec, log)
+
+    directory.save(Placement(chat_id, layout, target))
+    log("  state=active")
+    _wait_for_workers(wait_sec, log)
+
+    drop_source(client, chat_id, source)
+    log(f"  removed {chat_id} from {source.collection}")
+
+
+def tenant_sizes(client):
+    """テナントごとの点数と配置。Returns {chat_id: (count, Placement)}."""
+    directory = TenantDirectory(lambda: client, cache_ttl=0)
+    placements = directory.placements()
+    facet = client.facet(
+        collection_name=tenancy.serving_alias(settings.QDRANT_COLLECTION_NAME), key='chat_id', limit=100000, exact=True
+    )
+    sizes = {hit.value: (hit.count, tenancy.shared_placement(hit.value)) for hit in facet.hits}
+    for chat_id, placement in placements.items():
+        target = placement.read_target
+        count = client.count(
+            collection_name=target.serving_name,
+            count_filter=tenancy.tenant_filter(chat_id),
+            shard_key_selector=target.shard_key,
+        ).count
+        sizes[chat_id] = (count, placement)
+    return sizes
+
+
+def prepare_shared_collection(client, log=print):
+    name, _ = tenancy.ensure_serving_alias(client, settings.QDRANT_COLLECTION_NAME)
+    tenancy.ensure_payload_indexes(client, name)
+    tenancy.ensure_placements_collection(client)
+    if settings.QDRANT_TENANT_INDEX:
+        client.update_collection(collection_name=name, hnsw_config=CONFIG.hnsw_config(per_tenant=True))
+        log(f"{name}: per-tenant HNSW (m=0, payload_m={settings.QDRANT_TENANT_PAYLOAD_M}); "
+            "Qdrant rebuilds the index in the background")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--wait-sec', type=float, default=settings.QDRANT_TENANT_CACHE_TTL + 5,
+        help='配置を切り替えるたびに待つ秒数（ワーカーの QDRANT_TENANT_CACHE_TTL より長くする）',
+    )
+    parser.add_argument('--batch-size', type=int, default=256)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status')
+    sub.add_parser('prepare')
+    plan = sub.add_parser('plan')
+    plan.add_argument('--threshold', type=int, default=settings.QDRANT_TENANT_DEDICATED_THRESHOLD)
+    plan.add_argument('--to', choices=[DEDICATED, SHARD], default=DEDICATED)
+    plan.add_argument('--apply', action='store_true')
+    move = sub.add_parser('move')
+    move.add_argument('chat_id')
+    move.add_argument('--to', choices=list(tenancy.LAYOUTS), required=True)
+    args = parser.parse_args()
+
+    client = tenancy.admin_client()
+    if args.command == 'prepare':
+        prepare_shared_collection(client)
+    elif args.command == 'status':
+        sizes = tenant_sizes(client)
+        print(f"{'chat_id':<40} {'points':>9}  layout")
+        for chat_id, (count, placement) in sorted(sizes.items(), key=lambda item: -item[1][0]):
+            state = '' if placement.state == ACTIVE else f" ({placement.state})"
+            print(f"{chat_id:<40} {count:>9}  {placement.layout}{state}")
+    elif args.command == 'plan':
+        sizes = tenant_sizes(client)
+        moves = [
+            chat_id for chat_id, (count, placement) in sizes.items()
+            if placement.layout == SHARED and count >= args.threshold
+        ]
+        for chat_id in moves:
+            print(f"{chat_id}: {sizes[chat_id][0]} points -> {args.to}")
+        if not moves:
+            print(f"no shared tenant has {args.threshold} points or more")
+        if args.apply:
+            for chat_id in moves:
+                move_tenant(client, chat_id, args.to, args.wait_sec, args.batch_size)
+    elif args.command == 'move':
+        move_tenant(client, args.chat_id, args.to, args.wait_sec, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
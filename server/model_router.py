@@ -0,0 +1,101 @@
+"""Latency-aware routing across several Gemini models.
+
+GEMINI_MODELS の順にモデルを持ち、モデルごとに応答時間の指数移動平均（EWMA）と
+サーキットブレーカー（失敗率）を記録する。リクエストは健全なモデルのうち最も速いものに送る。
+
+速さの指標は EWMA と「実行中の呼び出しの最長経過時間」の大きい方。劣化が始まった直後でも
+完了を待たずに、実行中の呼び出しが長引いた時点で他のモデルに切り替わる。
+
+記録がないモデル（起動直後）の応答時間は見込みの値（GEMINI_ROUTER_PRIOR_MS）とし、記録は古くなるほど
+見込みの値に近づける（GEMINI_ROUTER_WINDOW_SEC ごとに差が約 1/e になる）。起動直後や暇な時間の後は
+GEMINI_MODELS の順に戻り、劣化して使われなくなったモデルも、選ばれているモデルが見込みより遅ければ
+再び試される。
+"""
+
+import itertools
+import math
+import threading
+import time
+
+import settings
+from circuit_breaker import OPEN, CircuitBreaker
+from metrics import LLM_MODEL_LATENCY, LLM_MODEL_REQUESTS
+
+EWMA_ALPHA = 0.2
+
+
+class ModelStats:
+    def __init__(self, name, index, window_sec, prior):
+        self.name = name
+        self.index = index
+        self.window_sec = window_sec
+        self.prior = prior
+        self.breaker = CircuitBreaker(f'gemini:{name}')
+        self._lock = threading.Lock()
+        self._ewma = None
+        self._updated = 0.0
+        self._in_flight = {}  # token -> start
+        self._tokens = itertools.count()
+
+    def start(self):
+        token = next(self._tokens)
+        with self._lock:
+            self._in_flight[token] = time.monotonic()
+        return token
+
+    def finish(self, token, result):
+        """呼び出しの終了を記録する（result: success / error / timeout / cancelled）。
+
+        timeout / cancelled（期限切れやヘッジで負けた呼び出し）の経過時間も
+        「少なくともこれだけかかる」値として応答時間に含める。
+        """
+        now = time.monotonic()
+        with self._lock:
+            latency = now - self._in_flight.pop(token, now)
+            if result != 'error':
+                if self._ewma is None:
+                    self._ewma = latency
+                else:
+                    self._ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self._decayed(now)
+                self._updated = now
+        LLM_MODEL_REQUESTS.inc(model=self.name, result=result)
+        if result == 'success':
+            LLM_MODEL_LATENCY.observe(latency, model=self.name)
+
+    def _decayed(self, now):
+        """経過時間に応じて見込みの値に近づけた EWMA（self._lock を保持して呼ぶ）。"""
+        if self._ewma is None:
+            return self.prior
+        weight = math.exp(-max(0.0, now - self._updated) / self.window_sec) if self.window_sec > 0 else 0.0
+        return self.prior + (self._ewma - self.prior) * weight
+
+    def score(self, now):
+        with self._lock:
+            longest = max((now - started for started in self._in_flight.values()), default=0.0)
+            return max(self._decayed(now), longest)
+
+    def snapshot(self, now):
+        return {
+            'model': self.name,
+            'latency_ms': round(self.score(now) * 1000, 1),
+            'in_flight': len(self._in_flight),
+            'circuit': self.breaker.state,
+        }
+
+
+class ModelRouter:
+    def __init__(self, models, window_sec=None, hedge_after=None, prior=None):
+        window_sec = settings.GEMINI_ROUTER_WINDOW_SEC if window_sec is None else window_sec
+        prior = settings.GEMINI_ROUTER_PRIOR_MS / 1000 if prior is None else prior
+        self.models = [ModelStats(name, i, window_sec, prior) for i, name in enumerate(models)]
+        self.hedge_after = settings.GEMINI_HEDGE_AFTER_MS / 1000 if hedge_after is None else hedge_after
+
+    def candidates(self):
+        """ブレーカーが open でないモデルを速い順に返す（10 ms 未満の差は同じとみなし GEMINI_MODELS の順）。"""
+        now = time.monotonic()
+        healthy = [model for model in self.models if model.breaker.state != OPEN]
+        return sorted(healthy, key=lambda model: (round(model.score(now), 2), model.index))
+
+    def stats(self):
+        now = time.monotonic()
+        return [model.snapshot(now) for model in self.models]
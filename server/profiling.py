@@ -0,0 +1,323 @@
+"""On-demand per-request profiling.
+
+`@profiled` を付けたエンドポイント（/api/chat と取り込み系）で、対象リクエストだけ
+プロファイラを動かして結果を PROFILE_OUTPUT_DIR に保存する。
+
+対象になるのは次のどちらか:
+- `X-Profile: 1` と `X-Admin-API-Key: <ADMIN_API_KEY>` を付けたリクエスト
+- PROFILE_SAMPLE_RATE（/api/admin/profiling で実行中に変更可）でサンプリングされたリクエスト
+  （gunicorn の複数ワーカーでは MULTIPROC_DIR のファイルを介して全ワーカーに反映する）
+
+出力形式:
+- speedscope（デフォルト）: 別スレッドから対象スレッドのスタックを定期的に採取する
+  統計的プロファイラ。https://www.speedscope.app/ で開ける
+- pstats: cProfile の結果。`python -m pstats <file>` や snakeviz で開ける
+
+取り込み系リクエストでは `X-Profile-Memory: 1`（または PROFILE_TRACEMALLOC=true）で
+tracemalloc の差分スナップショットも保存する。
+
+ASGI モード（asgi.py）の /api/chat は profile_async() で同じようにプロファイルする
+（speedscope ではイベントループのスレッドを採取するため、同時に処理中の他のリクエストも含まれる）。
+
+保存したファイル名はレスポンスの X-Profile-Artifacts ヘッダーに返し、
+GET /api/admin/profiles/<name>（ADMIN_API_KEY 必須）でダウンロードできる。
+"""
+
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+from flask import request
+
+import request_state
+import settings
+from auth import is_admin_request
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+FORMATS = ('speedscope', 'pstats')
+# ダウンロードを許可するファイル名（_artifact_path が作る名前のみ）
+_ARTIFACT_NAME = re.compile(r'^[0-9T]+-[A-Za-z0-9_.-]+\.(speedscope\.json|pstats|tracemalloc\.txt)$')
+
+# 本番で同時に複数のプロファイラを動かさないようにする
+_slots = threading.BoundedSemaphore(settings.PROFILE_MAX_CONCURRENT)
+_state_lock = threading.Lock()
+_sample_rate = settings.PROFILE_SAMPLE_RATE
+# 他のワーカーが変更したサンプリング率を読み直す間隔（秒）
+_SHARED_RATE_TTL = 1.0
+_shared_rate_checked_at = 0.0
+
+
+def _shared_rate_path():
+    return os.path.join(settings.MULTIPROC_DIR, 'profile_sample_rate') if settings.MULTIPROC_DIR else None
+
+
+def get_sample_rate():
+    global _sample_rate, _shared_rate_checked_at
+    path = _shared_rate_path()
+    if path is not None and time.monotonic() - _shared_rate_checked_at >= _SHARED_RATE_TTL:
+        _shared_rate_checked_at = time.monotonic()
+        try:
+            with open(path, encoding='utf-8') as f:
+                _sample_rate = min(max(float(f.read()), 0.0), 1.0)
+        except (OSError, ValueError):
+            pass
+    return _sample_rate
+
+
+def set_sample_rate(rate):
+    global _sample_rate
+    with _state_lock:
+        _sample_rate = min(max(float(rate), 0.0), 1.0)
+        path = _shared_rate_path()
+        if path is not None:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(repr(_sample_rate))
+            os.replace(tmp_path, path)
+    return _sample_rate
+
+
+def _header(headers, name):
+    if headers is None:
+        return request.headers.get(name)
+    return headers.get(name.lower())
+
+
+def _requested_format(headers=None):
+    fmt = (_header(headers, 'X-Profile-Format') or settings.PROFILE_FORMAT).strip().lower()
+    return fmt if fmt in FORMATS else 'speedscope'
+
+
+def _should_profile(headers=None):
+    if _header(headers, 'X-Profile') == '1' and is_admin_request(headers):
+        return True
+    rate = get_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def _should_trace_memory():
+    if request.headers.get('X-Profile-Memory') == '1' and is_admin_request():
+        return True
+    return settings.PROFILE_TRACEMALLOC
+
+
+def artifact_path(name):
+    """ダウンロード用に、PROFILE_OUTPUT_DIR にある保存済みのファイルのパスを返す（無ければ None）。"""
+    if not _ARTIFACT_NAME.match(name or ''):
+        return None
+    path = os.path.join(settings.PROFILE_OUTPUT_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def list_artifacts():
+    """保存済みのファイルを新しい順に返す。"""
+    try:
+        names = [name for name in os.listdir(settings.PROFILE_OUTPUT_DIR) if _ARTIFACT_NAME.match(name)]
+    except FileNotFoundError:
+        return []
+    artifacts = []
+    for name in names:
+        stat = os.stat(os.path.join(settings.PROFILE_OUTPUT_DIR, name))
+        artifacts.append({'name': name, 'size': stat.st_size, 'created_at': stat.st_mtime})
+    return sorted(artifacts, key=lambda a: a['created_at'], reverse=True)
+
+
+class SamplingProfiler:
+    """対象スレッドのスタックを interval 秒ごとに採取する統計的プロファイラ。"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self._frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.start_time = None
+        self.end_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.end_time = time.perf_counter()
+
+    def _frame_id(self, code, lineno):
+        key = (code.co_filename, code.co_name, code.co_firstlineno)
+        index = self._frame_index.get(key)
+        if index is None:
+            index = self._frame_index[key] = len(self.frames)
+            self.frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+        return index
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_id(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append((now - last) * 1000)
+            last = now
+
+    def to_speedscope(self, name):
+        duration_ms = ((self.end_time or time.perf_counter()) - self.start_time) * 1000
+        return {
+            '$schema': SPEEDSCOPE_SCHEMA,
+            'name': name,
+            'exporter': 'ai-chat-iflame-server',
+            'activeProfileIndex': 0,
+            'shared': {'frames': self.frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': round(duration_ms, 3),
+                'samples': self.samples,
+                'weights': [round(w, 3) for w in self.weights],
+            }],
+        }
+
+
+def _artifact_path(suffix):
+    state = request_state.current()
+    os.makedirs(settings.PROFILE_OUTPUT_DIR, exist_ok=True)
+    stamp = time.strftime('%Y%m%dT%H%M%S')
+    return os.path.join(settings.PROFILE_OUTPUT_DIR, f"{stamp}-{state.metrics_endpoint}-{state.request_id}.{suffix}")
+
+
+def _write_tracemalloc_diff(before, after, path, label, limit=30):
+    stats = after.compare_to(before, 'lineno')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"# tracemalloc diff for {label} ({request_state.current().request_id})\n")
+        for stat in stats[:limit]:
+            f.write(f"{stat}\n")
+
+
+def profiled(memory=False):
+    """対象リクエストのみプロファイルするデコレーター。
+
+    memory=True のエンドポイント（取り込み系）は tracemalloc の差分も保存できる。
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _should_profile():
+                return fn(*args, **kwargs)
+            if not _slots.acquire(blocking=False):
+                print(f"Profiling skipped for {request_state.current().request_id}: another profile is running")
+                return fn(*args, **kwargs)
+            try:
+                return _run_profiled(fn, args, kwargs, memory and _should_trace_memory())
+            finally:
+                _slots.release()
+
+        return wrapper
+
+    return decorator
+
+
+async def profile_async(headers, label, fn, *args):
+    """asyncio のハンドラー（asgi.py の /api/chat）用。対象リクエストなら fn(*args) をプロファイルしながら待つ。
+
+    headers は小文字のキーのリクエストヘッダー。
+    """
+    if not _should_profile(headers):
+        return await fn(*args)
+    if not _slots.acquire(blocking=False):
+        print(f"Profiling skipped for {request_state.current().request_id}: another profile is running")
+        return await fn(*args)
+    try:
+        fmt = _requested_format(headers)
+        profiler = _start_profiler(fmt)
+        try:
+            return await fn(*args)
+        finally:
+            _save_profile(profiler, fmt, label)
+    finally:
+        _slots.release()
+
+
+def _start_profiler(fmt):
+    """呼び出したスレッド（asyncio ではイベントループのスレッド）のプロファイラを開始する。"""
+    if fmt == 'pstats':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = SamplingProfiler(threading.get_ident(), settings.PROFILE_INTERVAL_MS / 1000)
+        profiler.start()
+    return profiler
+
+
+def _save_profile(profiler, fmt, label, snapshot_before=None):
+    """プロファイラを止めて結果を保存し、リクエスト状態の profile_artifacts に記録する。"""
+    state = request_state.current()
+    artifacts = []
+    try:
+        if fmt == 'pstats':
+            profiler.disable()
+            path = _artifact_path('pstats')
+            profiler.dump_stats(path)
+        else:
+            profiler.stop()
+            path = _artifact_path('speedscope.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(profiler.to_speedscope(label), f)
+        artifacts.append(path)
+
+        if snapshot_before is not None:
+            snapshot_after = tracemalloc.take_snapshot()
+            path = _artifact_path('tracemalloc.txt')
+            _write_tracemalloc_diff(snapshot_before, snapshot_after, path, label)
+            artifacts.append(path)
+    except Exception as e:
+        print(f"Failed to write profile for {state.request_id}: {e}")
+    if artifacts:
+        state.profile_artifacts = artifacts
+        print(f"Profile saved for {state.request_id}: {', '.join(artifacts)}")
+
+
+def artifacts_header(artifacts):
+    """X-Profile-Artifacts ヘッダーの値（ダウンロード用のファイル名）。"""
+    return ', '.join(os.path.basename(path) for path in artifacts)
+
+
+def _run_profiled(fn, args, kwargs, trace_memory):
+    fmt = _requested_format()
+
+    started_tracemalloc = False
+    snapshot_before = None
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(settings.PROFILE_TRACEMALLOC_FRAMES)
+            started_tracemalloc = True
+        snapshot_before = tracemalloc.take_snapshot()
+
+    profiler = _start_profiler(fmt)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        try:
+            _save_profile(profiler, fmt, f"{request.method} {request.path}", snapshot_before)
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
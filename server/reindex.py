@@ -0,0 +1,427 @@
+"""Re-embed the knowledge into a new versioned collection and switch to it through an alias.
+
+埋め込みモデル（EMBEDDING_MODEL）やベクトルの次元数・保存形式を変えるときに、既存のナレッジを
+保存済みの text から埋め込み直す。アプリは論理名（QDRANT_COLLECTION_NAME、テナント専用コレクション名）の
+エイリアス `<name>__live`（tenancy.serving_alias）で読み書きするので、実体を `<name>_v<N>` に作り直して
+エイリアスを付け替える。読み書き中のコレクションは削除しない。
+
+    cd server
+    python reindex.py status
+    EMBEDDING_MODEL=<new model> python reindex.py build   # 新しい版を作って埋め込み直す（中断しても再実行で続きから）
+    python reindex.py switch                              # 差分を反映し、エイリアスを新しい版に切り替える
+    python reindex.py finalize                            # 切り替え後に古いワーカーが書き込んだ点を埋め込み直す
+    python reindex.py switch --to chat_context_v2         # 以前の版に戻す
+    python reindex.py cleanup                             # エイリアスが指していない古い版を削除する
+
+手順:
+
+1. build: 現在のコレクションをページごとに（ベクトルなしで）読み、text を --batch-size ずつ埋め込んで
+   新しい版に書き込む。ページごとに続きの位置を `<QDRANT_COLLECTION_NAME>__reindex` に記録する。
+   読み終えたら、開始後に追加・更新された点（timestamp）を埋め込み直し、削除された点を新しい版から消す
+2. switch: もう一度差分を反映してから、1 回の API 呼び出しでエイリアスを原子的に付け替える。
+   エイリアスはアプリの起動時に作られる（エイリアスを使う前に作ったコレクション `<name>` にはエイリアスを
+   向けるだけ）ため、エイリアスが無ければ（アプリをまだデプロイしていなければ）切り替えない
+3. モデルを変えた場合は switch の直後に EMBEDDING_MODEL / EMBEDDING_VECTOR_SIZE を変えてデプロイし、
+   古いワーカーが無くなってから finalize を実行する
+4. cleanup: エイリアスが指していない古い版（エイリアスを使う前の `<name>` を含む）を削除する
+"""
+
+import argparse
+import sys
+import time
+import uuid
+from dataclasses import replace
+
+from qdrant_client.http.models import (
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+    FieldCondition,
+    Filter,
+    PointIdsList,
+    PointStruct,
+    Range,
+    ShardingMethod,
+)
+
+import embedding_cache
+import settings
+import tenancy
+from collection_config import CONFIG, knowledge_collections
+
+BUILDING = 'building'
+BUILT = 'built'
+SWITCHED = 'switched'
+DONE = 'done'
+
+# 「以降に書き込まれた点」を timestamp で探すときの余裕（ワーカーとの時計のずれ）
+CLOCK_SKEW_SEC = 60
+PROGRESS_INTERVAL_SEC = 10
+
+
+def state_collection():
+    return f"{settings.QDRANT_COLLECTION_NAME}__reindex"
+
+
+def _state_id(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"reindex:{name}"))
+
+
+def load_state(client, name):
+    if not client.collection_exists(state_collection()):
+        return None
+    records = client.retrieve(collection_name=state_collection(), ids=[_state_id(name)], with_payload=True)
+    return dict(records[0].payload) if records else None
+
+
+def save_state(client, state):
+    if not client.collection_exists(state_collection()):
+        client.create_collection(collection_name=state_collection(), vectors_config={})
+    state['updated_at'] = time.time()
+    client.upsert(
+        collection_name=state_collection(),
+        points=[PointStruct(id=_state_id(state['collection']), vector={}, payload=state)],
+    )
+
+
+def _since_filter(since):
+    return Filter(must=[FieldCondition(key='timestamp', range=Range(gte=since))])
+
+
+def _set_alias(client, name, collection):
+    """name のエイリアスを collection に付け替える（1 回の API 呼び出しで原子的に切り替わる）。
+
+    以前の reindex.py で作ったエイリアス name も同じ向きにそろえる。
+    """
+    aliases = {alias.alias_name for alias in client.get_aliases().aliases}
+    names = [tenancy.serving_alias(name)] + ([name] if name in aliases else [])
+    operations = []
+    for alias in names:
+        if alias in aliases:
+            operations.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)))
+        operations.append(CreateAliasOperation(create_alias=CreateAlias(collection_name=collection, alias_name=alias)))
+    client.update_collection_aliases(change_aliases_operations=operations)
+
+
+def _has_serving_alias(client, name):
+    return any(alias.alias_name == tenancy.serving_alias(name) for alias in client.get_aliases().aliases)
+
+
+class Reindexer:
+    """1 つの論理名（共有コレクションまたはテナント専用コレクション）の埋め込み直し。"""
+
+    def __init__(self, client, name, model=None, page_size=256, batch_size=64, log=print):
+        self.client = client
+        self.name = name
+        self.model = model
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.log = log
+        self._directory = tenancy.TenantDirectory(lambda: client, cache_ttl=60)
+        self._custom_sharding = None
+        self._shard_keys = set()
+
+    # --- writing ---
+
+    def _keys_for(self, target, chat_id):
+        """点を書き込むシャードキー（カスタムシャーディングでなければ [None]）。"""
+        if self._custom_sharding is None:
+            info = self.client.get_collection(target)
+            self._custom_sharding = info.config.params.sharding_method == ShardingMethod.CUSTOM
+        if not self._custom_sharding:
+            return [None]
+        placement = self._directory.placement(chat_id) if chat_id else None
+        keys = [
+            t.shard_key for t in (placement.write_targets if placement else [])
+            if t.collection == self.name and t.shard_key
+        ] or [tenancy.DEFAULT_SHARD_KEY]
+        for key in keys:
+            if key not in self._shard_keys:
+                try:
+                    self.client.create_shard_key(target, key)
+                except Exception as e:
+                    if 'already exists' not in str(e):
+                        raise
+                self._shard_keys.add(key)
+        return keys
+
+    def reembed(self, records, target):
+        """records の text を埋め込み直して target に書き込む。text の無い点は書き込まない。Returns written count."""
+        records = [r for r in records if isinstance((r.payload or {}).get('text'), str) and r.payload['text'].strip()]
+        if not records:
+            return 0
+        vectors = self.model.encode([r.payload['text'] for r in records], batch_size=self.batch_size)
+        groups = {}
+        for record, vector in zip(records, vectors):
+            point = PointStruct(id=record.id, vector=vector.tolist(), payload=record.payload)
+            for key in self._keys_for(target, record.payload.get('chat_id')):
+                groups.setdefault(key, []).append(point)
+        for key, points in groups.items():
+            self.client.upsert(collection_name=target, points=points, shard_key_selector=key, wait=True)
+        return len(records)
+
+    # --- catch-up ---
+
+    def copy_newer(self, source, target, since):
+        """since 以降に source へ書き込まれた点のうち、target に無いか古いものを埋め込み直す。"""
+        written = 0
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=source,
+                scroll_filter=_since_filter(since),
+                limit=self.page_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False,
+            )
+            if records:
+                existing = {
+                    record.id: (record.payload or {}).get('timestamp', 0)
+                    for record in self.client.retrieve(
+                        collection_name=target, ids=[record.id for record in records], with_payload=['timestamp']
+                    )
+                }
+                written += self.reembed(
+                    [
+                        record for record in records
+                        if record.id not in existing or existing[record.id] < record.payload.get('timestamp', 0)
+                    ],
+                    target,
+                )
+            if offset is None:
+                return written
+
+    def remove_stale(self, source, target):
+        """source から削除された点を target からも削除する。"""
+        removed = 0
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=target, limit=self.page_size * 4, offset=offset, with_payload=False
+            )
+            if records:
+                present = {
+                    record.id
+                    for record in self.client.retrieve(
+                        collection_name=source, ids=[record.id for record in records], with_payload=False
+                    )
+                }
+                stale = [record.id for record in records if record.id not in present]
+                if stale:
+                    self.client.delete(collection_name=target, points_selector=PointIdsList(points=stale))
+                removed += len(stale)
+            if offset is None:
+                return removed
+
+    def catch_up(self, state):
+        started = time.time()
+        written = self.copy_newer(state['source'], state['target'], state['caught_up_at'] - CLOCK_SKEW_SEC)
+        removed = self.remove_stale(state['source'], state['target'])
+        state['caught_up_at'] = started
+        self.log(f"  caught up: {written} points re-embedded, {removed} removed")
+
+    # --- commands ---
+
+    def build(self, model_name):
+        state = load_state(self.client, self.name)
+        if state and state['phase'] in (BUILT, SWITCHED):
+            self.log(f"{self.name}: {state['target']} is {state['phase']}; run switch/finalize first")
+            return
+        vector_size = self.model.get_sentence_embedding_dimension()
+        if state and state['phase'] == BUILDING:
+            if state['model'] != model_name:
+                sys.exit(f"{self.name} is being rebuilt with {state['model']}; rerun with that model or cleanup first")
+            self.log(f"{self.name}: resuming {state['target']} ({state['copied']} points done)")
+        else:
+            versions = tenancy.collection_versions(self.client, self.name)
+            source = tenancy.resolve_collection(self.client, self.name)
+            info = self.client.get_collection(source)
+            state = {
+                'collection': self.name,
+                'source': source,
+                'target': f"{self.name}_v{(versions[-1][0] if versions else 1) + 1}",
+                'model': model_name,
+                'vector_size': vector_size,
+                'phase': BUILDING,
+                'offset': None,
+                'scanned': False,
+                'copied': 0,
+                'skipped': 0,
+                'started_at': time.time(),
+            }
+            state['caught_up_at'] = state['started_at']
+            tenancy.create_knowledge_collection(
+                self.client,
+                state['target'],
+                custom_sharding=info.config.params.sharding_method == ShardingMethod.CUSTOM,
+                config=replace(CONFIG, vector_size=vector_size),
+                alias_of=self.name,
+            )
+            save_state(self.client, state)
+            self.log(f"{self.name}: {source} ({info.points_count} points) -> {state['target']} ({model_name}, {vector_size} dims)")
+
+        start = last_log = time.time()
+        done_at_start = state['copied']
+        while not state['scanned']:
+            records, offset = self.client.scroll(
+                collection_name=state['source'],
+                limit=self.page_size,
+                offset=state['offset'],
+                with_payload=True,
+                with_vectors=False,
+            )
+            written = self.reembed(records, state['target'])
+            state['copied'] += written
+            state['skipped'] += len(records) - written
+            state['offset'] = offset
+            state['scanned'] = offset is None
+            save_state(self.client, state)
+            if time.time() - last_log >= PROGRESS_INTERVAL_SEC or state['scanned']:
+                rate = (state['copied'] - done_at_start) / max(time.time() - start, 1e-6)
+                self.log(f"  {state['copied']} points re-embedded, {state['skipped']} without text ({rate:.0f}/s)")
+                last_log = time.time()
+
+        self.catch_up(state)
+        state['phase'] = BUILT
+        save_state(self.client, state)
+        self.log(f"  {state['target']} is ready; run `python reindex.py switch` to route traffic to it")
+
+    def switch(self):
+        state = load_state(self.client, self.name)
+        if not state or state['phase'] != BUILT:
+            phase = state['phase'] if state else 'not started'
+            self.log(f"{self.name}: nothing to switch ({phase})")
+            return
+        if not _has_serving_alias(self.client, self.name):
+            sys.exit(
+                f"'{tenancy.serving_alias(self.name)}' does not exist; deploy the app first (it serves "
+                f"'{self.name}' through that alias), then rerun switch"
+            )
+        self.catch_up(state)
+        switching_at = time.time()
+        _set_alias(self.client, self.name, state['target'])
+        self.log(f"  alias {tenancy.serving_alias(self.name)} -> {state['target']}")
+        # 最後の差分の反映から切り替えまでに旧版へ書き込まれた点（旧版は削除しない）
+        written = self.copy_newer(state['source'], state['target'], switching_at - CLOCK_SKEW_SEC)
+        self.log(f"  {written} points written to {state['source']} during the switch re-embedded")
+        state.update(phase=SWITCHED, switched_at=switching_at)
+        save_state(self.client, state)
+        if state['model'] != settings.EMBEDDING_MODEL or state['vector_size'] != settings.EMBEDDING_VECTOR_SIZE:
+            self.log(
+                f"  deploy with EMBEDDING_MODEL={state['model']} EMBEDDING_VECTOR_SIZE={state['vector_size']} now, "
+                "then run `python reindex.py finalize` once the old workers are gone"
+            )
+
+    def finalize(self):
+        state = load_state(self.client, self.name)
+        if not state or state['phase'] != SWITCHED:
+            self.log(f"{self.name}: nothing to finalize ({state['phase'] if state else 'not started'})")
+            return
+        written = 0
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=state['target'],
+                scroll_filter=_since_filter(state['switched_at'] - CLOCK_SKEW_SEC),
+                limit=self.page_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False,
+            )
+            written += self.reembed(records, state['target'])
+            if offset is None:
+                break
+        state['phase'] = DONE
+        save_state(self.client, state)
+        self.log(f"{self.name}: {written} points written since the switch re-embedded with {state['model']}")
+
+    def cleanup(self):
+        current = tenancy.resolve_collection(self.client, self.name)
+        state = load_state(self.client, self.name) or {}
+        keep = {current}
+        if state.get('phase') in (BUILDING, BUILT):
+            keep.add(state['target'])
+        collections = {collection.name for collection in self.client.get_collections().collections}
+        # エイリアスを使う前に作ったコレクション（切り替え後はどのエイリアスも指していない）
+        legacy = [self.name] if self.name in collections else []
+        for version in legacy + [version for _, version in tenancy.collection_versions(self.client, self.name)]:
+            if version not in keep:
+                self.client.delete_collection(version)
+                self.log(f"  deleted {version}")
+
+    def status(self):
+        current = tenancy.resolve_collection(self.client, self.name)
+        info = self.client.get_collection(current)
+        size = getattr(info.config.params.vectors, 'size', None)
+        alias = f" ({tenancy.serving_alias(self.name)}) -> {current}" if current != self.name else ''
+        self.log(f"{self.name}{alias}: {info.points_count} points, {size} dims")
+        state = load_state(self.client, self.name)
+        if state and state['phase'] != DONE:
+            self.log(
+                f"  {state['phase']}: {state['source']} -> {state['target']} ({state['model']}), "
+                f"{state['copied']} re-embedded, {state['skipped']} without text"
+            )
+        versions = [v for _, v in tenancy.collection_versions(self.client, self.name) if v != current]
+        if versions:
+            self.log(f"  other versions: {', '.join(versions)}")
+
+
+def _load_model(name):
+    from sentence_transformers import SentenceTransformer
+
+    return embedding_cache.cached(SentenceTransformer(name), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--collection', help='対象の論理名（既定: 共有コレクションと全テナント専用コレクション）')
+    parser.add_argument('--page-size', type=int, default=256, help='1 回に読み込む点数（メモリ使用量の上限）')
+    parser.add_argument('--batch-size', type=int, default=64, help='埋め込みのバッチサイズ')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status')
+    build = sub.add_parser('build')
+    build.add_argument('--model', default=settings.EMBEDDING_MODEL)
+    switch = sub.add_parser('switch')
+    switch.add_argument('--to', help='指定した版（例: chat_context_v2）にエイリアスを戻す（--collection と併用）')
+    sub.add_parser('finalize')
+    sub.add_parser('cleanup')
+    args = parser.parse_args()
+
+    client = tenancy.admin_client()
+    names = [args.collection] if args.collection else knowledge_collections(client)
+
+    if args.command == 'switch' and args.to:
+        if not args.collection:
+            sys.exit("--to requires --collection")
+        _set_alias(client, args.collection, args.to)
+        print(f"alias {args.collection} -> {args.to}")
+        return
+
+    model = None
+    if args.command == 'build':
+        model = _load_model(args.model)
+    elif args.command in ('switch', 'finalize'):
+        # 埋め込みには build に使ったモデルを使う
+        models = {state['model'] for state in (load_state(client, name) for name in names) if state}
+        if len(models) > 1:
+            sys.exit(f"collections were built with different models ({', '.join(sorted(models))}); use --collection")
+        model = _load_model(models.pop()) if models else None
+
+    for name in names:
+        reindexer = Reindexer(client, name, model, args.page_size, args.batch_size)
+        if args.command == 'status':
+            reindexer.status()
+        elif args.command == 'build':
+            reindexer.build(args.model)
+        elif args.command == 'switch':
+            reindexer.switch()
+        elif args.command == 'finalize':
+            reindexer.finalize()
+        elif args.command == 'cleanup':
+            reindexer.cleanup()
+
+
+if __name__ == '__main__':
+    main()
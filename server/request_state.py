@@ -0,0 +1,29 @@
+"""Per-request state shared by the Flask and asyncio serving paths.
+
+Flask のリクエスト中は flask.g を、ASGI の /api/chat（asgi.py）では contextvars に
+保持した g 互換のオブジェクトを返す。timing / tracing / structured_logging は
+どちらの経路でも current() を通して request_id やステージ別の所要時間を参照する。
+"""
+
+from contextvars import ContextVar
+
+from flask import g, has_app_context
+from flask.ctx import _AppCtxGlobals
+
+_state: ContextVar = ContextVar('request_state', default=None)
+
+
+def current():
+    """現在のリクエストの状態（g 互換）を返す。リクエスト外なら None。"""
+    if has_app_context():
+        return g
+    return _state.get()
+
+
+def begin(**values):
+    """asyncio のリクエスト処理の先頭で呼び、そのタスク専用の状態を作る。"""
+    state = _AppCtxGlobals()
+    for key, value in values.items():
+        setattr(state, key, value)
+    _state.set(state)
+    return state
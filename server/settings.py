@@ -5,6 +5,16 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def _get_float_env(name, default):
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        return default
+
+
 def _get_int_env(name, default):
     raw = os.getenv(name)
     if raw is None:
@@ -16,22 +26,107 @@ def _get_int_env(name, default):
         return default
 
 
+def _get_non_negative_int_env(name, default):
+    """0 に意味がある（無効にする・既定値に任せる）設定用。負の値と不正な値は default。"""
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+        return value if value >= 0 else default
+    except ValueError:
+        return default
+
+
 UPLOAD_FOLDER = '/tmp/uploads'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'md', 'json'}
 MAX_FILE_SIZE = 16 * 1024 * 1024
+# multipart のヘッダーやフォーム項目の分だけ余裕を持たせたリクエスト全体の上限
+MAX_REQUEST_SIZE = MAX_FILE_SIZE + 64 * 1024
+UPLOAD_SPOOL_MAX_BYTES = _get_int_env('UPLOAD_SPOOL_MAX_BYTES', 1024 * 1024)
+
+URL_FETCH_MAX_BYTES = _get_int_env('URL_FETCH_MAX_BYTES', 5 * 1024 * 1024)
+URL_FETCH_TIMEOUT_SEC = _get_int_env('URL_FETCH_TIMEOUT_SEC', 10)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-2.0-flash-lite')
-
-
-QDRANT_COLLECTION_NAME = "chat_context"
+# 振り分け先のモデル（カンマ区切り、優先順）。未設定なら GEMINI_MODEL_NAME のみ
+GEMINI_MODELS = [m.strip() for m in os.getenv('GEMINI_MODELS', '').split(',') if m.strip()] or [GEMINI_MODEL_NAME]
+# 応答時間の記録が古くなる速さ（秒）。この秒数ごとに見込みの値との差が約 1/e になる
+GEMINI_ROUTER_WINDOW_SEC = _get_int_env('GEMINI_ROUTER_WINDOW_SEC', 60)
+# 記録がない（古くなった）モデルの応答時間の見込み（ミリ秒）
+GEMINI_ROUTER_PRIOR_MS = _get_int_env('GEMINI_ROUTER_PRIOR_MS', 2000)
+# この時間（ミリ秒）応答がなければ次に速いモデルにも同じリクエストを送る（0 で無効）
+GEMINI_HEDGE_AFTER_MS = _get_int_env('GEMINI_HEDGE_AFTER_MS', 0)
+# 同期（Flask）経路でヘッジに使うスレッド数
+GEMINI_HEDGE_THREADS = _get_int_env('GEMINI_HEDGE_THREADS', 32)
+GEMINI_MAX_CONNECTIONS = _get_int_env('GEMINI_MAX_CONNECTIONS', 1000)
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL', '').strip() or None
+
+
+# 埋め込みモデルとベクトルの次元数（変更した場合は reindex.py で既存のナレッジを埋め込み直す）
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+EMBEDDING_VECTOR_SIZE = _get_int_env('EMBEDDING_VECTOR_SIZE', 384)
+# 埋め込みの永続キャッシュ（モデル名と正規化したテキストのハッシュをキーに SQLite に保存する）
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'data/embedding_cache.sqlite3')
+# 上限を超えたら最後に使われた時刻の古いものから消す（Cloud Run のディスクはメモリを使う点に注意）
+EMBEDDING_CACHE_MAX_MB = _get_int_env('EMBEDDING_CACHE_MAX_MB', 256)
+# float16 は float32 の半分の大きさ（コサイン類似度の誤差は 1e-3 程度）
+EMBEDDING_CACHE_DTYPE = os.getenv('EMBEDDING_CACHE_DTYPE', 'float16').strip().lower()
+
+QDRANT_COLLECTION_NAME = os.getenv('QDRANT_COLLECTION_NAME', 'chat_context')
 QDRANT_URL = os.getenv('QDRANT_URL')
 QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
 QDRANT_HOST = os.getenv('QDRANT_HOST', 'vectordb')
 QDRANT_PORT = int(os.getenv('QDRANT_PORT', '6333'))
+# gRPC で接続する（チャネルはプロセス内で使い回す）。QDRANT_URL のホスト、または QDRANT_HOST の QDRANT_GRPC_PORT に接続
+QDRANT_PREFER_GRPC = os.getenv('QDRANT_PREFER_GRPC', 'false').lower() == 'true'
+QDRANT_GRPC_PORT = _get_int_env('QDRANT_GRPC_PORT', 6334)
+# アイドル中もチャネルを維持するための keepalive 間隔（0 で gRPC の既定値）
+QDRANT_GRPC_KEEPALIVE_MS = _get_non_negative_int_env('QDRANT_GRPC_KEEPALIVE_MS', 30000)
+# chat_id を is_tenant のインデックスにし、共有コレクションの HNSW をテナントごとのグラフ（payload_m）で作る
+QDRANT_TENANT_INDEX = os.getenv('QDRANT_TENANT_INDEX', 'true').lower() == 'true'
+QDRANT_TENANT_PAYLOAD_M = _get_int_env('QDRANT_TENANT_PAYLOAD_M', 16)
+# 共有コレクション作成時のシャーディング（custom でテナント専用のシャードキーを使えるようにする）
+QDRANT_SHARDING = os.getenv('QDRANT_SHARDING', 'auto').strip().lower()
+# テナントの配置（tenancy.py）を読み直す間隔（秒）
+QDRANT_TENANT_CACHE_TTL = _get_int_env('QDRANT_TENANT_CACHE_TTL', 30)
+# migrate_tenant.py plan で専用コレクションへの移行を提案する点数
+QDRANT_TENANT_DEDICATED_THRESHOLD = _get_int_env('QDRANT_TENANT_DEDICATED_THRESHOLD', 20000)
+# ナレッジのコレクションの保存形式（新規作成時。既存のコレクションには collection_config.py apply で反映）
+# 量子化: none / scalar（int8）/ binary。検索時は量子化したベクトルで候補を oversampling 倍取り、元のベクトルで再スコアリング
+QDRANT_QUANTIZATION = os.getenv('QDRANT_QUANTIZATION', 'none').strip().lower()
+QDRANT_QUANTIZATION_ALWAYS_RAM = os.getenv('QDRANT_QUANTIZATION_ALWAYS_RAM', 'true').lower() == 'true'
+QDRANT_QUANTIZATION_RESCORE = os.getenv('QDRANT_QUANTIZATION_RESCORE', 'true').lower() == 'true'
+QDRANT_QUANTIZATION_OVERSAMPLING = _get_float_env('QDRANT_QUANTIZATION_OVERSAMPLING', 2.0)
+# 元の float32 ベクトル・ペイロードをディスクに置く（メモリを減らす代わりに再スコアリング・取得がディスク読み込みになる）
+QDRANT_VECTORS_ON_DISK = os.getenv('QDRANT_VECTORS_ON_DISK', 'false').lower() == 'true'
+QDRANT_PAYLOAD_ON_DISK = os.getenv('QDRANT_PAYLOAD_ON_DISK', 'false').lower() == 'true'
+QDRANT_HNSW_M = _get_int_env('QDRANT_HNSW_M', 16)
+QDRANT_HNSW_EF_CONSTRUCT = _get_int_env('QDRANT_HNSW_EF_CONSTRUCT', 100)
+# 検索時の ef（0 で Qdrant の既定値）
+QDRANT_SEARCH_HNSW_EF = _get_int_env('QDRANT_SEARCH_HNSW_EF', 0)
+# /api/chat の検索に使う質問のバリエーション数（1 で元の質問のみ）。全て 1 回の search_batch で検索する
+CHAT_QUERY_VARIANTS = _get_int_env('CHAT_QUERY_VARIANTS', 1)
+# 取り込みの点をまとめて upsert する（write_buffer.py）。BATCH_SIZE 件たまるか MAX_DELAY_MS 経過で書き込む
+QDRANT_WRITE_BUFFER = os.getenv('QDRANT_WRITE_BUFFER', 'true').lower() == 'true'
+QDRANT_WRITE_BATCH_SIZE = _get_int_env('QDRANT_WRITE_BATCH_SIZE', 256)
+QDRANT_WRITE_MAX_DELAY_MS = _get_int_env('QDRANT_WRITE_MAX_DELAY_MS', 20)
+# upsert の wait（true: インデックスへの反映まで待つ）と ordering（weak / medium / strong）
+QDRANT_WRITE_WAIT = os.getenv('QDRANT_WRITE_WAIT', 'true').lower() == 'true'
+QDRANT_WRITE_ORDERING = os.getenv('QDRANT_WRITE_ORDERING', 'weak').strip().lower()
+# flushed: 取り込みのリクエストは自分の点の書き込み完了を待って応答する / buffered: バッファに入れた時点で応答する
+# （buffered はワーカーが 1 つのときだけ有効。SERVER_WORKERS > 1 では flushed になる。write_buffer.ack_mode）
+QDRANT_WRITE_ACK = os.getenv('QDRANT_WRITE_ACK', 'flushed').strip().lower()
+QDRANT_WRITE_ACK_TIMEOUT_SEC = _get_float_env('QDRANT_WRITE_ACK_TIMEOUT_SEC', 30.0)
+# GET /api/knowledge の 1 ページの件数（既定と上限）と、エクスポートで 1 回に読み込む件数
+KNOWLEDGE_LIST_DEFAULT_LIMIT = _get_int_env('KNOWLEDGE_LIST_DEFAULT_LIMIT', 50)
+KNOWLEDGE_LIST_MAX_LIMIT = _get_int_env('KNOWLEDGE_LIST_MAX_LIMIT', 500)
+KNOWLEDGE_EXPORT_PAGE_SIZE = _get_int_env('KNOWLEDGE_EXPORT_PAGE_SIZE', 256)
 
 
 MGMT_API_BASE_URL = os.getenv('MGMT_API_BASE_URL', '').strip() or None
@@ -39,6 +134,15 @@ MGMT_ADMIN_API_KEY = os.getenv('MGMT_ADMIN_API_KEY', '')
 MGMT_API_CACHE_TTL = _get_int_env('MGMT_API_CACHE_TTL', 30)
 MGMT_API_TIMEOUT_SEC = _get_int_env('MGMT_API_TIMEOUT_SEC', 5)
 
+# インスタンス間で共有するキャッシュ（Redis 互換。例: redis://:password@10.0.0.3:6379/0、TLS は rediss://）
+# レジストリのスナップショット・埋め込み・回答を保持する。未設定なら使わない
+SHARED_CACHE_URL = os.getenv('SHARED_CACHE_URL', '').strip() or None
+SHARED_CACHE_PREFIX = os.getenv('SHARED_CACHE_PREFIX', 'iflame').strip()
+SHARED_CACHE_TIMEOUT_MS = _get_int_env('SHARED_CACHE_TIMEOUT_MS', 100)
+# 回答を共有する時間（0 で回答はキャッシュしない）。ナレッジの変更時はチャット単位で即座に無効化する
+SHARED_CACHE_ANSWER_TTL_SEC = _get_non_negative_int_env('SHARED_CACHE_ANSWER_TTL_SEC', 600)
+SHARED_CACHE_EMBEDDING_TTL_SEC = _get_int_env('SHARED_CACHE_EMBEDDING_TTL_SEC', 7 * 24 * 3600)
+
 
 JWT_SECRET = os.getenv('WIDGET_JWT_SECRET') or 'dev-change-me'
 
@@ -48,6 +152,85 @@ JWT_ALGORITHM = 'HS256'
 
 ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
 
+# レスポンスに Server-Timing ヘッダー（ステージ別の所要時間）を付与する
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+
+# /metrics（Prometheus 形式）
+# chat_id ラベルは系列数が増えるためデフォルトでは付与しない
+METRICS_CHAT_ID_LABEL = os.getenv('METRICS_CHAT_ID_LABEL', 'false').lower() == 'true'
+# 設定時は Authorization: Bearer <token> を要求する
+METRICS_AUTH_TOKEN = os.getenv('METRICS_AUTH_TOKEN', '')
+
+# リクエスト単位のトレース（json: ファイルへ追記 / otlp: OTLP/HTTP コレクターへ送信）
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '').strip().lower()
+TRACE_SAMPLE_RATE = _get_float_env('TRACE_SAMPLE_RATE', 0.0)
+TRACE_JSON_PATH = os.getenv('TRACE_JSON_PATH', '/tmp/traces.ndjson')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318')
+
 # Sentry Error Tracking
 SENTRY_DSN = os.getenv('SENTRY_DSN')
 SENTRY_ENVIRONMENT = os.getenv('SENTRY_ENVIRONMENT', 'development')
+
+# リクエスト単位のプロファイリング（X-Profile ヘッダー + ADMIN_API_KEY、またはサンプリング）
+PROFILE_SAMPLE_RATE = _get_float_env('PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_FORMAT = os.getenv('PROFILE_FORMAT', 'speedscope').strip().lower()
+PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', '/tmp/profiles')
+PROFILE_INTERVAL_MS = _get_float_env('PROFILE_INTERVAL_MS', 5.0)
+PROFILE_MAX_CONCURRENT = _get_int_env('PROFILE_MAX_CONCURRENT', 1)
+PROFILE_TRACEMALLOC = os.getenv('PROFILE_TRACEMALLOC', 'false').lower() == 'true'
+PROFILE_TRACEMALLOC_FRAMES = _get_int_env('PROFILE_TRACEMALLOC_FRAMES', 10)
+
+# 構造化ログ（バックグラウンドスレッドで stdout に書き込む）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').strip().upper()
+# プレビューなど大きなログ行を出力する割合
+LOG_SAMPLE_RATE = _get_float_env('LOG_SAMPLE_RATE', 0.1)
+LOG_QUEUE_SIZE = _get_int_env('LOG_QUEUE_SIZE', 10000)
+
+# ワーカーごとの PyTorch の演算スレッド数（未設定時は gunicorn.conf.py が CPU 数 / ワーカー数を設定）
+TORCH_NUM_THREADS = _get_int_env('TORCH_NUM_THREADS', 0)
+# gunicorn のワーカー数（gunicorn.conf.py が設定する）。Gemini のアドミッション制御の上限はワーカーで分け合う
+SERVER_WORKERS = _get_int_env('SERVER_WORKERS', 1)
+# ワーカー間で共有する状態（メトリクスのスナップショット・プロファイリングのサンプリング率）を置くディレクトリ。
+# gunicorn.conf.py がワーカーが 2 つ以上のときに一時ディレクトリを設定する（未設定ならプロセス内だけで保持する）
+MULTIPROC_DIR = os.getenv('MULTIPROC_DIR', '').strip() or None
+# 各ワーカーがメトリクスを MULTIPROC_DIR に書き出す間隔（秒）。/metrics の他のワーカーの値はこの分だけ古い
+METRICS_MULTIPROC_INTERVAL_SEC = _get_float_env('METRICS_MULTIPROC_INTERVAL_SEC', 5.0)
+
+# 起動時の準備（埋め込みモデルのロード・Qdrant への接続・ドメイン情報の取得）を並行にバックグラウンドで行い、
+# app.py の import を待たせない（false なら import 中に完了を待つ）。完了は GET /ready で確認する
+STARTUP_WARMUP_BACKGROUND = os.getenv('STARTUP_WARMUP_BACKGROUND', 'true').lower() == 'true'
+# gunicorn（preload）がワーカーをフォークする前に準備の完了を待つ上限（秒）
+STARTUP_WARMUP_TIMEOUT_SEC = _get_float_env('STARTUP_WARMUP_TIMEOUT_SEC', 300.0)
+
+# ASGI モード（uvicorn asgi:application）
+# 埋め込み計算（CPU）を実行するスレッド数
+ASYNC_EMBED_WORKERS = _get_int_env('ASYNC_EMBED_WORKERS', 2)
+# /api/chat 以外の Flask ルートを処理するスレッド数
+ASGI_WSGI_THREADS = _get_int_env('ASGI_WSGI_THREADS', 8)
+
+# Gemini 呼び出しのアドミッション制御（チャットごとの値は管理API のエントリーで上書き可）
+LLM_MAX_CONCURRENCY = _get_int_env('LLM_MAX_CONCURRENCY', 64)
+LLM_TENANT_MAX_CONCURRENCY = _get_int_env('LLM_TENANT_MAX_CONCURRENCY', 16)
+LLM_TENANT_RATE_PER_MIN = _get_int_env('LLM_TENANT_RATE_PER_MIN', 120)
+LLM_TENANT_BURST = _get_int_env('LLM_TENANT_BURST', 20)
+ADMISSION_MAX_WAIT_MS = _get_int_env('ADMISSION_MAX_WAIT_MS', 500)
+ADMISSION_MAX_QUEUE = _get_int_env('ADMISSION_MAX_QUEUE', 100)
+# 受け付けられなかった場合に検索結果からの抜粋で応答する（false なら 429 を返す）
+ADMISSION_FALLBACK = os.getenv('ADMISSION_FALLBACK', 'true').lower() == 'true'
+
+# /api/chat の処理時間の上限（ミリ秒、チャットごとの値は管理API の deadline_ms で上書き可）。
+# 超えそうな場合は Gemini の応答を待たずに検索結果からの抜粋で応答する
+CHAT_DEADLINE_MS = _get_int_env('CHAT_DEADLINE_MS', 10000)
+
+# 依存サービス（Qdrant / Gemini / 管理API）のサーキットブレーカー
+CIRCUIT_FAILURE_RATE = _get_float_env('CIRCUIT_FAILURE_RATE', 0.5)
+CIRCUIT_MIN_CALLS = _get_int_env('CIRCUIT_MIN_CALLS', 5)
+CIRCUIT_WINDOW_SEC = _get_int_env('CIRCUIT_WINDOW_SEC', 30)
+CIRCUIT_OPEN_SEC = _get_int_env('CIRCUIT_OPEN_SEC', 15)
+CIRCUIT_HALF_OPEN_PROBES = _get_int_env('CIRCUIT_HALF_OPEN_PROBES', 1)
+# 起動時に Qdrant へ接続できなかった場合のバックグラウンド再接続の間隔（秒、失敗ごとに倍にして上限まで）
+QDRANT_RECONNECT_INTERVAL_SEC = _get_float_env('QDRANT_RECONNECT_INTERVAL_SEC', 2.0)
+QDRANT_RECONNECT_MAX_INTERVAL_SEC = _get_float_env('QDRANT_RECONNECT_MAX_INTERVAL_SEC', 60.0)
+
+# 同時に届いた同一の (chat_id, 質問) の処理を 1 回にまとめる
+CHAT_COALESCE_ENABLED = os.getenv('CHAT_COALESCE_ENABLED', 'true').lower() == 'true'
@@ -0,0 +1,396 @@
+"""Cache tier shared across instances on a Redis-compatible server (redis-py).
+
+インスタンスごとのキャッシュ（DomainRegistry・埋め込みのキャッシュ）は新しいインスタンスでは空のため、
+スケールアウトのたびに管理API・埋め込みモデル・Gemini への呼び出しが増える。SHARED_CACHE_URL を
+設定すると、次のものを Redis 互換サーバー（Memorystore など）に置いてインスタンス間で共有する。
+キーは SHARED_CACHE_PREFIX と値の形式の版（SCHEMA_VERSION）から始まる。
+
+    registry                          管理API の /api/chats の応答と取得時刻（レジストリのスナップショット）
+    registry:lock                     スナップショットを取り直すインスタンスの排他（他は管理API を呼ばない）
+    embedding:<model>:<sha256>        埋め込み（float16）
+    generation:<chat_id>              チャットのナレッジの世代（ナレッジを変更するたびに INCR）
+    answer:<chat_id>:<世代>:<sha256>  回答（世代が変わると参照されなくなり、TTL で消える）
+
+変更は invalidate チャンネルに publish し、各インスタンスはローカルに持つ世代とレジストリをすぐに更新する。
+pub/sub が切れている間も世代は _GENERATION_TTL_SEC ごとに読み直す。サーバーに接続できない・遅い場合は
+キャッシュが無いものとして動く（サーキットブレーカーで呼び出しを止める）。
+
+SharedCache（SHARED_CACHE_URL 未設定時）は何も保持しない。RedisCache が redis-py を使う実装。
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import unicodedata
+from urllib.parse import urlparse
+
+import numpy as np
+import redis
+
+import settings
+from circuit_breaker import CircuitBreaker
+from metrics import CACHE_REQUESTS, SHARED_CACHE_ERRORS, SHARED_CACHE_INVALIDATIONS
+
+# 値の形式を変えたら上げる（古い形式のキーは参照されなくなり、TTL で消える）
+SCHEMA_VERSION = 1
+# pub/sub を取りこぼしても、ローカルに持つ世代はこの間隔で読み直す
+_GENERATION_TTL_SEC = 5
+# レジストリのスナップショットは取得から MGMT_API_CACHE_TTL 秒で取り直すが、管理API が落ちている間に
+# 起動したインスタンスのために古いものも残しておく
+_REGISTRY_SNAPSHOT_TTL_SEC = 24 * 3600
+_LISTENER_MAX_BACKOFF_SEC = 30
+
+
+class CacheUnavailable(Exception):
+    """共有キャッシュが未設定・接続できない。呼び出し側はキャッシュなしとして扱う。"""
+
+
+def _digest(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def normalize_query(query):
+    """回答のキーに使う質問（NFKC、連続する空白を 1 つにする）。"""
+    return ' '.join(unicodedata.normalize('NFKC', query or '').split())
+
+
+class SharedCache:
+    """共有キャッシュのインターフェース。このクラス自体は何も保持しない（SHARED_CACHE_URL 未設定時）。
+
+    get / mget / set / incr / delete / publish を実装したサブクラスが使える状態になり、
+    失敗時はそれらが CacheUnavailable を送出する。それ以外のメソッドはキャッシュなしとして振る舞う。
+    """
+
+    enabled = False
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix or settings.SHARED_CACHE_PREFIX
+        self._generations = {}  # chat_id -> (世代, 読み直す時刻)
+        self._registry_listeners = []
+
+    # --- 実装するもの ---
+
+    def get(self, key):
+        raise CacheUnavailable('shared cache is not configured')
+
+    def mget(self, keys):
+        raise CacheUnavailable('shared cache is not configured')
+
+    def set(self, key, value, ttl=None, nx=False):
+        """Returns False if nx and the key already exists."""
+        raise CacheUnavailable('shared cache is not configured')
+
+    def set_many(self, items, ttl=None):
+        raise CacheUnavailable('shared cache is not configured')
+
+    def incr(self, key):
+        raise CacheUnavailable('shared cache is not configured')
+
+    def delete(self, *keys):
+        raise CacheUnavailable('shared cache is not configured')
+
+    def publish(self, message):
+        raise CacheUnavailable('shared cache is not configured')
+
+    # --- キー ---
+
+    def key(self, *parts):
+        return ':'.join([self.prefix, f"v{SCHEMA_VERSION}", *map(str, parts)])
+
+    @property
+    def channel(self):
+        return self.key('invalidate')
+
+    # --- レジストリ ---
+
+    def registry_snapshot(self):
+        """Returns (rows, fetched_at) or None."""
+        if not self.enabled:
+            return None
+        try:
+            raw = self.get(self.key('registry'))
+        except CacheUnavailable:
+            return None
+        if raw is None:
+            CACHE_REQUESTS.inc(cache='shared_registry', result='miss')
+            return None
+        try:
+            data = json.loads(raw)
+            snapshot = data['chats'], float(data['fetched_at'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        CACHE_REQUESTS.inc(cache='shared_registry', result='hit')
+        return snapshot
+
+    def store_registry_snapshot(self, rows, fetched_at):
+        if not self.enabled:
+            return
+        try:
+            self.set(
+                self.key('registry'),
+                json.dumps({'fetched_at': fetched_at, 'chats': rows}, ensure_ascii=False),
+                ttl=_REGISTRY_SNAPSHOT_TTL_SEC,
+            )
+        except CacheUnavailable:
+            pass
+
+    def try_lock(self, name, ttl):
+        """name の排他を ttl 秒取る。Returns True（共有キャッシュが無い場合も）。"""
+        if not self.enabled:
+            return True
+        try:
+            return self.set(self.key(name, 'lock'), str(os.getpid()), ttl=max(1, int(ttl)), nx=True)
+        except CacheUnavailable:
+            return True
+
+    def on_registry_invalidated(self, callback):
+        """invalidate_registry() がどのインスタンスで呼ばれても callback() を呼ぶ。"""
+        self._registry_listeners.append(callback)
+
+    def invalidate_registry(self):
+        for callback in self._registry_listeners:
+            callback()
+        if not self.enabled:
+            return
+        try:
+            self.delete(self.key('registry'), self.key('registry', 'lock'))
+            self.publish({'type': 'registry'})
+        except CacheUnavailable:
+            pass
+
+    # --- 埋め込み ---
+
+    def get_vectors(self, model_id, digests):
+        """digests（embedding_cache.cache_key）の埋め込み。Returns {digest: np.ndarray(float32)}."""
+        if not self.enabled or not digests:
+            return {}
+        try:
+            values = self.mget([self.key('embedding', model_id, d.hex()) for d in digests])
+        except CacheUnavailable:
+            return {}
+        found = {d: np.frombuffer(v, dtype=np.float16).astype(np.float32) for d, v in zip(digests, values) if v}
+        if found:
+            CACHE_REQUESTS.inc(len(found), cache='shared_embedding', result='hit')
+        if len(found) < len(digests):
+            CACHE_REQUESTS.inc(len(digests) - len(found), cache='shared_embedding', result='miss')
+        return found
+
+    def put_vectors(self, model_id, items):
+        if not self.enabled or not items:
+            return
+        try:
+            self.set_many(
+                [(self.key('embedding', model_id, d.hex()), np.asarray(v, dtype=np.float16).tobytes()) for d, v in items],
+                ttl=settings.SHARED_CACHE_EMBEDDING_TTL_SEC,
+            )
+        except CacheUnavailable:
+            pass
+
+    # --- 回答 ---
+
+    def generation(self, chat_id):
+        """チャットのナレッジの世代。Returns None if unknown (共有キャッシュに接続できない)."""
+        cached = self._generations.get(chat_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        raw = self.get(self.key('generation', chat_id))
+        value = int(raw) if raw else 0
+        self._generations[chat_id] = (value, time.monotonic() + _GENERATION_TTL_SEC)
+        return value
+
+    def answer_generation(self, chat_id):
+        """回答を引く時点の世代。Returns None if answers are not cached (無効・接続できない)."""
+        if not self.enabled or settings.SHARED_CACHE_ANSWER_TTL_SEC <= 0:
+            return None
+        try:
+            return self.generation(chat_id)
+        except CacheUnavailable:
+            return None
+
+    def _answer_key(self, chat_id, generation, system_prompt, query):
+        return self.key('answer', chat_id, generation, _digest(system_prompt or '', normalize_query(query)))
+
+    def get_answer(self, chat_id, generation, system_prompt, query):
+        """generation は answer_generation() の値。Returns the answer dict stored by store_answer() or None."""
+        if generation is None:
+            return None
+        try:
+            raw = self.get(self._answer_key(chat_id, generation, system_prompt, query))
+        except CacheUnavailable:
+            return None
+        CACHE_REQUESTS.inc(cache='shared_answer', result='hit' if raw else 'miss')
+        try:
+            return json.loads(raw) if raw else None
+        except ValueError:
+            return None
+
+    def store_answer(self, chat_id, generation, system_prompt, query, answer):
+        """回答を引いた時点の世代で保存する。
+
+        回答を作っている間にナレッジが変わっても、古いナレッジから作った回答が新しい世代で使われないようにする。
+        """
+        if generation is None:
+            return
+        try:
+            self.set(
+                self._answer_key(chat_id, generation, system_prompt, query),
+                json.dumps(answer, ensure_ascii=False),
+                ttl=settings.SHARED_CACHE_ANSWER_TTL_SEC,
+            )
+        except CacheUnavailable:
+            pass
+
+    def invalidate_chat(self, chat_id):
+        """chat_id のナレッジが変わった。全インスタンスでそのチャットの回答を使わなくする。"""
+        if not self.enabled or not chat_id:
+            return
+        try:
+            generation = self.incr(self.key('generation', chat_id))
+            self._set_generation(chat_id, generation)
+            self.publish({'type': 'knowledge', 'chat_id': chat_id, 'generation': generation})
+        except CacheUnavailable:
+            # 世代を上げられなかった場合、古い回答は SHARED_CACHE_ANSWER_TTL_SEC で消える
+            self._generations.pop(chat_id, None)
+
+    # --- 無効化の受信 ---
+
+    def _set_generation(self, chat_id, generation):
+        cached = self._generations.get(chat_id)
+        if cached is None or cached[0] <= generation:
+            self._generations[chat_id] = (generation, time.monotonic() + _GENERATION_TTL_SEC)
+
+    def handle_message(self, raw):
+        try:
+            message = json.loads(raw)
+            kind = message['type']
+        except (ValueError, KeyError, TypeError):
+            return
+        SHARED_CACHE_INVALIDATIONS.inc(type=kind)
+        if kind == 'registry':
+            for callback in self._registry_listeners:
+                callback()
+        elif kind == 'knowledge' and message.get('chat_id'):
+            self._set_generation(message['chat_id'], int(message.get('generation') or 0))
+
+
+class RedisCache(SharedCache):
+    """Redis 互換サーバーを使う SharedCache。接続は redis-py のプール（プロセスごと）を使う。"""
+
+    enabled = True
+
+    def __init__(self, url, timeout_ms=None, prefix=None):
+        super().__init__(prefix)
+        if urlparse(url).scheme not in ('redis', 'rediss'):
+            raise ValueError(f"SHARED_CACHE_URL must be redis:// or rediss://, got {url!r}")
+        timeout = (settings.SHARED_CACHE_TIMEOUT_MS if timeout_ms is None else timeout_ms) / 1000
+        self.url = url
+        self.timeout = timeout
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.breaker = CircuitBreaker('shared_cache')
+        self._listener_lock = threading.Lock()
+        self._listener_pid = None
+
+    def _run(self, op, call):
+        # pre-fork サーバーではスレッドがワーカーに引き継がれないため、ワーカーで最初に使うときに起動する
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        if not self.breaker.allow():
+            raise CacheUnavailable('shared cache circuit is open')
+        try:
+            result = call(self.client)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.record_failure()
+            SHARED_CACHE_ERRORS.inc(op=op)
+            print(f"[WARN] Shared cache {op} failed: {type(e).__name__}: {e}")
+            raise CacheUnavailable(str(e)) from e
+        except redis.RedisError as e:
+            # サーバーのエラー応答（接続は使える）
+            self.breaker.record_success()
+            SHARED_CACHE_ERRORS.inc(op=op)
+            print(f"[WARN] Shared cache {op} failed: {e}")
+            raise CacheUnavailable(str(e)) from e
+        self.breaker.record_success()
+        return result
+
+    def get(self, key):
+        return self._run('get', lambda client: client.get(key))
+
+    def mget(self, keys):
+        return self._run('mget', lambda client: client.mget(keys)) if keys else []
+
+    def set(self, key, value, ttl=None, nx=False):
+        return bool(self._run('set', lambda client: client.set(key, value, ex=int(ttl) if ttl else None, nx=nx)))
+
+    def set_many(self, items, ttl=None):
+        if not items:
+            return
+
+        def call(client):
+            pipe = client.pipeline(transaction=False)
+            for key, value in items:
+                pipe.set(key, value, ex=int(ttl) if ttl else None)
+            return pipe.execute()
+
+        self._run('set', call)
+
+    def incr(self, key):
+        return self._run('incr', lambda client: client.incr(key))
+
+    def delete(self, *keys):
+        if keys:
+            self._run('delete', lambda client: client.delete(*keys))
+
+    def publish(self, message):
+        self._run('publish', lambda client: client.publish(self.channel, json.dumps(message, ensure_ascii=False)))
+
+    # --- pub/sub ---
+
+    def _start_listener(self):
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            self._generations.clear()
+            threading.Thread(target=self._listen, name='shared-cache-invalidation', daemon=True).start()
+
+    def _subscriber(self):
+        # 応答を待ち続けるため読み込みのタイムアウトは付けず、切れた接続は TCP keepalive で OS に検出させる
+        options = {
+            getattr(socket, name): value
+            for name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3))
+            if hasattr(socket, name)
+        }
+        client = redis.Redis.from_url(
+            self.url, socket_connect_timeout=self.timeout, socket_keepalive=True, socket_keepalive_options=options
+        )
+        return client.pubsub(ignore_subscribe_messages=True)
+
+    def _listen(self):
+        backoff = 1.0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._subscriber()
+                pubsub.subscribe(self.channel)
+                backoff = 1.0
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.handle_message(message['data'])
+            except Exception as e:
+                print(f"[WARN] Shared cache invalidation listener disconnected: {e} (retrying in {backoff:.0f}s)")
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+            # 切れていた間の無効化を取りこぼしているため、世代は読み直す
+            self._generations.clear()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, _LISTENER_MAX_BACKOFF_SEC)
+
+
+def from_settings():
+    if not settings.SHARED_CACHE_URL:
+        return SharedCache()
+    return RedisCache(settings.SHARED_CACHE_URL)
@@ -0,0 +1,75 @@
+"""Single-flight execution of identical in-flight work.
+
+同じキーの処理が実行中なら新たに実行せず、その結果を待って共有する（完了後は保持しない）。
+/api/chat では (chat_id, query) をキーにして、同時に届いた同一の質問の埋め込み・検索・
+Gemini 呼び出しを 1 回にまとめる。
+
+    result, shared = flights.do(key, fn)               # スレッド（Flask）
+    result, shared = await flights.do_async(key, fn)   # asyncio（fn はコルーチン関数）
+
+shared は他のリクエストの実行結果を受け取った場合に True。実行側で例外が発生した場合は
+待っていた側にも同じ例外を送出する。
+
+まとめるのはプロセス内だけで、gunicorn の別のワーカーに届いた同一の質問はそれぞれ実行する
+（SHARED_CACHE_URL を設定すると、先に完了した回答は共有キャッシュから返す）。
+"""
+
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key, fn):
+        task = self._tasks.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+
+        # 最初のリクエストが切断（キャンセル）されても、待っている側のために処理を続ける
+        task = asyncio.ensure_future(fn())
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return await asyncio.shield(task), False
+
+    def _finished(self, key, task):
+        self._tasks.pop(key, None)
+        # 待つ側がいなくなっていても "exception was never retrieved" を出さない
+        if not task.cancelled():
+            task.exception()
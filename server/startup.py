@@ -0,0 +1,120 @@
+"""Background startup warmup and readiness.
+
+起動時の準備（埋め込みモデルのロード・Qdrant への接続・ドメイン情報の取得など）をコンポーネントごとに
+別スレッドで並行に実行し、app.py の import を待たせない。GET /ready は各コンポーネントの状態を返す。
+
+    warmup = Warmup()
+    warmup.add('embedding_model', load_model, check=lambda: embedding_model is not None)
+    warmup.start()                                  # block=True なら全ての完了を待つ
+    warmup.wait(['embedding_model'], timeout=5.0)   # 完了したら True
+    warmup.status()                                 # /ready の本文
+
+check はコンポーネントが今使えるかを返す（準備に失敗した後、再接続などで使えるようになった場合も反映する）。
+required=False のコンポーネントは準備ができていなくても全体の ready を妨げない。
+"""
+
+import os
+import threading
+import time
+
+from metrics import STARTUP_COMPONENT_SECONDS
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class _Component:
+    def __init__(self, name, run, check, required):
+        self.name = name
+        self.run = run
+        self.check = check or (lambda: self.state == DONE)
+        self.required = required
+        self.state = PENDING
+        self.error = None
+        self.seconds = None
+        self.done = threading.Event()
+
+
+class Warmup:
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._pid = os.getpid()
+
+    def add(self, name, run, check=None, required=True):
+        """run は失敗時に例外を送出する。"""
+        self._components[name] = _Component(name, run, check, required)
+
+    def start(self, block=False):
+        """まだ実行していないコンポーネントの準備を開始する。"""
+        with self._lock:
+            started = [c for c in self._components.values() if c.state == PENDING]
+            for component in started:
+                component.state = RUNNING
+        for component in started:
+            threading.Thread(target=self._run, args=(component,), name=f"warmup-{component.name}", daemon=True).start()
+        if block:
+            self.wait()
+
+    def restart_after_fork(self):
+        """フォーク前に終わらなかった準備をワーカーでやり直す（実行中のスレッドはフォーク後に引き継がれない）。"""
+        if os.getpid() == self._pid:
+            # preload せずにワーカーで import した場合は、このプロセスのスレッドが準備を続けている
+            return
+        with self._lock:
+            self._pid = os.getpid()
+            for component in self._components.values():
+                if component.state == RUNNING:
+                    component.state = PENDING
+                    component.done = threading.Event()
+        self.start()
+
+    def _run(self, component):
+        start = time.perf_counter()
+        try:
+            component.run()
+        except Exception as e:
+            component.error = f"{type(e).__name__}: {e}"
+            component.state = FAILED
+            print(f"[WARN] Startup: {component.name} failed after {time.perf_counter() - start:.2f}s: {component.error}")
+        else:
+            component.error = None
+            component.state = DONE
+            print(f"[INFO] Startup: {component.name} ready in {time.perf_counter() - start:.2f}s")
+        finally:
+            component.seconds = time.perf_counter() - start
+            STARTUP_COMPONENT_SECONDS.set(component.seconds, component=component.name)
+            component.done.set()
+
+    def finished(self, names=None):
+        """names（省略時は全て）の準備が終わったか（失敗も含む）。"""
+        return all(self._components[name].done.is_set() for name in names or self._components)
+
+    def wait(self, names=None, timeout=None):
+        """names（省略時は全て）の準備が終わるまで最大 timeout 秒待つ。Returns finished()."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for name in names or list(self._components):
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not self._components[name].done.wait(remaining):
+                return False
+        return True
+
+    def status(self):
+        components = {}
+        for component in self._components.values():
+            entry = {'ready': bool(component.check()), 'state': component.state}
+            if component.seconds is not None:
+                entry['seconds'] = round(component.seconds, 3)
+            if component.error and not entry['ready']:
+                entry['error'] = component.error
+            if not component.required:
+                entry['required'] = False
+            components[component.name] = entry
+        return {
+            'ready': all(entry['ready'] for entry in components.values() if entry.get('required', True)),
+            'uptime_sec': round(time.time() - self._started_at, 3),
+            'components': components,
+        }
@@ -0,0 +1,152 @@
+"""Non-blocking structured logging.
+
+リクエスト処理中のログは dict のままキューに積み、JSON へのシリアライズと stdout への
+書き込みはバックグラウンドスレッド（QueueListener）で行う。Cloud Run のログエージェントが
+`severity` を解釈できるよう 1 行 1 JSON で出力する。
+
+- LOG_LEVEL 未満のログは dict を組み立てる前に捨てる（候補ごとの詳細は DEBUG）
+- sampled=True のログ（プレビューなど大きな行）は LOG_SAMPLE_RATE の割合だけ出力
+- orjson がインストールされていれば高速なエンコーダーを使う
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import random
+import sys
+from queue import Full, Queue
+
+import request_state
+import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+LOGGER_NAME = 'ai_chat_iflame'
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """dict のメッセージを 1 行の JSON に変換する。severity はレベル名から付与する。"""
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            payload = {'severity': record.levelname, **record.msg}
+        else:
+            payload = {'severity': record.levelname, 'message': record.getMessage()}
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        return dumps(payload)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが溢れたらブロックせずに捨てる QueueHandler。
+
+    標準の prepare() は呼び出し元スレッドでフォーマットしてしまうため、レコードを
+    そのまま渡してシリアライズをリスナースレッドに任せる。
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def _configure():
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(getattr(logging, settings.LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    handler = _DroppingQueueHandler(Queue(maxsize=settings.LOG_QUEUE_SIZE))
+    logger.addHandler(handler)
+    return logger, handler, stream_handler
+
+
+def _start_listener():
+    listener = logging.handlers.QueueListener(_queue_handler.queue, _stream_handler, respect_handler_level=False)
+    listener.start()
+    return listener
+
+
+logger, _queue_handler, _stream_handler = _configure()
+_listener = _start_listener()
+
+
+def shutdown():
+    """キューに残ったログを書き出してリスナースレッドを止める。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def restart_after_fork():
+    """pre-fork サーバーのワーカーでリスナースレッドを作り直す（スレッドはフォーク後に引き継がれない）。"""
+    global _listener
+    _queue_handler.queue = Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    _listener = _start_listener()
+
+
+atexit.register(shutdown)
+
+
+def is_enabled_for(level):
+    return logger.isEnabledFor(level)
+
+
+def log_event(log_type, level=logging.INFO, sampled=False, exc_info=False, **fields):
+    """構造化ログを 1 行出力する（書き込みはバックグラウンドスレッド）。
+
+    sampled=True の場合は LOG_SAMPLE_RATE の割合だけ出力する。
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sampled and settings.LOG_SAMPLE_RATE < 1.0 and random.random() >= settings.LOG_SAMPLE_RATE:
+        return
+    event = {'log_type': log_type}
+    state = request_state.current()
+    if state is not None and 'request_id' in state:
+        event['request_id'] = state.request_id
+    event.update(fields)
+    if exc_info:
+        exc_info = sys.exc_info()
+    # logger.log() は呼び出し元のスタックを辿るため、レコードを直接作って渡す
+    logger.handle(logger.makeRecord(logger.name, level, '', 0, event, None, exc_info or None))
+
+
+def debug(log_type, sampled=False, **fields):
+    log_event(log_type, logging.DEBUG, sampled, **fields)
+
+
+def info(log_type, sampled=False, **fields):
+    log_event(log_type, logging.INFO, sampled, **fields)
+
+
+def warning(log_type, **fields):
+    log_event(log_type, logging.WARNING, **fields)
+
+
+def error(log_type, **fields):
+    log_event(log_type, logging.ERROR, **fields)
+
+
+def exception(log_type, **fields):
+    """ERROR レベルでトレースバック付きのログを出力する（except 節の中で使う）。"""
+    log_event(log_type, logging.ERROR, exc_info=True, **fields)
@@ -0,0 +1,461 @@
+"""Tenant placement of knowledge in Qdrant.
+
+テナント（chat_id）ごとのナレッジの置き場所（レイアウト）:
+
+- shared: 共有コレクション（QDRANT_COLLECTION_NAME）に chat_id で絞り込んで格納する（既定）。
+  chat_id は is_tenant のキーワードインデックスにし、HNSW はテナントごとのグラフ（payload_m）で作るため、
+  小さいテナントの検索もコレクション全体の大きさに左右されない
+- shard: 共有コレクションの中でテナント専用のシャードキーに格納する
+  （コレクションを QDRANT_SHARDING=custom で作成した場合のみ。それ以外のテナントは "default"）
+- dedicated: テナント専用のコレクション `<QDRANT_COLLECTION_NAME>__<chat_id>_<hash>` に格納する
+  （chat_id のコレクション名に使えない文字は _ に置き換え、元の chat_id のハッシュを付けて別のテナントと区別する）
+
+アプリはどのコレクションも論理名そのものではなくエイリアス `<論理名>__live`（serving_alias()）で読み書きする。
+reindex.py はこのエイリアスを新しい版に付け替えるだけで、読み書き中のコレクションを削除しない。
+
+shared 以外のテナントの配置は `<QDRANT_COLLECTION_NAME>__tenants` コレクション（ベクトルなし）に記録し、
+各ワーカーは QDRANT_TENANT_CACHE_TTL 秒ごとに読み直す。レイアウトの移行（migrate_tenant.py）中は
+state と移行元を記録し、書き込みは移行元と移行先の両方に行う。
+
+    migrating: 読み込みは移行元、書き込みは両方（この間に既存の点をコピーする）
+    cutover:   読み込みは移行先、書き込みは両方（キャッシュの古いワーカーが移行元を読んでも欠けない）
+    active:    移行先のみ
+"""
+
+import hashlib
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+from qdrant_client import QdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import (
+    CreateAlias,
+    CreateAliasOperation,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    KeywordIndexParams,
+    KeywordIndexType,
+    MatchValue,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    ShardingMethod,
+)
+
+import settings
+from collection_config import CONFIG, per_tenant
+from metrics import CACHE_REQUESTS
+from write_buffer import ack_mode
+
+SHARED = 'shared'
+SHARD = 'shard'
+DEDICATED = 'dedicated'
+LAYOUTS = (SHARED, SHARD, DEDICATED)
+
+ACTIVE = 'active'
+MIGRATING = 'migrating'
+CUTOVER = 'cutover'
+
+DEFAULT_SHARD_KEY = 'default'
+SERVING_ALIAS_SUFFIX = '__live'
+
+
+@dataclass(frozen=True)
+class Target:
+    """点を読み書きするコレクションとシャードキー。"""
+    collection: str
+    shard_key: Optional[str] = None
+
+    @property
+    def serving_name(self):
+        """Qdrant の呼び出しに渡す名前（論理名 collection のエイリアス）。"""
+        return serving_alias(self.collection)
+
+
+@dataclass(frozen=True)
+class Placement:
+    chat_id: str
+    layout: str
+    target: Target
+    state: str = ACTIVE
+    source: Optional[Target] = None
+
+    @property
+    def read_target(self):
+        return self.source if self.state == MIGRATING and self.source else self.target
+
+    @property
+    def write_targets(self):
+        if self.source and self.state in (MIGRATING, CUTOVER):
+            return [self.target, self.source]
+        return [self.target]
+
+
+def placements_collection():
+    return f"{settings.QDRANT_COLLECTION_NAME}__tenants"
+
+
+def dedicated_collection(chat_id):
+    """テナント専用のコレクション名（a.b と a_b のように置き換え後が同じ chat_id も別のコレクションになる）。"""
+    digest = hashlib.sha256(chat_id.encode('utf-8')).hexdigest()[:8]
+    return f"{settings.QDRANT_COLLECTION_NAME}__{re.sub(r'[^0-9A-Za-z_-]', '_', chat_id)}_{digest}"
+
+
+def default_shard_key():
+    return DEFAULT_SHARD_KEY if settings.QDRANT_SHARDING == 'custom' else None
+
+
+def target_for(chat_id, layout):
+    if layout == DEDICATED:
+        return Target(dedicated_collection(chat_id))
+    if layout == SHARD:
+        return Target(settings.QDRANT_COLLECTION_NAME, shard_key=chat_id)
+    return Target(settings.QDRANT_COLLECTION_NAME, shard_key=default_shard_key())
+
+
+def shared_placement(chat_id):
+    return Placement(chat_id, SHARED, target_for(chat_id, SHARED))
+
+
+def tenant_filter(chat_id):
+    return Filter(must=[FieldCondition(key="chat_id", match=MatchValue(value=chat_id))])
+
+
+def _placement_id(chat_id):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"tenant:{chat_id}"))
+
+
+# --- collections ------------------------------------------------------------
+
+def admin_client():
+    """管理コマンド（migrate_tenant.py など）用の REST クライアント。"""
+    if settings.QDRANT_URL == ':memory:':
+        raise SystemExit("This command requires a Qdrant server (QDRANT_URL or QDRANT_HOST)")
+    if settings.QDRANT_URL:
+        return QdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
+    return QdrantClient(host=settings.QDRANT_HOST, port=settings.QDRANT_PORT)
+
+
+def _chat_id_index():
+    if settings.QDRANT_TENANT_INDEX:
+        return KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True)
+    return PayloadSchemaType.KEYWORD
+
+
+def serving_alias(name):
+    """論理名 name のコレクションを読み書きするときに使うエイリアス。"""
+    return f"{name}{SERVING_ALIAS_SUFFIX}"
+
+
+def resolve_collection(client, name):
+    """論理名 name が指している実体のコレクション名。
+
+    エイリアス serving_alias(name) があればその先、以前の reindex.py で作ったエイリアス name があればその先、
+    どちらも無ければ name（エイリアスを使う前に作ったコレクション）を返す。
+    """
+    aliases = {alias.alias_name: alias.collection_name for alias in client.get_aliases().aliases}
+    return aliases.get(serving_alias(name)) or aliases.get(name) or name
+
+
+def collection_versions(client, name):
+    """reindex.py で作った name の版（`<name>_v<N>`）。Returns [(N, collection)] in version order."""
+    pattern = re.compile(rf"{re.escape(name)}_v(\d+)")
+    versions = []
+    for collection in client.get_collections().collections:
+        match = pattern.fullmatch(collection.name)
+        if match:
+            versions.append((int(match.group(1)), collection.name))
+    return sorted(versions)
+
+
+def create_knowledge_collection(client, name, custom_sharding=False, config=None, alias_of=None):
+    """ナレッジ用のコレクションとペイロードインデックスを作成する（保存形式は collection_config）。
+
+    alias_of: エイリアスで切り替える前提の新しい版（reindex.py）を作る場合の論理名。
+    """
+    config = config or CONFIG
+    # 共有コレクションは全体のグラフを作らず、テナント（chat_id）ごとのグラフだけを作る（検索は常に chat_id で絞り込む）
+    client.create_collection(
+        collection_name=name,
+        sharding_method=ShardingMethod.CUSTOM if custom_sharding else None,
+        **config.create_kwargs(per_tenant=per_tenant(alias_of or name)),
+    )
+    if custom_sharding:
+        client.create_shard_key(name, DEFAULT_SHARD_KEY)
+    client.create_payload_index(collection_name=name, field_name="chat_id", field_schema=_chat_id_index())
+    client.create_payload_index(collection_name=name, field_name="type", field_schema=PayloadSchemaType.KEYWORD)
+
+
+def ensure_serving_alias(client, name, custom_sharding=False):
+    """name を読み書きするエイリアスが無ければ作る。Returns (実体のコレクション名, 新しく作ったか).
+
+    既存のコレクション（エイリアスを使う前に作ったもの）があればエイリアスをそれに向けるだけなので、
+    エイリアスを使わない古いワーカーと並行して動かせる。無ければ `<name>_v1` を作ってエイリアスを向ける。
+    """
+    alias = serving_alias(name)
+    current = resolve_collection(client, name)
+    existing = {collection.name for collection in client.get_collections().collections}
+    created = False
+    if current not in existing:
+        current = f"{name}_v1"
+        if current not in existing:
+            create_knowledge_collection(client, current, custom_sharding=custom_sharding, alias_of=name)
+            created = True
+    if not any(a.alias_name == alias for a in client.get_aliases().aliases):
+        # 複数のインスタンスが同時に作っても同じ向きになる
+        client.update_collection_aliases(change_aliases_operations=[
+            CreateAliasOperation(create_alias=CreateAlias(collection_name=current, alias_name=alias))
+        ])
+    return current, created
+
+
+def ensure_payload_indexes(client, name):
+    """ペイロードインデックスが無ければ作成する。chat_id は QDRANT_TENANT_INDEX なら is_tenant に作り直す。"""
+    info = client.get_collection(name)
+    schema = info.payload_schema or {}
+    chat_id_index = schema.get("chat_id")
+    is_tenant = bool(chat_id_index and getattr(chat_id_index.params, 'is_tenant', False))
+    if chat_id_index is None or (settings.QDRANT_TENANT_INDEX and not is_tenant):
+        client.create_payload_index(collection_name=name, field_name="chat_id", field_schema=_chat_id_index())
+        print(f"Created index for 'chat_id' field (is_tenant={settings.QDRANT_TENANT_INDEX})")
+    if "type" not in schema:
+        client.create_payload_index(collection_name=name, field_name="type", field_schema=PayloadSchemaType.KEYWORD)
+        print("Created missing index for 'type' field")
+
+
+def ensure_placements_collection(client):
+    if not client.collection_exists(placements_collection()):
+        client.create_collection(collection_name=placements_collection(), vectors_config={})
+
+
+# --- directory --------------------------------------------------------------
+
+class TenantDirectory:
+    """テナントの配置を Qdrant から読み込み、TTL の間キャッシュする。
+
+    get_client はその時点の QdrantClient（未接続なら None）を返す関数。
+    write_buffer（write_buffer.WriteBuffer）を渡すと upsert をまとめて書き込み、
+    点を読み込む・変更する操作の前に未書き込みの点を反映する。
+    on_change(chat_id) は点を書き込み・削除・更新した後に呼ばれる（回答のキャッシュの無効化など）。
+    """
+
+    def __init__(self, get_client, cache_ttl=None, write_buffer=None, on_change=None):
+        self._get_client = get_client
+        self.write_buffer = write_buffer
+        self.on_change = on_change
+        self.cache_ttl = settings.QDRANT_TENANT_CACHE_TTL if cache_ttl is None else cache_ttl
+        self._placements = {}
+        self._expires_at = 0.0
+        self._reload_lock = threading.Lock()
+
+    def reload(self):
+        client = self._get_client()
+        if client is None:
+            return
+        placements = {}
+        offset = None
+        try:
+            while True:
+                records, offset = client.scroll(
+                    collection_name=placements_collection(), limit=256, offset=offset, with_payload=True
+                )
+                for record in records:
+                    placement = self._from_payload(record.payload)
+                    placements[placement.chat_id] = placement
+                if offset is None:
+                    break
+        except UnexpectedResponse as e:
+            if e.status_code != 404:
+                print(f"[ERROR] TenantDirectory reload failed: {e}")
+                self._expires_at = time.time() + self.cache_ttl / 2
+                return
+        except Exception as e:
+            # 読み込めない間は前回の配置を使い続ける
+            print(f"[ERROR] TenantDirectory reload failed: {type(e).__name__}: {e}")
+            self._expires_at = time.time() + self.cache_ttl / 2
+            return
+        self._placements = placements
+        self._expires_at = time.time() + self.cache_ttl
+
+    def needs_reload(self):
+        """次の placement() で Qdrant への再読み込み（ブロッキング I/O）が発生するか。"""
+        return time.time() >= self._expires_at
+
+    def _ensure_latest(self):
+        if not self.needs_reload():
+            CACHE_REQUESTS.inc(cache='tenant_directory', result='hit')
+            return
+        CACHE_REQUESTS.inc(cache='tenant_directory', result='miss')
+        # 他のスレッドが読み込み中なら待たずに現在の配置を使う
+        if self._reload_lock.acquire(blocking=not self._placements and self._expires_at == 0.0):
+            try:
+                if self.needs_reload():
+                    self.reload()
+            finally:
+                self._reload_lock.release()
+
+    def placement(self, chat_id):
+        self._ensure_latest()
+        return self._placements.get(chat_id) or shared_placement(chat_id)
+
+    def read_target(self, chat_id):
+        return self.placement(chat_id).read_target
+
+    def placements(self):
+        self._ensure_latest()
+        return dict(self._placements)
+
+    def save(self, placement):
+        """配置を記録する（migrate_tenant.py から）。shared かつ active なら記録を消す。"""
+        client = self._client()
+        ensure_placements_collection(client)
+        if placement.layout == SHARED and placement.state == ACTIVE:
+            client.delete(
+                collection_name=placements_collection(),
+                points_selector=PointIdsList(points=[_placement_id(placement.chat_id)]),
+            )
+        else:
+            client.upsert(
+                collection_name=placements_collection(),
+                points=[PointStruct(id=_placement_id(placement.chat_id), vector={}, payload=self._to_payload(placement))],
+            )
+        self._expires_at = 0.0
+
+    # --- tenant-aware point operations ---
+
+    def _flush_writes(self):
+        if self.write_buffer is not None and self.write_buffer.has_pending():
+            self.write_buffer.flush(settings.QDRANT_WRITE_ACK_TIMEOUT_SEC)
+
+    def retrieve(self, chat_id, ids, **kwargs):
+        self._flush_writes()
+        target = self.read_target(chat_id)
+        return self._client().retrieve(
+            collection_name=target.serving_name, ids=ids, shard_key_selector=target.shard_key, **kwargs
+        )
+
+    def scroll(self, chat_id, scroll_filter=None, **kwargs):
+        """テナントの点を読み込み先から scroll する（scroll_filter の既定は chat_id の絞り込み）。"""
+        self._flush_writes()
+        target = self.read_target(chat_id)
+        return self._client().scroll(
+            collection_name=target.serving_name,
+            scroll_filter=scroll_filter or tenant_filter(chat_id),
+            shard_key_selector=target.shard_key,
+            **kwargs,
+        )
+
+    def upsert(self, chat_id, points):
+        """write_buffer があればまとめて書き込む（ack_mode() が flushed なら書き込み完了まで待つ）。"""
+        if self.write_buffer is not None:
+            ticket = self.write_buffer.submit(self.placement(chat_id).write_targets, points)
+            if ack_mode() == 'buffered':
+                # 書き込まれる前に無効化すると、その間に作られた（新しいナレッジを含まない）回答が
+                # 新しい世代でキャッシュされるため、書き込みが終わってから無効化する
+                ticket.add_done_callback(lambda _: self._changed(chat_id))
+                return
+            ticket.wait(settings.QDRANT_WRITE_ACK_TIMEOUT_SEC)
+            self._changed(chat_id)
+            return
+        client = self._client()
+        for target in self.placement(chat_id).write_targets:
+            client.upsert(collection_name=target.serving_name, points=points, shard_key_selector=target.shard_key)
+        self._changed(chat_id)
+
+    def delete(self, chat_id, ids):
+        self._flush_writes()
+        client = self._client()
+        for target in self.placement(chat_id).write_targets:
+            client.delete(
+                collection_name=target.serving_name,
+                points_selector=PointIdsList(points=ids),
+                shard_key_selector=target.shard_key,
+            )
+        self._changed(chat_id)
+
+    def count(self, chat_id, count_filter):
+        self._flush_writes()
+        target = self.read_target(chat_id)
+        return self._client().count(
+            collection_name=target.serving_name, count_filter=count_filter, shard_key_selector=target.shard_key
+        ).count
+
+    def delete_matching(self, chat_id, points_filter):
+        """Filter に一致する点を Qdrant 側でまとめて削除する（points_filter は chat_id で絞り込んだもの）。
+
+        Returns the UpdateResult of the primary write target（削除件数は Qdrant から返らない）.
+        """
+        self._flush_writes()
+        client = self._client()
+        results = [
+            client.delete(
+                collection_name=target.serving_name,
+                points_selector=FilterSelector(filter=points_filter),
+                shard_key_selector=target.shard_key,
+            )
+            for target in self.placement(chat_id).write_targets
+        ]
+        self._changed(chat_id)
+        return results[0]
+
+    def set_payload(self, chat_id, payload, points):
+        """ペイロードの一部だけを書き換える（ベクトルは送らない）。points は点 ID のリストか Filter。
+
+        Returns the UpdateResult of the primary write target.
+        """
+        self._flush_writes()
+        client = self._client()
+        selector = FilterSelector(filter=points) if isinstance(points, Filter) else PointIdsList(points=points)
+        results = [
+            client.set_payload(
+                collection_name=target.serving_name,
+                payload=payload,
+                points=selector,
+                shard_key_selector=target.shard_key,
+            )
+            for target in self.placement(chat_id).write_targets
+        ]
+        self._changed(chat_id)
+        return results[0]
+
+    def _changed(self, chat_id):
+        if self.on_change is not None:
+            self.on_change(chat_id)
+
+    def _client(self):
+        client = self._get_client()
+        if client is None:
+            raise RuntimeError("Qdrant not available")
+        return client
+
+    @staticmethod
+    def _to_payload(placement):
+        source = placement.source
+        return {
+            'chat_id': placement.chat_id,
+            'layout': placement.layout,
+            'state': placement.state,
+            'collection': placement.target.collection,
+            'shard_key': placement.target.shard_key,
+            'source_collection': source.collection if source else None,
+            'source_shard_key': source.shard_key if source else None,
+            'updated_at': time.time(),
+        }
+
+    @staticmethod
+    def _from_payload(payload):
+        source = None
+        if payload.get('source_collection'):
+            source = Target(payload['source_collection'], payload.get('source_shard_key'))
+        return Placement(
+            chat_id=payload['chat_id'],
+            layout=payload.get('layout', SHARED),
+            target=Target(payload['collection'], payload.get('shard_key')),
+            state=payload.get('state', ACTIVE),
+            source=source,
+        )
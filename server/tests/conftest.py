@@ -0,0 +1,153 @@
+"""テスト共通の設定。
+
+外部サービスは使わない: Qdrant はインメモリモード、管理API・Gemini・埋め込みモデルは
+app_module で bench/standins のスタブとフェイクに差し替える。settings は import 時に環境変数を読むため、
+サーバーのモジュールを import する前にここで環境変数を設定する。
+
+    cd server
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+ADMIN_API_KEY = 'test-admin-key'
+
+_tmp_dir = tempfile.mkdtemp(prefix='iflame-tests-')
+os.environ.update({
+    'QDRANT_URL': ':memory:',
+    'GEMINI_API_KEY': 'test',
+    'BQ_ENABLED': 'false',
+    'ADMIN_API_KEY': ADMIN_API_KEY,
+    'STARTUP_WARMUP_BACKGROUND': 'true',
+    'EMBEDDING_CACHE_PATH': os.path.join(_tmp_dir, 'embedding_cache.sqlite3'),
+    'PROFILE_OUTPUT_DIR': os.path.join(_tmp_dir, 'profiles'),
+    'TRACE_JSON_PATH': os.path.join(_tmp_dir, 'traces.ndjson'),
+})
+for _name in ('SHARED_CACHE_URL', 'SENTRY_DSN', 'GEMINI_BASE_URL', 'TRACE_EXPORTER', 'METRICS_AUTH_TOKEN'):
+    os.environ.pop(_name, None)
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """起動時の準備を終えた app モジュール（管理API はスタブ、埋め込みモデルと Gemini はフェイク）。"""
+    from bench.standins import FakeEmbedder, FakeGenaiClient, make_chats, serve_management_stub
+
+    import settings
+
+    # app は import 時に管理API のクライアントを作るので、その前にスタブを起動する
+    mgmt_server, mgmt_url = serve_management_stub(make_chats(3))
+    os.environ['MGMT_API_BASE_URL'] = settings.MGMT_API_BASE_URL = mgmt_url
+    import app
+    import embedding_cache
+
+    app.warmup.wait(timeout=30)
+    # sentence-transformers を使わずに済むよう、準備の結果に関わらずフェイクの埋め込みに差し替える
+    app.embedding_model = embedding_cache.cached(FakeEmbedder(), shared=app.shared_tier)
+    app.ai_agent.client = FakeGenaiClient()
+    assert app.qdrant_client is not None
+    yield app
+    mgmt_server.shutdown()
+    mgmt_server.server_close()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def asgi_client(app_module):
+    """asgi.application にリクエストを 1 件送る関数。Returns (status, headers, body)。"""
+    import asgi
+
+    def call(method, path, json_body=None, headers=None):
+        if isinstance(json_body, bytes):
+            body = json_body
+        else:
+            body = json.dumps(json_body).encode('utf-8') if json_body is not None else b''
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'raw_path': path.encode('latin-1'),
+            'query_string': b'',
+            'root_path': '',
+            'scheme': 'http',
+            'http_version': '1.1',
+            'server': ('testserver', 80),
+            'client': ('127.0.0.1', 12345),
+            'headers': [(b'host', b'testserver'), (b'content-type', b'application/json')] + [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()
+            ],
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+        start = next(m for m in sent if m['type'] == 'http.response.start')
+        response_headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+        content = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+        return start['status'], response_headers, content
+
+    return call
+
+
+@pytest.fixture
+def chat_ids():
+    from bench.standins import make_chats
+
+    return [chat['id'] for chat in make_chats(3)]
+
+
+@pytest.fixture
+def http_server():
+    """パスごとの (status, headers, body) を返すローカル HTTP サーバー。Returns (routes, base_url)。"""
+    routes = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in routes:
+                self.send_error(404)
+                return
+            status, headers, body = routes[self.path]
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if isinstance(body, (list, tuple)):
+                # Content-Length なしで分割して送る（上限を読みながら判定する経路）
+                for chunk in body:
+                    self.wfile.write(chunk)
+            else:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield routes, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, TokenBucket
+
+CHAT = {'id': 'c1', 'llm_max_concurrency': 1, 'llm_rate_limit_per_min': 60, 'llm_burst': 2}
+
+
+def _controller(max_concurrency=10, max_queue=10, max_wait=1.0):
+    return AdmissionController(max_concurrency=max_concurrency, max_queue=max_queue, max_wait=max_wait)
+
+
+def _tokens(controller, chat_id='c1'):
+    return controller._buckets[chat_id].tokens
+
+
+def test_token_bucket_reserves_and_refunds():
+    bucket = TokenBucket(rate_per_sec=1.0, burst=1)
+    now = bucket.updated
+
+    assert bucket.reserve(now, max_wait=0) == 0.0
+    assert bucket.reserve(now, max_wait=0) is None
+    assert bucket.reserve(now, max_wait=2) == pytest.approx(1.0)
+    bucket.refund()
+    bucket.refund()
+    assert bucket.tokens == 1
+
+
+def test_rate_limited_when_burst_is_used_up():
+    controller = _controller(max_wait=0.1)
+    chat = {**CHAT, 'llm_max_concurrency': 5}
+
+    with controller.admit(chat), controller.admit(chat):
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.acquire(chat)
+
+    assert rejected.value.reason == 'rate_limited'
+    assert rejected.value.retry_after > 0
+
+
+def test_queue_full_refunds_the_token():
+    controller = _controller(max_queue=0)
+
+    with controller.admit(CHAT):
+        tokens = _tokens(controller)
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.acquire(CHAT)
+
+        assert rejected.value.reason == 'queue_full'
+        assert _tokens(controller) == pytest.approx(tokens, abs=0.01)
+
+
+def test_concurrency_timeout_refunds_the_token():
+    controller = _controller(max_wait=0.05)
+
+    with controller.admit(CHAT):
+        tokens = _tokens(controller)
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.acquire(CHAT)
+
+        assert rejected.value.reason == 'concurrency'
+        assert _tokens(controller) == pytest.approx(tokens, abs=0.1)
+        assert controller._waiting == 0
+
+
+def test_waiting_request_gets_the_released_slot():
+    controller = _controller()
+    chat_id = controller.acquire(CHAT)
+    threading.Timer(0.05, controller.release, [chat_id]).start()
+
+    with controller.admit(CHAT, max_wait=2):
+        assert controller._in_flight == 1
+
+
+def test_async_waiter_is_woken_by_release_from_another_thread():
+    controller = _controller(max_wait=5)
+    chat_id = controller.acquire(CHAT)
+
+    async def wait_for_slot():
+        start = time.monotonic()
+        threading.Timer(0.05, controller.release, [chat_id]).start()
+        async with controller.admit_async(CHAT):
+            return time.monotonic() - start, controller._in_flight
+
+    elapsed, in_flight = asyncio.run(wait_for_slot())
+
+    assert elapsed < 1
+    assert in_flight == 1
+    assert controller._async_waiters == set()
+
+
+def test_async_concurrency_timeout_refunds_the_token():
+    controller = _controller(max_wait=0.05)
+
+    async def acquire_while_busy():
+        async with controller.admit_async(CHAT):
+            tokens = _tokens(controller)
+            with pytest.raises(AdmissionRejected) as rejected:
+                await controller.acquire_async(CHAT)
+            return rejected.value.reason, tokens
+
+    reason, tokens = asyncio.run(acquire_while_busy())
+
+    assert reason == 'concurrency'
+    # 最初の 1 件分だけ減っている（拒否された分は戻る）
+    assert _tokens(controller) == pytest.approx(tokens, abs=0.1)
+    assert controller._waiting == 0
@@ -0,0 +1,70 @@
+import asyncio
+
+import numpy as np
+import pytest
+import requests
+from google.api_core.exceptions import ResourceExhausted
+
+from bench import bench_chat
+from bench.standins import FakeEmbedder, FakeGenaiClient, make_chats, serve_gemini_stub, serve_management_stub
+
+
+def test_fake_embedder_is_deterministic_unit_vectors():
+    embedder = FakeEmbedder()
+
+    single = embedder.encode('営業時間')
+    batch = embedder.encode(['営業時間', '料金'])
+
+    assert single.shape == (embedder.get_sentence_embedding_dimension(),)
+    assert np.allclose(batch[0], single)
+    assert np.isclose(np.linalg.norm(batch[1]), 1.0)
+    assert not np.allclose(batch[0], batch[1])
+
+
+def test_fake_genai_client_sync_async_and_errors():
+    client = FakeGenaiClient()
+
+    answer = client.models.generate_content(model='m1', contents='質問')
+    async_answer = asyncio.run(client.aio.models.generate_content(model='m2', contents='質問'))
+
+    assert answer.text.startswith('[m1]')
+    assert async_answer.text.startswith('[m2]')
+    assert client.models.calls_by_model == {'m1': 1, 'm2': 1}
+
+    client.models.model_error_rate['m1'] = 1.0
+    with pytest.raises(ResourceExhausted):
+        client.models.generate_content(model='m1', contents='質問')
+
+
+def test_management_stub_serves_chats():
+    chats = make_chats(2)
+    server, base_url = serve_management_stub(chats)
+    try:
+        res = requests.get(f"{base_url}/api/chats", timeout=5)
+        assert res.json() == {'chats': chats}
+        assert requests.get(f"{base_url}/other", timeout=5).status_code == 404
+    finally:
+        server.shutdown()
+
+
+def test_gemini_stub_answers_and_injects_errors():
+    server, base_url = serve_gemini_stub()
+    failing, failing_url = serve_gemini_stub(error_rate=1.0)
+    try:
+        url = '/v1beta/models/m:generateContent'
+        res = requests.post(base_url + url, json={'contents': []}, timeout=5)
+        assert res.status_code == 200
+        assert res.json()['candidates'][0]['content']['parts'][0]['text']
+        assert requests.post(failing_url + url, json={}, timeout=5).status_code == 429
+    finally:
+        server.shutdown()
+        failing.shutdown()
+
+
+def test_bench_helpers():
+    assert bench_chat._parse_server_timing('embed;dur=1.5, search;dur=2, bad') == {'embed': 1.5, 'search': 2.0}
+    summary = bench_chat._summarize([float(v) for v in range(1, 101)])
+    assert summary['count'] == 100
+    assert summary['p50'] == 50.0
+    assert summary['p99'] == 99.0
+    assert bench_chat._summarize([])['p95'] is None
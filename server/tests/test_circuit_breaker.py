@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_agent import ANSWER_FALLBACK_UNAVAILABLE, AIAgent
+from bench.standins import FakeGenaiClient
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, GuardedClient
+
+CONTEXT = "営業時間は平日 9 時から 18 時までです。"
+
+
+def _breaker(**kwargs):
+    options = dict(failure_rate=0.5, min_calls=4, window_sec=60, open_sec=0.05, half_open_probes=1)
+    options.update(kwargs)
+    return CircuitBreaker('t_dependency', **options)
+
+
+def _open(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_opens_when_failure_rate_is_reached():
+    breaker = _breaker()
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpen) as raised:
+        breaker.check()
+    assert raised.value.name == 't_dependency'
+    assert 0 < raised.value.retry_after <= 0.05
+
+
+def test_old_failures_leave_the_window(monkeypatch):
+    breaker = _breaker(window_sec=10)
+    now = [1000.0]
+    monkeypatch.setattr('circuit_breaker.time.monotonic', lambda: now[0])
+    for _ in range(3):
+        breaker.record_failure()
+
+    now[0] += 11
+    breaker.record_failure()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_closes_on_success():
+    breaker = _breaker()
+    _open(breaker)
+    time.sleep(0.06)
+
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # 試行枠は 1 件
+    breaker.record_success()
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_reopens_on_failure():
+    breaker = _breaker()
+    _open(breaker)
+    time.sleep(0.06)
+
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+
+
+class _Client:
+    def __init__(self, error=None):
+        self.error = error
+        self.name = 'client'
+
+    def search(self):
+        if self.error:
+            raise self.error
+        return 'hits'
+
+    async def search_async(self):
+        return self.search()
+
+
+def test_guarded_client_counts_only_failures():
+    breaker = _breaker(min_calls=2)
+    guarded = GuardedClient(_Client(ValueError('bad request')), breaker, is_failure=lambda e: not isinstance(e, ValueError))
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            guarded.search()
+
+    assert breaker.state == CLOSED
+    assert guarded.name == 'client'
+
+
+def test_guarded_client_rejects_while_open():
+    breaker = _breaker(min_calls=2)
+    guarded = GuardedClient(_Client(ConnectionError('down')), breaker)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            asyncio.run(guarded.search_async())
+
+    with pytest.raises(CircuitOpen):
+        guarded.search()
+
+
+def test_open_gemini_breaker_answers_from_knowledge(monkeypatch):
+    agent = AIAgent(models=['gemini-test'])
+    agent.client = FakeGenaiClient()
+    monkeypatch.setattr(agent.router.models[0].breaker, 'allow', lambda: False)
+
+    response, _, _, answer_path, model = agent.think_and_respond('営業時間は？', CONTEXT)
+
+    assert answer_path == ANSWER_FALLBACK_UNAVAILABLE
+    assert CONTEXT in response
+    assert model is None
+    assert agent.client.models.calls == 0
+
+
+def test_chat_answers_without_search_while_qdrant_breaker_is_open(client, chat_ids, app_module, monkeypatch):
+    monkeypatch.setattr(app_module.qdrant_breaker, 'allow', lambda: False)
+
+    res = client.post('/api/chat', json={'chat_id': chat_ids[0], 'message': '営業時間は？'})
+
+    assert res.status_code == 200
+    assert res.get_json()['context_found'] is False
+
+
+def test_qdrant_reconnects_in_background(app_module, monkeypatch):
+    connected = app_module.qdrant_client._client
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError('qdrant down')
+        return connected
+
+    monkeypatch.setattr(app_module, 'qdrant_client', None)
+    monkeypatch.setattr(app_module, '_connect_qdrant', connect)
+    monkeypatch.setattr(app_module.settings, 'QDRANT_RECONNECT_INTERVAL_SEC', 0.01)
+    monkeypatch.setattr(app_module.settings, 'QDRANT_RECONNECT_MAX_INTERVAL_SEC', 0.02)
+
+    app_module._reconnect_qdrant()
+
+    assert len(attempts) == 3
+    assert app_module.qdrant_client._client is connected
@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import BinaryQuantization, Disabled, ScalarQuantization
+
+import collection_config
+import tenancy
+from collection_config import CollectionConfig
+from tenancy import DEDICATED, Placement, TenantDirectory
+
+
+def test_defaults_send_no_search_params():
+    config = CollectionConfig(vector_size=384)
+
+    assert config.search_params() is None
+    assert config.quantization_config() is None
+    assert config.update_kwargs()['quantization_config'] == Disabled.DISABLED
+
+
+def test_scalar_quantization_rescores_with_oversampling():
+    config = CollectionConfig(vector_size=384, quantization='scalar', oversampling=3.0, search_ef=64)
+
+    assert isinstance(config.quantization_config(), ScalarQuantization)
+    params = config.search_params()
+    assert params.hnsw_ef == 64
+    assert (params.quantization.rescore, params.quantization.oversampling) == (True, 3.0)
+
+
+def test_per_tenant_hnsw_skips_the_global_graph(monkeypatch):
+    monkeypatch.setattr(collection_config.settings, 'QDRANT_TENANT_PAYLOAD_M', 16)
+    config = CollectionConfig(vector_size=384, hnsw_m=32)
+
+    assert (config.hnsw_config(per_tenant=True).m, config.hnsw_config(per_tenant=True).payload_m) == (0, 16)
+    assert config.hnsw_config().m == 32
+
+
+@pytest.mark.parametrize('quantization, on_disk, expected', [
+    ('none', False, 1000 * 384 * 4),
+    ('scalar', True, 1000 * 384),
+    ('binary', True, 1000 * 384 // 8),
+    ('scalar', False, 1000 * 384 * 5),
+])
+def test_estimated_ram(quantization, on_disk, expected):
+    config = CollectionConfig(vector_size=384, quantization=quantization, vectors_on_disk=on_disk)
+
+    assert config.estimated_ram_bytes(1000) == expected
+
+
+def test_unknown_quantization_falls_back_to_none(monkeypatch):
+    monkeypatch.setattr(collection_config.settings, 'QDRANT_QUANTIZATION', 'pq')
+
+    assert CollectionConfig.from_settings().quantization == 'none'
+
+
+class _RecordingClient:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, kwargs))
+
+
+def test_new_collections_use_the_config(monkeypatch):
+    monkeypatch.setattr(collection_config.settings, 'QDRANT_COLLECTION_NAME', 't_config')
+    monkeypatch.setattr(collection_config.settings, 'QDRANT_TENANT_INDEX', True)
+    client = _RecordingClient()
+    scalar = CollectionConfig(vector_size=384, quantization='scalar', payload_on_disk=True)
+
+    tenancy.create_knowledge_collection(client, 't_config_v2', config=scalar, alias_of='t_config')
+
+    name, kwargs = client.calls[0]
+    assert name == 'create_collection'
+    assert isinstance(kwargs['quantization_config'], ScalarQuantization)
+    assert kwargs['on_disk_payload'] is True
+    # エイリアスで切り替える共有コレクションの新しい版もテナントごとのグラフで作る
+    assert kwargs['hnsw_config'].m == 0
+    assert [call[1]['field_name'] for call in client.calls[1:]] == ['chat_id', 'type']
+
+
+def test_describe_reads_collection_info():
+    info = SimpleNamespace(
+        points_count=10,
+        config=SimpleNamespace(
+            params=SimpleNamespace(vectors=SimpleNamespace(size=384, on_disk=True), on_disk_payload=None),
+            quantization_config=BinaryQuantization(binary={'always_ram': True}),
+            hnsw_config=SimpleNamespace(m=0, payload_m=16, ef_construct=100),
+        ),
+    )
+
+    assert collection_config.describe(info) == {
+        'points': 10,
+        'vector_size': 384,
+        'quantization': 'binary',
+        'vectors_on_disk': True,
+        'payload_on_disk': False,
+        'hnsw_m': 0,
+        'payload_m': 16,
+        'ef_construct': 100,
+    }
+
+
+def test_knowledge_collections_include_dedicated_tenants(monkeypatch):
+    monkeypatch.setattr(collection_config.settings, 'QDRANT_COLLECTION_NAME', 't_config')
+    client = QdrantClient(location=':memory:')
+    tenancy.create_knowledge_collection(client, 't_config')
+    tenancy.ensure_placements_collection(client)
+    target = tenancy.target_for('big', DEDICATED)
+    tenancy.create_knowledge_collection(client, target.collection)
+    TenantDirectory(lambda: client).save(Placement('big', DEDICATED, target))
+
+    assert collection_config.knowledge_collections(client) == ['t_config', target.collection]
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import chat_pipeline
+from ai_agent import ANSWER_FALLBACK_DEADLINE, ANSWER_LLM, AIAgent
+from bench.standins import FakeGenaiClient
+
+CONTEXT = "営業時間は平日 9 時から 18 時までです。\n---\n土日祝日は休業です。"
+KNOWLEDGE = "期限テストの営業時間は平日 9 時から 18 時までです"
+
+
+class SlowGenaiClient(FakeGenaiClient):
+    """HTTP のタイムアウト（config.http_options.timeout）を守る遅い Gemini。"""
+
+    def __init__(self, latency_ms):
+        super().__init__(latency_ms=latency_ms)
+        self.latency = latency_ms / 1000
+        self.models = SimpleNamespace(generate_content=self._generate_content, calls=0)
+
+    def _generate_content(self, model, contents, config=None):
+        self.models.calls += 1
+        latency = self.latency
+        timeout = config.http_options.timeout / 1000 if config else None
+        if timeout is not None and timeout < latency:
+            time.sleep(timeout)
+            raise httpx.ReadTimeout('timed out')
+        time.sleep(latency)
+        return SimpleNamespace(text='late answer', usage_metadata=None)
+
+
+def _agent(latency_ms):
+    agent = AIAgent(models=['gemini-test'])
+    agent.client = SlowGenaiClient(latency_ms)
+    return agent
+
+
+def test_request_deadline_uses_the_tenant_budget(monkeypatch):
+    monkeypatch.setattr(chat_pipeline.settings, 'CHAT_DEADLINE_MS', 10000)
+
+    assert chat_pipeline.request_deadline({'deadline_ms': 2500}, 100.0) == 102.5
+    assert chat_pipeline.request_deadline({}, 100.0) == 110.0
+    assert chat_pipeline.search_timeout(time.time() + 0.2) == 1
+
+
+def test_slow_gemini_falls_back_to_extractive_answer():
+    agent = _agent(latency_ms=2000)
+
+    start = time.monotonic()
+    response, tokens_in, tokens_out, answer_path, model = agent.think_and_respond('営業時間は？', CONTEXT, timeout=0.1)
+
+    assert time.monotonic() - start < 1
+    assert answer_path == ANSWER_FALLBACK_DEADLINE
+    assert '営業時間は平日 9 時から 18 時までです。' in response
+    assert (tokens_in, tokens_out, model) == (None, None, None)
+
+
+def test_slow_gemini_is_cancelled_on_the_async_path():
+    agent = _agent(latency_ms=2000)
+
+    start = time.monotonic()
+    result = asyncio.run(agent.think_and_respond_async('営業時間は？', CONTEXT, timeout=0.1))
+
+    assert time.monotonic() - start < 1
+    assert result[3] == ANSWER_FALLBACK_DEADLINE
+    assert agent.model_stats()[0]['in_flight'] == 0
+
+
+def test_expired_budget_skips_gemini():
+    agent = _agent(latency_ms=0)
+
+    assert agent.think_and_respond('営業時間は？', CONTEXT, timeout=0)[3] == ANSWER_FALLBACK_DEADLINE
+    assert agent.client.models.calls == 0
+
+
+def test_answer_within_budget_uses_gemini():
+    agent = _agent(latency_ms=10)
+
+    assert agent.think_and_respond('営業時間は？', CONTEXT, timeout=2)[3] == ANSWER_LLM
+
+
+@pytest.fixture
+def knowledge(client, chat_ids):
+    res = client.post('/api/add_knowledge', json={'chat_id': chat_ids[0], 'content': KNOWLEDGE, 'title': 'deadline'})
+    assert res.status_code == 200
+    return KNOWLEDGE
+
+
+@pytest.mark.parametrize('entrypoint', ['wsgi', 'asgi'])
+def test_chat_answers_from_knowledge_when_the_deadline_expires(
+    entrypoint, client, asgi_client, app_module, chat_ids, knowledge, monkeypatch
+):
+    monkeypatch.setattr(app_module.ai_agent, 'client', SlowGenaiClient(latency_ms=3000))
+    monkeypatch.setattr(chat_pipeline.settings, 'CHAT_DEADLINE_MS', 500)
+    logged = []
+    monkeypatch.setattr(chat_pipeline, 'log_chat_request', lambda **kwargs: logged.append(kwargs))
+    body = {'chat_id': chat_ids[0], 'message': knowledge}
+
+    start = time.monotonic()
+    if entrypoint == 'wsgi':
+        res = client.post('/api/chat', json=body)
+        status, payload = res.status_code, res.get_json()
+    else:
+        status, _, content = asgi_client('POST', '/api/chat', body)
+        payload = json.loads(content)
+
+    assert time.monotonic() - start < 2
+    assert status == 200
+    assert payload['context_found']
+    assert knowledge in payload['response']
+    assert logged[0]['answer_path'] == ANSWER_FALLBACK_DEADLINE
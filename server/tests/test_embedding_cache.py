@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+import metrics
+from bench.standins import FakeEmbedder
+from embedding_cache import CachedEmbedder, EmbeddingCache, cache_key
+
+
+class _CountingEmbedder(FakeEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.encoded = []
+
+    def encode(self, sentences, **kwargs):
+        self.encoded += [sentences] if isinstance(sentences, str) else list(sentences)
+        return super().encode(sentences, **kwargs)
+
+
+class _SharedVectors:
+    """shared_cache.SharedCache の埋め込み部分の代替。"""
+
+    enabled = True
+
+    def __init__(self):
+        self.vectors = {}
+
+    def get_vectors(self, model_id, keys):
+        return {key: self.vectors[model_id, key] for key in keys if (model_id, key) in self.vectors}
+
+    def put_vectors(self, model_id, items):
+        for key, vector in items:
+            self.vectors[model_id, key] = vector
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(path=str(tmp_path / 'embeddings.sqlite3'), max_mb=16)
+
+
+def _requests(result):
+    return metrics.CACHE_REQUESTS.value(cache='embedding', result=result)
+
+
+def test_miss_then_hit(cache):
+    model = _CountingEmbedder()
+    embedder = CachedEmbedder(model, cache, 'fake')
+    hits, misses = _requests('hit'), _requests('miss')
+
+    first = embedder.encode(['営業時間', '料金'])
+    second = embedder.encode(['料金', '営業時間'])
+
+    assert model.encoded == ['営業時間', '料金']
+    np.testing.assert_array_equal(second, first[::-1])
+    assert (_requests('hit') - hits, _requests('miss') - misses) == (2, 2)
+
+
+def test_cached_and_computed_vectors_are_identical(cache):
+    embedder = CachedEmbedder(_CountingEmbedder(), cache, 'fake')
+
+    computed = embedder.encode('営業時間')
+    cached = embedder.encode('営業時間')
+
+    assert computed.shape == (FakeEmbedder().vector_size,)
+    assert computed.dtype == np.float32
+    np.testing.assert_array_equal(computed, cached)
+    # float16 の精度に丸めてから返す
+    np.testing.assert_array_equal(computed, computed.astype(np.float16).astype(np.float32))
+
+
+def test_equivalent_texts_share_an_entry(cache):
+    model = _CountingEmbedder()
+    embedder = CachedEmbedder(model, cache, 'fake')
+
+    embedder.encode(['  ｶﾞ  ', 'ガ', 'カ\u3099'])
+
+    # 前後の空白と NFC の違いは同じキー（NFKC ではないので半角カナは別）
+    assert model.encoded == ['ｶﾞ', 'ガ']
+
+
+def test_entries_are_per_model_and_persist(cache):
+    CachedEmbedder(_CountingEmbedder(), cache, 'fake').encode(['営業時間'])
+    reopened = EmbeddingCache(path=cache.path)
+    model = _CountingEmbedder()
+
+    CachedEmbedder(model, reopened, 'fake').encode(['営業時間'])
+    CachedEmbedder(model, reopened, 'other-model').encode(['営業時間'])
+
+    assert model.encoded == ['営業時間']
+
+
+def test_options_that_change_the_output_bypass_the_cache(cache):
+    model = _CountingEmbedder()
+    embedder = CachedEmbedder(model, cache, 'fake')
+    embedder.encode(['営業時間'])
+
+    embedder.encode(['営業時間'], normalize_embeddings=True)
+
+    assert model.encoded == ['営業時間', '営業時間']
+
+
+def test_entries_with_another_dtype_are_recomputed(tmp_path):
+    path = str(tmp_path / 'embeddings.sqlite3')
+    CachedEmbedder(_CountingEmbedder(), EmbeddingCache(path=path, dtype='float32'), 'fake').encode(['営業時間'])
+    model = _CountingEmbedder()
+
+    CachedEmbedder(model, EmbeddingCache(path=path, dtype='float16'), 'fake').encode(['営業時間'])
+
+    assert model.encoded == ['営業時間']
+
+
+def test_eviction_removes_entries_over_the_limit(cache):
+    cache.put_many([(cache_key('fake', str(i)), np.ones(384)) for i in range(200)])
+    cache.max_bytes = cache.used_bytes() // 2
+
+    removed = cache.evict()
+
+    assert removed > 0
+    assert len(cache.get_many([cache_key('fake', str(i)) for i in range(200)])) == 200 - removed
+
+
+def test_shared_cache_fills_the_local_cache(cache):
+    shared = _SharedVectors()
+    CachedEmbedder(_CountingEmbedder(), None, 'fake', shared).encode(['営業時間'])
+    model = _CountingEmbedder()
+    embedder = CachedEmbedder(model, cache, 'fake', shared)
+
+    embedder.encode(['営業時間'])
+
+    assert model.encoded == []
+    assert list(cache.get_many([cache_key('fake', '営業時間')])) == [cache_key('fake', '営業時間')]
+
+
+def test_computed_vectors_are_shared(cache):
+    shared = _SharedVectors()
+
+    CachedEmbedder(_CountingEmbedder(), cache, 'fake', shared).encode(['営業時間', '料金'])
+
+    assert set(shared.vectors) == {('fake', cache_key('fake', '営業時間')), ('fake', cache_key('fake', '料金'))}
@@ -0,0 +1,137 @@
+import uuid
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+
+import knowledge_bulk
+import tenancy
+from bench.standins import FakeEmbedder
+from conftest import ADMIN_API_KEY
+
+COLLECTION = 't_bulk'
+ADMIN_HEADERS = {'X-Admin-API-Key': ADMIN_API_KEY}
+
+
+@pytest.fixture
+def qdrant(monkeypatch):
+    monkeypatch.setattr(tenancy.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+    client = QdrantClient(location=':memory:')
+    tenancy.ensure_serving_alias(client, COLLECTION)
+    embedder = FakeEmbedder()
+    payloads = [
+        {'chat_id': 'c1', 'type': 'url_fetch', 'url': 'https://example.com/a', 'timestamp': 100},
+        {'chat_id': 'c1', 'type': 'url_fetch', 'url': 'https://example.com/b', 'timestamp': 200},
+        {'chat_id': 'c1', 'type': 'knowledge', 'source': 'file_upload', 'title': 'old.pdf', 'timestamp': 300},
+        {'chat_id': 'c1', 'type': 'knowledge', 'file_name': 'new.pdf', 'tags': ['faq', 'price'], 'timestamp': 400},
+        {'chat_id': 'c1', 'type': 'chat', 'url': 'https://example.com/a', 'timestamp': 500},
+        {'chat_id': 'c2', 'type': 'url_fetch', 'url': 'https://example.com/a', 'timestamp': 100},
+    ]
+    client.upsert(collection_name=tenancy.serving_alias(COLLECTION), points=[
+        PointStruct(id=str(uuid.uuid4()), vector=embedder.encode(str(i)).tolist(), payload=payload)
+        for i, payload in enumerate(payloads)
+    ])
+    return client
+
+
+def _count(client, criteria, chat_id='c1'):
+    return client.count(tenancy.serving_alias(COLLECTION), count_filter=knowledge_bulk.selection_filter(chat_id, criteria)).count
+
+
+@pytest.mark.parametrize('criteria, expected', [
+    ({'url': 'https://example.com/a'}, 1),
+    ({'url': ['https://example.com/a', 'https://example.com/b']}, 2),
+    ({'type': 'chat'}, 1),
+    ({'tags': 'price'}, 1),
+    ({'file_name': ['old.pdf', 'new.pdf']}, 2),
+    ({'timestamp': {'gte': 200, 'lt': 400}}, 2),
+    ({'type': 'url_fetch', 'timestamp': {'gt': 100}}, 1),
+])
+def test_selection_filter(qdrant, criteria, expected):
+    assert _count(qdrant, criteria) == expected
+
+
+def test_chat_logs_are_excluded_unless_type_is_given(qdrant):
+    assert _count(qdrant, {'timestamp': {'gte': 0}}) == 4
+    assert _count(qdrant, {'timestamp': {'gte': 0}}, chat_id='c2') == 1
+
+
+@pytest.mark.parametrize('criteria', [
+    None,
+    {},
+    {'text': 'x'},
+    {'url': ''},
+    {'tags': [1]},
+    {'timestamp': 100},
+    {'timestamp': {'after': 100}},
+    {'timestamp': {'gte': True}},
+])
+def test_invalid_criteria_are_rejected(criteria):
+    with pytest.raises(ValueError):
+        knowledge_bulk.selection_filter('c1', criteria)
+
+
+def test_only_patchable_fields_can_be_set():
+    assert knowledge_bulk.parse_patch({'category': None, 'tags': ['a']}) == {'category': None, 'tags': ['a']}
+    for value in (None, {}, {'text': 'x'}, {'title': 1}, {'tags': 'a'}):
+        with pytest.raises(ValueError):
+            knowledge_bulk.parse_patch(value)
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/api/knowledge/bulk_delete', {'chat_id': 'bench-chat-0', 'filter': {'category': 'x'}}),
+    ('/api/knowledge/bulk_update', {'chat_id': 'bench-chat-0', 'filter': {'category': 'x'}, 'set': {'title': 't'}}),
+    ('/api/cache/invalidate', {'registry': True}),
+])
+def test_filter_wide_endpoints_require_the_admin_key(client, path, body):
+    assert client.post(path, json=body).status_code == 401
+    assert client.post(path, json=body, headers={'X-Admin-API-Key': 'wrong'}).status_code == 401
+    assert client.post(path, json=body, headers=ADMIN_HEADERS).status_code == 200
+
+
+def _add(client, chat_id, category, count):
+    for i in range(count):
+        res = client.post('/api/add_knowledge', json={'chat_id': chat_id, 'content': f'{category} {i}', 'category': category})
+        assert res.status_code == 200
+
+
+def _list(client, chat_id, category):
+    items = client.get(f'/api/knowledge?chat_id={chat_id}&limit=500&fields=category,title').get_json()['items']
+    return [item for item in items if item.get('category') == category]
+
+
+def test_bulk_delete_endpoint(client, chat_ids):
+    _add(client, chat_ids[0], 'bulk-delete', 3)
+    _add(client, chat_ids[0], 'bulk-keep', 1)
+    body = {'chat_id': chat_ids[0], 'filter': {'category': 'bulk-delete'}}
+
+    dry_run = client.post('/api/knowledge/bulk_delete', json={**body, 'dry_run': True}, headers=ADMIN_HEADERS)
+    assert dry_run.get_json() == {'success': True, 'dry_run': True, 'matched': 3}
+    assert len(_list(client, chat_ids[0], 'bulk-delete')) == 3
+
+    res = client.post('/api/knowledge/bulk_delete', json=body, headers=ADMIN_HEADERS)
+
+    assert res.get_json() == {'success': True, 'estimated_deleted': 3, 'status': 'completed'}
+    assert _list(client, chat_ids[0], 'bulk-delete') == []
+    assert len(_list(client, chat_ids[0], 'bulk-keep')) == 1
+
+
+def test_bulk_update_endpoint(client, chat_ids):
+    _add(client, chat_ids[0], 'bulk-update', 2)
+
+    res = client.post('/api/knowledge/bulk_update', headers=ADMIN_HEADERS, json={
+        'chat_id': chat_ids[0], 'filter': {'category': 'bulk-update'}, 'set': {'title': '一括更新'},
+    })
+
+    assert res.get_json()['estimated_updated'] == 2
+    assert {item['title'] for item in _list(client, chat_ids[0], 'bulk-update')} == {'一括更新'}
+
+
+def test_bulk_endpoints_validate_the_request(client, chat_ids):
+    def post(path, body):
+        return client.post(path, json=body, headers=ADMIN_HEADERS).status_code
+
+    assert post('/api/knowledge/bulk_delete', {'filter': {'category': 'x'}}) == 400
+    assert post('/api/knowledge/bulk_delete', {'chat_id': 'unknown', 'filter': {'category': 'x'}}) == 404
+    assert post('/api/knowledge/bulk_delete', {'chat_id': chat_ids[0]}) == 400
+    assert post('/api/knowledge/bulk_update', {'chat_id': chat_ids[0], 'filter': {'category': 'x'}, 'set': {'text': 'x'}}) == 400
@@ -0,0 +1,140 @@
+import gzip
+import json
+import uuid
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+
+import knowledge_listing
+import tenancy
+from bench.standins import FakeEmbedder
+from tenancy import TenantDirectory
+
+COLLECTION = 't_listing'
+
+
+@pytest.fixture
+def tenants(monkeypatch):
+    monkeypatch.setattr(tenancy.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+    client = QdrantClient(location=':memory:')
+    tenancy.ensure_serving_alias(client, COLLECTION)
+    embedder = FakeEmbedder()
+    points = [
+        PointStruct(
+            id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{chat_id}/{i}")),
+            vector=embedder.encode(f"{chat_id} {i}").tolist(),
+            payload={
+                'chat_id': chat_id,
+                'text': f"{chat_id} {i}",
+                'title': f"title {i}",
+                'type': point_type,
+                'timestamp': i,
+            },
+        )
+        for chat_id in ('c1', 'c2')
+        for i, point_type in enumerate(['knowledge'] * 5 + ['url_fetch'] * 2 + ['chat'])
+    ]
+    client.upsert(collection_name=tenancy.serving_alias(COLLECTION), points=points)
+    return TenantDirectory(lambda: client, cache_ttl=60)
+
+
+def _walk(tenants, chat_id, limit, **kwargs):
+    pages = []
+    cursor = None
+    while True:
+        page = knowledge_listing.list_page(tenants, chat_id, limit, cursor, **kwargs)
+        pages.append(page['items'])
+        if page['next_cursor'] is None:
+            return pages
+        cursor = knowledge_listing.decode_cursor(page['next_cursor'])
+
+
+def test_cursor_walks_every_point_once(tenants):
+    pages = _walk(tenants, 'c1', 3)
+
+    items = [item for page in pages for item in page]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert len({item['id'] for item in items}) == 7
+    # 会話ログは一覧に含めない
+    assert {item['type'] for item in items} == {'knowledge', 'url_fetch'}
+
+
+def test_default_fields_exclude_text(tenants):
+    item = knowledge_listing.list_page(tenants, 'c1', 1)['items'][0]
+
+    assert 'text' not in item and 'chat_id' not in item
+    assert item['title'].startswith('title')
+    assert set(knowledge_listing.list_page(tenants, 'c1', 1, fields=['text'])['items'][0]) == {'id', 'text'}
+
+
+def test_type_filter(tenants):
+    items = [item for page in _walk(tenants, 'c2', 10, types=['url_fetch']) for item in page]
+
+    assert len(items) == 2
+    assert {item['type'] for item in items} == {'url_fetch'}
+
+
+@pytest.mark.parametrize('offset', [17, 'a0b1c2d3-0000-5000-8000-000000000000'])
+def test_cursor_round_trip(offset):
+    cursor = knowledge_listing.encode_cursor(offset)
+
+    assert '=' not in cursor
+    assert knowledge_listing.decode_cursor(cursor) == offset
+    assert knowledge_listing.encode_cursor(None) is None
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', knowledge_listing.encode_cursor(17)[:-1] + '_', 'dHJ1ZQ'])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        knowledge_listing.decode_cursor(cursor)
+
+
+def test_invalid_fields_are_rejected():
+    assert knowledge_listing.parse_fields('title, text') == ['title', 'text']
+    with pytest.raises(ValueError):
+        knowledge_listing.parse_fields('title,vector.0')
+
+
+def test_export_streams_pages_as_ndjson(tenants):
+    chunks = list(knowledge_listing.iter_export(tenants, 'c1', page_size=3))
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+
+    assert len(chunks) == 3
+    assert len(lines) == 7
+    assert {json.loads(line)['chat_id'] for line in lines} == {'c1'}
+    assert gzip.decompress(b''.join(knowledge_listing.gzip_stream(iter(chunks)))) == b''.join(chunks)
+
+
+def test_list_endpoint_pages_through_a_chat(client, chat_ids):
+    for i in range(3):
+        assert client.post('/api/add_knowledge', json={'chat_id': chat_ids[2], 'content': f'一覧テスト {i}'}).status_code == 200
+
+    ids = []
+    cursor = ''
+    while True:
+        res = client.get(f'/api/knowledge?chat_id={chat_ids[2]}&limit=2&cursor={cursor}')
+        assert res.status_code == 200
+        body = res.get_json()
+        ids += [item['id'] for item in body['items']]
+        if body['next_cursor'] is None:
+            break
+        cursor = body['next_cursor']
+
+    assert len(ids) == len(set(ids)) >= 3
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=abc', 'cursor=%25%25', 'fields=a-b'])
+def test_list_endpoint_rejects_bad_parameters(client, chat_ids, query):
+    assert client.get(f'/api/knowledge?chat_id={chat_ids[0]}&{query}').status_code == 400
+
+
+def test_export_endpoint_streams_gzip(client, chat_ids):
+    assert client.post('/api/add_knowledge', json={'chat_id': chat_ids[2], 'content': 'エクスポートテスト'}).status_code == 200
+
+    res = client.get(f'/api/knowledge/export?chat_id={chat_ids[2]}&gzip=1')
+
+    assert res.status_code == 200
+    assert res.headers['Content-Disposition'] == f'attachment; filename="{chat_ids[2]}.ndjson.gz"'
+    lines = gzip.decompress(res.data).decode('utf-8').splitlines()
+    assert 'エクスポートテスト' in {json.loads(line).get('text') for line in lines}
@@ -0,0 +1,81 @@
+import json
+import threading
+
+from bench import loadgen
+from bench.standins import chats_from_events
+
+
+class _RecordingSender:
+    def __init__(self, outcome='ok'):
+        self.outcome = outcome
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, event, scheduled_at=None):
+        with self._lock:
+            self.sent.append(event)
+        return 1.0, self.outcome
+
+
+def _level(label, rps, p99=100.0, error_rate=0.0):
+    return {'level': label, 'throughput_rps': rps, 'error_rate': error_rate, 'latency_ms': {'p99': p99}}
+
+
+def test_load_events_ndjson_filters_and_sorts(tmp_path):
+    path = tmp_path / 'events.ndjson'
+    rows = [
+        {'event_type': 'chat_request', 'chat_id': 'c1', 'message_content': '二件目', 'event_timestamp': '2024-01-01T00:00:02Z'},
+        {'event_type': 'chat_request', 'chat_id': 'c2', 'message_content': '一件目', 'event_timestamp': '2024-01-01 00:00:01 UTC'},
+        {'event_type': 'init', 'chat_id': 'c1', 'message_content': 'x'},
+        {'event_type': 'chat_request', 'chat_id': '', 'message_content': 'chat_id なし'},
+    ]
+    path.write_text('\n'.join(json.dumps(r, ensure_ascii=False) for r in rows), encoding='utf-8')
+
+    events = loadgen.load_events(str(path))
+
+    assert [e['message'] for e in events] == ['一件目', '二件目']
+    assert events[1]['ts'] - events[0]['ts'] == 1.0
+
+
+def test_load_events_csv(tmp_path):
+    path = tmp_path / 'events.csv'
+    path.write_text(
+        'event_type,chat_id,message_content,response_content,event_timestamp\n'
+        'chat_request,c1,質問,回答,2024-01-01T00:00:00\n',
+        encoding='utf-8',
+    )
+
+    events = loadgen.load_events(str(path))
+
+    assert events == [{'chat_id': 'c1', 'message': '質問', 'response': '回答', 'ts': 1704067200.0}]
+    assert [chat['id'] for chat in chats_from_events(events)] == ['c1']
+
+
+def test_run_replay_keeps_order_and_limit():
+    events = [{'chat_id': 'c', 'message': str(i), 'ts': 100.0 + i * 0.01} for i in range(5)]
+    sender = _RecordingSender()
+
+    results, elapsed = loadgen.run_replay(sender, events, speedup=10.0, max_inflight=1, limit=3)
+
+    assert [e['message'] for e in sender.sent] == ['0', '1', '2']
+    assert len(results) == 3
+    assert elapsed >= 0.002
+
+
+def test_run_closed_and_summary():
+    sender = _RecordingSender(outcome='http_503')
+
+    results, elapsed = loadgen.run_closed(sender, [{'chat_id': 'c', 'message': 'q'}], concurrency=2, duration=0.05)
+    summary = loadgen._summarize_level('c=2', 2, results, elapsed)
+
+    assert summary['sent'] == len(results) > 0
+    assert summary['ok'] == 0
+    assert summary['error_rate'] == 1.0
+    assert summary['errors'] == {'http_503': len(results)}
+
+
+def test_find_saturation():
+    assert loadgen.find_saturation([_level('a', 10), _level('b', 20)], slo_p99_ms=500, max_error_rate=0.01) is None
+    assert loadgen.find_saturation([_level('a', 10), _level('b', 10.2)], 500, 0.01)['level'] == 'b'
+    assert loadgen.find_saturation([_level('a', 10, p99=900)], 500, 0.01)['reason'].startswith('p99')
+    assert loadgen.find_saturation([_level('a', 10, error_rate=0.5)], 500, 0.01)['reason'].startswith('error rate')
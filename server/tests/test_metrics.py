@@ -0,0 +1,69 @@
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    requests = registry.register(Counter('t_requests_total', 'Requests.', ['result']))
+    in_flight = registry.register(Gauge('t_in_flight', 'In flight.'))
+
+    requests.inc(result='ok')
+    requests.inc(2, result='ok')
+    requests.inc(result='error')
+    with in_flight.track_inprogress():
+        assert in_flight.value() == 1
+    in_flight.set(0.5)
+
+    text = registry.render()
+    assert '# TYPE t_requests_total counter' in text
+    assert 't_requests_total{result="error"} 1\n' in text
+    assert 't_requests_total{result="ok"} 3\n' in text
+    assert 't_in_flight 0.5\n' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.register(Histogram('t_latency_seconds', 'Latency.', ['stage'], buckets=(0.1, 1.0)))
+
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, stage='llm')
+
+    lines = registry.render().splitlines()
+    assert 't_latency_seconds_bucket{stage="llm",le="0.1"} 2' in lines
+    assert 't_latency_seconds_bucket{stage="llm",le="1"} 3' in lines
+    assert 't_latency_seconds_bucket{stage="llm",le="+Inf"} 4' in lines
+    assert 't_latency_seconds_sum{stage="llm"} 3.65' in lines
+    assert 't_latency_seconds_count{stage="llm"} 4' in lines
+
+
+def test_labels_are_validated_and_escaped():
+    registry = Registry()
+    errors = registry.register(Counter('t_errors_total', 'Errors.', ['type']))
+
+    with pytest.raises(ValueError):
+        errors.inc(kind='x')
+    with pytest.raises(ValueError):
+        registry.register(Counter('t_errors_total', 'Duplicate.'))
+    errors.inc(type='a"b\n')
+    assert 't_errors_total{type="a\\"b\\n"} 1' in registry.render()
+
+
+def test_metrics_endpoint_exports_request_and_stage_metrics(client):
+    assert client.get('/health').status_code == 200
+
+    res = client.get('/metrics')
+
+    assert res.status_code == 200
+    assert res.mimetype == 'text/plain'
+    text = res.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{endpoint="health",status="2xx"}' in text
+    assert '# TYPE request_stage_duration_seconds histogram' in text
+
+
+def test_metrics_endpoint_requires_token_when_configured(client, monkeypatch):
+    monkeypatch.setattr(metrics.settings, 'METRICS_AUTH_TOKEN', 'secret')
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
@@ -0,0 +1,160 @@
+import asyncio
+import math
+import time
+
+import pytest
+
+import metrics
+from ai_agent import ANSWER_FALLBACK_DEADLINE, ANSWER_LLM, AIAgent
+from bench.standins import FakeGenaiClient
+from model_router import ModelRouter
+
+CONTEXT = "営業時間は平日 9 時から 18 時までです。"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('model_router.time.monotonic', lambda: now[0])
+    return now
+
+
+def _record(model, clock, latency):
+    token = model.start()
+    clock[0] += latency
+    model.finish(token, 'success')
+
+
+def _names(router):
+    return [model.name for model in router.candidates()]
+
+
+def _agent(models, latency_ms, hedge_after=None):
+    agent = AIAgent(models=models)
+    agent.client = FakeGenaiClient()
+    agent.client.models.model_latency_ms.update(latency_ms)
+    agent.router = ModelRouter(models, window_sec=60, hedge_after=hedge_after, prior=2.0)
+    return agent
+
+
+def test_ewma_orders_models_by_latency(clock):
+    router = ModelRouter(['primary', 'secondary'], window_sec=60, prior=2.0)
+    primary, secondary = router.models
+
+    _record(primary, clock, 1.0)
+    _record(secondary, clock, 0.3)
+    assert _names(router) == ['secondary', 'primary']
+
+    # 1 件遅い応答があっても EWMA なので急には入れ替わらない
+    _record(secondary, clock, 1.5)
+    assert secondary.score(clock[0]) < 0.6
+    assert _names(router) == ['secondary', 'primary']
+
+
+def test_configured_order_without_stats(clock):
+    router = ModelRouter(['primary', 'secondary', 'tertiary'], window_sec=60, prior=2.0)
+    primary = router.models[0]
+
+    assert _names(router) == ['primary', 'secondary', 'tertiary']
+    # 記録がないモデルは見込みの値で比べるので、primary が見込みより速ければ primary のまま
+    _record(primary, clock, 0.5)
+    assert _names(router) == ['primary', 'secondary', 'tertiary']
+
+
+def test_in_flight_calls_do_not_push_a_model_to_infinity(clock):
+    router = ModelRouter(['primary', 'secondary'], window_sec=60, prior=2.0)
+    secondary = router.models[1]
+
+    secondary.start()
+    clock[0] += 0.5
+
+    assert secondary.score(clock[0]) == 2.0
+    assert router.stats()[1]['latency_ms'] == 2000.0
+
+
+def test_stale_stats_decay_toward_the_prior(clock):
+    router = ModelRouter(['primary', 'secondary'], window_sec=60, prior=2.0)
+    primary, secondary = router.models
+    _record(primary, clock, 6.0)
+    _record(secondary, clock, 2.5)
+    assert _names(router) == ['secondary', 'primary']
+
+    clock[0] += 57.5
+    # primary の記録から 60 秒で差が 1/e になる。まだ遅いまま（0 に戻って最優先にはならない）
+    assert primary.score(clock[0]) == pytest.approx(2.0 + 4.0 / math.e)
+    assert _names(router) == ['secondary', 'primary']
+
+    clock[0] += 600
+    # 十分に時間が経てば両方とも見込みの値になり、GEMINI_MODELS の順に戻る
+    assert _names(router) == ['primary', 'secondary']
+
+
+def test_hedge_fires_after_the_delay():
+    agent = _agent(['slow', 'fast'], {'slow': 1000, 'fast': 10}, hedge_after=0.05)
+    hedged = metrics.LLM_HEDGED.value(winner='secondary')
+
+    start = time.monotonic()
+    response, _, _, answer_path, model = agent.think_and_respond('営業時間は？', CONTEXT, timeout=5)
+
+    assert time.monotonic() - start < 0.5
+    assert (answer_path, model) == (ANSWER_LLM, 'fast')
+    assert response.startswith('[fast]')
+    assert agent.client.models.calls_by_model == {'slow': 1, 'fast': 1}
+    assert metrics.LLM_HEDGED.value(winner='secondary') == hedged + 1
+
+
+def test_fast_primary_is_not_hedged():
+    agent = _agent(['primary', 'secondary'], {'primary': 10, 'secondary': 10}, hedge_after=0.5)
+
+    assert agent.think_and_respond('営業時間は？', CONTEXT, timeout=5)[4] == 'primary'
+    assert agent.client.models.calls_by_model == {'primary': 1}
+
+
+def test_async_hedge_cancels_the_loser():
+    agent = _agent(['slow', 'fast'], {'slow': 1000, 'fast': 10}, hedge_after=0.05)
+
+    result = asyncio.run(agent.think_and_respond_async('営業時間は？', CONTEXT, timeout=5))
+
+    assert result[4] == 'fast'
+    assert [stats['in_flight'] for stats in agent.model_stats()] == [0, 0]
+
+
+def test_no_hedge_when_hedge_threads_are_busy(monkeypatch):
+    agent = _agent(['slow', 'fast'], {'slow': 100, 'fast': 10}, hedge_after=0.01)
+    monkeypatch.setattr(agent._hedge_slots, 'acquire', lambda blocking=True: False)
+
+    result = agent.think_and_respond('営業時間は？', CONTEXT, timeout=5)
+
+    # スレッドの空きを待たずにリクエストのスレッドで primary を呼ぶ
+    assert result[4] == 'slow'
+    assert agent.client.models.calls_by_model == {'slow': 1}
+    assert agent._hedge_executor is None
+
+
+def test_losing_hedge_call_releases_its_thread():
+    agent = _agent(['slow', 'fast'], {'slow': 200, 'fast': 10}, hedge_after=0.02)
+
+    agent.think_and_respond('営業時間は？', CONTEXT, timeout=5)
+    agent._hedge_executor.shutdown(wait=True)
+
+    assert agent._hedge_slots._value == agent._hedge_slots._initial_value
+
+
+def test_open_breaker_skips_the_model(monkeypatch):
+    agent = _agent(['primary', 'secondary'], {'primary': 10, 'secondary': 10}, hedge_after=0.05)
+    monkeypatch.setattr(agent.router.models[0].breaker, 'allow', lambda: False)
+
+    assert agent.think_and_respond('営業時間は？', CONTEXT, timeout=5)[4] == 'secondary'
+    assert agent.client.models.calls_by_model == {'secondary': 1}
+
+
+def test_deadline_expiry_falls_back_to_extractive_answer():
+    agent = _agent(['slow', 'slower'], {'slow': 1000, 'slower': 1000}, hedge_after=0.02)
+
+    start = time.monotonic()
+    response, _, _, answer_path, model = agent.think_and_respond('営業時間は？', CONTEXT, timeout=0.1)
+
+    assert time.monotonic() - start < 0.5
+    assert answer_path == ANSWER_FALLBACK_DEADLINE
+    assert CONTEXT in response
+    assert model is None
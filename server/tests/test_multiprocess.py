@@ -0,0 +1,167 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+import admission
+import metrics
+import profiling
+from conftest import ADMIN_API_KEY, SERVER_DIR
+from metrics import Counter, Gauge, Histogram, Registry
+
+# 存在しないプロセス（終了したワーカー）の pid
+DEAD_PID = 2 ** 22 + 12345
+
+
+def _registry():
+    registry = Registry()
+    registry.register(Counter('t_requests_total', 'Requests.', ['endpoint']))
+    registry.register(Gauge('t_in_flight', 'In flight.'))
+    registry.register(Gauge('t_state', 'State.', multiprocess_mode='max'))
+    registry.register(Histogram('t_latency_seconds', 'Latency.', buckets=(0.1, 1.0)))
+    return registry
+
+
+def _fill(registry, requests_count, in_flight, state, latency):
+    requests_metric, in_flight_metric, state_metric, latency_metric = registry._metrics.values()
+    requests_metric.inc(requests_count, endpoint='chat')
+    in_flight_metric.set(in_flight)
+    state_metric.set(state)
+    latency_metric.observe(latency)
+
+
+def test_render_merges_other_workers():
+    own, other, dead = _registry(), _registry(), _registry()
+    _fill(own, 2, 1, 0, 0.05)
+    _fill(other, 3, 4, 2, 0.5)
+    _fill(dead, 5, 7, 1, 5.0)
+
+    lines = own.render([(other.snapshot(), True), (dead.snapshot(), False)]).splitlines()
+
+    # カウンターとヒストグラムは終了したワーカーの分も合計し、ゲージは生きているワーカーだけ
+    assert 't_requests_total{endpoint="chat"} 10' in lines
+    assert 't_in_flight 5' in lines
+    assert 't_state 2' in lines
+    assert 't_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 't_latency_seconds_bucket{le="1"} 2' in lines
+    assert 't_latency_seconds_count 3' in lines
+
+
+def test_render_all_reads_snapshots_from_multiproc_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_multiproc_dir', str(tmp_path))
+    metrics.write_snapshot()
+    own_value = metrics.CACHE_REQUESTS.value(cache='t_multiproc', result='hit')
+    other = {'cache_requests_total': [[['t_multiproc', 'hit'], 5]], 'llm_in_flight': [[[], 3]]}
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(other))
+    (tmp_path / f"{DEAD_PID}.json").write_text(json.dumps(other))
+    (tmp_path / 'garbage.json').write_text('{')
+
+    text = metrics.render_all()
+
+    assert f'cache_requests_total{{cache="t_multiproc",result="hit"}} {own_value + 10}' in text
+    assert f'llm_in_flight {metrics.LLM_IN_FLIGHT.value() + 3}' in text
+
+
+def test_worker_writes_snapshot_until_exit(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_multiproc_dir', None)
+    metrics.start_multiprocess(str(tmp_path), interval=0.05)
+    try:
+        metrics.CACHE_REQUESTS.inc(cache='t_snapshot', result='miss')
+        path = tmp_path / f"{os.getpid()}.json"
+        for _ in range(100):
+            if path.exists() and 't_snapshot' in path.read_text():
+                break
+            time.sleep(0.02)
+        assert [['t_snapshot', 'miss'], 1] in json.loads(path.read_text())['cache_requests_total']
+    finally:
+        metrics.stop_multiprocess()
+        monkeypatch.setattr(metrics, '_multiproc_dir', None)
+
+
+def test_profiling_sample_rate_is_shared_through_multiproc_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling.settings, 'MULTIPROC_DIR', str(tmp_path))
+    monkeypatch.setattr(profiling, '_sample_rate', 0.0)
+    monkeypatch.setattr(profiling, '_shared_rate_checked_at', 0.0)
+
+    profiling.set_sample_rate(0.25)
+    assert (tmp_path / 'profile_sample_rate').read_text() == '0.25'
+
+    # 別のワーカーが書き換えた値を読み直す
+    (tmp_path / 'profile_sample_rate').write_text('0.5')
+    monkeypatch.setattr(profiling, '_shared_rate_checked_at', 0.0)
+    assert profiling.get_sample_rate() == 0.5
+
+
+def test_admission_limits_are_divided_by_worker_count(monkeypatch):
+    monkeypatch.setattr(admission.settings, 'SERVER_WORKERS', 4)
+
+    limits = admission._Limits({'llm_max_concurrency': 10, 'llm_rate_limit_per_min': 240, 'llm_burst': 2})
+
+    assert limits.max_concurrency == 3
+    assert limits.rate_per_sec == 1.0
+    assert limits.burst == 1
+    assert admission.per_worker(64) == 16
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_gunicorn_workers_share_metrics_and_profiling_rate(tmp_path):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        'WEB_CONCURRENCY': '2',
+        'GUNICORN_THREADS': '2',
+        'METRICS_MULTIPROC_INTERVAL_SEC': '0.1',
+        'MULTIPROC_DIR': str(tmp_path),
+        'EMBEDDING_CACHE_PATH': str(tmp_path / 'embedding_cache.sqlite3'),
+        'STARTUP_WARMUP_TIMEOUT_SEC': '30',
+    }
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{port}", 'app:app'],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(600):
+            try:
+                if requests.get(f"{base}/health", timeout=1).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            pytest.fail('gunicorn did not start')
+        # 両方のワーカーが起動するまで待つ（スナップショットのファイルが 2 つ）
+        for _ in range(100):
+            if len(list(tmp_path.glob('*.json'))) >= 2:
+                break
+            time.sleep(0.1)
+        assert len(list(tmp_path.glob('*.json'))) == 2
+
+        with requests.Session() as session:
+            for _ in range(20):
+                session.get(f"{base}/health", headers={'Connection': 'close'}, timeout=5)
+        time.sleep(0.5)
+
+        pattern = 'http_request_duration_seconds_count{endpoint="health",status="2xx"} '
+        for _ in range(4):
+            text = requests.get(f"{base}/metrics", timeout=5).text
+            count = int(next(line for line in text.splitlines() if line.startswith(pattern))[len(pattern):])
+            assert count >= 21
+
+        headers = {'X-Admin-API-Key': ADMIN_API_KEY}
+        requests.post(f"{base}/api/admin/profiling", json={'sample_rate': 0.3}, headers=headers, timeout=5)
+        time.sleep(1.1)
+        for _ in range(4):
+            assert requests.get(f"{base}/api/admin/profiling", headers=headers, timeout=5).json()['sample_rate'] == 0.3
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
@@ -0,0 +1,94 @@
+import json
+import pstats
+
+import pytest
+
+import auth
+import profiling
+from conftest import ADMIN_API_KEY
+
+PROFILE_HEADERS = {'X-Profile': '1', 'X-Admin-API-Key': ADMIN_API_KEY}
+ADMIN_HEADERS = {'X-Admin-API-Key': ADMIN_API_KEY}
+
+
+@pytest.fixture(autouse=True)
+def no_sampling(monkeypatch):
+    monkeypatch.setattr(profiling, '_sample_rate', 0.0)
+
+
+def _download(client, header):
+    names = [name.strip() for name in header.split(',')]
+    assert names
+    res = client.get(f"/api/admin/profiles/{names[0]}", headers=ADMIN_HEADERS)
+    assert res.status_code == 200
+    return names[0], res.get_data()
+
+
+def test_sample_rate_is_clamped():
+    assert profiling.set_sample_rate(2) == 1.0
+    assert profiling.set_sample_rate(-1) == 0.0
+    assert profiling.get_sample_rate() == 0.0
+
+
+def test_admin_key_check_uses_lowercase_headers_for_asgi():
+    assert auth.is_admin_request({'x-admin-api-key': ADMIN_API_KEY})
+    assert not auth.is_admin_request({'x-admin-api-key': 'wrong'})
+    assert not auth.is_admin_request({})
+
+
+def test_unprofiled_request_has_no_artifacts(client, chat_ids):
+    res = client.post('/api/chat', json={'chat_id': chat_ids[0], 'message': '営業時間は？'})
+
+    assert res.status_code == 200
+    assert 'X-Profile-Artifacts' not in res.headers
+
+
+def test_profile_header_requires_admin_key(client, chat_ids):
+    res = client.post('/api/chat', json={'chat_id': chat_ids[0], 'message': '営業時間は？'}, headers={'X-Profile': '1'})
+
+    assert 'X-Profile-Artifacts' not in res.headers
+
+
+def test_wsgi_chat_profile_can_be_downloaded(client, chat_ids):
+    res = client.post('/api/chat', json={'chat_id': chat_ids[0], 'message': '営業時間は？'}, headers=PROFILE_HEADERS)
+
+    assert res.status_code == 200
+    name, content = _download(client, res.headers['X-Profile-Artifacts'])
+    assert name.endswith('.speedscope.json')
+    profile = json.loads(content)
+    assert profile['name'] == 'POST /api/chat'
+    assert profile['profiles'][0]['type'] == 'sampled'
+
+    listed = client.get('/api/admin/profiles', headers=ADMIN_HEADERS).get_json()['profiles']
+    assert name in [entry['name'] for entry in listed]
+
+
+def test_pstats_format(client, chat_ids, tmp_path):
+    res = client.post(
+        '/api/chat',
+        json={'chat_id': chat_ids[0], 'message': '料金は？'},
+        headers={**PROFILE_HEADERS, 'X-Profile-Format': 'pstats'},
+    )
+
+    name, content = _download(client, res.headers['X-Profile-Artifacts'])
+    assert name.endswith('.pstats')
+    path = tmp_path / name
+    path.write_bytes(content)
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+def test_asgi_chat_is_profiled(asgi_client, client, chat_ids):
+    status, headers, _ = asgi_client(
+        'POST', '/api/chat', {'chat_id': chat_ids[0], 'message': '営業時間は？'}, headers=PROFILE_HEADERS
+    )
+
+    assert status == 200
+    _, content = _download(client, headers['x-profile-artifacts'])
+    assert json.loads(content)['name'] == 'POST /api/chat'
+
+
+def test_profile_download_requires_admin_and_a_known_name(client):
+    assert client.get('/api/admin/profiles').status_code == 401
+    assert client.get('/api/admin/profiles/x.pstats').status_code == 401
+    assert client.get('/api/admin/profiles/..%2Fsettings.py', headers=ADMIN_HEADERS).status_code == 404
+    assert client.get('/api/admin/profiles/20240101T000000-chat-x.pstats', headers=ADMIN_HEADERS).status_code == 404
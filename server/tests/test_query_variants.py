@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import chat_pipeline
+
+
+def _point(point_id, score, text='t'):
+    return SimpleNamespace(id=point_id, score=score, payload={'text': text, 'title': ''})
+
+
+def test_variants_normalize_width_and_drop_question_suffix():
+    assert chat_pipeline.query_variants('営業時間を教えてください？', limit=3) == [
+        '営業時間を教えてください？',
+        '営業時間を教えてください',
+        '営業時間',
+    ]
+    assert chat_pipeline.query_variants('ＡＢＣとは', limit=3) == ['ＡＢＣとは', 'ABCとは', 'ABC']
+
+
+def test_variants_are_deduplicated_and_limited():
+    assert chat_pipeline.query_variants('料金', limit=3) == ['料金']
+    assert chat_pipeline.query_variants('営業時間ですか？', limit=1) == ['営業時間ですか？']
+    # 質問の言い回しだけの場合は空にしない
+    assert chat_pipeline.query_variants('とは', limit=3) == ['とは']
+
+
+def test_one_search_request_per_variant_with_tenant_filter():
+    requests = chat_pipeline.search_requests([[0.1, 0.2], [0.3, 0.4]], 'c1', shard_key='shard-a')
+
+    assert [request.vector for request in requests] == [[0.1, 0.2], [0.3, 0.4]]
+    for request in requests:
+        assert request.filter.must[0].key == 'chat_id'
+        assert request.filter.must[0].match.value == 'c1'
+        assert request.filter.must_not[0].match.value == 'chat'
+        assert request.limit == chat_pipeline.SEARCH_LIMIT
+        assert request.shard_key == 'shard-a'
+        assert request.with_payload.include == chat_pipeline.SEARCH_PAYLOAD_FIELDS
+
+
+def test_merge_keeps_best_score_per_point():
+    merged = chat_pipeline.merge_search_results([
+        [_point(1, 0.5), _point(2, 0.4)],
+        [_point(2, 0.9), _point(3, 0.1)],
+    ])
+
+    assert [(point.id, point.score) for point in merged] == [(2, 0.9), (1, 0.5), (3, 0.1)]
+
+
+def test_merge_limits_to_search_limit():
+    batches = [[_point(i, i / 100) for i in range(8)], [_point(i, i / 100) for i in range(8, 16)]]
+
+    merged = chat_pipeline.merge_search_results(batches)
+
+    assert len(merged) == chat_pipeline.SEARCH_LIMIT
+    assert merged[0].id == 15
+
+
+def test_context_uses_points_above_threshold():
+    result = chat_pipeline.build_context([_point(1, 0.8, 'a'), _point(2, 0.5, 'b'), _point(3, 0.01, 'c')], 'c1')
+
+    assert result.context == 'a\n---\nb'
+    assert (result.context_found, result.sources_count, result.top_score) == (True, 2, 0.8)
+    assert chat_pipeline.build_context([], 'c1').context_found is False
+
+
+def test_chat_finds_knowledge_with_a_question_variant(client, chat_ids, monkeypatch):
+    monkeypatch.setattr(chat_pipeline.settings, 'CHAT_QUERY_VARIANTS', 3)
+    content = '変種テストの駐車場'
+    assert client.post('/api/add_knowledge', json={'chat_id': chat_ids[1], 'content': content}).status_code == 200
+
+    # 末尾の言い回しを除いた変種が登録した文と同じベクトルになる（フェイクの埋め込み）
+    res = client.post('/api/chat', json={'chat_id': chat_ids[1], 'message': f'{content}について教えてください'})
+
+    assert res.status_code == 200
+    assert res.get_json()['context_found'] is True
@@ -0,0 +1,152 @@
+import time
+import uuid
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointIdsList, PointStruct
+
+import reindex
+import tenancy
+from bench.standins import FakeEmbedder
+from reindex import BUILDING, BUILT, SWITCHED, Reindexer
+
+COLLECTION = 't_reindex'
+
+
+@pytest.fixture
+def qdrant(monkeypatch):
+    monkeypatch.setattr(reindex.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+    client = QdrantClient(location=':memory:')
+    # エイリアスを使う前に作ったコレクションに、アプリの起動時にエイリアスが向けられた状態
+    tenancy.create_knowledge_collection(client, COLLECTION)
+    tenancy.ensure_serving_alias(client, COLLECTION)
+    return client
+
+
+def _id(i):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"reindex/{i}"))
+
+
+def _upsert(client, ids, text=True, timestamp=0, collection=tenancy.serving_alias(COLLECTION)):
+    embedder = FakeEmbedder()
+    client.upsert(collection_name=collection, points=[
+        PointStruct(
+            id=_id(i),
+            vector=embedder.encode(f"text {i}").tolist(),
+            payload={'chat_id': 'c1', 'type': 'knowledge', 'timestamp': timestamp, **({'text': f"text {i}"} if text else {})},
+        )
+        for i in ids
+    ])
+
+
+def _reindexer(client, **kwargs):
+    return Reindexer(client, COLLECTION, FakeEmbedder(vector_size=8), log=lambda message: None, **kwargs)
+
+
+def _vector_size(client, name):
+    return client.get_collection(name).config.params.vectors.size
+
+
+def test_build_reembeds_into_a_new_version(qdrant):
+    _upsert(qdrant, range(5))
+    _upsert(qdrant, [5], text=False)
+
+    _reindexer(qdrant, page_size=2).build('fake-8')
+
+    state = reindex.load_state(qdrant, COLLECTION)
+    assert (state['phase'], state['target'], state['copied'], state['skipped']) == (BUILT, f"{COLLECTION}_v2", 5, 1)
+    assert qdrant.count(f"{COLLECTION}_v2").count == 5
+    assert _vector_size(qdrant, f"{COLLECTION}_v2") == 8
+    # 切り替えるまでアプリは元のコレクションを使う
+    assert tenancy.resolve_collection(qdrant, COLLECTION) == COLLECTION
+
+
+def test_interrupted_build_resumes_from_the_saved_offset(qdrant):
+    _upsert(qdrant, range(6))
+    interrupted = _reindexer(qdrant, page_size=2)
+    reembed = interrupted.reembed
+    pages = []
+
+    def fail_on_second_page(records, target):
+        if pages:
+            raise RuntimeError('interrupted')
+        pages.append(len(records))
+        return reembed(records, target)
+
+    interrupted.reembed = fail_on_second_page
+    with pytest.raises(RuntimeError):
+        interrupted.build('fake-8')
+    state = reindex.load_state(qdrant, COLLECTION)
+    assert (state['phase'], state['copied']) == (BUILDING, 2)
+
+    resumed = _reindexer(qdrant, page_size=2)
+    written = []
+    resumed.reembed = lambda records, target: written.append(len(records)) or reembed(records, target)
+    resumed.build('fake-8')
+
+    assert sum(written) == 4
+    assert reindex.load_state(qdrant, COLLECTION)['copied'] == 6
+    assert qdrant.count(f"{COLLECTION}_v2").count == 6
+
+
+def test_resume_with_another_model_is_refused(qdrant):
+    _upsert(qdrant, range(2))
+    reindex.save_state(qdrant, {
+        'collection': COLLECTION, 'source': COLLECTION, 'target': f"{COLLECTION}_v2", 'model': 'fake-8',
+        'phase': BUILDING, 'offset': None, 'scanned': False, 'copied': 0, 'skipped': 0,
+    })
+
+    with pytest.raises(SystemExit):
+        _reindexer(qdrant).build('other-model')
+
+
+def test_switch_catches_up_and_moves_the_alias(qdrant):
+    _upsert(qdrant, range(4))
+    reindexer = _reindexer(qdrant)
+    reindexer.build('fake-8')
+    # build の後に追加・削除された点
+    _upsert(qdrant, [10], timestamp=time.time())
+    qdrant.delete(collection_name=tenancy.serving_alias(COLLECTION), points_selector=PointIdsList(points=[_id(0)]))
+
+    reindexer.switch()
+
+    target = f"{COLLECTION}_v2"
+    assert tenancy.resolve_collection(qdrant, COLLECTION) == target
+    assert reindex.load_state(qdrant, COLLECTION)['phase'] == SWITCHED
+    ids = {record.id for record in qdrant.scroll(collection_name=tenancy.serving_alias(COLLECTION), limit=10)[0]}
+    assert ids == {_id(1), _id(2), _id(3), _id(10)}
+    # 切り替えでは元のコレクションを削除しない
+    assert qdrant.count(COLLECTION).count == 4
+
+
+def test_switch_needs_the_serving_alias():
+    client = QdrantClient(location=':memory:')
+    tenancy.create_knowledge_collection(client, COLLECTION)
+    _upsert(client, range(2), collection=COLLECTION)
+    reindexer = _reindexer(client)
+    reindexer.build('fake-8')
+
+    with pytest.raises(SystemExit):
+        reindexer.switch()
+
+    assert tenancy.resolve_collection(client, COLLECTION) == COLLECTION
+    assert reindex.load_state(client, COLLECTION)['phase'] == BUILT
+
+
+def test_second_reindex_switches_between_versions_and_cleans_up(qdrant):
+    _upsert(qdrant, range(3))
+    reindexer = _reindexer(qdrant)
+    reindexer.build('fake-8')
+    reindexer.switch()
+    reindexer.finalize()
+
+    reindexer.build('fake-8')
+    assert reindex.load_state(qdrant, COLLECTION)['target'] == f"{COLLECTION}_v3"
+    reindexer.switch()
+    reindexer.cleanup()
+
+    assert tenancy.resolve_collection(qdrant, COLLECTION) == f"{COLLECTION}_v3"
+    assert tenancy.collection_versions(qdrant, COLLECTION) == [(3, f"{COLLECTION}_v3")]
+    # エイリアスを使う前のコレクションも cleanup で削除される
+    assert not qdrant.collection_exists(COLLECTION)
+    assert qdrant.count(tenancy.serving_alias(COLLECTION)).count == 3
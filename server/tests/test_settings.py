@@ -0,0 +1,28 @@
+import pytest
+
+import settings
+
+
+@pytest.mark.parametrize('raw, expected', [(None, 7), ('0', 0), ('12', 12), ('-1', 7), ('x', 7)])
+def test_non_negative_int_env_keeps_zero(monkeypatch, raw, expected):
+    if raw is None:
+        monkeypatch.delenv('T_NON_NEGATIVE', raising=False)
+    else:
+        monkeypatch.setenv('T_NON_NEGATIVE', raw)
+
+    assert settings._get_non_negative_int_env('T_NON_NEGATIVE', 7) == expected
+
+
+def test_zero_grpc_keepalive_uses_the_grpc_default(app_module, monkeypatch):
+    monkeypatch.setenv('QDRANT_GRPC_KEEPALIVE_MS', '0')
+    monkeypatch.setattr(app_module.settings, 'QDRANT_URL', 'http://qdrant:6333')
+    monkeypatch.setattr(app_module.settings, 'QDRANT_PREFER_GRPC', True)
+    monkeypatch.setattr(
+        app_module.settings, 'QDRANT_GRPC_KEEPALIVE_MS',
+        settings._get_non_negative_int_env('QDRANT_GRPC_KEEPALIVE_MS', 30000),
+    )
+
+    kwargs = app_module.qdrant_client_kwargs()
+
+    assert kwargs['prefer_grpc'] is True
+    assert 'grpc_options' not in kwargs
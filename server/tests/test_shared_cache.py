@@ -0,0 +1,202 @@
+import socket
+import time
+
+import numpy as np
+import pytest
+
+import chat_pipeline
+import metrics
+import shared_cache
+from ai_agent import ANSWER_CACHED, ANSWER_LLM
+from bench.standins import serve_resp_stub
+from circuit_breaker import OPEN
+from shared_cache import CacheUnavailable, RedisCache, SharedCache
+
+PROMPT = 'あなたはサポート担当です。'
+
+
+@pytest.fixture(scope='module')
+def resp_stub():
+    server, url = serve_resp_stub()
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def resp_url(resp_stub):
+    return resp_stub[1]
+
+
+@pytest.fixture
+def cache(resp_url, request):
+    # テストごとに接頭辞を変えて、ほかのテストのキーや無効化の通知と混ざらないようにする
+    return RedisCache(resp_url, timeout_ms=1000, prefix=f"t-{request.node.name}")
+
+
+def _lookup(cache, chat_id, system_prompt, query):
+    return cache.get_answer(chat_id, cache.answer_generation(chat_id), system_prompt, query)
+
+
+def _store(cache, chat_id, system_prompt, query, answer):
+    cache.store_answer(chat_id, cache.answer_generation(chat_id), system_prompt, query, answer)
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _subscribed(server, cache, count):
+    """count 個のインスタンスが cache の無効化のチャンネルを購読するまで待つ。"""
+    return _wait_for(lambda: len(server.subscribers.get(cache.channel.encode(), ())) >= count)
+
+
+def test_answer_miss_then_hit(cache):
+    hits = metrics.CACHE_REQUESTS.value(cache='shared_answer', result='hit')
+
+    assert _lookup(cache, 'c1', PROMPT, '営業時間は？') is None
+    _store(cache, 'c1', PROMPT, '営業時間は？', {'response': '9時からです'})
+
+    # 全角・半角と空白の違いは同じ質問として扱う
+    assert _lookup(cache, 'c1', PROMPT, ' 営業時間は? ') == {'response': '9時からです'}
+    assert _lookup(cache, 'c1', 'ほかのプロンプト', '営業時間は？') is None
+    assert _lookup(cache, 'c2', PROMPT, '営業時間は？') is None
+    assert metrics.CACHE_REQUESTS.value(cache='shared_answer', result='hit') == hits + 1
+
+
+def test_vectors_round_trip_as_float16(cache):
+    vector = np.linspace(-1, 1, 8, dtype=np.float32)
+    digest = b'\x01' * 32
+
+    assert cache.get_vectors('fake', [digest]) == {}
+    cache.put_vectors('fake', [(digest, vector)])
+
+    found = cache.get_vectors('fake', [digest, b'\x02' * 32])
+    assert list(found) == [digest]
+    np.testing.assert_array_equal(found[digest], vector.astype(np.float16).astype(np.float32))
+
+
+def test_registry_snapshot_and_lock(cache):
+    assert cache.registry_snapshot() is None
+    cache.store_registry_snapshot([{'id': 'c1'}], 123.0)
+
+    assert cache.registry_snapshot() == ([{'id': 'c1'}], 123.0)
+    assert cache.try_lock('registry', 5) is True
+    assert cache.try_lock('registry', 5) is False
+
+
+def test_knowledge_change_invalidates_answers_on_other_instances(resp_stub, cache):
+    server, url = resp_stub
+    other = RedisCache(url, timeout_ms=1000, prefix=cache.prefix)
+    _store(cache, 'c1', PROMPT, '料金は？', {'response': '無料です'})
+    assert _lookup(other, 'c1', PROMPT, '料金は？') == {'response': '無料です'}
+    assert _subscribed(server, cache, 2)
+
+    cache.invalidate_chat('c1')
+
+    assert _lookup(cache, 'c1', PROMPT, '料金は？') is None
+    # 通知を受け取ったインスタンスは世代を読み直す間隔を待たずに更新する
+    assert _wait_for(lambda: other._generations.get('c1', (0,))[0] == 1)
+    assert _lookup(other, 'c1', PROMPT, '料金は？') is None
+    # 新しい世代の回答は両方から参照できる
+    _store(other, 'c1', PROMPT, '料金は？', {'response': '有料です'})
+    assert _lookup(cache, 'c1', PROMPT, '料金は？') == {'response': '有料です'}
+
+
+def _answered(result, response):
+    result.response, result.answer_path, result.vector_search_duration_ms = response, ANSWER_LLM, 1
+    return result
+
+
+def test_answer_is_stored_under_the_generation_it_was_looked_up_with(cache):
+    result = chat_pipeline.cached_answer(cache, 'c1', PROMPT, '送料は？')
+    assert result.answer_path is None
+
+    # Gemini が回答を作っている間にナレッジが変わった
+    cache.invalidate_chat('c1')
+    chat_pipeline.store_answer(cache, 'c1', PROMPT, '送料は？', _answered(result, '古いナレッジからの回答'))
+
+    result = chat_pipeline.cached_answer(cache, 'c1', PROMPT, '送料は？')
+    assert result.answer_path is None
+    assert result.cache_generation == 1
+    # 変更がなければ次の質問から使われる
+    chat_pipeline.store_answer(cache, 'c1', PROMPT, '送料は？', _answered(result, '新しいナレッジからの回答'))
+    cached = chat_pipeline.cached_answer(cache, 'c1', PROMPT, '送料は？')
+    assert (cached.answer_path, cached.response) == (ANSWER_CACHED, '新しいナレッジからの回答')
+
+
+def test_registry_invalidation_reaches_other_instances(resp_stub, cache):
+    server, url = resp_stub
+    other = RedisCache(url, timeout_ms=1000, prefix=cache.prefix)
+    calls = []
+    other.on_registry_invalidated(lambda: calls.append(1))
+    other.store_registry_snapshot([{'id': 'c1'}], 1.0)
+    cache.registry_snapshot()
+    assert _subscribed(server, cache, 2)
+
+    cache.invalidate_registry()
+
+    assert _wait_for(lambda: calls == [1])
+    assert other.registry_snapshot() is None
+
+
+def _closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_server_down_behaves_like_no_cache():
+    cache = RedisCache(f"redis://127.0.0.1:{_closed_port()}/0", timeout_ms=100, prefix='t-down')
+    errors = metrics.SHARED_CACHE_ERRORS.value(op='get')
+
+    assert _lookup(cache, 'c1', PROMPT, '営業時間は？') is None
+    _store(cache, 'c1', PROMPT, '営業時間は？', {'response': 'x'})
+    cache.invalidate_chat('c1')
+    assert cache.get_vectors('fake', [b'\x01' * 32]) == {}
+    assert cache.registry_snapshot() is None
+    assert cache.try_lock('registry', 5) is True
+    assert metrics.SHARED_CACHE_ERRORS.value(op='get') > errors
+
+    for _ in range(cache.breaker.min_calls):
+        with pytest.raises(CacheUnavailable):
+            cache.get('k')
+    assert cache.breaker.state == OPEN
+    start = time.monotonic()
+    with pytest.raises(CacheUnavailable):
+        cache.get('k')
+    # 開いている間はサーバーに接続しない
+    assert time.monotonic() - start < 0.05
+
+
+def test_unconfigured_cache_keeps_nothing(monkeypatch):
+    monkeypatch.setattr(shared_cache.settings, 'SHARED_CACHE_URL', '')
+    cache = shared_cache.from_settings()
+
+    assert type(cache) is SharedCache and not cache.enabled
+    _store(cache, 'c1', PROMPT, 'q', {'response': 'x'})
+    assert _lookup(cache, 'c1', PROMPT, 'q') is None
+    assert cache.try_lock('registry', 5) is True
+
+
+def test_only_redis_urls_are_accepted():
+    with pytest.raises(ValueError):
+        RedisCache('http://localhost:6379')
+
+
+def test_zero_answer_ttl_disables_answer_caching(resp_stub, cache, monkeypatch):
+    server, _ = resp_stub
+    monkeypatch.setenv('SHARED_CACHE_ANSWER_TTL_SEC', '0')
+    ttl = shared_cache.settings._get_non_negative_int_env('SHARED_CACHE_ANSWER_TTL_SEC', 600)
+    monkeypatch.setattr(shared_cache.settings, 'SHARED_CACHE_ANSWER_TTL_SEC', ttl)
+
+    _store(cache, 'c1', PROMPT, '営業時間は？', {'response': '9時からです'})
+
+    assert ttl == 0
+    assert _lookup(cache, 'c1', PROMPT, '営業時間は？') is None
+    assert not any(key.startswith(cache.key('answer').encode()) for key in server.store)
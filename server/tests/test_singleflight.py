@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import chat_pipeline
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'answer'
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        leader = pool.submit(flights.do, 'k', fn)
+        started.wait(5)
+        followers = [pool.submit(flights.do, 'k', fn) for _ in range(2)]
+        time.sleep(0.1)
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert calls == [1]
+    assert results == [('answer', False), ('answer', True), ('answer', True)]
+    # 完了した結果は保持しない
+    assert flights.do('k', lambda: 'again') == ('again', False)
+
+
+def test_error_is_raised_to_every_waiter():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError('search failed')
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flights.do, 'k', fn)
+        started.wait(5)
+        follower = pool.submit(flights.do, 'k', fn)
+        time.sleep(0.1)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError, match='search failed'):
+                future.result()
+
+    assert flights._calls == {}
+
+
+def test_async_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return 'answer'
+
+    async def run():
+        return await asyncio.gather(*(flights.do_async('k', fn) for _ in range(3)))
+
+    assert asyncio.run(run()) == [('answer', False), ('answer', True), ('answer', True)]
+    assert calls == [1]
+    assert flights._tasks == {}
+
+
+def test_async_leader_cancellation_does_not_cancel_followers():
+    flights = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def run():
+        leader = asyncio.ensure_future(flights.do_async('k', fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do_async('k', fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower, leader.cancelled()
+
+    assert asyncio.run(run()) == (('answer', True), True)
+
+
+def test_coalesce_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(chat_pipeline.settings, 'CHAT_COALESCE_ENABLED', False)
+
+    assert chat_pipeline.coalesce('c1', 'q', lambda: 'result') == ('result', False)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from startup import DONE, FAILED, PENDING, RUNNING, Warmup
+
+
+def _sleep(seconds):
+    return lambda: time.sleep(seconds)
+
+
+def _fail():
+    raise ConnectionError('qdrant down')
+
+
+def test_components_warm_up_in_parallel():
+    warmup = Warmup()
+    warmup.add('a', _sleep(0.2))
+    warmup.add('b', _sleep(0.2))
+    assert warmup.status()['components']['a']['state'] == PENDING
+
+    start = time.monotonic()
+    warmup.start(block=True)
+
+    assert time.monotonic() - start < 0.35
+    status = warmup.status()
+    assert status['ready'] is True
+    assert {name: entry['state'] for name, entry in status['components'].items()} == {'a': DONE, 'b': DONE}
+    assert status['components']['a']['seconds'] >= 0.2
+
+
+def test_wait_returns_false_until_the_named_components_finish():
+    warmup = Warmup()
+    warmup.add('fast', lambda: None)
+    warmup.add('slow', _sleep(0.3))
+    warmup.start()
+
+    assert warmup.wait(['fast'], timeout=1) is True
+    assert warmup.wait(timeout=0.01) is False
+    assert not warmup.finished()
+    assert warmup.status()['components']['slow']['state'] == RUNNING
+    assert warmup.wait(timeout=2) is True
+
+
+def test_failed_component_is_not_ready():
+    warmup = Warmup()
+    warmup.add('qdrant', _fail)
+    warmup.start(block=True)
+
+    status = warmup.status()
+
+    assert status['ready'] is False
+    assert status['components']['qdrant'] == {
+        'ready': False,
+        'state': FAILED,
+        'seconds': status['components']['qdrant']['seconds'],
+        'error': 'ConnectionError: qdrant down',
+    }
+    assert warmup.finished(['qdrant'])
+
+
+def test_check_reflects_recovery_after_a_failure():
+    connected = []
+    warmup = Warmup()
+    warmup.add('qdrant', _fail, check=lambda: bool(connected))
+    warmup.start(block=True)
+    assert warmup.status()['ready'] is False
+
+    # 再接続のスレッドが接続した
+    connected.append(True)
+
+    status = warmup.status()
+    assert status['ready'] is True
+    assert 'error' not in status['components']['qdrant']
+
+
+def test_optional_components_do_not_block_readiness():
+    warmup = Warmup()
+    warmup.add('qdrant', lambda: None)
+    warmup.add('bigquery', _fail, required=False)
+    warmup.start(block=True)
+
+    status = warmup.status()
+
+    assert status['ready'] is True
+    assert status['components']['bigquery']['required'] is False
+    assert status['components']['bigquery']['ready'] is False
+
+
+def test_unfinished_components_restart_in_a_forked_worker():
+    release = threading.Event()
+    runs = []
+    warmup = Warmup()
+    warmup.add('model', lambda: runs.append(1) or release.wait(5))
+    warmup.start()
+    assert warmup.wait(timeout=0.05) is False
+
+    # フォーク後のワーカー（準備のスレッドは引き継がれない）
+    warmup._pid = -1
+    warmup.restart_after_fork()
+    release.set()
+
+    assert warmup.wait(timeout=5) is True
+    assert len(runs) == 2
+
+
+def test_restart_in_the_same_process_does_nothing():
+    runs = []
+    warmup = Warmup()
+    warmup.add('model', lambda: runs.append(1))
+    warmup.start(block=True)
+
+    warmup.restart_after_fork()
+
+    assert warmup.wait(timeout=1) and runs == [1]
+
+
+def test_ready_endpoint(client):
+    res = client.get('/ready')
+
+    assert res.status_code == 200
+    body = res.get_json()
+    assert body['ready'] is True
+    assert set(body['components']) >= {'embedding_model', 'qdrant', 'domain_registry'}
+
+
+def test_ready_endpoint_reports_missing_components(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'qdrant_client', None)
+
+    res = client.get('/ready')
+
+    assert res.status_code == 503
+    body = res.get_json()
+    assert body['ready'] is False
+    assert body['components']['qdrant']['ready'] is False
+    assert body['components']['domain_registry']['ready'] is True
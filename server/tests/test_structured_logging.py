@@ -0,0 +1,85 @@
+import contextvars
+import io
+import json
+import logging
+from queue import Queue
+
+import pytest
+
+import request_state
+import structured_logging as slog
+
+
+@pytest.fixture
+def output():
+    stream = io.StringIO()
+    slog._queue_handler.queue.join()
+    previous = slog._stream_handler.setStream(stream)
+
+    def lines():
+        slog._queue_handler.queue.join()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    try:
+        yield lines
+    finally:
+        slog._queue_handler.queue.join()
+        slog._stream_handler.setStream(previous)
+
+
+def test_event_is_written_as_one_json_line_with_request_id(output):
+    def handle():
+        request_state.begin(request_id='req-1')
+        slog.info('chat_request', message='営業時間は？', chat_id='c1')
+
+    contextvars.copy_context().run(handle)
+
+    assert output() == [{
+        'severity': 'INFO', 'log_type': 'chat_request', 'request_id': 'req-1', 'message': '営業時間は？', 'chat_id': 'c1',
+    }]
+
+
+def test_levels_below_log_level_are_skipped(output):
+    assert not slog.is_enabled_for(logging.DEBUG)
+
+    slog.debug('vector_candidates', candidates=[1, 2])
+    slog.warning('deadline_exceeded', stage='llm')
+
+    assert [line['log_type'] for line in output()] == ['deadline_exceeded']
+
+
+def test_sampled_events_follow_log_sample_rate(output, monkeypatch):
+    monkeypatch.setattr(slog.settings, 'LOG_SAMPLE_RATE', 0.0)
+    slog.info('llm_input', sampled=True, context_preview='...')
+    monkeypatch.setattr(slog.settings, 'LOG_SAMPLE_RATE', 1.0)
+    slog.info('llm_input', sampled=True, context_preview='kept')
+
+    assert [line['context_preview'] for line in output()] == ['kept']
+
+
+def test_exception_includes_traceback(output):
+    try:
+        raise ValueError('bad payload')
+    except ValueError:
+        slog.exception('ingest_failed', chat_id='c1')
+
+    (line,) = output()
+    assert line['severity'] == 'ERROR'
+    assert 'ValueError: bad payload' in line['exception']
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = slog._DroppingQueueHandler(Queue(maxsize=1))
+    record = logging.LogRecord('t', logging.INFO, '', 0, {'log_type': 'x'}, None, None)
+
+    handler.handle(record)
+    handler.handle(record)
+
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 1
+
+
+def test_formatter_handles_plain_messages():
+    record = logging.LogRecord('t', logging.WARNING, '', 0, 'plain %s', ('text',), None)
+
+    assert json.loads(slog.JsonFormatter().format(record)) == {'severity': 'WARNING', 'message': 'plain text'}
@@ -0,0 +1,118 @@
+import uuid
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+
+import migrate_tenant
+import tenancy
+from bench.standins import FakeEmbedder
+from tenancy import ACTIVE, CUTOVER, DEDICATED, MIGRATING, SHARED, Placement, Target, TenantDirectory
+
+COLLECTION = 't_tenancy'
+
+
+@pytest.fixture
+def qdrant(monkeypatch):
+    monkeypatch.setattr(tenancy.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+    client = QdrantClient(location=':memory:')
+    tenancy.ensure_serving_alias(client, COLLECTION)
+    tenancy.ensure_placements_collection(client)
+    return client
+
+
+def _points(chat_id, count):
+    embedder = FakeEmbedder()
+    return [
+        PointStruct(
+            id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{chat_id}/{i}")),
+            vector=embedder.encode(f"{chat_id} {i}").tolist(),
+            payload={'chat_id': chat_id, 'text': f"{chat_id} {i}", 'type': 'knowledge', 'timestamp': i},
+        )
+        for i in range(count)
+    ]
+
+
+def _count(client, collection, chat_id):
+    return client.count(collection_name=tenancy.serving_alias(collection), count_filter=tenancy.tenant_filter(chat_id)).count
+
+
+def test_dedicated_collections_do_not_collide(monkeypatch):
+    monkeypatch.setattr(tenancy.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+
+    names = {tenancy.dedicated_collection(chat_id) for chat_id in ('a.b', 'a_b', 'a b', 'a/b')}
+
+    assert len(names) == 4
+    assert tenancy.dedicated_collection('a.b') == tenancy.dedicated_collection('a.b')
+    assert all(name.startswith(f"{COLLECTION}__a_b_") for name in names)
+
+
+def test_placement_targets_follow_migration_state():
+    source, target = Target('shared'), Target('dedicated')
+
+    assert Placement('c1', DEDICATED, target, MIGRATING, source).read_target == source
+    assert Placement('c1', DEDICATED, target, MIGRATING, source).write_targets == [target, source]
+    assert Placement('c1', DEDICATED, target, CUTOVER, source).read_target == target
+    assert Placement('c1', DEDICATED, target, CUTOVER, source).write_targets == [target, source]
+    assert Placement('c1', DEDICATED, target, ACTIVE, source).write_targets == [target]
+
+
+def test_directory_reads_saved_placements(qdrant):
+    directory = TenantDirectory(lambda: qdrant, cache_ttl=60)
+    placement = Placement('big', DEDICATED, tenancy.target_for('big', DEDICATED))
+
+    assert directory.placement('big') == tenancy.shared_placement('big')
+    directory.save(placement)
+
+    assert directory.placement('big') == placement
+    assert directory.placement('small').layout == SHARED
+
+    directory.save(tenancy.shared_placement('big'))
+    assert directory.placements() == {}
+
+
+def test_writes_go_to_both_layouts_while_migrating(qdrant):
+    directory = TenantDirectory(lambda: qdrant, cache_ttl=60)
+    target = tenancy.target_for('big', DEDICATED)
+    tenancy.ensure_serving_alias(qdrant, target.collection)
+    directory.save(Placement('big', DEDICATED, target, MIGRATING, tenancy.target_for('big', SHARED)))
+
+    directory.upsert('big', _points('big', 2))
+
+    assert _count(qdrant, COLLECTION, 'big') == 2
+    assert _count(qdrant, target.collection, 'big') == 2
+
+
+def test_move_tenant_to_dedicated_and_back(qdrant):
+    qdrant.upsert(collection_name=tenancy.serving_alias(COLLECTION), points=_points('big', 5) + _points('other', 3))
+    directory = TenantDirectory(lambda: qdrant, cache_ttl=0)
+
+    migrate_tenant.move_tenant(qdrant, 'big', DEDICATED, wait_sec=0, batch_size=2, log=lambda message: None)
+
+    dedicated = tenancy.dedicated_collection('big')
+    assert directory.placement('big') == Placement('big', DEDICATED, Target(dedicated))
+    assert _count(qdrant, dedicated, 'big') == 5
+    assert _count(qdrant, COLLECTION, 'big') == 0
+    assert _count(qdrant, COLLECTION, 'other') == 3
+    records, _ = directory.scroll('big', limit=10)
+    assert len(records) == 5
+
+    migrate_tenant.move_tenant(qdrant, 'big', SHARED, wait_sec=0, log=lambda message: None)
+
+    assert directory.placement('big').layout == SHARED
+    assert _count(qdrant, COLLECTION, 'big') == 5
+    assert not qdrant.collection_exists(tenancy.serving_alias(dedicated))
+    assert not qdrant.collection_exists(f"{dedicated}_v1")
+
+
+def test_existing_dedicated_placement_keeps_its_collection(qdrant):
+    directory = TenantDirectory(lambda: qdrant, cache_ttl=0)
+    legacy = Target(f"{COLLECTION}__big")
+    tenancy.create_knowledge_collection(qdrant, legacy.collection)
+    directory.save(Placement('big', DEDICATED, legacy))
+    messages = []
+
+    migrate_tenant.move_tenant(qdrant, 'big', DEDICATED, wait_sec=0, log=messages.append)
+
+    assert messages == ['big: already dedicated']
+    assert directory.read_target('big') == legacy
@@ -0,0 +1,132 @@
+import asyncio
+import contextvars
+import json
+
+import pytest
+
+import request_state
+import tracing
+from timing import get_stage_timings, stage
+
+TRACEPARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+class _RecordingExporter:
+    def __init__(self):
+        self.traces = []
+
+    def submit(self, trace):
+        self.traces.append(trace)
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    recording = _RecordingExporter()
+    monkeypatch.setattr(tracing, '_exporter', recording)
+    monkeypatch.setattr(tracing.settings, 'TRACE_SAMPLE_RATE', 1.0)
+    return recording
+
+
+def _in_request(fn):
+    """asyncio 経路と同じく contextvars のリクエスト状態の中で fn を実行する。"""
+    def run():
+        request_state.begin(request_id='req-1')
+        return fn()
+    return contextvars.copy_context().run(run)
+
+
+def test_parse_traceparent():
+    assert tracing._parse_traceparent(TRACEPARENT) == ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True)
+    assert tracing._parse_traceparent('00-xyz-b7ad6b7169203331-01') is None
+    assert tracing._parse_traceparent(None) is None
+
+
+def test_stages_become_nested_spans(exporter):
+    def handle():
+        tracing.start_request_trace('0123-4567', 'chat')
+        with stage('embed'):
+            with tracing.span('search', hits=3):
+                pass
+        timings = get_stage_timings()
+        tracing.finish_request_trace(200)
+        return timings
+
+    timings = _in_request(handle)
+
+    assert set(timings) == {'embed'}
+    (trace,) = exporter.traces
+    root, embed, search = trace.spans
+    assert trace.trace_id == '01234567'
+    assert root.name == 'http chat' and root.attributes['http.status_code'] == 200
+    assert embed.parent_span_id == root.span_id
+    assert search.parent_span_id == embed.span_id
+    assert search.attributes == {'hits': 3}
+    assert all(span.end_ns is not None for span in trace.spans)
+
+
+def test_concurrent_async_stages_are_children_of_root(exporter):
+    async def handle():
+        tracing.start_request_trace('req-2', 'chat')
+
+        async def run_stage(name):
+            with stage(name):
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(run_stage('registry'), run_stage('embed'))
+        tracing.finish_request_trace(200)
+
+    _in_request(lambda: asyncio.run(handle()))
+
+    (trace,) = exporter.traces
+    root = trace.root
+    assert {span.name for span in trace.spans if span.parent_span_id == root.span_id} == {'registry', 'embed'}
+
+
+def test_incoming_traceparent_is_continued_and_errors_recorded(exporter, monkeypatch):
+    monkeypatch.setattr(tracing.settings, 'TRACE_SAMPLE_RATE', 0.0)
+
+    def handle():
+        tracing.start_request_trace('req-3', 'chat', TRACEPARENT)
+        with pytest.raises(RuntimeError):
+            with tracing.span('llm'):
+                raise RuntimeError('boom')
+        tracing.finish_request_trace(500)
+
+    _in_request(handle)
+
+    (trace,) = exporter.traces
+    assert trace.trace_id == '0af7651916cd43dd8448eb211c80319c'
+    assert trace.root.parent_span_id == 'b7ad6b7169203331'
+    assert trace.spans[1].error == 'RuntimeError: boom'
+
+
+def test_unsampled_requests_are_not_traced(exporter, monkeypatch):
+    monkeypatch.setattr(tracing.settings, 'TRACE_SAMPLE_RATE', 0.0)
+
+    def handle():
+        assert tracing.start_request_trace('req-4', 'chat') is None
+        with tracing.span('embed') as span:
+            assert span is None
+        tracing.finish_request_trace(200)
+
+    _in_request(handle)
+    assert exporter.traces == []
+
+
+def test_json_and_otlp_encoding(tmp_path):
+    trace = tracing.Trace('ab' * 16, 'http chat')
+    child = trace.start_span('llm', {'model': 'm', 'hedged': True}, parent_span_id=trace.root.span_id)
+    child.error = 'TimeoutError: late'
+    for span in trace.spans:
+        trace.end_span(span)
+
+    exporter = tracing.JsonFileExporter.__new__(tracing.JsonFileExporter)
+    exporter.path = str(tmp_path / 'traces.ndjson')
+    exporter.export(trace.spans)
+    rows = [json.loads(line) for line in open(exporter.path, encoding='utf-8')]
+    assert [row['name'] for row in rows] == ['http chat', 'llm']
+
+    encoded = tracing._otlp_span(child)
+    assert encoded['parentSpanId'] == trace.root.span_id
+    assert encoded['status'] == {'code': 2, 'message': 'TimeoutError: late'}
+    assert {'key': 'hedged', 'value': {'boolValue': True}} in encoded['attributes']
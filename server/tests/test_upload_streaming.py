@@ -0,0 +1,106 @@
+import io
+import tempfile
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import file_utils
+from file_utils import ContentTooLargeError, UploadRequest
+
+
+class _NonSeekable(io.RawIOBase):
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+
+def test_request_stream_uses_memory_for_small_and_disk_for_large(monkeypatch):
+    monkeypatch.setattr(file_utils.settings, 'UPLOAD_SPOOL_MAX_BYTES', 1024)
+    request = UploadRequest.from_values()
+
+    assert isinstance(request._get_file_stream(100, 'text/plain'), io.BytesIO)
+    assert isinstance(request._get_file_stream(None, 'text/plain'), tempfile.SpooledTemporaryFile)
+    large = request._get_file_stream(4096, 'text/plain')
+    try:
+        assert not isinstance(large, (io.BytesIO, tempfile.SpooledTemporaryFile))
+        assert large.fileno() >= 0
+    finally:
+        large.close()
+
+
+def test_spool_upload_reuses_seekable_stream():
+    stream = io.BytesIO(b'hello')
+
+    spooled, size = file_utils._spool_upload(FileStorage(stream, 'a.txt'), max_bytes=10)
+
+    assert spooled is stream
+    assert size == 5
+
+
+def test_spool_upload_copies_non_seekable_stream_and_enforces_cap():
+    spooled, size = file_utils._spool_upload(FileStorage(_NonSeekable(b'x' * 100), 'a.txt'), max_bytes=100)
+    assert size == 100
+    assert spooled.read() == b'x' * 100
+
+    with pytest.raises(ContentTooLargeError):
+        file_utils._spool_upload(FileStorage(_NonSeekable(b'x' * 101), 'a.txt'), max_bytes=100)
+    with pytest.raises(ContentTooLargeError):
+        file_utils._spool_upload(FileStorage(io.BytesIO(b'x' * 101), 'a.txt'), max_bytes=100)
+
+
+def test_disk_upload_is_memory_mapped():
+    with tempfile.TemporaryFile('rb+') as stream:
+        stream.write('ディスク上のアップロード'.encode('utf-8'))
+        stream.seek(0)
+        with file_utils._open_upload_source(stream) as source:
+            assert isinstance(source, file_utils._MappedReader)
+            assert file_utils.extract_text_from_file(source, 'txt') == 'ディスク上のアップロード'
+
+
+def test_upload_file_endpoint(client, chat_ids):
+    data = {'chat_id': chat_ids[0], 'file': (io.BytesIO('営業時間は 9 時からです。'.encode('utf-8')), 'hours.txt')}
+
+    res = client.post('/api/upload_file', data=data, content_type='multipart/form-data')
+
+    assert res.status_code == 200
+    body = res.get_json()
+    assert body['success'] is True
+    assert body['extracted_text'] == '営業時間は 9 時からです。'
+
+
+def test_upload_file_rejects_over_cap_and_empty(client, chat_ids, monkeypatch):
+    monkeypatch.setattr(file_utils.settings, 'MAX_FILE_SIZE', 16)
+
+    res = client.post(
+        '/api/upload_file',
+        data={'chat_id': chat_ids[0], 'file': (io.BytesIO(b'x' * 17), 'big.txt')},
+        content_type='multipart/form-data',
+    )
+    assert res.status_code == 413
+
+    res = client.post(
+        '/api/upload_file',
+        data={'chat_id': chat_ids[0], 'file': (io.BytesIO(b''), 'empty.txt')},
+        content_type='multipart/form-data',
+    )
+    assert res.status_code == 400
+
+
+def test_request_over_max_content_length_is_rejected_before_reading(client, app_module, chat_ids, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_CONTENT_LENGTH', 1024)
+
+    res = client.post(
+        '/api/upload_file',
+        data={'chat_id': chat_ids[0], 'file': (io.BytesIO(b'x' * 4096), 'big.txt')},
+        content_type='multipart/form-data',
+    )
+
+    assert res.status_code == 413
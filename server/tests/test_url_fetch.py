@@ -0,0 +1,106 @@
+import subprocess
+import sys
+
+import pytest
+
+import file_utils
+from conftest import SERVER_DIR
+from file_utils import ContentTooLargeError, extract_html_content, fetch_url_content
+
+PAGE = """<!doctype html>
+<html><head><title> 営業案内 </title><script>var x = 1;</script></head>
+<body>
+  <header>サイトヘッダー</header>
+  <nav><a href="/">ホーム</a><a href="/a">A</a><a href="/b">B</a></nav>
+  <main>
+    <h1>営業時間</h1>
+    <p>平日は 9 時から 18 時まで営業しています。</p>
+    <div hidden>非表示の文章</div>
+  </main>
+  <footer>フッター</footer>
+</body></html>
+""".encode('utf-8')
+
+
+@pytest.mark.parametrize('extract', [file_utils._extract_html_lxml, file_utils._extract_html_bs4])
+def test_extract_html_keeps_main_content(extract):
+    title, text = extract(PAGE, 'utf-8')
+
+    assert title == '営業案内'
+    assert '平日は 9 時から 18 時まで営業しています。' in text
+    for boilerplate in ('サイトヘッダー', 'ホーム', 'フッター', 'var x'):
+        assert boilerplate not in text
+
+
+def test_extract_html_uses_declared_charset():
+    page = '<html><body><p>日本語のページ</p></body></html>'.encode('shift_jis')
+
+    _, text = extract_html_content(page, 'shift_jis')
+
+    assert text == '日本語のページ'
+
+
+def test_lxml_is_imported_on_first_use():
+    code = 'import sys, file_utils; print("lxml" in sys.modules)'
+
+    result = subprocess.run([sys.executable, '-c', code], cwd=SERVER_DIR, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == 'False'
+
+
+def test_extract_html_falls_back_to_bs4_without_lxml(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'lxml.html', None)
+    calls = []
+    extract_bs4 = file_utils._extract_html_bs4
+    monkeypatch.setattr(file_utils, '_extract_html_bs4', lambda *args: calls.append(args) or extract_bs4(*args))
+
+    title, text = extract_html_content(PAGE, 'utf-8')
+
+    assert len(calls) == 1
+    assert title == '営業案内'
+    assert '平日は 9 時から 18 時まで営業しています。' in text
+
+
+def test_charset_from_headers():
+    assert file_utils._charset_from_headers({'Content-Type': 'text/html; charset="Shift_JIS"'}) == 'shift_jis'
+    assert file_utils._charset_from_headers({'Content-Type': 'text/html; charset=unknown-x'}) is None
+    assert file_utils._charset_from_headers({'Content-Type': 'text/html'}) is None
+
+
+def test_fetch_url_content(http_server):
+    routes, base_url = http_server
+    routes['/page'] = (200, {'Content-Type': 'text/html; charset=utf-8', 'Content-Length': str(len(PAGE))}, PAGE)
+
+    result = fetch_url_content(f"{base_url}/page")
+
+    assert result['title'] == '営業案内'
+    assert '営業時間' in result['content']
+    assert result['url'] == f"{base_url}/page"
+
+
+def test_download_rejects_declared_length_over_cap(http_server):
+    routes, base_url = http_server
+    routes['/big'] = (200, {'Content-Length': '2048'}, b'x' * 2048)
+
+    with pytest.raises(ContentTooLargeError) as excinfo:
+        file_utils._download_capped(f"{base_url}/big", 1024, timeout=5)
+    assert excinfo.value.limit == 1024
+
+
+def test_download_stops_reading_undeclared_body_over_cap(http_server):
+    routes, base_url = http_server
+    # Content-Length なしで上限を超える本文（読みながら打ち切る）
+    routes['/stream'] = (200, {'Connection': 'close'}, [b'x' * 600, b'y' * 600])
+
+    with pytest.raises(ContentTooLargeError):
+        file_utils._download_capped(f"{base_url}/stream", 1024, timeout=5)
+
+
+def test_fetch_url_content_reraises_too_large_and_returns_none_on_error(http_server, monkeypatch):
+    routes, base_url = http_server
+    routes['/big'] = (200, {'Content-Length': '4096'}, b'x' * 4096)
+    monkeypatch.setattr(file_utils.settings, 'URL_FETCH_MAX_BYTES', 1024)
+
+    with pytest.raises(ContentTooLargeError):
+        fetch_url_content(f"{base_url}/big")
+    assert fetch_url_content(f"{base_url}/missing") is None
@@ -0,0 +1,187 @@
+import uuid
+
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+
+import tenancy
+import write_buffer
+from bench.standins import FakeEmbedder
+from tenancy import Target, TenantDirectory
+from write_buffer import WriteBuffer
+
+COLLECTION = 't_write_buffer'
+
+
+class _RecordingClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.upserts = []
+
+    def upsert(self, collection_name, points, **kwargs):
+        self.upserts.append((collection_name, [point.id for point in points]))
+        if self.error:
+            raise self.error
+
+
+def _point(i, text='t'):
+    return PointStruct(id=i, vector=[0.1, 0.2], payload={'text': text})
+
+
+def test_concurrent_submits_are_written_in_one_upsert():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10_000)
+    target = Target('a')
+
+    tickets = [buffer.submit([target], [_point(i)]) for i in range(3)]
+    assert not any(ticket.done for ticket in tickets)
+    buffer.flush(timeout=5)
+
+    assert all(ticket.done for ticket in tickets)
+    assert client.upserts == [('a__live', [0, 1, 2])]
+    buffer.close()
+
+
+def test_batch_size_triggers_a_write():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=2, max_delay_ms=10_000)
+
+    buffer.submit([Target('a')], [_point(1), _point(2)]).wait(timeout=5)
+
+    assert client.upserts == [('a__live', [1, 2])]
+    buffer.close()
+
+
+def test_max_delay_triggers_a_write():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10)
+
+    buffer.submit([Target('a')], [_point(1)]).wait(timeout=5)
+
+    assert client.upserts == [('a__live', [1])]
+    buffer.close()
+
+
+def test_last_write_of_a_point_wins_and_targets_are_grouped():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10_000)
+
+    buffer.submit([Target('a'), Target('b')], [_point(1, 'old')])
+    buffer.submit([Target('a')], [_point(2), _point(1, 'new')])
+    buffer.flush(timeout=5)
+
+    assert sorted(client.upserts) == [('a__live', [2, 1]), ('b__live', [1])]
+    buffer.close()
+
+
+def test_write_errors_are_returned_to_the_submitter():
+    buffer = WriteBuffer(lambda: _RecordingClient(ConnectionError('qdrant down')), batch_size=1, max_delay_ms=0)
+
+    ticket = buffer.submit([Target('a')], [_point(1)])
+
+    with pytest.raises(ConnectionError):
+        ticket.wait(timeout=5)
+    buffer.close()
+
+
+def test_done_callbacks_run_after_the_write():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10_000)
+    calls = []
+    ticket = buffer.submit([Target('a')], [_point(1)])
+
+    ticket.add_done_callback(lambda t: calls.append(list(client.upserts)))
+    assert calls == []
+    buffer.flush(timeout=5)
+
+    assert calls == [[('a__live', [1])]]
+    # 終わった後に登録した callback はすぐに呼ばれる
+    ticket.add_done_callback(lambda t: calls.append(t.error))
+    assert calls[-1] is None
+    buffer.close()
+
+
+def test_close_writes_what_is_left():
+    client = _RecordingClient()
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10_000)
+    ticket = buffer.submit([Target('a')], [_point(1)])
+
+    buffer.close()
+
+    assert ticket.done
+    assert client.upserts == [('a__live', [1])]
+
+
+@pytest.mark.parametrize('ack, workers, expected', [
+    ('flushed', 1, 'flushed'),
+    ('buffered', 1, 'buffered'),
+    ('buffered', 4, 'flushed'),
+    ('later', 1, 'flushed'),
+])
+def test_buffered_ack_needs_a_single_worker(monkeypatch, ack, workers, expected):
+    monkeypatch.setattr(write_buffer.settings, 'QDRANT_WRITE_ACK', ack)
+    monkeypatch.setattr(write_buffer.settings, 'SERVER_WORKERS', workers)
+
+    assert write_buffer.ack_mode() == expected
+
+
+@pytest.fixture
+def tenants(monkeypatch):
+    monkeypatch.setattr(tenancy.settings, 'QDRANT_COLLECTION_NAME', COLLECTION)
+    client = QdrantClient(location=':memory:')
+    tenancy.ensure_serving_alias(client, COLLECTION)
+    buffer = WriteBuffer(lambda: client, batch_size=100, max_delay_ms=10_000)
+    yield TenantDirectory(lambda: client, cache_ttl=60, write_buffer=buffer)
+    buffer.close()
+
+
+def _points(count):
+    embedder = FakeEmbedder()
+    return [
+        PointStruct(
+            id=str(uuid.uuid4()),
+            vector=embedder.encode(f"ryw {i}").tolist(),
+            payload={'chat_id': 'c1', 'text': f"ryw {i}", 'type': 'knowledge'},
+        )
+        for i in range(count)
+    ]
+
+
+def test_buffered_writes_are_read_back_by_the_same_process(tenants, monkeypatch):
+    monkeypatch.setattr(write_buffer.settings, 'QDRANT_WRITE_ACK', 'buffered')
+    monkeypatch.setattr(write_buffer.settings, 'SERVER_WORKERS', 1)
+    points = _points(3)
+
+    tenants.upsert('c1', points)
+
+    # 応答の時点ではまだ書き込まれていないが、読み込みの前に書き込まれる
+    assert tenants.write_buffer.has_pending()
+    records, _ = tenants.scroll('c1', limit=10)
+    assert {record.id for record in records} == {point.id for point in points}
+    assert not tenants.write_buffer.has_pending()
+
+
+def test_flushed_ack_waits_for_the_write(tenants, monkeypatch):
+    # ワーカーが 2 つ以上なら buffered の指定は flushed として扱う
+    monkeypatch.setattr(write_buffer.settings, 'QDRANT_WRITE_ACK', 'buffered')
+    monkeypatch.setattr(write_buffer.settings, 'SERVER_WORKERS', 2)
+    monkeypatch.setattr(tenants.write_buffer, 'max_delay', 0.01)
+
+    tenants.upsert('c1', _points(2))
+
+    assert not tenants.write_buffer.has_pending()
+    assert tenants._client().count(tenancy.serving_alias(COLLECTION), count_filter=tenancy.tenant_filter('c1')).count == 2
+
+
+def test_buffered_ack_invalidates_after_the_write(tenants, monkeypatch):
+    monkeypatch.setattr(write_buffer.settings, 'QDRANT_WRITE_ACK', 'buffered')
+    monkeypatch.setattr(write_buffer.settings, 'SERVER_WORKERS', 1)
+    changed = []
+    tenants.on_change = changed.append
+
+    tenants.upsert('c1', _points(2))
+
+    # 書き込まれる前に無効化すると、古いナレッジの回答が新しい世代でキャッシュされる
+    assert changed == []
+    tenants.write_buffer.flush(timeout=5)
+    assert changed == ['c1']
@@ -0,0 +1,46 @@
+"""Per-request stage timings.
+
+`stage()` で囲んだ処理の所要時間をリクエストごとに `stage_timings`（g または asyncio の
+リクエスト状態、request_state を参照）へ記録する。
+記録した値は Server-Timing ヘッダー（SERVER_TIMING_ENABLED 時）やベンチマークで参照する。
+"""
+
+import time
+from contextlib import contextmanager
+
+import request_state
+import tracing
+from metrics import STAGE_DURATION
+
+
+@contextmanager
+def stage(name):
+    """処理ステージの所要時間を計測して記録する（トレース対象ならスパンも開く）。"""
+    with tracing.span(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record_stage(name, (time.perf_counter() - start) * 1000)
+
+
+def record_stage(name, duration_ms):
+    """計測済みの所要時間（ミリ秒）を現在のリクエストに加算する。"""
+    STAGE_DURATION.observe(duration_ms / 1000, stage=name)
+    state = request_state.current()
+    if state is None:
+        return
+    timings = state.setdefault('stage_timings', {})
+    timings[name] = timings.get(name, 0.0) + duration_ms
+
+
+def get_stage_timings():
+    state = request_state.current()
+    if state is None:
+        return {}
+    return dict(state.get('stage_timings', {}))
+
+
+def server_timing_header(timings):
+    """timings を Server-Timing ヘッダーの値に変換する。"""
+    return ', '.join(f"{name};dur={duration_ms:.1f}" for name, duration_ms in timings.items())
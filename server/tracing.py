@@ -0,0 +1,293 @@
+"""Lightweight request-scoped tracing.
+
+リクエストごとにルートスパンを開き、timing.stage() のステージ（registry / embed /
+search / llm など）を子スパンとして記録する。トレース ID は request_id から作る
+（受信した traceparent ヘッダーがあればそれを引き継ぐ）。親スパンは contextvars で追跡するため、
+asyncio で並行に動くステージはそれぞれルートスパンの子になる。
+
+サンプリングされたトレースはバックグラウンドスレッドでエクスポートする。
+- TRACE_EXPORTER=json: TRACE_JSON_PATH に 1 スパン 1 行の JSON を追記
+- TRACE_EXPORTER=otlp: TRACE_OTLP_ENDPOINT の /v1/traces に OTLP/HTTP JSON で送信
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from queue import Empty, Full, Queue
+
+import requests
+
+import request_state
+import settings
+
+SERVICE_NAME = 'ai-chat-iflame-server'
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+_active_span: ContextVar = ContextVar('active_span', default=None)
+
+
+def _new_span_id():
+    return os.urandom(8).hex()
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace_id, name, parent_span_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self):
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'name': self.name,
+            'start_unix_nano': self.start_ns,
+            'end_unix_nano': self.end_ns,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class Trace:
+    """1 リクエスト分のスパンを保持する。"""
+
+    def __init__(self, trace_id, root_name, parent_span_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.spans = []
+        self.root = self.start_span(root_name, attributes, kind=SPAN_KIND_SERVER, parent_span_id=parent_span_id)
+
+    def start_span(self, name, attributes=None, kind=SPAN_KIND_INTERNAL, parent_span_id=None):
+        span = Span(self.trace_id, name, parent_span_id, kind, attributes)
+        self.spans.append(span)
+        return span
+
+    def end_span(self, span):
+        span.end_ns = time.time_ns()
+
+
+def _parse_traceparent(header):
+    """W3C traceparent を (trace_id, parent_span_id, sampled) に分解する。不正なら None。"""
+    parts = (header or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 0x01)
+
+
+def start_request_trace(request_id, endpoint, traceparent=None):
+    """リクエスト開始時に呼び、サンプリングされた場合はリクエスト状態（g）の trace に設定する。"""
+    parent = _parse_traceparent(traceparent)
+    if parent:
+        trace_id, parent_span_id, sampled = parent
+        sampled = sampled or random.random() < settings.TRACE_SAMPLE_RATE
+    else:
+        trace_id, parent_span_id = request_id.replace('-', ''), None
+        sampled = random.random() < settings.TRACE_SAMPLE_RATE
+
+    state = request_state.current()
+    if not sampled or _exporter is None:
+        state.trace = None
+        return None
+
+    state.trace = Trace(trace_id, f"http {endpoint}", parent_span_id, {'request_id': request_id, 'endpoint': endpoint})
+    return state.trace
+
+
+def finish_request_trace(status_code=None, error=None):
+    """リクエスト終了時に呼び、トレースをエクスポートキューに渡す。"""
+    state = request_state.current()
+    trace = state.pop('trace', None) if state is not None else None
+    if trace is None:
+        return
+    root = trace.root
+    if status_code is not None:
+        root.set_attribute('http.status_code', status_code)
+    if error is not None:
+        root.error = f"{type(error).__name__}: {error}"
+    for span in trace.spans:
+        if span.end_ns is None:
+            trace.end_span(span)
+    _exporter.submit(trace)
+
+
+def current_trace():
+    state = request_state.current()
+    if state is None:
+        return None
+    return state.get('trace')
+
+
+@contextmanager
+def span(name, **attributes):
+    """現在のリクエストのトレースに子スパンを開く（トレース対象外なら何もしない）。"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    parent = _active_span.get()
+    if parent is None or parent.trace_id != trace.trace_id:
+        parent = trace.root
+    current = trace.start_span(name, attributes, parent_span_id=parent.span_id)
+    token = _active_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _active_span.reset(token)
+        trace.end_span(current)
+
+
+def slowest_stage(timings):
+    """ステージ別所要時間（ミリ秒）から最も遅いステージ名を返す。"""
+    if not timings:
+        return None
+    return max(timings.items(), key=lambda item: item[1])[0]
+
+
+# --- Exporters --------------------------------------------------------------
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_span(span):
+    encoded = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns or span.start_ns),
+        'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span.attributes.items() if v is not None],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_span_id:
+        encoded['parentSpanId'] = span.parent_span_id
+    return encoded
+
+
+class _BackgroundExporter:
+    """完了したトレースをキューに積み、バックグラウンドスレッドでまとめて書き出す。"""
+
+    def __init__(self, max_queue_size=2048, batch_size=64, flush_interval=2.0):
+        self._queue = Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except Full:
+            pass
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            if not batch:
+                continue
+            try:
+                self.export([span for trace in batch for span in trace.spans])
+            except Exception as e:
+                print(f"Trace export failed: {e}")
+
+    def export(self, spans):
+        raise NotImplementedError
+
+
+class JsonFileExporter(_BackgroundExporter):
+    def __init__(self, path, **kwargs):
+        self.path = path
+        super().__init__(**kwargs)
+
+    def export(self, spans):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + '\n')
+
+
+class OtlpHttpExporter(_BackgroundExporter):
+    def __init__(self, endpoint, timeout=2, **kwargs):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.timeout = timeout
+        self._session = requests.Session()
+        super().__init__(**kwargs)
+
+    def export(self, spans):
+        body = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+                'scopeSpans': [{
+                    'scope': {'name': 'ai-chat-iflame.tracing'},
+                    'spans': [_otlp_span(span) for span in spans],
+                }],
+            }],
+        }
+        res = self._session.post(self.url, json=body, timeout=self.timeout)
+        if not res.ok:
+            print(f"OTLP export failed: {res.status_code} {res.text[:200]}")
+
+
+def _create_exporter():
+    if not settings.TRACE_EXPORTER:
+        return None
+    if settings.TRACE_EXPORTER == 'json':
+        print(f"Tracing enabled: sample_rate={settings.TRACE_SAMPLE_RATE}, json={settings.TRACE_JSON_PATH}")
+        return JsonFileExporter(settings.TRACE_JSON_PATH)
+    if settings.TRACE_EXPORTER == 'otlp':
+        print(f"Tracing enabled: sample_rate={settings.TRACE_SAMPLE_RATE}, otlp={settings.TRACE_OTLP_ENDPOINT}")
+        return OtlpHttpExporter(settings.TRACE_OTLP_ENDPOINT)
+    print(f"Unknown TRACE_EXPORTER '{settings.TRACE_EXPORTER}', tracing disabled")
+    return None
+
+
+_exporter = _create_exporter()
+
+
+def restart_after_fork():
+    """pre-fork サーバーのワーカーでエクスポーターのスレッドを作り直す。"""
+    global _exporter
+    _exporter = _create_exporter()
@@ -0,0 +1,235 @@
+"""Write-behind buffer that coalesces Qdrant upserts from concurrent ingestions.
+
+取り込み（add_knowledge / upload_file / fetch_url / 更新）の点をすぐには書き込まず、
+書き込み先（コレクション・シャードキー）ごとにためて、QDRANT_WRITE_BATCH_SIZE 件に達するか
+最も古い点が QDRANT_WRITE_MAX_DELAY_MS 経過した時点でまとめて upsert する。
+書き込みは 1 本のバックグラウンドスレッドが受け付け順に行うため、同じ点への書き込みの順序は保たれる。
+
+submit() は書き込み完了を待てる WriteTicket を返す。未書き込みの点を読み込み・削除の前に
+反映したい呼び出し側（自分の書き込みを読む）は flush() を呼ぶ（tenancy.TenantDirectory が行う）。
+バッファはプロセスごとにあるため、書き込み前に応答する（ack_mode() が buffered）のは単一プロセスのときだけ。
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from qdrant_client.http.models import WriteOrdering
+
+import settings
+from metrics import QDRANT_WRITE_BATCH_POINTS, QDRANT_WRITE_ERRORS, QDRANT_WRITE_LATENCY, QDRANT_WRITE_PENDING
+
+_ORDERINGS = {'weak': WriteOrdering.WEAK, 'medium': WriteOrdering.MEDIUM, 'strong': WriteOrdering.STRONG}
+
+
+def ack_mode():
+    """取り込みのリクエストが応答する時点（QDRANT_WRITE_ACK）。Returns 'buffered' or 'flushed'.
+
+    buffered で自分の書き込みを読めるのはバッファを持つプロセスの中だけで（ほかのワーカーの一覧・検索には
+    まだ無く、プロセスが落ちれば失われる）、ワーカーが 2 つ以上（SERVER_WORKERS > 1）なら flushed として扱う。
+    """
+    if settings.QDRANT_WRITE_ACK == 'buffered' and settings.SERVER_WORKERS <= 1:
+        return 'buffered'
+    return 'flushed'
+
+
+class WriteTicket:
+    """submit() した点の書き込み結果。"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._resolved = False
+        self.error = None
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def _resolve(self, error=None):
+        with self._lock:
+            self.error = error
+            self._resolved = True
+            callbacks, self._callbacks = self._callbacks, []
+        # 待っている側（wait / flush）には callback の後に知らせる
+        for callback in callbacks:
+            self._run_callback(callback)
+        self._event.set()
+
+    def add_done_callback(self, callback):
+        """書き込みが終わったら（失敗した場合も）callback(ticket) を呼ぶ。終わっていればすぐに呼ぶ。
+
+        書き込みのスレッドで呼ばれるため、callback は短い処理にする。
+        """
+        with self._lock:
+            if not self._resolved:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            print(f"[ERROR] Qdrant write callback failed: {e}")
+
+    def wait(self, timeout=None):
+        """書き込みが終わるまで待つ。失敗した場合はその例外を送出する。"""
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"Qdrant write not flushed within {timeout}s")
+        if self.error is not None:
+            raise self.error
+
+
+@dataclass
+class _Entry:
+    targets: list
+    points: list
+    ticket: WriteTicket
+    enqueued_at: float
+
+
+class WriteBuffer:
+    """get_client はその時点の QdrantClient（未接続なら None）を返す関数。"""
+
+    def __init__(self, get_client, batch_size=None, max_delay_ms=None, wait=None, ordering=None):
+        self._get_client = get_client
+        self.batch_size = batch_size or settings.QDRANT_WRITE_BATCH_SIZE
+        self.max_delay = (settings.QDRANT_WRITE_MAX_DELAY_MS if max_delay_ms is None else max_delay_ms) / 1000
+        self.wait = settings.QDRANT_WRITE_WAIT if wait is None else wait
+        self.ordering = _ORDERINGS.get(ordering or settings.QDRANT_WRITE_ORDERING, WriteOrdering.WEAK)
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_points = 0
+        self._in_flight = []
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _ensure_thread(self):
+        # pre-fork サーバーではスレッドがワーカーに引き継がれないため、最初の submit で起動する
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name='qdrant-write-buffer', daemon=True)
+            self._thread.start()
+
+    def submit(self, targets, points):
+        """targets（tenancy.Target のリスト）のそれぞれに points を書き込む予約をする。Returns WriteTicket."""
+        ticket = WriteTicket()
+        if not points:
+            ticket._resolve()
+            return ticket
+        with self._cond:
+            self._ensure_thread()
+            self._pending.append(_Entry(list(targets), list(points), ticket, time.monotonic()))
+            self._pending_points += len(points)
+            QDRANT_WRITE_PENDING.set(self._pending_points)
+            self._cond.notify()
+        return ticket
+
+    def has_pending(self):
+        with self._cond:
+            return bool(self._pending or self._in_flight)
+
+    def flush(self, timeout=None):
+        """未書き込みの点をすぐに書き込み、書き込み終わるまで待つ（失敗は各 submit 元に返る）。"""
+        with self._cond:
+            tickets = [entry.ticket for entry in self._pending + self._in_flight]
+            if not tickets:
+                return
+            self._flush_requested = True
+            self._cond.notify()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for ticket in tickets:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not ticket._event.wait(remaining):
+                raise TimeoutError(f"Qdrant write buffer not flushed within {timeout}s")
+
+    def close(self, timeout=10.0):
+        """残りを書き込んでスレッドを止める（ワーカー終了時）。"""
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    # --- background writer ---
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    age = time.monotonic() - self._pending[0].enqueued_at
+                    if (
+                        self._flush_requested or self._closed
+                        or self._pending_points >= self.batch_size or age >= self.max_delay
+                    ):
+                        break
+                    self._cond.wait(self.max_delay - age)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch, self._pending = self._pending, []
+            self._pending_points = 0
+            self._flush_requested = False
+            self._in_flight = batch
+            QDRANT_WRITE_PENDING.set(0)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._in_flight = []
+
+    def _write(self, batch):
+        groups = {}
+        for entry in batch:
+            for target in entry.targets:
+                # 同じ点が複数回書き込まれていれば最後のものだけを送る
+                group = groups.setdefault(target, {})
+                for point in entry.points:
+                    group.pop(point.id, None)
+                    group[point.id] = point
+
+        errors = {}
+        client = self._get_client()
+        for target, points_by_id in groups.items():
+            points = list(points_by_id.values())
+            try:
+                if client is None:
+                    raise RuntimeError("Qdrant not available")
+                for offset in range(0, len(points), self.batch_size):
+                    chunk = points[offset:offset + self.batch_size]
+                    start = time.perf_counter()
+                    client.upsert(
+                        collection_name=target.serving_name,
+                        points=chunk,
+                        shard_key_selector=target.shard_key,
+                        wait=self.wait,
+                        ordering=self.ordering,
+                    )
+                    QDRANT_WRITE_LATENCY.observe(time.perf_counter() - start)
+                    QDRANT_WRITE_BATCH_POINTS.observe(len(chunk))
+            except Exception as e:
+                QDRANT_WRITE_ERRORS.inc()
+                print(f"[ERROR] Buffered Qdrant upsert to {target.collection} failed ({len(points)} points): {e}")
+                errors[target] = e
+
+        for entry in batch:
+            entry.ticket._resolve(next((errors[t] for t in entry.targets if t in errors), None))